@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Compare the threaded and asyncio server engines, proxying to a slow upstream.
+
+The upstream is the asyncio echo server, without logging, which holds each request open for the
+``--upstream-delay`` latency as a slow real backend would, and answers with a short body. The delay
+is a number of seconds or a distribution, see :class:`jwt_proxy.simulation.Latency`.
+
+Usage::
+
+    python -m benchmarks.bench_engines --concurrency 1000 --upstream-delay 0.5
+    python -m benchmarks.bench_engines --upstream-delay lognormal:0.1:0.5
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+
+from benchmarks.loadgen import (
+    SIGNING_SECRET,
+    closed_loop,
+    free_port,
+    peak_rss_kib,
+    start_server,
+)
+
+
+def run(engine: str, concurrency: int, duration: float, delay: str) -> dict:
+    echo_port = free_port()
+    proxy_port = free_port()
+    echo = start_server(
+        ["echo_server.py"],
+        {
+            "SERVER_ENGINE": "asyncio",
+            "ECHO_HTTP_PORT": str(echo_port),
+            "ECHO_LATENCY": delay,
+            "ECHO_SIZE": "2",
+            "ECHO_QUIET": "1",
+        },
+        echo_port,
+    )
+    proxy = start_server(
+        ["proxy_server.py"],
+        {
+            "SERVER_ENGINE": engine,
+            "PROXY_HTTP_PORT": str(proxy_port),
+            "UPSTREAM_SERVER": f"127.0.0.1:{echo_port}",
+            "JWT_SIGNING_SECRET": SIGNING_SECRET,
+            "UPSTREAM_POOL_MAX_TOTAL": str(concurrency * 2),
+            "UPSTREAM_POOL_MAX_IDLE": str(concurrency * 2),
+            "HTTP_KEEPALIVE_MAX_REQUESTS": "1000000",
+        },
+        proxy_port,
+    )
+    try:
+        result = asyncio.run(closed_loop(proxy_port, concurrency, duration))
+        result["proxy_peak_rss_kib"] = peak_rss_kib(proxy.pid)
+    finally:
+        proxy.terminate()
+        echo.terminate()
+        proxy.wait()
+        echo.wait()
+    result.update(engine=engine, concurrency=concurrency, upstream_delay=delay)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--engines", default="threaded,asyncio")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--upstream-delay", default="0.1")
+    args = parser.parse_args()
+
+    # Each client holds one socket, and the proxy and upstream one or two more each
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    for engine in args.engines.split(","):
+        result = run(engine, args.concurrency, args.duration, args.upstream_delay)
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks for creating and verifying the proxy's JWT tokens.
+
+Compares the original per-request path (environment lookup, user and date lookup, and
+:func:`jwt_proxy.jwt.encode_jwt_hs512`) with the precomputed :class:`jwt_proxy.tokens.UserTokenFactory`,
+and the throughput of each signing algorithm. Then compares verifying tokens with
+:class:`jwt_proxy.jwt.JWTVerifier` with and without its cache, for a working set of
+``--distinct-tokens`` tokens seen again and again.
+
+Usage::
+
+    python -m benchmarks.bench_jwt
+"""
+
+import argparse
+import getpass
+import itertools
+import json
+import os
+import timeit
+from datetime import date
+
+from jwt_proxy.jwt import SIGNING_ALGORITHMS, JWTSigner, JWTVerifier, encode_jwt_hs512
+from jwt_proxy.keys import SigningKey
+from jwt_proxy.tokens import UserTokenFactory
+
+SECRET = b"0123456789abcdef" * 8
+
+
+def per_request_token() -> bytes:
+    token_payload = dict(user=getpass.getuser(), date=date.today().isoformat())
+    return encode_jwt_hs512(token_payload, os.getenv("JWT_SIGNING_SECRET").encode("ascii"))
+
+
+def bench(name: str, func, number: int, repeat: int) -> dict:
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    return {"name": name, "ns_per_token": best * 1e9, "tokens_per_s": 1 / best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--distinct-tokens", type=int, default=1000)
+    args = parser.parse_args()
+
+    os.environ["JWT_SIGNING_SECRET"] = SECRET.decode("ascii")
+    payload = dict(user=getpass.getuser(), date=date.today().isoformat())
+    signer = JWTSigner(payload, SECRET)
+    factory = UserTokenFactory(SECRET)
+    jti = "0" * 64
+
+    results = [
+        bench("encode_jwt_hs512 per request", per_request_token, args.number, args.repeat),
+        bench(
+            "encode_jwt_hs512 fixed jti",
+            lambda: encode_jwt_hs512(payload, SECRET, None, jti),
+            args.number,
+            args.repeat,
+        ),
+        bench(
+            "JWTSigner.encode fixed jti", lambda: signer.encode(None, jti), args.number, args.repeat
+        ),
+        bench("UserTokenFactory.create_token", factory.create_token, args.number, args.repeat),
+    ]
+    for algorithm in SIGNING_ALGORITHMS:
+        signer = JWTSigner(payload, SECRET, algorithm, "bench-key")
+        results.append(
+            bench(f"JWTSigner.encode {algorithm} with kid", signer.encode, args.number, args.repeat)
+        )
+    baseline = results[0]["ns_per_token"]
+    for result in results:
+        result["speedup"] = baseline / result["ns_per_token"]
+        print(json.dumps(result))
+
+    signer = JWTSigner(payload, SECRET)
+    tokens = [signer.encode() for _ in range(args.distinct_tokens)]
+    results = []
+    for name, cache_size in (("uncached", 0), ("cached", args.distinct_tokens)):
+        verifier = JWTVerifier([SigningKey(None, SECRET)], cache_size=cache_size)
+        next_token = itertools.cycle(tokens).__next__
+        results.append(
+            bench(
+                f"JWTVerifier.verify HS512 {name}",
+                lambda: verifier.verify(next_token()),
+                args.number,
+                args.repeat,
+            )
+        )
+    for result in results:
+        result["speedup"] = results[0]["ns_per_token"] / result["ns_per_token"]
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Measure the throughput and latency of the proxy in front of the echo server.
+
+Both servers are started locally from their entry point scripts, and driven by a closed-loop or
+open-loop load generator for each combination of concurrency (or request rate), body size and
+keep-alive setting. One JSON object is printed per combination, with requests per second, latency
+percentiles, and the CPU time and peak RSS of each server process.
+
+Usage::
+
+    python -m benchmarks.bench_load --mode closed --concurrency 1,16,64 --body-sizes 16,65536
+    python -m benchmarks.bench_load --mode open --rate 500,2000 --keep-alive on,off
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import resource
+import sys
+from typing import Dict, List
+
+from benchmarks.loadgen import (
+    SIGNING_SECRET,
+    closed_loop,
+    free_port,
+    open_loop,
+    peak_rss_kib,
+    process_cpu_seconds,
+    start_server,
+)
+
+
+def int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def bool_list(value: str) -> List[bool]:
+    return [item.strip().lower() in ("on", "true", "yes", "1") for item in value.split(",")]
+
+
+def start_servers(engine: str, workers: int, extra_env: Dict[str, str]):
+    echo_port = free_port()
+    proxy_port = free_port()
+    env = {"SERVER_ENGINE": engine, **extra_env}
+    # Detail logs would make the echo server the bottleneck
+    echo_env = {"ECHO_QUIET": "1", **env, "ECHO_HTTP_PORT": str(echo_port)}
+    echo = start_server(["echo_server.py"], echo_env, echo_port)
+    proxy = start_server(
+        ["proxy_server.py"],
+        {
+            **env,
+            "SERVER_WORKERS": str(workers),
+            "PROXY_HTTP_PORT": str(proxy_port),
+            "UPSTREAM_SERVER": f"127.0.0.1:{echo_port}",
+            "JWT_SIGNING_SECRET": SIGNING_SECRET,
+        },
+        proxy_port,
+    )
+    return echo, proxy, proxy_port
+
+
+def run(args, echo, proxy, proxy_port: int, load: int, body_size: int, keep_alive: bool) -> dict:
+    body = b"x" * body_size
+    if args.mode == "closed":
+        test = closed_loop(proxy_port, load, args.duration, body, keep_alive=keep_alive)
+    else:
+        test = open_loop(
+            proxy_port,
+            load,
+            args.duration,
+            body,
+            keep_alive=keep_alive,
+            max_connections=args.max_connections,
+        )
+
+    cpu_before = {
+        name: process_cpu_seconds(p.pid) for name, p in (("proxy", proxy), ("echo", echo))
+    }
+    client_before = resource.getrusage(resource.RUSAGE_SELF)
+    result = asyncio.run(test)
+    client_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    for name, process in (("proxy", proxy), ("echo", echo)):
+        before = cpu_before[name]
+        after = process_cpu_seconds(process.pid)
+        cpu = None if before is None or after is None else after - before
+        result[f"{name}_cpu_s"] = cpu
+        result[f"{name}_cpu_us_per_request"] = (
+            cpu / result["requests"] * 1e6 if cpu is not None and result["requests"] else None
+        )
+        result[f"{name}_peak_rss_kib"] = peak_rss_kib(process.pid)
+    # If the load generator itself uses a whole core, the results are limited by the client
+    result["client_cpu_s"] = (
+        client_after.ru_utime
+        + client_after.ru_stime
+        - client_before.ru_utime
+        - client_before.ru_stime
+    )
+    result.update(
+        mode=args.mode,
+        engine=args.engine,
+        workers=args.workers,
+        concurrency=load if args.mode == "closed" else None,
+        body_size=body_size,
+        keep_alive=keep_alive,
+        duration_s=args.duration,
+    )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--workers", type=int, default=1, help="proxy worker processes")
+    parser.add_argument(
+        "--concurrency", type=int_list, default=[1, 16, 64], help="closed loop connections"
+    )
+    parser.add_argument(
+        "--rate", type=int_list, default=[500, 2000], help="open loop requests per second"
+    )
+    parser.add_argument("--max-connections", type=int, default=1000, help="open loop limit")
+    parser.add_argument("--body-sizes", type=int_list, default=[16, 65536])
+    parser.add_argument("--keep-alive", type=bool_list, default=[True, False], help="e.g. on,off")
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="environment variable for both servers, may be repeated",
+    )
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    env = {"HTTP_KEEPALIVE_MAX_REQUESTS": "1000000"}
+    env.update(item.split("=", 1) for item in args.env)
+    echo, proxy, proxy_port = start_servers(args.engine, args.workers, env)
+    try:
+        if args.warmup > 0:
+            asyncio.run(closed_loop(proxy_port, 4, args.warmup))
+        loads = args.concurrency if args.mode == "closed" else args.rate
+        for load, body_size, keep_alive in itertools.product(
+            loads, args.body_sizes, args.keep_alive
+        ):
+            result = run(args, echo, proxy, proxy_port, load, body_size, keep_alive)
+            print(json.dumps(result), flush=True)
+            if proxy.poll() is not None or echo.poll() is not None:
+                sys.exit("A server exited during the benchmark")
+    finally:
+        for process in (proxy, echo):
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
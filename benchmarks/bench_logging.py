@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Measures the cost of logging per request, for each logging configuration.
+
+Pipelined echo requests are handled by :class:`jwt_proxy.echo_server.EchoRequestHandler` on a fake
+connection, with log output going to ``/dev/null``, and compared against the same requests with
+logging disabled. ``request_us`` is the time spent on the request thread; ``total_us`` also
+includes waiting for the writer thread to write the queued records, which is the CPU cost of
+logging when the process is saturated.
+
+Usage::
+
+    python -m benchmarks.bench_logging
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import time
+
+from jwt_proxy.echo_server import EchoRequestHandler
+from jwt_proxy.http_base import ProxyHTTPServer
+from jwt_proxy.logger import init_logging, stop_logging
+
+REQUEST = (
+    b"POST /api/v1/items HTTP/1.1\r\n"
+    b"Host: echo.example.com\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/119.0\r\n"
+    b"Accept: application/json, text/plain, */*\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Content-Length: %d\r\n"
+    b"\r\n"
+)
+
+CONFIGURATIONS = [
+    ("disabled", None),
+    ("sync", {}),
+    ("sync, 1% detail", {"LOG_DETAIL_SAMPLE_RATE": "0.01"}),
+    ("queue", {"LOG_QUEUE_SIZE": "100000"}),
+    ("queue, 1% detail", {"LOG_QUEUE_SIZE": "100000", "LOG_DETAIL_SAMPLE_RATE": "0.01"}),
+]
+
+
+class PipelinedConnection:
+    """
+    A socket stand-in which supplies the given requests, and discards the responses.
+    """
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def makefile(self, mode, bufsize=None):
+        return io.BytesIO(self.data)
+
+    def sendall(self, data):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, level, optname, value):
+        pass
+
+
+def run(env, requests: int, body_size: int, devnull) -> dict:
+    for name in ("LOG_QUEUE_SIZE", "LOG_DETAIL_SAMPLE_RATE"):
+        os.environ.pop(name, None)
+    os.environ.update(env or {})
+    init_logging(devnull)
+    logging.disable(logging.CRITICAL if env is None else logging.NOTSET)
+
+    server = ProxyHTTPServer(("127.0.0.1", 0), EchoRequestHandler)
+    body = b"x" * body_size
+    connection = PipelinedConnection((REQUEST % body_size + body) * requests)
+    try:
+        start = time.perf_counter()
+        EchoRequestHandler(connection, ("127.0.0.1", 12345), server)
+        handled = time.perf_counter()
+        stop_logging()
+        written = time.perf_counter()
+    finally:
+        server.server_close()
+    return {
+        "request_us": (handled - start) / requests * 1e6,
+        "total_us": (written - start) / requests * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--body-size", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    os.environ["HTTP_KEEPALIVE_MAX_REQUESTS"] = str(args.requests + 1)
+    with open(os.devnull, "w") as devnull:
+        baseline = None
+        for name, env in CONFIGURATIONS:
+            results = [run(env, args.requests, args.body_size, devnull) for _ in range(args.repeat)]
+            best = {key: min(result[key] for result in results) for key in results[0]}
+            if baseline is None:
+                baseline = best
+            result = {"name": name, **best}
+            for key in best:
+                result[f"logging_{key}"] = best[key] - baseline[key]
+            print(json.dumps(result))
+    logging.disable(logging.NOTSET)
+
+
+if __name__ == "__main__":
+    main()
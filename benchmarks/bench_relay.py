@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Measure the CPU time the proxy spends relaying large bodies, per GB, with and without zero-copy
+relaying (``PROXY_ZERO_COPY``).
+
+The proxy runs in a subprocess with the threaded engine, in front of a minimal upstream running
+in this process, which discards request bodies and answers with a body of the requested size.
+Bodies are relayed in one direction at a time: ``upload`` sends large request bodies and gets
+empty responses, ``download`` sends empty requests and gets large responses.
+
+Usage::
+
+    python -m benchmarks.bench_relay --body-size 16777216 --total 1073741824
+"""
+
+import argparse
+import json
+import socket
+import threading
+import time
+from http.client import HTTPConnection
+
+from benchmarks.loadgen import (
+    SIGNING_SECRET,
+    free_port,
+    process_cpu_seconds,
+    start_server,
+)
+
+BUFFER_SIZE = 1024 * 1024
+
+
+def serve_connection(conn: socket.socket) -> None:
+    """
+    Answer the requests of one connection: discard the body, and respond with ``X-Response-Size``
+    bytes.
+    """
+    view = memoryview(bytearray(BUFFER_SIZE))
+    rfile = conn.makefile("rb")
+    try:
+        while True:
+            request_line = rfile.readline()
+            if not request_line:
+                return
+            headers = {}
+            while True:
+                line = rfile.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            remaining = int(headers.get("content-length", 0))
+            while remaining > 0:
+                received = rfile.readinto(view[: min(remaining, BUFFER_SIZE)])
+                if not received:
+                    return
+                remaining -= received
+
+            size = int(headers.get("x-response-size", 0))
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % size)
+            while size > 0:
+                conn.sendall(view[: min(size, BUFFER_SIZE)])
+                size -= BUFFER_SIZE
+    except OSError:
+        pass
+    finally:
+        rfile.close()
+        conn.close()
+
+
+def serve(listener: socket.socket) -> None:
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=serve_connection, args=(conn,), daemon=True).start()
+
+
+def run(zero_copy: bool, direction: str, body_size: int, total: int, upstream_port: int) -> dict:
+    proxy_port = free_port()
+    proxy = start_server(
+        ["proxy_server.py"],
+        {
+            "SERVER_ENGINE": "threaded",
+            "PROXY_HTTP_PORT": str(proxy_port),
+            "UPSTREAM_SERVER": f"127.0.0.1:{upstream_port}",
+            "JWT_SIGNING_SECRET": SIGNING_SECRET,
+            "PROXY_ZERO_COPY": "1" if zero_copy else "0",
+            "HTTP_KEEPALIVE_MAX_REQUESTS": "1000000",
+        },
+        proxy_port,
+    )
+    body = bytes(body_size) if direction == "upload" else b""
+    headers = {"X-Response-Size": str(body_size if direction == "download" else 0)}
+    view = memoryview(bytearray(BUFFER_SIZE))
+    requests = max(1, total // body_size)
+    try:
+        conn = HTTPConnection("127.0.0.1", proxy_port)
+        # Warm up the connections before measuring
+        conn.request("POST", "/", body=b"", headers={"X-Response-Size": "0"})
+        conn.getresponse().read()
+
+        cpu_before = process_cpu_seconds(proxy.pid)
+        start = time.perf_counter()
+        for _ in range(requests):
+            conn.request("POST", "/relay", body=body, headers=headers)
+            response = conn.getresponse()
+            while response.readinto(view):
+                pass
+            if response.status != 200:
+                raise RuntimeError(f"Unexpected response status {response.status}")
+        elapsed = time.perf_counter() - start
+        cpu_after = process_cpu_seconds(proxy.pid)
+        cpu = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+        conn.close()
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+    gigabytes = requests * body_size / 1e9
+    return {
+        "zero_copy": zero_copy,
+        "direction": direction,
+        "body_size": body_size,
+        "requests": requests,
+        "gb_per_s": round(gigabytes / elapsed, 3),
+        "proxy_cpu_s_per_gb": None if cpu is None else round(cpu / gigabytes, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--body-size", type=int, default=16 * 1024 * 1024)
+    parser.add_argument("--total", type=int, default=1024 * 1024 * 1024)
+    parser.add_argument("--directions", default="upload,download")
+    args = parser.parse_args()
+
+    listener = socket.create_server(("127.0.0.1", 0))
+    threading.Thread(target=serve, args=(listener,), daemon=True).start()
+    try:
+        for direction in args.directions.split(","):
+            for zero_copy in (False, True):
+                result = run(
+                    zero_copy, direction, args.body_size, args.total, listener.getsockname()[1]
+                )
+                print(json.dumps(result), flush=True)
+    finally:
+        listener.close()
+
+
+if __name__ == "__main__":
+    main()
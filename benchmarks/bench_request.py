@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks for the header and URL handling in the proxy's ``do_POST``.
+
+Each step is timed separately, using a request head with typical browser-like headers: parsing the
+head, copying the headers, building the upstream headers and URL, and splitting the URL into the
+pooled connection key and request target. JWT token creation is covered by :mod:`benchmarks.bench_jwt`.
+
+Usage::
+
+    python -m benchmarks.bench_request
+"""
+
+import argparse
+import io
+import json
+import timeit
+from collections import OrderedDict
+from http.client import parse_headers
+from urllib.parse import urlsplit, urlunsplit
+
+from jwt_proxy.config import ProxyConfig
+from jwt_proxy.proxy_server import ProxyRequestMixin
+
+REQUEST_HEAD = (
+    b"Host: proxy.example.com\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/119.0\r\n"
+    b"Accept: application/json, text/plain, */*\r\n"
+    b"Accept-Language: en-US,en;q=0.5\r\n"
+    b"Accept-Encoding: gzip, deflate, br\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Content-Length: 128\r\n"
+    b"Origin: https://app.example.com\r\n"
+    b"Connection: keep-alive\r\n"
+    b"Cookie: session=0123456789abcdef0123456789abcdef; theme=dark\r\n"
+    b"\r\n"
+)
+PATH = "/api/v1/items/12345?expand=owner&sort=-created"
+TOKEN = b"x" * 300
+
+
+def parse_head():
+    return parse_headers(io.BytesIO(REQUEST_HEAD))
+
+
+def copy_headers(message):
+    headers = OrderedDict()
+    for name, value in message.items():
+        headers[name] = value
+    return headers
+
+
+def split_url(url: str):
+    scheme, netloc, path, query, _ = urlsplit(url)
+    target = urlunsplit(("", "", path or "/", query, ""))
+    parsed = urlsplit(f"//{netloc}")
+    return scheme, parsed.hostname, parsed.port, target
+
+
+def bench(name: str, func, number: int, repeat: int) -> dict:
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    return {"name": name, "ns_per_call": best * 1e9, "calls_per_s": 1 / best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    config = ProxyConfig.from_settings(
+        {"UPSTREAM_SERVER": "http://upstream.example.com:9200", "JWT_SIGNING_SECRET": "secret"}
+    )
+    balancer = config.create_balancer()
+    message = parse_head()
+    headers = copy_headers(message)
+    url = balancer.choose(PATH).build_url(PATH)
+
+    def all_steps():
+        headers = copy_headers(parse_head())
+        ProxyRequestMixin.build_upstream_headers(headers, TOKEN)
+        split_url(balancer.choose(PATH).build_url(PATH))
+
+    steps = [
+        ("parse request headers", parse_head),
+        ("copy headers", lambda: copy_headers(message)),
+        (
+            "build_upstream_headers",
+            lambda: ProxyRequestMixin.build_upstream_headers(headers, TOKEN),
+        ),
+        ("choose upstream URL", lambda: balancer.choose(PATH).build_url(PATH)),
+        ("split upstream URL", lambda: split_url(url)),
+        ("all steps", all_steps),
+    ]
+    for name, func in steps:
+        print(json.dumps(bench(name, func, args.number, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+A minimal asyncio HTTP/1.1 load generator and helpers for running the servers under benchmark.
+"""
+
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIGNING_SECRET = "benchmark-secret"
+
+
+def free_port() -> int:
+    """
+    Find a free TCP port on localhost.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0) -> None:
+    """
+    Wait until a server accepts connections on a local port.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def start_server(args: List[str], env: Dict[str, str], port: int) -> subprocess.Popen:
+    """
+    Start a server in a Python subprocess, and wait until it is listening.
+
+    :param args: The interpreter arguments, such as an entry point script relative to the
+                 repository root, or ``["-m", module]``.
+    :param env: Additional environment variables.
+    :param port: The port the server will listen on.
+    :return: The process.
+    """
+    process = subprocess.Popen(
+        [sys.executable, *args],
+        env={**os.environ, **env},
+        cwd=REPO_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    wait_for_port(port)
+    return process
+
+
+def process_tree(pid: int) -> List[int]:
+    """
+    Get a process and its running descendants, such as pre-forked workers, from ``/proc``
+    (Linux only).
+    """
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open(f"/proc/{parent}/task/{parent}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def peak_rss_kib(pid: int) -> Optional[int]:
+    """
+    Get the peak resident set size of a process and its descendants in KiB, from ``/proc``
+    (Linux only).
+    """
+    total = None
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total = (total or 0) + int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """
+    Get the user and system CPU time used so far by a process and its running descendants, from
+    ``/proc`` (Linux only).
+    """
+    total = None
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as f:
+                # The command name in parentheses may contain spaces, so split after it
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15 of the file, counting the pid and command as 1 and 2
+        total = (total or 0) + (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return total
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], errors: List[int], elapsed: float) -> Dict[str, float]:
+    """
+    Compute throughput and latency statistics for a load test.
+
+    :param latencies: The latencies of the completed requests, in seconds.
+    :param errors: The status of each failed request, or 0 for connection errors.
+    :param elapsed: The duration of the test, in seconds.
+    :return: The statistics, with latencies in milliseconds.
+    """
+    latencies = sorted(latencies)
+    result = {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+    }
+    for name, pct in (("p50", 50), ("p95", 95), ("p99", 99), ("p999", 99.9)):
+        result[f"{name}_ms"] = percentile(latencies, pct) * 1000
+    result["max_ms"] = latencies[-1] * 1000 if latencies else 0.0
+    return result
+
+
+def build_request(port: int, body: bytes, path: str = "/", keep_alive: bool = True) -> bytes:
+    """
+    Build a raw POST request.
+    """
+    connection = "" if keep_alive else "Connection: close\r\n"
+    return (
+        f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n{connection}"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    ).encode("ascii") + body
+
+
+async def _read_response(reader: asyncio.StreamReader) -> Tuple[int, bool]:
+    """
+    Read a response with a ``Content-Length`` or chunked body.
+
+    :return: The status, and whether the server will close the connection.
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    chunked = False
+    close = head.startswith(b"HTTP/1.0")
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if name == b"content-length":
+            length = int(value)
+        elif name == b"transfer-encoding":
+            chunked = value == b"chunked"
+        elif name == b"connection":
+            close = value == b"close"
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b";", 1)[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(length)
+    return status, close
+
+
+async def _connect(port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    return await asyncio.open_connection("127.0.0.1", port, limit=2**20)
+
+
+async def _client(
+    port: int,
+    request: bytes,
+    deadline: float,
+    keep_alive: bool,
+    latencies: List[float],
+    errors: List[int],
+) -> None:
+    writer = None
+    try:
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            if writer is None:
+                reader, writer = await _connect(port)
+            writer.write(request)
+            status, close = await _read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+            if close or not keep_alive:
+                writer.close()
+                writer = None
+    except (ConnectionError, asyncio.IncompleteReadError):
+        errors.append(0)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def closed_loop(
+    port: int,
+    concurrency: int,
+    duration: float,
+    body: bytes = b"x",
+    path: str = "/",
+    keep_alive: bool = True,
+) -> Dict[str, float]:
+    """
+    Run a closed-loop load test: each of ``concurrency`` clients sends its next request as soon as
+    the previous response arrived, reusing its connection if ``keep_alive`` is set.
+
+    :return: Throughput and latency statistics, with latencies in milliseconds.
+    """
+    request = build_request(port, body, path, keep_alive)
+    latencies: List[float] = []
+    errors: List[int] = []
+    start = time.monotonic()
+    deadline = start + duration
+    await asyncio.gather(
+        *(
+            _client(port, request, deadline, keep_alive, latencies, errors)
+            for _ in range(concurrency)
+        )
+    )
+    return summarize(latencies, errors, time.monotonic() - start)
+
+
+async def open_loop(
+    port: int,
+    rate: float,
+    duration: float,
+    body: bytes = b"x",
+    path: str = "/",
+    keep_alive: bool = True,
+    max_connections: int = 1000,
+) -> Dict[str, float]:
+    """
+    Run an open-loop load test: requests are started at a fixed rate, independently of how fast
+    responses arrive. Latency is measured from the time each request was scheduled, so time spent
+    waiting for a free connection counts, and a slow server is not hidden by a slower request rate.
+
+    :param rate: Requests per second.
+    :param max_connections: The maximum number of concurrent connections.
+    :return: Throughput and latency statistics, with latencies in milliseconds.
+    """
+    request = build_request(port, body, path, keep_alive)
+    latencies: List[float] = []
+    errors: List[int] = []
+    idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+    slots = asyncio.Semaphore(max_connections)
+
+    async def send(scheduled: float) -> None:
+        async with slots:
+            reader, writer = idle.pop() if idle else await _connect(port)
+            try:
+                writer.write(request)
+                status, close = await _read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                errors.append(0)
+                writer.close()
+                return
+            latencies.append(time.perf_counter() - scheduled)
+            if status != 200:
+                errors.append(status)
+            if close or not keep_alive:
+                writer.close()
+            else:
+                idle.append((reader, writer))
+
+    tasks = []
+    start = time.perf_counter()
+    count = int(rate * duration)
+    for i in range(count):
+        scheduled = start + i / rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(scheduled)))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    result = summarize(latencies, errors, time.perf_counter() - start)
+    result["target_rps"] = rate
+    for _, writer in idle:
+        writer.close()
+    return result
@@ -0,0 +1,1530 @@
+"""
+An asyncio-based server engine, as an alternative to the thread-per-connection
+:class:`jwt_proxy.http_base.ProxyHTTPServer`.
+
+Each client connection and each upstream request is a coroutine instead of an OS thread, so a
+single process can hold many thousands of slow in-flight requests. The request handlers share
+their request processing with the threaded handlers through the mixins in
+:mod:`jwt_proxy.proxy_server` and :mod:`jwt_proxy.echo_server`.
+"""
+
+import asyncio
+import email.utils
+import os
+import signal
+import socket
+import ssl
+import sys
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from email.message import Message
+from http import HTTPStatus
+from http.client import RemoteDisconnected, parse_headers
+from io import BytesIO
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Awaitable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+from urllib.parse import urlsplit, urlunsplit
+
+from jwt_proxy.breaker import CircuitOpenError
+from jwt_proxy.cache import CachedResponse, ResponseCache
+from jwt_proxy.concurrency import ConcurrencyLimitExceeded
+from jwt_proxy.echo_server import EchoRequestHandler, EchoRequestMixin
+from jwt_proxy.http_base import (
+    BODY_CHUNK_SIZE,
+    LAST_CHUNK,
+    BodyFramingError,
+    WorkerStatsMixin,
+    build_status_page,
+    check_admin_request,
+    create_server_metrics,
+    encode_chunk,
+    inherited_listen_socket,
+    is_chunked,
+    notify_ready,
+    observe_request,
+    parse_chunk_size,
+    spawn_replacement,
+)
+from jwt_proxy.logger import LogSettings, get_logger, log_access
+from jwt_proxy.metrics import PROMETHEUS_CONTENT_TYPE, PhaseTimer
+from jwt_proxy.profiler import (
+    PROFILE_PATH,
+    format_stacks,
+    parse_profile_duration,
+    sample_stacks,
+)
+from jwt_proxy.proxy_server import (
+    METHODS_WITH_BODY,
+    HedgeTarget,
+    ProxyRequestHandler,
+    ProxyRequestMixin,
+    is_response_chunked,
+    response_has_body,
+)
+from jwt_proxy.retry import RETRYABLE_STATUSES
+from jwt_proxy.tokens import close_token_source
+from jwt_proxy.upstream import (
+    _DEFAULT_PORTS,
+    PoolKey,
+    UpstreamPoolExhausted,
+    pool_key,
+    timeouts_from_environment,
+)
+
+if TYPE_CHECKING:
+    from jwt_proxy.workers import SharedStats
+
+# Maximum size of a request or response head (request line/status line and headers)
+_MAX_HEAD_SIZE = 65536
+
+HeaderValue = Union[str, bytes]
+
+T = TypeVar("T")
+
+
+async def _with_timeout(awaitable: Awaitable[T], timeout: Optional[float]) -> T:
+    """
+    Await with a timeout, raising :class:`TimeoutError` like a blocking socket would.
+
+    :param awaitable: The awaitable.
+    :param timeout: Seconds to wait, or None to wait forever.
+    """
+    if timeout is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError("timed out") from None
+
+
+def _encode_headers(headers: Iterable[Tuple[str, HeaderValue]]) -> bytes:
+    lines = []
+    for name, value in headers:
+        if isinstance(value, str):
+            value = value.encode("latin-1")
+        lines.append(name.encode("latin-1") + b": " + value + b"\r\n")
+    return b"".join(lines)
+
+
+def _connection_tokens(headers: Message) -> Set[str]:
+    value = headers.get("Connection", "")
+    return {token.strip().lower() for token in value.split(",") if token.strip()}
+
+
+class AsyncUpstreamResponse:
+    """
+    The asyncio counterpart of :class:`http.client.HTTPResponse`: the head of an upstream response,
+    whose body is read incrementally with :meth:`read1`.
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        method: str,
+        version: str,
+        status: int,
+        reason: str,
+        headers: Message,
+        read_timeout: Optional[float] = None,
+    ):
+        self.reader = reader
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.read_timeout = read_timeout
+        #: Seconds from sending the request until the response started, set by the pool.
+        self.latency = 0.0
+
+        tokens = _connection_tokens(headers)
+        self.will_close = "close" in tokens or (
+            version == "HTTP/1.0" and "keep-alive" not in tokens
+        )
+
+        # Remaining length of a Content-Length delimited body, or of the current chunk
+        self._remaining = 0
+        self._chunked = False
+        self._eof = False
+        transfer_encoding = headers.get("Transfer-Encoding")
+        length = headers.get("Content-Length")
+        if not response_has_body(method, status):
+            self._eof = True
+        elif transfer_encoding is not None and is_chunked(transfer_encoding):
+            self._chunked = True
+        elif length is not None:
+            self._remaining = int(length)
+            self._eof = self._remaining == 0
+        else:
+            # Delimited by the upstream closing the connection
+            self._remaining = -1
+            self.will_close = True
+
+    def getheaders(self) -> List[Tuple[str, str]]:
+        return list(self.headers.items())
+
+    def isclosed(self) -> bool:
+        """
+        Whether the whole body has been read.
+        """
+        return self._eof
+
+    async def read(self) -> bytes:
+        """
+        Read the rest of the body.
+        """
+        pieces = []
+        while True:
+            piece = await self.read1(65536)
+            if not piece:
+                return b"".join(pieces)
+            pieces.append(piece)
+
+    async def read1(self, size: int) -> bytes:
+        """
+        Read up to ``size`` bytes of the body, within the read timeout.
+
+        :return: The data, or an empty string at the end of the body.
+        """
+        if self._eof:
+            return b""
+        return await _with_timeout(self._read1(size), self.read_timeout)
+
+    async def _read1(self, size: int) -> bytes:
+        if self._chunked and self._remaining == 0:
+            self._remaining = parse_chunk_size(await self.reader.readline())
+            if self._remaining == 0:
+                # Discard trailers
+                while (await self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                self._eof = True
+                return b""
+
+        if self._remaining < 0:
+            data = await self.reader.read(size)
+            self._eof = not data
+            return data
+
+        data = await self.reader.read(min(size, self._remaining))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", self._remaining)
+        self._remaining -= len(data)
+        if self._remaining == 0:
+            if self._chunked:
+                await self.reader.readexactly(2)
+            else:
+                self._eof = True
+        return data
+
+
+class AsyncUpstreamConnection:
+    """
+    A persistent HTTP/1.1 connection to an upstream server.
+    """
+
+    def __init__(
+        self,
+        key: PoolKey,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        read_timeout: Optional[float] = None,
+    ):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.read_timeout = read_timeout
+
+    @property
+    def is_stale(self) -> bool:
+        """
+        Whether the peer has closed the connection while it was idle.
+        """
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    async def request(
+        self,
+        method: str,
+        target: str,
+        headers: Dict[str, HeaderValue],
+        body: Union[None, bytes, AsyncIterator[bytes]],
+    ) -> AsyncUpstreamResponse:
+        """
+        Send a request, and read the head of the response within the read timeout.
+
+        :param method: The HTTP method.
+        :param target: The request target (path and query).
+        :param headers: The request headers.
+        :param body: The request body, either complete or as an async iterator of pieces, or None.
+                     Iterators are sent with chunked encoding unless the headers include
+                     ``Content-Length``.
+        :return: The response, whose body has not been read yet.
+        """
+        scheme, host, port = self.key
+        lower_names = {name.lower() for name in headers}
+        extra = []
+        if "host" not in lower_names:
+            extra.append(("Host", host if port == _DEFAULT_PORTS[scheme] else f"{host}:{port}"))
+        chunked = False
+        if body is None:
+            # Like http.client, announce an empty body for methods which expect one
+            if method in METHODS_WITH_BODY and "content-length" not in lower_names:
+                extra.append(("Content-Length", "0"))
+            body = b""
+        elif "content-length" not in lower_names:
+            if isinstance(body, bytes):
+                extra.append(("Content-Length", str(len(body))))
+            else:
+                chunked = True
+                extra.append(("Transfer-Encoding", "chunked"))
+
+        head = (
+            f"{method} {target} HTTP/1.1\r\n".encode("latin-1")
+            + _encode_headers(list(headers.items()) + extra)
+            + b"\r\n"
+        )
+        if isinstance(body, bytes):
+            self.writer.write(head + body)
+        else:
+            self.writer.write(head)
+            async for chunk in body:
+                self.writer.write(encode_chunk(chunk) if chunked else chunk)
+                await self.writer.drain()
+            if chunked:
+                self.writer.write(LAST_CHUNK)
+        await self.writer.drain()
+        return await _with_timeout(self._read_response_head(method), self.read_timeout)
+
+    async def _read_response_head(self, method: str) -> AsyncUpstreamResponse:
+        while True:
+            try:
+                head = await self.reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError as e:
+                if not e.partial:
+                    raise RemoteDisconnected("Remote end closed connection without response")
+                raise
+            status_line, _, header_block = head.partition(b"\r\n")
+            version, status, reason = (status_line.decode("latin-1").split(" ", 2) + [""])[:3]
+            status = int(status)
+            headers = parse_headers(BytesIO(header_block))
+            # Skip interim responses such as 100 Continue
+            if status >= 200 or status == HTTPStatus.SWITCHING_PROTOCOLS:
+                return AsyncUpstreamResponse(
+                    self.reader, method, version, status, reason, headers, self.read_timeout
+                )
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class AsyncUpstreamConnectionPool:
+    """
+    The asyncio counterpart of :class:`jwt_proxy.upstream.UpstreamConnectionPool`.
+
+    Since all coroutines run on one event loop thread, no locking is needed; the total number of
+    connections in use is bounded with a semaphore.
+    """
+
+    def __init__(
+        self,
+        max_idle_per_host: int = 10,
+        max_total: int = 100,
+        idle_timeout: float = 30.0,
+        acquire_timeout: Optional[float] = 10.0,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+    ):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.logger = get_logger(type(self))
+
+        self._slots = asyncio.Semaphore(max_total)
+        self._idle: Dict[PoolKey, Deque[Tuple[AsyncUpstreamConnection, float]]] = {}
+        self._in_use = 0
+        self.hits = 0
+        self.misses = 0
+        self._ssl_context: Optional[ssl.SSLContext] = None
+
+    @classmethod
+    def from_environment(cls) -> "AsyncUpstreamConnectionPool":
+        """
+        Create a pool configured from the ``UPSTREAM_POOL_*`` and ``UPSTREAM_*_TIMEOUT``
+        environment variables.
+        """
+        return cls(
+            max_idle_per_host=int(os.environ.get("UPSTREAM_POOL_MAX_IDLE", 10)),
+            max_total=int(os.environ.get("UPSTREAM_POOL_MAX_TOTAL", 100)),
+            idle_timeout=float(os.environ.get("UPSTREAM_POOL_IDLE_TIMEOUT", 30)),
+            **timeouts_from_environment(),
+        )
+
+    async def acquire(
+        self, scheme: str, host: str, port: Optional[int] = None
+    ) -> Tuple[AsyncUpstreamConnection, bool]:
+        """
+        Check out a connection, see :meth:`jwt_proxy.upstream.UpstreamConnectionPool.acquire`.
+        """
+        key = pool_key(scheme, host, port)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise UpstreamPoolExhausted(
+                f"No upstream connection available after {self.acquire_timeout} seconds"
+            )
+
+        try:
+            now = time.monotonic()
+            idle = self._idle.get(key)
+            while idle:
+                conn, returned = idle.pop()
+                if conn.is_stale or now - returned > self.idle_timeout:
+                    conn.close()
+                    continue
+                self.hits += 1
+                self._in_use += 1
+                return conn, True
+
+            self.misses += 1
+            if scheme == "https":
+                if self._ssl_context is None:
+                    self._ssl_context = ssl.create_default_context()
+                connecting = asyncio.open_connection(
+                    key[1], key[2], ssl=self._ssl_context, limit=_MAX_HEAD_SIZE
+                )
+            else:
+                connecting = asyncio.open_connection(key[1], key[2], limit=_MAX_HEAD_SIZE)
+            reader, writer = await _with_timeout(connecting, self.connect_timeout)
+            self._in_use += 1
+            return AsyncUpstreamConnection(key, reader, writer, self.read_timeout), False
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn: AsyncUpstreamConnection, reusable: bool) -> None:
+        """
+        Return a connection to the pool, see :meth:`jwt_proxy.upstream.UpstreamConnectionPool.release`.
+        """
+        self._in_use -= 1
+        self._slots.release()
+        idle = self._idle.setdefault(conn.key, deque())
+        if reusable and not conn.is_stale and len(idle) < self.max_idle_per_host:
+            idle.append((conn, time.monotonic()))
+        else:
+            conn.close()
+
+    @asynccontextmanager
+    async def request(
+        self,
+        url: str,
+        method: str,
+        body: Union[None, bytes, AsyncIterator[bytes]],
+        headers: Dict[str, HeaderValue],
+        timer: Optional[PhaseTimer] = None,
+        hedge: Optional[Tuple[float, HedgeTarget]] = None,
+    ) -> AsyncIterator[AsyncUpstreamResponse]:
+        """
+        Send a request to the upstream server over a pooled persistent connection, see
+        :meth:`jwt_proxy.proxy_server.ProxyRequestHandler.upstream_request`.
+
+        :param url: The complete upstream URL.
+        :param method: The HTTP method.
+        :param body: The request body, complete or as an async iterator of pieces, or None.
+        :param headers: The request headers.
+        :param timer: Marks the ``connect`` and ``upstream`` phases, if given.
+        :param hedge: The delay after which a copy of the request is sent if no response has
+                      started, and the target of the copy, or None to not hedge. See
+                      :meth:`jwt_proxy.proxy_server.ProxyRequestHandler.race_hedge`.
+        :return: An async context manager for the response, whose body has not been read yet.
+        """
+        scheme, netloc, path, query, _ = urlsplit(url)
+        target = urlunsplit(("", "", path or "/", query, ""))
+        parsed = urlsplit(f"//{netloc}")
+
+        while True:
+            conn, reused = await self.acquire(scheme, parsed.hostname, parsed.port)
+            try:
+                if timer is not None:
+                    timer.mark("connect")
+                sent_at = time.perf_counter()
+                if hedge is None:
+                    response = await conn.request(method, target, headers, body)
+                else:
+                    conn, response = await self._race_hedge(
+                        conn, method, target, headers, body, *hedge
+                    )
+                response.latency = time.perf_counter() - sent_at
+                if timer is not None:
+                    timer.mark("upstream")
+                break
+            except (ConnectionResetError, BrokenPipeError, RemoteDisconnected):
+                self.release(conn, False)
+                # See ProxyRequestHandler.upstream_request
+                if not reused or not isinstance(body, (bytes, type(None))):
+                    raise
+                self.logger.info("Pooled connection to %s was closed, reconnecting", netloc)
+            except BaseException:
+                self.release(conn, False)
+                raise
+
+        reusable = False
+        try:
+            yield response
+            reusable = response.isclosed() and not response.will_close
+        finally:
+            self.release(conn, reusable)
+
+    async def _race_hedge(
+        self,
+        conn: AsyncUpstreamConnection,
+        method: str,
+        target: str,
+        headers: Dict[str, HeaderValue],
+        body: Optional[bytes],
+        delay: float,
+        hedge: HedgeTarget,
+    ) -> Tuple[AsyncUpstreamConnection, AsyncUpstreamResponse]:
+        """
+        Send a request, and race it with a copy sent to the upstream chosen by ``hedge`` after
+        ``delay`` seconds, leaving the outcome of the race on ``hedge``. ``conn`` is released if
+        the copy wins, and otherwise left to the caller.
+        """
+        primary = asyncio.ensure_future(conn.request(method, target, headers, body))
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            return conn, primary.result()
+
+        hedge_url = hedge.choose()
+        if hedge_url is None:
+            return conn, await primary
+        scheme, netloc, path, query, _ = urlsplit(hedge_url)
+        parsed = urlsplit(f"//{netloc}")
+        try:
+            hedge_conn, _ = await self.acquire(scheme, parsed.hostname, parsed.port)
+        except (OSError, UpstreamPoolExhausted) as e:
+            hedge.abandon()
+            self.logger.info("Could not hedge request to %s: %s", hedge_url, e)
+            return conn, await primary
+        hedge_target = urlunsplit(("", "", path or "/", query, ""))
+        secondary = asyncio.ensure_future(hedge_conn.request(method, hedge_target, headers, body))
+
+        winner = None
+        error: Optional[BaseException] = None
+        pending = {primary, secondary}
+        try:
+            while winner is None and pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        hedge.loser_failed = True
+                    elif winner is None:
+                        winner = task
+            if winner is None:
+                raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if winner is not secondary:
+                self.release(hedge_conn, False)
+        if winner is secondary:
+            self.release(conn, False)
+        hedge.winner = "primary" if winner is primary else "hedge"
+        return (conn if winner is primary else hedge_conn), winner.result()
+
+    def close(self) -> None:
+        """
+        Close all idle connections.
+        """
+        for idle in self._idle.values():
+            for conn, _ in idle:
+                conn.close()
+        self._idle.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get a snapshot of the pool counters.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "idle": sum(len(idle) for idle in self._idle.values()),
+            "in_use": self._in_use,
+        }
+
+
+class AsyncHTTPServer(WorkerStatsMixin):
+    """
+    An HTTP/1.1 server running on an asyncio event loop. Like
+    :class:`jwt_proxy.http_base.ProxyHTTPServer`, it holds the metrics and shared state which
+    are accessed by request handlers.
+    """
+
+    def __init__(
+        self,
+        server_address: Tuple[str, int],
+        handler_cls: Type["AsyncRequestHandler"],
+        reuse_port: bool = False,
+        listen_socket: Optional[socket.socket] = None,
+    ):
+        """
+        :param server_address: The address to listen on.
+        :param handler_cls: The request handler class.
+        :param reuse_port: Whether to set ``SO_REUSEPORT``, so that several worker processes can
+                           listen on the same port.
+        :param listen_socket: A socket which is already listening, used instead of binding the
+                              address, see :class:`jwt_proxy.http_base.ProxyHTTPServer`.
+        """
+        self.server_address = server_address
+        self.reuse_port = reuse_port
+        self.listen_socket = listen_socket
+        self.handler_cls = handler_cls
+        self.logger = get_logger(type(self))
+        self.start_time = time.time()
+        self.metrics = create_server_metrics(self)
+        self.keep_alive_timeout = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 15))
+        self.max_keep_alive_requests = int(os.environ.get("HTTP_KEEPALIVE_MAX_REQUESTS", 100))
+        self.log_settings = LogSettings.from_environment()
+        self.admin_token = os.environ.get("ADMIN_TOKEN") or None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.StreamWriter] = set()
+        # The connections handling a request, rather than waiting for the next one
+        self._busy: Set[asyncio.StreamWriter] = set()
+        # Set once the server drains, after which every request closes its connection
+        self.draining = False
+        self._drained = asyncio.Event()
+
+    async def start(self) -> None:
+        """
+        Start listening. The handler's shared state is created here, because it may need the
+        running event loop.
+        """
+        self.handler_cls.init_server(self)
+        if self.listen_socket is not None:
+            self._server = await asyncio.start_server(
+                self._handle_connection, sock=self.listen_socket, backlog=1024, limit=_MAX_HEAD_SIZE
+            )
+        else:
+            self._server = await asyncio.start_server(
+                self._handle_connection,
+                *self.server_address,
+                reuse_address=True,
+                reuse_port=self.reuse_port or None,
+                backlog=1024,
+                limit=_MAX_HEAD_SIZE,
+            )
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+
+    @property
+    def listening_socket(self) -> socket.socket:
+        """
+        The listening socket, to be passed to a new process.
+        """
+        return self._server.sockets[0]
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Stop accepting connections, and let the open ones finish the requests in progress, like
+        :meth:`jwt_proxy.http_base.ProxyHTTPServer.drain`.
+
+        :param timeout: Seconds to wait for the connections to close.
+        :return: Whether they all closed in time.
+        """
+        self.draining = True
+        self._server.close()
+        for writer in self._connections - self._busy:
+            writer.close()
+        if not self._connections:
+            return True
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def open_connections(self) -> int:
+        """
+        Get the number of open client connections.
+        """
+        return len(self._connections)
+
+    async def close(self) -> None:
+        """
+        Stop listening, and close all client connections.
+        """
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        self.handler_cls.close_server(self)
+
+    def reload_config(self) -> None:
+        """
+        See :meth:`jwt_proxy.http_base.ProxyHTTPServer.reload_config`.
+        """
+        self.handler_cls.reload_server(self)
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self._connections.add(writer)
+        client_address = writer.get_extra_info("peername")
+        requests_on_connection = 0
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), self.keep_alive_timeout
+                    )
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await AsyncRequestHandler.send_bare_error(
+                        writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE
+                    )
+                    break
+
+                requests_on_connection += 1
+                start = time.perf_counter()
+                self._busy.add(writer)
+                handler = self.handler_cls(self, reader, writer, client_address)
+                if not handler.parse_request(head):
+                    await handler.send_error(HTTPStatus.BAD_REQUEST, "Bad request syntax")
+                    break
+                if requests_on_connection >= self.max_keep_alive_requests or self.draining:
+                    handler.close_connection = True
+
+                try:
+                    await handler.handle()
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                finally:
+                    if handler.response_status is not None:
+                        duration = time.perf_counter() - start
+                        observe_request(
+                            self.metrics, handler.command, handler.response_status, duration
+                        )
+                        log_access(
+                            client_address[0],
+                            handler.requestline,
+                            handler.response_status,
+                            duration,
+                        )
+                if handler.close_connection or self.draining:
+                    break
+                self._busy.discard(writer)
+        except Exception:
+            self.logger.exception("Error while handling connection from %s", client_address)
+        finally:
+            self._connections.discard(writer)
+            self._busy.discard(writer)
+            writer.close()
+            if self.draining and not self._connections:
+                self._drained.set()
+
+
+class AsyncRequestHandler:
+    """
+    Base request handler for :class:`AsyncHTTPServer`, mirroring
+    :class:`jwt_proxy.http_base.ProxyBaseHTTPRequestHandler`. One handler instance is created
+    for each request.
+    """
+
+    server_version = "BaseHTTP"
+    sys_version = "Python/" + sys.version.split()[0]
+
+    def __init__(
+        self,
+        server: AsyncHTTPServer,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        client_address: Tuple[str, int],
+    ):
+        self._server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = client_address
+        self.logger = get_logger(type(self))
+        # The logger for request details, which are only logged for a sample of requests
+        self.detail_logger = server.log_settings.detail_logger(self.logger)
+        self.close_connection = True
+        self.command = ""
+        self.path = ""
+        self.request_version = "HTTP/1.1"
+        self.requestline = ""
+        self.headers = Message()
+        # The status of the response, once it has been started
+        self.response_status: Optional[int] = None
+
+    @classmethod
+    def init_server(cls, server: AsyncHTTPServer) -> None:
+        """
+        See :meth:`jwt_proxy.http_base.ProxyBaseHTTPRequestHandler.init_server`.
+        """
+
+    @classmethod
+    def close_server(cls, server: AsyncHTTPServer) -> None:
+        """
+        See :meth:`jwt_proxy.http_base.ProxyBaseHTTPRequestHandler.close_server`.
+        """
+
+    @classmethod
+    def reload_server(cls, server: AsyncHTTPServer) -> None:
+        """
+        See :meth:`jwt_proxy.http_base.ProxyBaseHTTPRequestHandler.reload_server`.
+        """
+
+    def parse_request(self, head: bytes) -> bool:
+        """
+        Parse the request line and headers.
+
+        :param head: The request head, including the terminating empty line.
+        :return: Whether the request is valid.
+        """
+        request_line, _, header_block = head.partition(b"\r\n")
+        self.requestline = request_line.decode("latin-1")
+        words = self.requestline.split()
+        if len(words) != 3 or not words[2].startswith("HTTP/1."):
+            return False
+        self.command, self.path, self.request_version = words
+        try:
+            self.headers = parse_headers(BytesIO(header_block))
+        except Exception:
+            return False
+
+        tokens = _connection_tokens(self.headers)
+        if self.request_version == "HTTP/1.0":
+            self.close_connection = "keep-alive" not in tokens
+        else:
+            self.close_connection = "close" in tokens
+        return True
+
+    async def handle(self) -> None:
+        """
+        Dispatch the request to the ``do_<method>`` coroutine.
+        """
+        method = getattr(self, "do_" + self.command, None)
+        if method is None:
+            await self.send_error(
+                HTTPStatus.NOT_IMPLEMENTED, f"Unsupported method ({self.command!r})"
+            )
+            return
+        await method()
+
+    def iter_request_body(
+        self, chunk_size: int = BODY_CHUNK_SIZE
+    ) -> Optional[AsyncIterator[bytes]]:
+        """
+        See :meth:`jwt_proxy.http_base.ProxyBaseHTTPRequestHandler.iter_request_body`.
+        """
+        transfer_encoding = self.headers.get("Transfer-Encoding")
+        length = self.headers.get("Content-Length")
+        if transfer_encoding is not None:
+            if length is not None:
+                raise BodyFramingError("Both Transfer-Encoding and Content-Length")
+            if is_chunked(transfer_encoding):
+                return self._iter_chunked_body(chunk_size)
+
+        if length is None:
+            return None
+        try:
+            remaining = int(length)
+        except ValueError:
+            raise BodyFramingError(f"Invalid Content-Length {length!r}")
+        if remaining < 0:
+            raise BodyFramingError(f"Invalid Content-Length {length!r}")
+        return self._iter_sized_body(remaining, chunk_size)
+
+    def _send_continue(self) -> None:
+        if (
+            self.request_version != "HTTP/1.0"
+            and self.headers.get("Expect", "").lower() == "100-continue"
+        ):
+            self.writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            # Only one interim response per request
+            del self.headers["Expect"]
+
+    async def _read(self, size: int) -> bytes:
+        try:
+            return await asyncio.wait_for(self.reader.read(size), self._server.keep_alive_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.close_connection = True
+            raise BodyFramingError(f"Error reading the body from the client: {e!r}") from e
+
+    async def _readline(self) -> bytes:
+        try:
+            return await asyncio.wait_for(self.reader.readline(), self._server.keep_alive_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.close_connection = True
+            raise BodyFramingError(f"Error reading the body from the client: {e!r}") from e
+
+    async def _iter_sized_body(self, remaining: int, chunk_size: int) -> AsyncIterator[bytes]:
+        self._send_continue()
+        while remaining > 0:
+            chunk = await self._read(min(remaining, chunk_size))
+            if not chunk:
+                self.close_connection = True
+                raise BodyFramingError("Client closed the connection before sending the whole body")
+            remaining -= len(chunk)
+            yield chunk
+
+    async def _iter_chunked_body(self, chunk_size: int) -> AsyncIterator[bytes]:
+        self._send_continue()
+        while True:
+            size = parse_chunk_size(await self._readline())
+            if size == 0:
+                break
+            async for chunk in self._iter_sized_body(size, chunk_size):
+                yield chunk
+            if (await self._readline()) not in (b"\r\n", b"\n"):
+                self.close_connection = True
+                raise BodyFramingError("Missing line terminator after chunk data")
+
+        # Trailers are not forwarded
+        while True:
+            line = await self._readline()
+            if line in (b"\r\n", b"\n"):
+                break
+            if not line:
+                self.close_connection = True
+                raise BodyFramingError("Client closed the connection before the end of the body")
+
+    async def read_body(self) -> Optional[bytes]:
+        """
+        Read the complete request body.
+
+        :return: The body, or None if the request has no body.
+        :raises BodyFramingError: if the body framing headers are invalid.
+        """
+        body = self.iter_request_body()
+        if body is None:
+            return None
+        return b"".join([chunk async for chunk in body])
+
+    async def discard_request_body(self) -> None:
+        """
+        See :meth:`jwt_proxy.http_base.ProxyBaseHTTPRequestHandler.discard_request_body`.
+        """
+        try:
+            body = self.iter_request_body()
+            if body is not None:
+                async for _ in body:
+                    pass
+        except BodyFramingError:
+            self.close_connection = True
+
+    def record_request(self) -> None:
+        """
+        Add a metric that a request was processed. No lock is needed on the event loop thread.
+        """
+        self._server.count_request()
+
+    def status_lines(self) -> List[str]:
+        """
+        See :meth:`jwt_proxy.http_base.ProxyBaseHTTPRequestHandler.status_lines`.
+        """
+        return []
+
+    async def do_GET(self):
+        await self.discard_request_body()
+        content_type = "text/plain; charset=utf-8"
+        path, _, query = self.path.partition("?")
+        if path == "/status":
+            status = HTTPStatus.OK
+            response = build_status_page(
+                self.server_version,
+                self._server.start_time,
+                self._server.requests_processed(),
+                self._server.server_status_lines() + self.status_lines(),
+            )
+        elif path == "/metrics":
+            status = HTTPStatus.OK
+            response = self._server.metrics.render_prometheus().encode("utf-8")
+            content_type = PROMETHEUS_CONTENT_TYPE
+        elif path == PROFILE_PATH:
+            status, response = await self.profile(query)
+        else:
+            status = HTTPStatus.NOT_FOUND
+            response = b"Not Found"
+
+        await self.send_response(
+            status,
+            [
+                ("Content-type", content_type),
+                ("Content-Length", str(len(response))),
+            ],
+            response,
+        )
+
+    async def profile(self, query: str) -> Tuple[HTTPStatus, bytes]:
+        """
+        See :meth:`jwt_proxy.http_base.ProxyBaseHTTPRequestHandler.profile`. Stacks are sampled on
+        another thread, so that the event loop keeps running and is itself profiled.
+        """
+        error = check_admin_request(self.headers, self._server.admin_token)
+        if error is not None:
+            return error
+        try:
+            seconds = parse_profile_duration(query)
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, str(e).encode("utf-8")
+        self.logger.info("Profiling for %g seconds", seconds)
+        stacks = await asyncio.get_running_loop().run_in_executor(None, sample_stacks, seconds)
+        return HTTPStatus.OK, format_stacks(stacks).encode("utf-8")
+
+    def write_response_head(
+        self,
+        code: int,
+        headers: List[Tuple[str, HeaderValue]],
+        server_headers: bool = True,
+    ) -> None:
+        """
+        Write the status line and headers of a response. The ``Connection`` header is added to
+        match the connection state.
+
+        :param code: The status code.
+        :param headers: The response headers, which must include the framing of the body.
+        :param server_headers: Whether to add the ``Server`` and ``Date`` headers. The proxy
+                               disables this to preserve the upstream headers.
+        """
+        self.response_status = code
+        try:
+            phrase = HTTPStatus(code).phrase
+        except ValueError:
+            phrase = ""
+        all_headers = list(headers)
+        if server_headers:
+            all_headers.append(("Server", f"{self.server_version} {self.sys_version}"))
+            all_headers.append(("Date", email.utils.formatdate(usegmt=True)))
+        if not any(name.lower() == "connection" for name, _ in headers):
+            if self.close_connection and self.request_version != "HTTP/1.0":
+                all_headers.append(("Connection", "close"))
+            elif not self.close_connection and self.request_version == "HTTP/1.0":
+                all_headers.append(("Connection", "keep-alive"))
+
+        self.writer.write(
+            f"HTTP/1.1 {int(code)} {phrase}\r\n".encode("latin-1")
+            + _encode_headers(all_headers)
+            + b"\r\n"
+        )
+
+    async def send_response(
+        self,
+        code: int,
+        headers: List[Tuple[str, HeaderValue]],
+        body: bytes,
+        server_headers: bool = True,
+    ) -> None:
+        """
+        Send a complete response, see :meth:`write_response_head`.
+
+        :param code: The status code.
+        :param headers: The response headers, which must include the framing of the body.
+        :param body: The response body.
+        :param server_headers: Whether to add the ``Server`` and ``Date`` headers.
+        """
+        self.write_response_head(code, headers, server_headers)
+        self.writer.write(body)
+        await self.writer.drain()
+
+    async def send_error(self, code: int, message: Optional[str] = None) -> None:
+        """
+        Send an error response and close the connection, like
+        :meth:`http.server.BaseHTTPRequestHandler.send_error`.
+        """
+        code = HTTPStatus(code)
+        self.logger.error("[%s] code %d, message %s", self.client_address[0], code, message)
+        self.close_connection = True
+        body = f"{code.value} {message or code.phrase}".encode("utf-8")
+        await self.send_response(
+            code,
+            [
+                ("Content-Type", "text/plain; charset=utf-8"),
+                ("Content-Length", str(len(body))),
+                ("Connection", "close"),
+            ],
+            body,
+        )
+
+    @staticmethod
+    async def send_bare_error(writer: asyncio.StreamWriter, code: HTTPStatus) -> None:
+        """
+        Send an error response before a request could be parsed.
+        """
+        writer.write(
+            f"HTTP/1.1 {code.value} {code.phrase}\r\nContent-Length: 0\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1")
+        )
+        await writer.drain()
+
+
+class AsyncEchoRequestHandler(EchoRequestMixin, AsyncRequestHandler):
+    """
+    The asyncio counterpart of :class:`jwt_proxy.echo_server.EchoRequestHandler`.
+    """
+
+    async def do_POST(self):
+        self.record_request()
+        try:
+            simulation = self.request_simulation()
+        except ValueError as e:
+            await self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        self.detail_logger.info("Got POST request for %s", self.path)
+
+        try:
+            req_content = await self.read_body()
+        except BodyFramingError as e:
+            self.logger.error("Invalid request body framing: %s", e)
+            await self.send_error(HTTPStatus.BAD_REQUEST, "invalid body framing")
+            return
+        if req_content is None:
+            self.logger.error("Missing Content-Length header!")
+            await self.send_error(HTTPStatus.BAD_REQUEST, "missing length")
+            return
+
+        error = self.verify_token()
+        if error is not None:
+            await self.send_error(HTTPStatus.UNAUTHORIZED, error)
+            return
+
+        delay = simulation.latency.sample()
+        if delay:
+            await asyncio.sleep(delay)
+        status, headers, pieces = self.simulated_response(simulation, req_content)
+        if status is None:
+            return
+
+        # Written in pieces, waiting for each to be sent, so that large bodies are not buffered
+        self.write_response_head(status, headers)
+        for piece in pieces:
+            await self.writer.drain()
+            self.writer.write(piece)
+        await self.writer.drain()
+
+
+class AsyncProxyRequestHandler(ProxyRequestMixin, AsyncRequestHandler):
+    """
+    The asyncio counterpart of :class:`jwt_proxy.proxy_server.ProxyRequestHandler`.
+    """
+
+    async def do_GET(self):
+        if self.is_local_request():
+            await super().do_GET()
+        else:
+            await self.forward_request()
+
+    async def forward_request(self):
+        """
+        See :meth:`jwt_proxy.proxy_server.ProxyRequestHandler.forward_request`.
+        """
+        self.record_request()
+        self.proxy_state = self._server.proxy_state
+        self.config = self.proxy_state.config
+        self.timer = PhaseTimer()
+        self.detail_logger.info("Got %s request for %s", self.command, self.path)
+
+        refusal = self.rate_limit_response()
+        if refusal is not None:
+            await self.send_response(*refusal)
+            return
+
+        headers = OrderedDict(self.headers.items())
+        try:
+            req_body = self.iter_request_body()
+        except BodyFramingError as e:
+            self.logger.error("Invalid request body framing: %s", e)
+            await self.send_error(HTTPStatus.BAD_REQUEST, "invalid body framing")
+            return
+        if req_body is None and self.command in METHODS_WITH_BODY:
+            self.logger.error("Missing Content-Length header!")
+            await self.send_error(HTTPStatus.BAD_REQUEST, "missing length")
+            return
+
+        # See ProxyRequestHandler.forward_request
+        self.body_length = self.request_body_length()
+        if req_body is not None and self.body_length is not None:
+            if self.body_length <= BODY_CHUNK_SIZE:
+                req_body = b"".join([chunk async for chunk in req_body])
+                self.detail_logger.info("Got %d bytes in %s body", len(req_body), self.command)
+        self.timer.mark("read_body")
+
+        cache = self._server.response_cache
+        cache_key = self.cache_key()
+        entry = None
+        if cache_key is not None:
+            entry = cache.get(cache_key)
+            if self.is_servable(entry):
+                await self.send_cached_response(entry, "hit")
+                self.timer.mark("respond")
+                self.observe_phases()
+                return
+
+        token = self.create_token()
+        self.timer.mark("token")
+
+        if cache_key is None:
+            await self.proxy_upstream(headers, req_body, token)
+            return
+
+        waiter = cache.claim(cache_key)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter.wait(), cache.coalesce_timeout)
+            except asyncio.TimeoutError:
+                pass
+            entry = cache.get(cache_key)
+            if self.is_servable(entry):
+                await self.send_cached_response(entry, "coalesced")
+                self.timer.mark("respond")
+                self.observe_phases()
+                return
+        try:
+            await self.proxy_upstream(
+                self.cache_request_headers(headers, entry), req_body, token, cache_key, entry
+            )
+        finally:
+            if waiter is None:
+                cache.release(cache_key)
+
+    do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = forward_request
+
+    async def proxy_upstream(
+        self,
+        headers: Dict[str, str],
+        req_body: Union[None, bytes, AsyncIterator[bytes]],
+        token: bytes,
+        cache_key: Optional[str] = None,
+        entry: Optional[CachedResponse] = None,
+    ) -> None:
+        """
+        See :meth:`jwt_proxy.proxy_server.ProxyRequestHandler.proxy_upstream`.
+        """
+        upstream_headers = self.build_upstream_headers(headers, token, self.body_length)
+        attempts = self.retry_attempts(req_body)
+        try:
+            retry_reason = None
+            for attempt in range(1, attempts + 1):
+                if retry_reason is not None:
+                    await asyncio.sleep(self.retry_delay(attempt - 1, retry_reason))
+                retry_reason = await self.attempt_upstream(
+                    upstream_headers, req_body, cache_key, entry, attempt == attempts
+                )
+                if retry_reason is None:
+                    break
+        except (CircuitOpenError, ConcurrencyLimitExceeded) as e:
+            await self.send_response(*self.short_circuit_response(e, req_body))
+        finally:
+            self.observe_phases()
+
+    async def attempt_upstream(
+        self,
+        headers: Dict[str, HeaderValue],
+        req_body: Union[None, bytes, AsyncIterator[bytes]],
+        cache_key: Optional[str],
+        entry: Optional[CachedResponse],
+        last: bool,
+    ) -> Optional[str]:
+        """
+        See :meth:`jwt_proxy.proxy_server.ProxyRequestHandler.attempt_upstream`.
+        """
+        balancer = self.proxy_state.balancer
+        limiter = self.proxy_state.concurrency_limiter
+        # See ProxyRequestHandler.attempt_upstream
+        if limiter is not None and not await limiter.acquire_async(
+            self.config.concurrency_queue_timeout
+        ):
+            raise ConcurrencyLimitExceeded(int(limiter.limit))
+        rtt, failed = None, False
+        hedge = HedgeTarget(balancer, limiter, self.path)
+        try:
+            with balancer.select(self.path) as (upstream, generation):
+                upstream_url = upstream.build_url(self.path)
+                hedge_delay = self.hedge_delay(req_body)
+                try:
+                    async with self._server.upstream_pool.request(
+                        upstream_url,
+                        self.command,
+                        req_body,
+                        headers,
+                        self.timer,
+                        None if hedge_delay is None else (hedge_delay, hedge),
+                    ) as response:
+                        rtt, failed = response.latency, response.status >= 500
+                        hedge.record(upstream, generation, not failed)
+                        self._server.upstream_latency.observe(response.latency)
+                        if hedge.winner is not None:
+                            self.count_hedge(hedge.winner)
+                        if not last and response.status in RETRYABLE_STATUSES:
+                            self.logger.warning(
+                                "Upstream %s answered %d %s, retrying",
+                                upstream_url,
+                                response.status,
+                                response.reason,
+                            )
+                            await self._discard_upstream_body(response)
+                            return "status"
+                        if cache_key is None:
+                            await self.relay_upstream_response(upstream_url, response)
+                        else:
+                            await self.relay_cacheable_response(
+                                upstream_url, response, cache_key, entry
+                            )
+                        self.timer.mark("respond")
+                except BodyFramingError as e:
+                    balancer.release(upstream, generation)
+                    self.logger.error("Invalid request body framing: %s", e)
+                    await self.send_error(HTTPStatus.BAD_REQUEST, "invalid body framing")
+                except UpstreamPoolExhausted as e:
+                    balancer.release(upstream, generation)
+                    self.logger.error("%s", e)
+                    self.count_upstream_error("pool_exhausted")
+                    await self.send_error(
+                        HTTPStatus.SERVICE_UNAVAILABLE, "upstream connections exhausted"
+                    )
+                except (OSError, asyncio.IncompleteReadError, RemoteDisconnected) as e:
+                    # See ProxyRequestHandler.attempt_upstream
+                    if self.response_status is not None:
+                        raise
+                    hedge.record(upstream, generation, False)
+                    failed = True
+                    reason = "timeout" if isinstance(e, TimeoutError) else "error"
+                    if not last:
+                        self.logger.warning("Error from upstream %s, retrying: %s", upstream_url, e)
+                        return reason
+                    self.close_connection = True
+                    if reason == "timeout":
+                        self.logger.error("Timed out waiting for upstream %s", upstream_url)
+                        self.count_upstream_error("timeout")
+                        await self.send_error(HTTPStatus.GATEWAY_TIMEOUT, "upstream timed out")
+                    else:
+                        self.logger.error(
+                            "Error while connecting to upstream %s", upstream_url, exc_info=e
+                        )
+                        self.count_upstream_error("connect")
+                        await self.send_error(HTTPStatus.BAD_GATEWAY, "upstream unavailable")
+        finally:
+            hedge.close()
+            if limiter is not None:
+                limiter.release(rtt, failed)
+        return None
+
+    async def relay_cacheable_response(
+        self,
+        upstream_url: str,
+        response: AsyncUpstreamResponse,
+        cache_key: str,
+        entry: Optional[CachedResponse],
+    ) -> None:
+        """
+        See :meth:`jwt_proxy.proxy_server.ProxyRequestHandler.relay_cacheable_response`.
+        """
+        headers = response.getheaders()
+        if response.status == HTTPStatus.NOT_MODIFIED and entry is not None:
+            await response.read()
+            await self.send_cached_response(
+                self.refresh_response(cache_key, entry, headers), "revalidated"
+            )
+        elif self.should_store(response.status, headers):
+            body = await response.read()
+            await self.send_cached_response(
+                self.store_response(cache_key, response.status, headers, body), "miss"
+            )
+        else:
+            self._server.response_cache.count("miss")
+            await self.relay_upstream_response(upstream_url, response)
+
+    async def send_cached_response(self, entry: CachedResponse, result: str) -> None:
+        """
+        See :meth:`jwt_proxy.proxy_server.ProxyRequestHandler.send_cached_response`.
+        """
+        status, headers, body = self.cached_response(entry, result)
+        await self.send_response(status, headers, body, server_headers=False)
+
+    async def relay_upstream_response(
+        self, upstream_url: str, response: AsyncUpstreamResponse
+    ) -> None:
+        """
+        See :meth:`jwt_proxy.proxy_server.ProxyRequestHandler.relay_upstream_response`.
+        """
+        resp_status, resp_headers, resp_body = self.translate_upstream_response(
+            upstream_url, response.status, response.reason, response.getheaders()
+        )
+        if resp_body is not None:
+            await self._discard_upstream_body(response)
+            await self.send_response(resp_status, resp_headers, resp_body, server_headers=False)
+            return
+
+        self.write_response_head(resp_status, resp_headers, server_headers=False)
+        if response_has_body(self.command, resp_status):
+            chunked = is_response_chunked(resp_headers)
+            compressor = self.compressor
+            try:
+                while True:
+                    chunk = await response.read1(BODY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if compressor is not None:
+                        chunk = compressor.compress(chunk)
+                        if not chunk:
+                            continue
+                    self.writer.write(encode_chunk(chunk) if chunked else chunk)
+                    await self.writer.drain()
+            except (asyncio.IncompleteReadError, BodyFramingError, OSError) as e:
+                self.logger.error("Error while relaying response from %s", upstream_url, exc_info=e)
+                self.count_upstream_error("relay")
+                self.close_connection = True
+                return
+            if compressor is not None:
+                tail = compressor.finish()
+                self.writer.write(encode_chunk(tail) if chunked else tail)
+                self.count_compression(compressor)
+            if chunked:
+                self.writer.write(LAST_CHUNK)
+        await self.writer.drain()
+
+    @staticmethod
+    async def _discard_upstream_body(
+        response: AsyncUpstreamResponse, limit: int = 16 * BODY_CHUNK_SIZE
+    ) -> None:
+        """
+        See :meth:`jwt_proxy.proxy_server.ProxyRequestHandler._discard_upstream_body`.
+        """
+        discarded = 0
+        while discarded < limit:
+            chunk = await response.read1(BODY_CHUNK_SIZE)
+            if not chunk:
+                break
+            discarded += len(chunk)
+
+    @classmethod
+    def init_server(cls, server: AsyncHTTPServer) -> None:
+        cls.init_proxy_server(
+            server,
+            AsyncUpstreamConnectionPool.from_environment(),
+            ResponseCache.from_environment(asyncio.Event),
+        )
+
+    @classmethod
+    def close_server(cls, server: AsyncHTTPServer) -> None:
+        server.proxy_state.balancer.close()
+        server.upstream_pool.close()
+        close_token_source(server.token_source)
+
+
+# Asyncio handlers for each threaded handler type
+_ASYNC_HANDLERS = {
+    EchoRequestHandler: AsyncEchoRequestHandler,
+    ProxyRequestHandler: AsyncProxyRequestHandler,
+}
+
+
+def get_async_handler(handler_cls: type) -> Type[AsyncRequestHandler]:
+    """
+    Find the asyncio handler which implements the same behavior as a threaded handler.
+
+    :param handler_cls: The threaded handler class, or an asyncio handler class.
+    :return: The asyncio handler class.
+    """
+    if issubclass(handler_cls, AsyncRequestHandler):
+        return handler_cls
+    for cls in handler_cls.__mro__:
+        if cls in _ASYNC_HANDLERS:
+            return _ASYNC_HANDLERS[cls]
+    raise ValueError(f"No asyncio handler available for {handler_cls.__name__}")
+
+
+def run_async_server(
+    handler_cls: type,
+    port: int,
+    shared_stats: Optional["SharedStats"] = None,
+    worker_id: int = 0,
+) -> None:
+    """
+    Run an HTTP server on the asyncio engine until ``SIGINT`` or ``SIGTERM`` is received, and
+    drain it. ``SIGHUP`` reloads the configuration, and ``SIGUSR2`` hands the listening socket over
+    to a new process, see :func:`jwt_proxy.http_base.run_server`.
+
+    :param handler_cls: The threaded or asyncio request handler class.
+    :param port: The port to listen on.
+    :param shared_stats: The statistics shared by all workers, when running as one of several
+                         worker processes.
+    :param worker_id: The slot of this worker in the shared statistics.
+    """
+    log = get_logger(run_async_server)
+
+    async def _main():
+        server = AsyncHTTPServer(
+            ("0.0.0.0", port),
+            get_async_handler(handler_cls),
+            reuse_port=shared_stats is not None,
+            listen_socket=inherited_listen_socket(),
+        )
+        if shared_stats is not None:
+            server.attach_shared_stats(shared_stats, worker_id)
+        await server.start()
+        log.info("Started asyncio server")
+        notify_ready()
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+
+            def _handler(signum=signum):
+                log.info("Got signal %d (%s), exiting", signum, signal.strsignal(signum))
+                stop.set()
+
+            loop.add_signal_handler(signum, _handler)
+        loop.add_signal_handler(signal.SIGHUP, server.reload_config)
+
+        replacing = False
+
+        async def _replace():
+            nonlocal replacing
+            timeout = float(os.environ.get("SERVER_REEXEC_TIMEOUT", 30))
+            try:
+                # Waiting for the new process blocks, so it runs on another thread
+                if await loop.run_in_executor(
+                    None, spawn_replacement, server.listening_socket, timeout
+                ):
+                    stop.set()
+            finally:
+                replacing = False
+
+        def _replace_handler():
+            nonlocal replacing
+            log.info("Got signal %d (%s)", signal.SIGUSR2, signal.strsignal(signal.SIGUSR2))
+            if not replacing:
+                replacing = True
+                loop.create_task(_replace())
+
+        if shared_stats is None:
+            loop.add_signal_handler(signal.SIGUSR2, _replace_handler)
+
+        await stop.wait()
+        drain_timeout = float(os.environ.get("SERVER_DRAIN_TIMEOUT", 30))
+        log.info("Shutting down, draining connections for up to %g seconds", drain_timeout)
+        if not await server.drain(drain_timeout):
+            log.warning("Closing %d connections which did not finish", server.open_connections())
+        await server.close()
+
+    asyncio.run(_main())
+    sys.exit(0)
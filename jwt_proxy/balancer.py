@@ -0,0 +1,347 @@
+"""
+Load balancing across several upstream servers, and active health checks which take failing
+upstreams out of rotation.
+"""
+
+import bisect
+import hashlib
+import itertools
+import threading
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+
+from jwt_proxy.breaker import CircuitBreaker
+from jwt_proxy.logger import get_logger
+
+#: The balancing policies, selected by ``UPSTREAM_POLICY``.
+BALANCE_POLICIES = ("round_robin", "least_outstanding", "consistent_hash")
+
+
+class Upstream:
+    """
+    The state of one upstream server, shared by all requests.
+    """
+
+    __slots__ = ("url", "healthy", "outstanding", "breaker", "_passes", "_failures")
+
+    def __init__(self, url: str, breaker: Optional[CircuitBreaker] = None):
+        """
+        :param url: The upstream scheme and network location, such as ``http://echo:9100``.
+        :param breaker: The upstream's circuit breaker, or None to always send it requests.
+        """
+        self.url = url
+        #: The circuit breaker, or None.
+        self.breaker = breaker
+        #: Whether the upstream is in rotation.
+        self.healthy = True
+        #: The number of requests currently sent to the upstream.
+        self.outstanding = 0
+        # Consecutive passed and failed health checks
+        self._passes = 0
+        self._failures = 0
+
+    def build_url(self, path: str) -> str:
+        """
+        Build the URL of a request to this upstream.
+
+        :param path: The URL path, including the query.
+        :return: The complete URL.
+        """
+        return self.url + path
+
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class UpstreamBalancer:
+    """
+    Chooses the upstream for each request according to a policy:
+
+    ``round_robin``
+        Each upstream in turn.
+    ``least_outstanding``
+        The upstream with the fewest requests in progress, taking turns among equals.
+    ``consistent_hash``
+        The upstream owning the request path on a hash ring, so that each path keeps going to the
+        same upstream, and only the paths of an upstream leaving or joining the rotation move.
+
+    Upstreams marked unhealthy are skipped. If none are healthy, all of them are used, since
+    refusing every request is never better than trying. Upstreams whose circuit breaker is open
+    are skipped too, but if all of them are open, requests are refused by :meth:`select`, since
+    those upstreams failed actual requests.
+    """
+
+    def __init__(
+        self,
+        urls: Sequence[str],
+        policy: str = "round_robin",
+        replicas: int = 100,
+        circuit_breaker: Optional[Callable[[str], CircuitBreaker]] = None,
+    ):
+        """
+        :param urls: The upstream URLs, as in :attr:`Upstream.url`.
+        :param policy: One of :data:`BALANCE_POLICIES`.
+        :param replicas: Points on the hash ring per upstream, for ``consistent_hash``.
+        :param circuit_breaker: Creates the circuit breaker of an upstream from its URL, or None
+                                to not use circuit breakers.
+        """
+        if not urls:
+            raise ValueError("At least one upstream is required")
+        if policy not in BALANCE_POLICIES:
+            raise ValueError(f"Unknown balancing policy {policy!r}")
+        self.upstreams = [
+            Upstream(url, None if circuit_breaker is None else circuit_breaker(url)) for url in urls
+        ]
+        self.policy = policy
+        self.health_checker: Optional[HealthChecker] = None
+        self.logger = get_logger(type(self))
+
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self._healthy = list(self.upstreams)
+        ring = sorted(
+            (_ring_hash(f"{upstream.url}#{replica}"), index)
+            for index, upstream in enumerate(self.upstreams)
+            for replica in range(replicas)
+        )
+        self._ring_hashes = [point for point, _ in ring]
+        self._ring_owners = [index for _, index in ring]
+
+    def choose(self, path: str) -> Upstream:
+        """
+        Choose the upstream for a request.
+
+        :param path: The URL path, including the query, which is ignored.
+        :return: The upstream.
+        """
+        candidates = self._healthy or self.upstreams
+        if len(candidates) == 1:
+            return candidates[0]
+        if any(
+            upstream.breaker is not None and upstream.breaker.state != "closed"
+            for upstream in candidates
+        ):
+            candidates = [
+                upstream for upstream in candidates if upstream.breaker.available()
+            ] or candidates
+        if self.policy == "consistent_hash":
+            return self._owner(path.partition("?")[0], candidates)
+        turn = next(self._turn) % len(candidates)
+        if self.policy == "round_robin":
+            return candidates[turn]
+        rotated = candidates[turn:] + candidates[:turn]
+        return min(rotated, key=lambda upstream: upstream.outstanding)
+
+    def _owner(self, path: str, candidates: List[Upstream]) -> Upstream:
+        start = bisect.bisect(self._ring_hashes, _ring_hash(path))
+        size = len(self._ring_owners)
+        for offset in range(size):
+            upstream = self.upstreams[self._ring_owners[(start + offset) % size]]
+            if upstream in candidates:
+                return upstream
+        return candidates[0]
+
+    @contextmanager
+    def select(self, path: str) -> Iterator[Tuple[Upstream, int]]:
+        """
+        Choose the upstream for a request, counting the request as outstanding until the context
+        exits. Also usable from coroutines, as it does not block. The outcome of the request should
+        be passed to :meth:`record`, or :meth:`release` called if it has none.
+
+        :param path: The URL path, including the query.
+        :return: A context manager for the upstream, and the generation of its circuit breaker
+                 the request was let through in, see :meth:`CircuitBreaker.acquire`.
+        :raises CircuitOpenError: if the circuit breaker of the chosen upstream refuses requests.
+        """
+        upstream = self.choose(path)
+        generation = 0 if upstream.breaker is None else upstream.breaker.acquire()
+        with self._lock:
+            upstream.outstanding += 1
+        try:
+            yield upstream, generation
+        finally:
+            with self._lock:
+                upstream.outstanding -= 1
+
+    @staticmethod
+    def record(upstream: Upstream, generation: int, success: bool) -> None:
+        """
+        Record the outcome of a request in the circuit breaker of its upstream, if any.
+
+        :param upstream: The upstream chosen by :meth:`select`.
+        :param generation: The generation given by :meth:`select`.
+        :param success: Whether the upstream answered, without a server error.
+        """
+        if upstream.breaker is not None:
+            upstream.breaker.record(generation, success)
+
+    @staticmethod
+    def release(upstream: Upstream, generation: int) -> None:
+        """
+        Record that a request chosen by :meth:`select` ended without an outcome for the upstream,
+        such as one refused before it was sent, so that its circuit breaker probe is given back.
+
+        :param upstream: The upstream chosen by :meth:`select`.
+        :param generation: The generation given by :meth:`select`.
+        """
+        if upstream.breaker is not None:
+            upstream.breaker.release(generation)
+
+    def set_healthy(self, upstream: Upstream, healthy: bool) -> None:
+        """
+        Take an upstream out of rotation, or add it back.
+
+        :param upstream: One of :attr:`upstreams`.
+        :param healthy: Whether it should be in rotation.
+        """
+        with self._lock:
+            upstream.healthy = healthy
+            # Replaced rather than modified, so that choose() never needs the lock
+            self._healthy = [upstream for upstream in self.upstreams if upstream.healthy]
+
+    def start_health_checks(self, path: str, interval: float = 5.0, timeout: float = 2.0) -> None:
+        """
+        Check the health of the upstreams periodically in a background thread.
+
+        :param path: The path requested from each upstream; a response status below 400 passes.
+        :param interval: Seconds between checks.
+        :param timeout: Seconds to wait for each response.
+        """
+        self.health_checker = HealthChecker(self, path, interval, timeout)
+        self.health_checker.start()
+
+    def close(self, wait: bool = True) -> None:
+        """
+        Stop the health checks, if any.
+
+        :param wait: Whether to wait for a health check in progress to finish.
+        """
+        if self.health_checker is not None:
+            self.health_checker.stop(wait)
+            self.health_checker = None
+
+    def stats(self) -> List[Tuple[str, bool, int]]:
+        """
+        Get the URL, health and number of outstanding requests of each upstream.
+        """
+        return [
+            (upstream.url, upstream.healthy, upstream.outstanding) for upstream in self.upstreams
+        ]
+
+    def breaker_stats(self) -> List[Tuple[str, CircuitBreaker]]:
+        """
+        Get the URL and circuit breaker of each upstream which has one.
+        """
+        return [
+            (upstream.url, upstream.breaker)
+            for upstream in self.upstreams
+            if upstream.breaker is not None
+        ]
+
+
+class HealthChecker:
+    """
+    Requests a path from every upstream of a balancer in a background thread. An upstream is taken
+    out of rotation after ``fall`` consecutive failed checks, and added back after ``rise``
+    consecutive passed ones.
+    """
+
+    def __init__(
+        self,
+        balancer: UpstreamBalancer,
+        path: str,
+        interval: float = 5.0,
+        timeout: float = 2.0,
+        rise: int = 2,
+        fall: int = 2,
+    ):
+        """
+        :param balancer: The balancer whose upstreams are checked.
+        :param path: The path requested from each upstream.
+        :param interval: Seconds between checks.
+        :param timeout: Seconds to wait for each response.
+        :param rise: Passed checks before an unhealthy upstream is added back.
+        :param fall: Failed checks before a healthy upstream is taken out.
+        """
+        self.balancer = balancer
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self.rise = rise
+        self.fall = fall
+        self.logger = get_logger(type(self))
+
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Start checking the upstreams.
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True, name="health-checker")
+        self._thread.start()
+
+    def stop(self, wait: bool = True) -> None:
+        """
+        Stop checking the upstreams.
+
+        :param wait: Whether to wait for a check in progress to finish.
+        """
+        self._stopped.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def check(self) -> None:
+        """
+        Check every upstream once, and update its health.
+        """
+        for upstream in self.balancer.upstreams:
+            error = self.probe(upstream)
+            if error is None:
+                upstream._passes += 1
+                upstream._failures = 0
+                if not upstream.healthy and upstream._passes >= self.rise:
+                    self.logger.info("Upstream %s recovered, adding it back", upstream.url)
+                    self.balancer.set_healthy(upstream, True)
+            else:
+                upstream._failures += 1
+                upstream._passes = 0
+                if upstream.healthy and upstream._failures >= self.fall:
+                    self.logger.warning(
+                        "Upstream %s failed its health check, taking it out: %s",
+                        upstream.url,
+                        error,
+                    )
+                    self.balancer.set_healthy(upstream, False)
+
+    def probe(self, upstream: Upstream) -> Optional[str]:
+        """
+        Request the health check path from an upstream.
+
+        :param upstream: The upstream.
+        :return: None if the check passed, otherwise the reason it failed.
+        """
+        scheme, netloc, _, _, _ = urlsplit(upstream.url)
+        connection_class = HTTPSConnection if scheme == "https" else HTTPConnection
+        conn = connection_class(netloc, timeout=self.timeout)
+        try:
+            conn.request("GET", self.path)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, HTTPException) as e:
+            return str(e) or type(e).__name__
+        finally:
+            conn.close()
+        if response.status >= 400:
+            return f"{response.status} {response.reason}"
+        return None
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                self.logger.exception("Error while checking upstream health")
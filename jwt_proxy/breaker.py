@@ -0,0 +1,191 @@
+"""
+Circuit breakers, which stop sending requests to an upstream that keeps failing, so that they are
+answered right away instead of each waiting for the failure.
+"""
+
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Deque, Dict
+
+from jwt_proxy.logger import get_logger
+
+#: The states of a circuit breaker, in the order of their values in the metrics.
+BREAKER_STATES = ("closed", "half_open", "open")
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a request is refused because the circuit breaker of its upstream is open.
+    """
+
+    #: The message for the client.
+    reason = "upstream circuit open"
+
+    def __init__(self, upstream: str, retry_after: float):
+        """
+        :param upstream: The upstream URL.
+        :param retry_after: Seconds until the breaker lets probe requests through.
+        """
+        super().__init__(f"Circuit breaker for upstream {upstream} is open")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcomes of the requests sent to one upstream, in three states:
+
+    ``closed``
+        Requests are sent. The breaker opens after ``consecutive_failures`` failures in a row, or
+        when at least ``failure_rate`` of the last ``window`` requests failed.
+    ``open``
+        Requests are refused with :class:`CircuitOpenError`, for ``open_seconds``.
+    ``half_open``
+        Up to ``probes`` requests are sent to probe the upstream. The breaker closes once they all
+        succeed, and opens again as soon as one fails. Probes whose outcome is never recorded are
+        replaced after ``open_seconds``.
+
+    Each request is tagged with the generation of the breaker it was let through in, which changes
+    with the state, so that outcomes of requests let through before are ignored.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        consecutive_failures: int = 5,
+        failure_rate: float = 0.5,
+        window: int = 20,
+        open_seconds: float = 10.0,
+        probes: int = 1,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param name: The upstream URL, for logging.
+        :param consecutive_failures: Failures in a row which open the breaker.
+        :param failure_rate: Fraction of failed requests in a full window which opens the breaker.
+        :param window: The number of recent outcomes for the failure rate.
+        :param open_seconds: Seconds the breaker stays open before probing the upstream.
+        :param probes: Requests let through while half-open.
+        :param clock: Returns the current time in seconds.
+        """
+        self.name = name
+        self.consecutive_failures = consecutive_failures
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.clock = clock
+        self.logger = get_logger(type(self))
+
+        #: The current state, one of :data:`BREAKER_STATES`.
+        self.state = "closed"
+        #: Requests refused while open.
+        self.short_circuited = 0
+        #: State changes, by the state entered.
+        self.transitions: Dict[str, int] = Counter()
+
+        self._lock = threading.Lock()
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._failures = 0
+        self._consecutive = 0
+        self._changed_at = 0.0
+        self._probes_started = 0
+        self._probes_passed = 0
+        self._generation = 0
+
+    def available(self) -> bool:
+        """
+        Check without locking whether a request would be let through, to choose among upstreams.
+        """
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return self.clock() >= self._changed_at + self.open_seconds
+        return self._probes_started < self.probes
+
+    def acquire(self) -> int:
+        """
+        Let a request through, or refuse it.
+
+        :return: The generation the request was let through in, for :meth:`record` or
+                 :meth:`release`.
+        :raises CircuitOpenError: if the breaker is open, or half-open with all its probes sent.
+        """
+        generation = self._generation
+        if self.state == "closed":
+            return generation
+        with self._lock:
+            now = self.clock()
+            if self.state == "open" and now >= self._changed_at + self.open_seconds:
+                self._change("half_open", now)
+            elif self.state == "half_open" and now >= self._changed_at + self.open_seconds:
+                # The probes were abandoned without an outcome
+                self._changed_at = now
+                self._probes_started = self._probes_passed
+                self._generation += 1
+            if self.state == "half_open" and self._probes_started < self.probes:
+                self._probes_started += 1
+                return self._generation
+            if self.state == "closed":
+                return self._generation
+            self.short_circuited += 1
+            retry_after = max(0.0, self._changed_at + self.open_seconds - now)
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, generation: int, success: bool) -> None:
+        """
+        Record the outcome of a request let through by :meth:`acquire`.
+
+        :param generation: The generation returned by :meth:`acquire`.
+        :param success: Whether the upstream answered, without a server error.
+        """
+        with self._lock:
+            if generation != self._generation:
+                # Let through before the last state change
+                return
+            if self.state == "closed":
+                if len(self._outcomes) == self._outcomes.maxlen:
+                    self._failures -= not self._outcomes[0]
+                self._outcomes.append(success)
+                self._failures += not success
+                self._consecutive = 0 if success else self._consecutive + 1
+                if self._consecutive >= self.consecutive_failures or (
+                    len(self._outcomes) == self._outcomes.maxlen
+                    and self._failures >= self.failure_rate * len(self._outcomes)
+                ):
+                    self._change("open", self.clock())
+            elif self.state == "half_open":
+                if not success:
+                    self._change("open", self.clock())
+                else:
+                    self._probes_passed += 1
+                    if self._probes_passed >= self.probes:
+                        self._change("closed", self.clock())
+
+    def release(self, generation: int) -> None:
+        """
+        Give back a request let through by :meth:`acquire` whose outcome says nothing about the
+        upstream, such as one which was never sent, so that it does not use up a probe.
+
+        :param generation: The generation returned by :meth:`acquire`.
+        """
+        if self.state == "closed":
+            return
+        with self._lock:
+            if (
+                generation == self._generation
+                and self.state == "half_open"
+                and self._probes_started > self._probes_passed
+            ):
+                self._probes_started -= 1
+
+    def _change(self, state: str, now: float) -> None:
+        log = self.logger.warning if state == "open" else self.logger.info
+        log("Circuit breaker for upstream %s changed from %s to %s", self.name, self.state, state)
+        self.state = state
+        self.transitions[state] += 1
+        self._changed_at = now
+        self._outcomes.clear()
+        self._failures = self._consecutive = 0
+        self._probes_started = self._probes_passed = 0
+        self._generation += 1
@@ -0,0 +1,336 @@
+"""
+An in-memory cache of upstream responses to GET and HEAD requests, following the rules for shared
+caches of RFC 9111.
+"""
+
+import email.utils
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Responses which may be stored, among those relayed to the client (errors are not relayed)
+CACHEABLE_STATUSES = frozenset((200, 203, 204, 300, 301, 308))
+
+# Bytes counted for each entry besides its body and headers
+_ENTRY_OVERHEAD = 200
+
+Headers = List[Tuple[str, str]]
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """
+    Parse a ``Cache-Control`` header.
+
+    :param value: The header value, or None if there is none.
+    :return: The directives, with lower-case names, and their arguments or None.
+    """
+    directives: Dict[str, Optional[str]] = {}
+    if value:
+        for part in value.split(","):
+            name, sep, argument = part.strip().partition("=")
+            if name:
+                directives[name.lower()] = argument.strip('"') if sep else None
+    return directives
+
+
+def get_header(headers: Iterable[Tuple[str, str]], name: str) -> Optional[str]:
+    """
+    Get the first value of a header from a list of headers, ignoring the case of the names.
+    """
+    name = name.lower()
+    for header, value in headers:
+        if header.lower() == name:
+            return value
+    return None
+
+
+def _parse_seconds(value: Optional[str]) -> Optional[int]:
+    try:
+        return max(0, int(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _parse_date(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers: Headers, now: float) -> Optional[float]:
+    """
+    Get how long a response stays fresh, from ``Cache-Control`` or ``Expires``.
+
+    :param headers: The response headers.
+    :param now: The current time, for responses without a ``Date`` header.
+    :return: The lifetime in seconds, or None if the response does not give one.
+    """
+    directives = parse_cache_control(get_header(headers, "Cache-Control"))
+    if "no-cache" in directives:
+        return 0.0
+    for name in ("s-maxage", "max-age"):
+        seconds = _parse_seconds(directives.get(name))
+        if seconds is not None:
+            return float(seconds)
+    expires = get_header(headers, "Expires")
+    if expires is not None:
+        # An invalid date means the response has already expired
+        expires_at = _parse_date(expires) or 0.0
+        return max(0.0, expires_at - (_parse_date(get_header(headers, "Date")) or now))
+    return None
+
+
+def is_storable(status: int, headers: Headers) -> bool:
+    """
+    Check whether a response may be stored: it must have a cacheable status, allow shared caches,
+    not vary by request headers, and have a freshness lifetime or a validator for revalidation.
+    """
+    if status not in CACHEABLE_STATUSES:
+        return False
+    directives = parse_cache_control(get_header(headers, "Cache-Control"))
+    if "no-store" in directives or "private" in directives:
+        return False
+    if get_header(headers, "Vary"):
+        return False
+    if freshness_lifetime(headers, time.time()):
+        return True
+    return (
+        get_header(headers, "ETag") is not None or get_header(headers, "Last-Modified") is not None
+    )
+
+
+class CachedResponse(NamedTuple):
+    """
+    A stored response.
+    """
+
+    #: The response status.
+    status: int
+    #: The response headers, without hop-by-hop headers and ``Age``.
+    headers: Headers
+    #: The complete body.
+    body: bytes
+    #: When the response was received, as a Unix timestamp.
+    stored_at: float
+    #: Until when the response is fresh, as a Unix timestamp.
+    expires_at: float
+    #: The age of the response when it was received, from the ``Age`` header.
+    initial_age: float
+    #: The bytes used by the entry, roughly.
+    size: int
+
+    @classmethod
+    def create(cls, status: int, headers: Headers, body: bytes, now: float) -> "CachedResponse":
+        """
+        Create an entry for a response which :func:`is_storable`.
+
+        :param status: The response status.
+        :param headers: The response headers, without hop-by-hop headers.
+        :param body: The complete body.
+        :param now: The current time.
+        :return: The entry.
+        """
+        age = float(_parse_seconds(get_header(headers, "Age")) or 0)
+        headers = [(name, value) for name, value in headers if name.lower() != "age"]
+        lifetime = freshness_lifetime(headers, now) or 0.0
+        size = len(body) + sum(len(name) + len(value) for name, value in headers) + _ENTRY_OVERHEAD
+        return cls(status, headers, body, now, now + lifetime - age, age, size)
+
+    def is_fresh(self, now: float) -> bool:
+        """
+        Whether the entry can be served without revalidation.
+        """
+        return now < self.expires_at
+
+    def age(self, now: float) -> int:
+        """
+        The value of the ``Age`` header when serving the entry.
+        """
+        return int(self.initial_age + max(0.0, now - self.stored_at))
+
+    def validators(self) -> Headers:
+        """
+        The headers which make a request conditional on the entry having changed.
+        """
+        validators = []
+        etag = get_header(self.headers, "ETag")
+        if etag is not None:
+            validators.append(("If-None-Match", etag))
+        last_modified = get_header(self.headers, "Last-Modified")
+        if last_modified is not None:
+            validators.append(("If-Modified-Since", last_modified))
+        return validators
+
+    def revalidate(self, headers: Headers, now: float) -> "CachedResponse":
+        """
+        Refresh the entry with the headers of a ``304 Not Modified`` response.
+
+        :param headers: The headers of the ``304`` response, without hop-by-hop headers.
+        :param now: The current time.
+        :return: The refreshed entry.
+        """
+        # The body is unchanged, and so is its framing
+        updated = {
+            name.lower(): (name, value)
+            for name, value in headers
+            if name.lower() not in ("content-length", "transfer-encoding")
+        }
+        merged = [updated.pop(name.lower(), (name, value)) for name, value in self.headers]
+        merged.extend(updated.values())
+        return self.create(self.status, merged, self.body, now)
+
+    def is_not_modified(self, request_headers) -> bool:
+        """
+        Whether a conditional request is satisfied by the entry, so that ``304 Not Modified`` can
+        be sent instead of the entry.
+
+        :param request_headers: The client's request headers.
+        """
+        if_none_match = request_headers.get("If-None-Match")
+        if if_none_match is not None:
+            etag = get_header(self.headers, "ETag")
+            if etag is None:
+                return False
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or etag.removeprefix("W/") in tags
+        since = _parse_date(request_headers.get("If-Modified-Since"))
+        last_modified = _parse_date(get_header(self.headers, "Last-Modified"))
+        return since is not None and last_modified is not None and last_modified <= since
+
+
+class ResponseCache:
+    """
+    A size-bounded LRU cache of responses, shared by all requests of a server.
+
+    Concurrent misses for the same key are coalesced: the first request to :meth:`claim` a key
+    fetches it, while the others wait for it to be released and then look in the cache again.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        max_entry_bytes: int = 1024 * 1024,
+        coalesce_timeout: float = 10.0,
+        event_factory: Callable[[], object] = threading.Event,
+    ):
+        """
+        :param max_bytes: The maximum total size of the entries.
+        :param max_entry_bytes: The maximum size of a response body to store.
+        :param coalesce_timeout: Seconds to wait for another request's fetch of the same key.
+        :param event_factory: Creates the events waited on for coalesced fetches, such as
+                              :class:`threading.Event` or :class:`asyncio.Event`.
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.coalesce_timeout = coalesce_timeout
+        self.event_factory = event_factory
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._fetching: Dict[str, object] = {}
+        self._bytes = 0
+        self._results = dict.fromkeys(("hit", "coalesced", "revalidated", "miss"), 0)
+        self._evictions = 0
+
+    @classmethod
+    def from_environment(
+        cls, event_factory: Callable[[], object] = threading.Event
+    ) -> Optional["ResponseCache"]:
+        """
+        Create a cache configured from the ``RESPONSE_CACHE_*`` environment variables.
+
+        :param event_factory: See :meth:`__init__`.
+        :return: The cache, or None if ``RESPONSE_CACHE_SIZE`` is not set above 0.
+        """
+        max_bytes = int(os.environ.get("RESPONSE_CACHE_SIZE", 0))
+        if max_bytes <= 0:
+            return None
+        return cls(
+            max_bytes,
+            max_entry_bytes=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRY_SIZE", 1024 * 1024)),
+            coalesce_timeout=float(os.environ.get("RESPONSE_CACHE_COALESCE_TIMEOUT", 10.0)),
+            event_factory=event_factory,
+        )
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """
+        Look up an entry, fresh or not, and mark it as recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CachedResponse) -> None:
+        """
+        Store an entry, evicting the least recently used ones to make room.
+        """
+        if len(entry.body) > self.max_entry_bytes or entry.size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            while self._entries and self._bytes + entry.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self._evictions += 1
+            self._entries[key] = entry
+            self._bytes += entry.size
+
+    def remove(self, key: str) -> None:
+        """
+        Remove an entry, if present.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def claim(self, key: str):
+        """
+        Claim the fetch of a key from the upstream.
+
+        :return: None if the caller fetches the key, and must :meth:`release` it afterwards, or
+                 the event set once the request fetching it is done.
+        """
+        with self._lock:
+            event = self._fetching.get(key)
+            if event is None:
+                self._fetching[key] = self.event_factory()
+            return event
+
+    def release(self, key: str) -> None:
+        """
+        Release a claimed key, waking the requests waiting for it.
+        """
+        with self._lock:
+            event = self._fetching.pop(key)
+        event.set()
+
+    def count(self, result: str) -> None:
+        """
+        Count a lookup: ``hit``, ``coalesced`` (a hit after waiting for another request's fetch),
+        ``revalidated`` (a stale entry confirmed by the upstream) or ``miss``.
+        """
+        with self._lock:
+            self._results[result] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the number of entries, their size in bytes, the number of evictions, and the number
+        of lookups with each result.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "evictions": self._evictions,
+                **self._results,
+            }
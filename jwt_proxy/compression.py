@@ -0,0 +1,128 @@
+"""
+Compression of response bodies with an encoding accepted by the client.
+"""
+
+import time
+import zlib
+from typing import Iterable, Optional, Tuple
+
+# zlib window bits for each supported content coding, in order of preference. HTTP's ``deflate``
+# is the zlib format (RFC 9110 section 8.4.1.2), not raw deflate.
+ENCODINGS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+#: The content types compressed by default, matched against the type without parameters.
+#: A ``/*`` suffix matches all subtypes. Event streams are left out, since compressed output is
+#: held back until enough of the body has arrived.
+DEFAULT_COMPRESSIBLE_TYPES = (
+    "text/plain",
+    "text/html",
+    "text/css",
+    "text/csv",
+    "text/xml",
+    "text/javascript",
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Choose the content coding for a response from the client's ``Accept-Encoding`` header.
+
+    :param accept_encoding: The header value, or None if the client did not send it.
+    :return: The supported coding with the highest quality, preferring the order of
+             :data:`ENCODINGS` among equals, or None if the client accepts none of them.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        quality = 1.0
+        name, sep, value = params.strip().partition("=")
+        if sep and name.strip().lower() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def is_compressible_type(content_type: Optional[str], types: Iterable[str]) -> bool:
+    """
+    Check whether a content type is in an allow-list such as :data:`DEFAULT_COMPRESSIBLE_TYPES`.
+
+    :param content_type: The ``Content-Type`` header, or None if there is none.
+    :param types: The allowed types.
+    """
+    if not content_type:
+        return False
+    media_type = content_type.partition(";")[0].strip().lower()
+    main_type = media_type.partition("/")[0]
+    return any(
+        media_type == allowed or (allowed.endswith("/*") and allowed[:-2] == main_type)
+        for allowed in types
+    )
+
+
+def parse_compressible_types(value: Optional[str]) -> Tuple[str, ...]:
+    """
+    Parse a comma-separated list of content types, or return the defaults if it is not set.
+    """
+    if value is None:
+        return DEFAULT_COMPRESSIBLE_TYPES
+    return tuple(part.strip().lower() for part in value.split(",") if part.strip())
+
+
+class Compressor:
+    """
+    Compresses one response body, piece by piece, keeping count of its bytes and CPU time.
+    """
+
+    __slots__ = ("encoding", "bytes_in", "bytes_out", "cpu_seconds", "_zlib")
+
+    def __init__(self, encoding: str, level: int = 6):
+        """
+        :param encoding: One of :data:`ENCODINGS`.
+        :param level: The zlib compression level, from 1 (fastest) to 9 (smallest).
+        """
+        self.encoding = encoding
+        #: The bytes given to the compressor so far.
+        self.bytes_in = 0
+        #: The compressed bytes returned so far.
+        self.bytes_out = 0
+        #: The CPU time spent compressing, in seconds.
+        self.cpu_seconds = 0.0
+        self._zlib = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+
+    def compress(self, data: bytes) -> bytes:
+        """
+        Compress a piece of a streamed body. Compressed output is only returned once zlib has
+        gathered enough input, so it may be empty.
+        """
+        return self._run(data, False)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        """
+        Compress the last piece of the body, or a complete body, and end the stream.
+        """
+        return self._run(data, True)
+
+    def _run(self, data: bytes, finish: bool) -> bytes:
+        start = time.thread_time()
+        output = self._zlib.compress(data)
+        if finish:
+            output += self._zlib.flush()
+        self.cpu_seconds += time.thread_time() - start
+        self.bytes_in += len(data)
+        self.bytes_out += len(output)
+        return output
@@ -0,0 +1,211 @@
+"""
+An adaptive limit on the requests in flight to the upstreams, so that a struggling upstream is
+not pushed further into queueing by the proxy's clients.
+"""
+
+import asyncio
+import math
+import threading
+from collections import deque
+from typing import Deque, Optional
+
+
+class ConcurrencyLimitExceeded(Exception):
+    """
+    Raised when a request could not be sent because the concurrency limit was reached.
+    """
+
+    #: The message for the client.
+    reason = "upstream concurrency limit reached"
+
+    def __init__(self, limit: int, retry_after: float = 1.0):
+        """
+        :param limit: The limit at the time.
+        :param retry_after: Seconds after which the client may try again.
+        """
+        super().__init__(f"Upstream concurrency limit of {limit} requests reached")
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class AdaptiveLimiter:
+    """
+    Limits the requests in flight, adjusting the limit from the round-trip times of completed
+    requests with a gradient algorithm:
+
+    * The no-load RTT is the lowest RTT observed. Every ``probe_interval`` samples, it is measured
+      again, so that it follows an upstream which became slower for good: the limit drops to its
+      square root, and once the requests admitted before have completed, the lowest RTT is the
+      new no-load RTT.
+    * RTTs are averaged over windows of at least ``min_window`` samples, and as many as the limit.
+      After each window, the limit moves toward ``limit * gradient + sqrt(limit)``, where the
+      gradient is ``tolerance * no-load RTT / average RTT``, capped to 0.5..1. While the RTT stays
+      within ``tolerance`` times the no-load RTT, the limit grows by the square root term; beyond
+      that, queueing in the upstream shrinks it, smoothed by ``smoothing``.
+    * Failed requests multiply the limit by ``backoff`` right away.
+    * The limit only grows if at least half of it was used during the window, so that it stays
+      close to the concurrency actually reached.
+
+    Requests are admitted with :meth:`acquire` on threads or :meth:`acquire_async` on an event
+    loop, and must be followed by :meth:`release`.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 20,
+        min_limit: int = 1,
+        max_limit: int = 200,
+        tolerance: float = 2.0,
+        smoothing: float = 0.2,
+        backoff: float = 0.9,
+        min_window: int = 10,
+        probe_interval: int = 1000,
+    ):
+        """
+        :param initial_limit: The limit before any request completed.
+        :param min_limit: The lowest limit.
+        :param max_limit: The highest limit.
+        :param tolerance: The ratio of RTT to no-load RTT from which the limit decreases.
+        :param smoothing: The weight of each window in a decreasing limit, from 0 to 1.
+        :param backoff: The factor applied to the limit when a request fails.
+        :param min_window: The fewest samples over which RTTs are averaged.
+        :param probe_interval: Samples after which the no-load RTT is measured again.
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.min_window = min_window
+        self.probe_interval = probe_interval
+
+        #: The current limit, fractional so that it can move by less than one request.
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+        #: The requests in flight.
+        self.in_flight = 0
+        #: Requests which could not be sent within their wait.
+        self.rejected = 0
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._async_waiters: Deque[asyncio.Future] = deque()
+        self._rtt_noload: Optional[float] = None
+        self._probe_skip = 0
+        self._samples = 0
+        self._window_total = 0.0
+        self._window_samples = 0
+        self._window_peak = 0
+
+    def acquire(self, timeout: float) -> bool:
+        """
+        Admit a request, waiting up to ``timeout`` seconds for another one to complete if the
+        limit is reached.
+
+        :return: Whether the request was admitted; if not, it is counted as rejected.
+        """
+        with self._available:
+            if self._available.wait_for(self._has_room, timeout):
+                self._admit()
+                return True
+            self.rejected += 1
+            return False
+
+    def try_acquire(self) -> bool:
+        """
+        Admit an optional request, such as a hedged copy, only if the limit is not reached,
+        without waiting and without counting a refusal as rejected.
+
+        :return: Whether the request was admitted.
+        """
+        with self._lock:
+            if self._has_room():
+                self._admit()
+                return True
+            return False
+
+    async def acquire_async(self, timeout: float) -> bool:
+        """
+        Like :meth:`acquire`, for requests on the event loop, which all run on one thread.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._lock:
+                if self._has_room():
+                    self._admit()
+                    return True
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self.rejected += 1
+                    return False
+                waiter = loop.create_future()
+                self._async_waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, rtt: Optional[float] = None, dropped: bool = False) -> None:
+        """
+        Complete an admitted request, and adjust the limit.
+
+        :param rtt: The request's round-trip time in seconds, or None if it did not complete.
+        :param dropped: Whether the request failed, in a way which suggests the upstream is
+                        overloaded, such as a timeout or a server error.
+        """
+        with self._available:
+            if dropped:
+                self._set_limit(self.limit * self.backoff)
+            elif rtt is not None:
+                self._update(rtt)
+            self.in_flight -= 1
+            self._available.notify()
+            while self._async_waiters:
+                waiter = self._async_waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+
+    def _has_room(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def _admit(self) -> None:
+        self.in_flight += 1
+        self._window_peak = max(self._window_peak, self.in_flight)
+
+    def _update(self, rtt: float) -> None:
+        self._samples += 1
+        if self._samples % self.probe_interval == 0:
+            self._start_probe()
+            return
+        if self._probe_skip > 0:
+            self._probe_skip -= 1
+            return
+        if self._rtt_noload is None or rtt < self._rtt_noload:
+            self._rtt_noload = rtt
+
+        self._window_total += rtt
+        self._window_samples += 1
+        if self._window_samples < max(self.min_window, int(self.limit)):
+            return
+        average = self._window_total / self._window_samples
+        peak = self._window_peak
+        self._window_total, self._window_samples, self._window_peak = 0.0, 0, self.in_flight
+
+        gradient = max(0.5, min(1.0, self.tolerance * self._rtt_noload / max(average, 1e-9)))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        if target > self.limit:
+            if peak >= self.limit / 2:
+                self._set_limit(target)
+        else:
+            self._set_limit(self.limit * (1 - self.smoothing) + target * self.smoothing)
+
+    def _start_probe(self) -> None:
+        self._rtt_noload = None
+        self._set_limit(math.sqrt(self.limit))
+        # The other requests in flight were admitted at the previous concurrency
+        self._probe_skip = self.in_flight - 1
+        self._window_total, self._window_samples, self._window_peak = 0.0, 0, 0
+
+    def _set_limit(self, limit: float) -> None:
+        self.limit = max(float(self.min_limit), min(float(self.max_limit), limit))
@@ -0,0 +1,400 @@
+"""
+The proxy's reloadable configuration, read from the environment and an optional configuration file.
+"""
+
+import functools
+import math
+import os
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+from jwt_proxy.balancer import BALANCE_POLICIES, UpstreamBalancer
+from jwt_proxy.breaker import CircuitBreaker
+from jwt_proxy.compression import DEFAULT_COMPRESSIBLE_TYPES, parse_compressible_types
+from jwt_proxy.concurrency import AdaptiveLimiter
+from jwt_proxy.keys import SigningKey, signing_key_from_settings
+from jwt_proxy.ratelimit import RateLimiter
+
+
+def read_config_file(path: str) -> Dict[str, str]:
+    """
+    Read a configuration file of ``NAME=VALUE`` lines, using the names of the environment
+    variables. Empty lines and lines starting with ``#`` are ignored.
+
+    :param path: The path of the file.
+    :return: The settings.
+    :raises ValueError: if a line is not of the form ``NAME=VALUE``.
+    """
+    settings = {}
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            name, sep, value = line.partition("=")
+            if not sep or not name.strip():
+                raise ValueError(f"{path}:{number}: expected NAME=VALUE")
+            settings[name.strip()] = value.strip()
+    return settings
+
+
+def read_settings(environ: Optional[Mapping[str, str]] = None) -> Dict[str, str]:
+    """
+    Read the settings: the environment, overridden by the file named by ``PROXY_CONFIG_FILE``.
+
+    :param environ: The environment, by default :data:`os.environ`.
+    :return: The settings.
+    """
+    settings = dict(os.environ if environ is None else environ)
+    config_file = settings.get("PROXY_CONFIG_FILE")
+    if config_file:
+        settings.update(read_config_file(config_file))
+    return settings
+
+
+def parse_flag(value: Optional[str]) -> bool:
+    """
+    Parse a boolean setting, which is true if it is ``1``, ``true``, ``yes`` or ``on``, ignoring case.
+    """
+    return value is not None and value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class ProxyConfig(NamedTuple):
+    """
+    The settings used while handling requests, parsed once. A server holds the current
+    configuration, which is replaced as a whole when it is reloaded, so a request reads it once
+    and uses the same configuration throughout, without locking.
+    """
+
+    #: The scheme and network location of each upstream, such as ``http://echo:9100``.
+    upstreams: Tuple[str, ...]
+    #: The signing key, or None if the keys are loaded from ``keys_file``.
+    signing_key: Optional[SigningKey]
+    #: The key file given by ``JWT_KEYS_FILE``, if any.
+    keys_file: Optional[str]
+    #: Whether to send the ``Server-Timing`` header.
+    server_timing: bool = False
+    #: How requests are spread over the upstreams, one of
+    #: :data:`jwt_proxy.balancer.BALANCE_POLICIES`.
+    balance_policy: str = "round_robin"
+    #: The path requested from each upstream to check its health, or None to not check.
+    health_check_path: Optional[str] = None
+    #: Seconds between health checks.
+    health_check_interval: float = 5.0
+    #: Seconds to wait for a health check response.
+    health_check_timeout: float = 2.0
+    #: Consecutive failed requests which open the circuit breaker of an upstream, or 0 to not use
+    #: circuit breakers.
+    breaker_failures: int = 5
+    #: The fraction of failed requests in the window which opens a circuit breaker.
+    breaker_failure_rate: float = 0.5
+    #: The number of recent requests over which the failure rate is computed.
+    breaker_window: int = 20
+    #: Seconds an open circuit breaker refuses requests before probing the upstream.
+    breaker_open_seconds: float = 10.0
+    #: Probe requests sent while a circuit breaker is half-open.
+    breaker_probes: int = 1
+    #: Whether the requests in flight to the upstreams are limited, see
+    #: :class:`jwt_proxy.concurrency.AdaptiveLimiter`.
+    adaptive_concurrency: bool = False
+    #: The concurrency limit before any upstream request completed.
+    concurrency_initial_limit: int = 20
+    #: The highest concurrency limit.
+    concurrency_max_limit: int = 200
+    #: The ratio of upstream latency to its no-load latency from which the limit decreases.
+    concurrency_tolerance: float = 2.0
+    #: Seconds a request over the limit waits for another one to complete before it is refused.
+    concurrency_queue_timeout: float = 0.05
+    #: Requests per second allowed for each client, or 0 to not limit them, see
+    #: :class:`jwt_proxy.ratelimit.RateLimiter`.
+    rate_limit: float = 0.0
+    #: The requests a client may send at once after being idle.
+    rate_limit_burst: int = 1
+    #: The request header identifying clients, or None to identify them by IP address.
+    rate_limit_header: Optional[str] = None
+    #: The number of clients whose request rate is tracked.
+    rate_limit_clients: int = 100000
+    #: The number of times a failed idempotent request is sent again, see
+    #: :func:`jwt_proxy.retry.is_retryable`.
+    retries: int = 1
+    #: The maximum delay before the first retry, in seconds, doubled for each further one.
+    retry_backoff: float = 0.05
+    #: Whether a late response to an idempotent request is raced by a copy of the request.
+    hedging: bool = False
+    #: The percentile of recent upstream latencies after which a request is hedged.
+    hedge_percentile: float = 95.0
+    #: The minimum delay before a request is hedged, in seconds.
+    hedge_min_delay: float = 0.005
+    #: Whether large bodies are relayed between sockets without copying them into Python objects.
+    zero_copy: bool = True
+    #: Whether responses are compressed for clients which accept it.
+    compression: bool = False
+    #: The zlib compression level.
+    compression_level: int = 6
+    #: The smallest response body compressed, if its length is known.
+    compression_min_size: int = 1024
+    #: The content types compressed, see :func:`jwt_proxy.compression.is_compressible_type`.
+    compression_types: Tuple[str, ...] = DEFAULT_COMPRESSIBLE_TYPES
+
+    @classmethod
+    def from_settings(cls, settings: Mapping[str, str]) -> "ProxyConfig":
+        """
+        Parse the configuration.
+
+        :param settings: The settings from :func:`read_settings`.
+        :return: The configuration.
+        :raises ValueError: if a setting is missing or invalid.
+        """
+        servers = [server.strip() for server in settings.get("UPSTREAM_SERVER", "").split(",")]
+        if not any(servers):
+            raise ValueError(
+                "Could not get upstream server address from environment variable UPSTREAM_SERVER"
+            )
+        upstreams = []
+        for server in filter(None, servers):
+            if "://" not in server:
+                server = "http://" + server
+            scheme, netloc, _, _, _ = urlsplit(server)
+            if scheme not in ("http", "https") or not netloc:
+                raise ValueError(f"Invalid upstream server {server!r}")
+            upstreams.append(f"{scheme}://{netloc}")
+
+        policy = settings.get("UPSTREAM_POLICY", "round_robin")
+        if policy not in BALANCE_POLICIES:
+            raise ValueError(
+                f"Invalid UPSTREAM_POLICY {policy!r}, expected one of {', '.join(BALANCE_POLICIES)}"
+            )
+        health_check_path = settings.get("UPSTREAM_HEALTH_CHECK_PATH") or None
+        if health_check_path is not None and not health_check_path.startswith("/"):
+            raise ValueError(f"Invalid UPSTREAM_HEALTH_CHECK_PATH {health_check_path!r}")
+
+        compression_level = int(settings.get("PROXY_COMPRESSION_LEVEL", 6))
+        if not 1 <= compression_level <= 9:
+            raise ValueError(
+                f"Invalid PROXY_COMPRESSION_LEVEL {compression_level}, expected 1 to 9"
+            )
+
+        breaker_failures = int(settings.get("UPSTREAM_BREAKER_FAILURES", 5))
+        breaker_failure_rate = float(settings.get("UPSTREAM_BREAKER_FAILURE_RATE", 0.5))
+        breaker_window = int(settings.get("UPSTREAM_BREAKER_WINDOW", 20))
+        breaker_probes = int(settings.get("UPSTREAM_BREAKER_PROBES", 1))
+        if breaker_failures < 0:
+            raise ValueError(f"Invalid UPSTREAM_BREAKER_FAILURES {breaker_failures}")
+        if not 0 < breaker_failure_rate <= 1:
+            raise ValueError(f"Invalid UPSTREAM_BREAKER_FAILURE_RATE {breaker_failure_rate}")
+        if breaker_window < 1 or breaker_probes < 1:
+            raise ValueError("UPSTREAM_BREAKER_WINDOW and UPSTREAM_BREAKER_PROBES must be positive")
+
+        concurrency_initial_limit = int(settings.get("UPSTREAM_CONCURRENCY_INITIAL_LIMIT", 20))
+        concurrency_max_limit = int(settings.get("UPSTREAM_CONCURRENCY_MAX_LIMIT", 200))
+        if not 1 <= concurrency_initial_limit <= concurrency_max_limit:
+            raise ValueError(
+                f"Invalid UPSTREAM_CONCURRENCY_INITIAL_LIMIT {concurrency_initial_limit}, expected "
+                f"1 to UPSTREAM_CONCURRENCY_MAX_LIMIT ({concurrency_max_limit})"
+            )
+        concurrency_tolerance = float(settings.get("UPSTREAM_CONCURRENCY_TOLERANCE", 2.0))
+        if concurrency_tolerance < 1:
+            raise ValueError(f"Invalid UPSTREAM_CONCURRENCY_TOLERANCE {concurrency_tolerance}")
+
+        rate_limit = float(settings.get("PROXY_RATE_LIMIT", 0))
+        if rate_limit < 0:
+            raise ValueError(f"Invalid PROXY_RATE_LIMIT {rate_limit}")
+        rate_limit_burst = int(
+            settings.get("PROXY_RATE_LIMIT_BURST", max(1, math.ceil(rate_limit)))
+        )
+        rate_limit_clients = int(settings.get("PROXY_RATE_LIMIT_CLIENTS", 100000))
+        if rate_limit_burst < 1 or rate_limit_clients < 1:
+            raise ValueError("PROXY_RATE_LIMIT_BURST and PROXY_RATE_LIMIT_CLIENTS must be positive")
+
+        retries = int(settings.get("UPSTREAM_RETRIES", 1))
+        if retries < 0:
+            raise ValueError(f"Invalid UPSTREAM_RETRIES {retries}")
+        hedge_percentile = float(settings.get("UPSTREAM_HEDGE_PERCENTILE", 95.0))
+        if not 0 < hedge_percentile < 100:
+            raise ValueError(f"Invalid UPSTREAM_HEDGE_PERCENTILE {hedge_percentile}")
+
+        keys_file = settings.get("JWT_KEYS_FILE") or None
+        return cls(
+            upstreams=tuple(upstreams),
+            signing_key=None if keys_file else signing_key_from_settings(settings),
+            keys_file=keys_file,
+            server_timing=parse_flag(settings.get("PROXY_SERVER_TIMING")),
+            balance_policy=policy,
+            health_check_path=health_check_path,
+            health_check_interval=float(settings.get("UPSTREAM_HEALTH_CHECK_INTERVAL", 5.0)),
+            health_check_timeout=float(settings.get("UPSTREAM_HEALTH_CHECK_TIMEOUT", 2.0)),
+            breaker_failures=breaker_failures,
+            breaker_failure_rate=breaker_failure_rate,
+            breaker_window=breaker_window,
+            breaker_open_seconds=float(settings.get("UPSTREAM_BREAKER_OPEN_SECONDS", 10.0)),
+            breaker_probes=breaker_probes,
+            adaptive_concurrency=parse_flag(settings.get("UPSTREAM_ADAPTIVE_CONCURRENCY")),
+            concurrency_initial_limit=concurrency_initial_limit,
+            concurrency_max_limit=concurrency_max_limit,
+            concurrency_tolerance=concurrency_tolerance,
+            concurrency_queue_timeout=float(
+                settings.get("UPSTREAM_CONCURRENCY_QUEUE_TIMEOUT", 0.05)
+            ),
+            rate_limit=rate_limit,
+            rate_limit_burst=rate_limit_burst,
+            rate_limit_header=settings.get("PROXY_RATE_LIMIT_HEADER") or None,
+            rate_limit_clients=rate_limit_clients,
+            retries=retries,
+            retry_backoff=float(settings.get("UPSTREAM_RETRY_BACKOFF", 0.05)),
+            hedging=parse_flag(settings.get("UPSTREAM_HEDGING")),
+            hedge_percentile=hedge_percentile,
+            hedge_min_delay=float(settings.get("UPSTREAM_HEDGE_MIN_DELAY", 0.005)),
+            zero_copy=parse_flag(settings.get("PROXY_ZERO_COPY", "1")),
+            compression=parse_flag(settings.get("PROXY_COMPRESSION")),
+            compression_level=compression_level,
+            compression_min_size=int(settings.get("PROXY_COMPRESSION_MIN_SIZE", 1024)),
+            compression_types=parse_compressible_types(settings.get("PROXY_COMPRESSION_TYPES")),
+        )
+
+    @classmethod
+    def from_environment(cls) -> "ProxyConfig":
+        """
+        Parse the configuration from the environment and ``PROXY_CONFIG_FILE``.
+        """
+        return cls.from_settings(read_settings())
+
+    def create_balancer(self) -> UpstreamBalancer:
+        """
+        Create a balancer for the upstreams, with their circuit breakers, and start its health
+        checks if configured.
+        """
+        circuit_breaker = None
+        if self.breaker_failures > 0:
+            circuit_breaker = functools.partial(
+                CircuitBreaker,
+                consecutive_failures=self.breaker_failures,
+                failure_rate=self.breaker_failure_rate,
+                window=self.breaker_window,
+                open_seconds=self.breaker_open_seconds,
+                probes=self.breaker_probes,
+            )
+        balancer = UpstreamBalancer(
+            self.upstreams, self.balance_policy, circuit_breaker=circuit_breaker
+        )
+        if self.health_check_path is not None:
+            balancer.start_health_checks(
+                self.health_check_path, self.health_check_interval, self.health_check_timeout
+            )
+        return balancer
+
+    def create_concurrency_limiter(self) -> Optional[AdaptiveLimiter]:
+        """
+        Create the limiter of requests in flight to the upstreams, or return None if the
+        concurrency is not limited.
+        """
+        if not self.adaptive_concurrency:
+            return None
+        return AdaptiveLimiter(
+            self.concurrency_initial_limit,
+            max_limit=self.concurrency_max_limit,
+            tolerance=self.concurrency_tolerance,
+        )
+
+    def same_concurrency_limit(self, other: "ProxyConfig") -> bool:
+        """
+        Check whether another configuration limits the upstream concurrency in the same way, so
+        that a limiter created for one, with the limit it has learned, can be kept for the other.
+        """
+        return (
+            self.adaptive_concurrency,
+            self.concurrency_initial_limit,
+            self.concurrency_max_limit,
+            self.concurrency_tolerance,
+        ) == (
+            other.adaptive_concurrency,
+            other.concurrency_initial_limit,
+            other.concurrency_max_limit,
+            other.concurrency_tolerance,
+        )
+
+    def create_rate_limiter(self) -> Optional[RateLimiter]:
+        """
+        Create the limiter of each client's request rate, or return None if it is not limited.
+        """
+        if self.rate_limit == 0:
+            return None
+        return RateLimiter(self.rate_limit, self.rate_limit_burst, self.rate_limit_clients)
+
+    def same_rate_limit(self, other: "ProxyConfig") -> bool:
+        """
+        Check whether another configuration limits the request rate of clients in the same way,
+        so that the buckets of a limiter created for one can be kept for the other.
+        """
+        return (self.rate_limit, self.rate_limit_burst, self.rate_limit_clients) == (
+            other.rate_limit,
+            other.rate_limit_burst,
+            other.rate_limit_clients,
+        )
+
+    def same_balancing(self, other: "ProxyConfig") -> bool:
+        """
+        Check whether another configuration balances requests in the same way, so that a balancer
+        created for one can be kept for the other.
+        """
+        return self._balancing() == other._balancing()
+
+    def _balancing(self) -> tuple:
+        return (
+            self.upstreams,
+            self.balance_policy,
+            self.health_check_path,
+            self.health_check_interval,
+            self.health_check_timeout,
+            self.breaker_failures,
+            self.breaker_failure_rate,
+            self.breaker_window,
+            self.breaker_open_seconds,
+            self.breaker_probes,
+        )
+
+
+class ProxyState(NamedTuple):
+    """
+    A configuration together with the balancer and limiters created from it. A server holds the
+    current state, which a reload replaces with a single assignment, so a request which reads it
+    once never sees a configuration mixed with the balancer or limiters of another one.
+    """
+
+    #: The configuration.
+    config: ProxyConfig
+    #: The balancer of the upstreams.
+    balancer: UpstreamBalancer
+    #: The limiter of requests in flight to the upstreams, or None.
+    concurrency_limiter: Optional[AdaptiveLimiter]
+    #: The limiter of each client's request rate, or None.
+    rate_limiter: Optional[RateLimiter]
+
+    @classmethod
+    def create(cls, config: ProxyConfig) -> "ProxyState":
+        """
+        Create the balancer and limiters for a configuration.
+        """
+        return cls(
+            config,
+            config.create_balancer(),
+            config.create_concurrency_limiter(),
+            config.create_rate_limiter(),
+        )
+
+    def reconfigure(self, config: ProxyConfig) -> "ProxyState":
+        """
+        Get the state for a new configuration, keeping the balancer and limiters whose settings
+        did not change, along with the health, breaker states and limits they have learned.
+        """
+        return ProxyState(
+            config,
+            self.balancer if config.same_balancing(self.config) else config.create_balancer(),
+            (
+                self.concurrency_limiter
+                if config.same_concurrency_limit(self.config)
+                else config.create_concurrency_limiter()
+            ),
+            self.rate_limiter
+            if config.same_rate_limit(self.config)
+            else config.create_rate_limiter(),
+        )
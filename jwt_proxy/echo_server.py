@@ -1,48 +1,275 @@
 """
 Implements an HTTP server which logs all incoming requests and echoes information back to the client.
+
+The responses can be shaped like those of a real backend for load and resilience tests, see
+:class:`jwt_proxy.simulation.ResponseSimulation`.
 """
+import os
+import random
+import time
+from email.message import Message
 from http import HTTPStatus
+from typing import Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from jwt_proxy.config import parse_flag
+from jwt_proxy.http_base import (
+    LAST_CHUNK,
+    BodyFramingError,
+    ProxyBaseHTTPRequestHandler,
+    encode_chunk,
+)
+from jwt_proxy.jwt import InvalidTokenError, JWTVerifier
+from jwt_proxy.keys import load_key_set, signing_key_from_settings
+from jwt_proxy.logger import suppressed_logger
+from jwt_proxy.simulation import DROP, ResponseSimulation, request_params
 
-from jwt_proxy.http_base import ProxyBaseHTTPRequestHandler
+_INVALID_TOKENS_METRIC_KEY = "jwt_invalid_tokens_total"
+_SIMULATED_FAILURES_METRIC_KEY = "echo_simulated_failures_total"
 
 
-class EchoRequestHandler(ProxyBaseHTTPRequestHandler):
+def create_token_verifier(settings: Mapping[str, str]) -> Optional[JWTVerifier]:
     """
-    A request handler which echoes information back to the client.
+    Create the verifier of the tokens received by the echo server, if ``ECHO_VERIFY_JWT`` is set.
+    Tokens may be signed with any key of ``JWT_KEYS_FILE``, or else with the key configured by
+    ``JWT_SIGNING_SECRET``, ``JWT_SIGNING_ALGORITHM`` and ``JWT_KEY_ID``.
+
+    :param settings: The settings, such as :data:`os.environ`.
+    :return: The verifier, or None if tokens are not verified.
+    :raises ValueError: if the keys are missing or invalid.
+    """
+    if not parse_flag(settings.get("ECHO_VERIFY_JWT")):
+        return None
+    keys_file = settings.get("JWT_KEYS_FILE")
+    if keys_file:
+        keys = list(load_key_set(keys_file).keys.values())
+    else:
+        keys = [signing_key_from_settings(settings)]
+    max_age = float(settings.get("ECHO_JWT_MAX_AGE", 60))
+    return JWTVerifier(
+        keys,
+        max_age=max_age or None,
+        leeway=float(settings.get("ECHO_JWT_CLOCK_SKEW", 30)),
+        cache_size=int(settings.get("ECHO_JWT_CACHE_SIZE", 10000)),
+    )
+
+
+def _encode_chunks(pieces: Iterable[bytes]) -> Iterator[bytes]:
+    for piece in pieces:
+        if piece:
+            yield encode_chunk(piece)
+    yield LAST_CHUNK
+
+
+class EchoRequestMixin:
+    """
+    Request processing shared by the echo server's request handlers for all server engines.
+    Classes using this mixin must provide a ``detail_logger`` and the server as ``_server``.
     """
 
     server_version = "EchoServer"
 
-    def do_POST(self):
-        self.record_request()
-        self.logger.info("Got POST request for %s", self.path)
+    #: The request header carrying the token to verify.
+    JWT_TOKEN_HEADER = "x-my-jwt"
+
+    @classmethod
+    def init_server(cls, server) -> None:
+        """
+        Attach the response simulation defaults and the token verifier to the server, for both
+        engines.
+        """
+        server.simulation = ResponseSimulation.from_environment()
+        server.metrics.counter(
+            _SIMULATED_FAILURES_METRIC_KEY,
+            "Responses failed on purpose, by status, or drop for closed connections.",
+            ("status",),
+        )
+
+        server.token_verifier = create_token_verifier(os.environ)
+        if server.token_verifier is None:
+            return
+
+        def verifier_stats(*names):
+            return lambda: [((name,), server.token_verifier.stats()[name]) for name in names]
+
+        server.metrics.counter(
+            _INVALID_TOKENS_METRIC_KEY,
+            "Requests refused because their token was missing or invalid.",
+        )
+        server.metrics.gauge(
+            "jwt_verify_cache_lookups_total",
+            "Tokens verified, by result: hits (found in the cache) or misses (checked by HMAC).",
+            verifier_stats("hits", "misses"),
+            ("result",),
+            kind="counter",
+        )
+
+    def verify_token(self) -> Optional[str]:
+        """
+        Verify the token of the current request, if the server verifies tokens.
+
+        :return: None if the token is valid or not verified, or else why it is not.
+        """
+        verifier = self._server.token_verifier
+        if verifier is None:
+            return None
+        token = self.headers.get(self.JWT_TOKEN_HEADER)
+        if token is None:
+            error = "missing token"
+        else:
+            try:
+                verifier.verify(token)
+                return None
+            except InvalidTokenError as e:
+                error = str(e)
+        self._server.metrics.inc(_INVALID_TOKENS_METRIC_KEY)
+        return error
+
+    def request_simulation(self) -> ResponseSimulation:
+        """
+        Get the simulation parameters of the current request, over the server's defaults. The
+        details of quiet requests are not logged.
 
+        :raises ValueError: if a parameter is invalid.
+        """
+        simulation = self._server.simulation.override(request_params(self.path, self.headers))
+        if simulation.quiet:
+            self.detail_logger = suppressed_logger()
+        return simulation
+
+    def simulated_response(
+        self, simulation: ResponseSimulation, content: bytes
+    ) -> Tuple[Optional[int], List[Tuple[str, str]], Iterable[bytes]]:
+        """
+        Build the response to the current request, once its latency has passed: a failure, the
+        echo of the request, or a generated body, framed as the simulation says.
+
+        :param simulation: The simulation parameters of the request.
+        :param content: The request body.
+        :return: The status, or None to close the connection without a response, the headers, and
+                 the body in pieces, encoded for the framing.
+        """
+        status = simulation.status
+        pieces: Iterable[bytes]
+        if random.random() < simulation.fail_rate:
+            status = simulation.fail_status
+            self._server.metrics.inc(_SIMULATED_FAILURES_METRIC_KEY, (str(status),))
+            if status == DROP:
+                self.close_connection = True
+                return None, [], ()
+            pieces = [f"{status} simulated failure\n".encode("utf-8")]
+            length = len(pieces[0])
+        elif simulation.size is None:
+            body = memoryview(self.build_echo_response(self.path, self.headers, content))
+            pieces = (
+                body[i : i + simulation.chunk_size]
+                for i in range(0, len(body), simulation.chunk_size)
+            )
+            length = len(body)
+        else:
+            self.detail_logger.info(
+                "Got %d bytes in POST body, sending %d bytes", len(content), simulation.size
+            )
+            pieces = simulation.body_pieces()
+            length = simulation.size
+
+        headers = [("Content-type", "text/plain; charset=utf-8")]
+        framing = simulation.framing
+        if framing == "chunked" and self.request_version == "HTTP/1.0":
+            # HTTP/1.0 clients do not understand chunked encoding
+            framing = "close"
+        if framing == "length":
+            headers.append(("Content-Length", str(length)))
+        elif framing == "chunked":
+            headers.append(("Transfer-Encoding", "chunked"))
+            pieces = _encode_chunks(pieces)
+        else:
+            self.close_connection = True
+        return status, headers, pieces
+
+    def status_lines(self) -> List[str]:
+        verifier = self._server.token_verifier
+        if verifier is None:
+            return []
+        stats = verifier.stats()
+        invalid = int(self._server.metrics.get(_INVALID_TOKENS_METRIC_KEY))
+        return [
+            f"Verified {stats['hits'] + stats['misses']} tokens, {stats['hits']} from the cache, "
+            f"{invalid} requests refused"
+        ]
+
+    def build_echo_response(self, path: str, headers: Message, content: bytes) -> bytes:
+        """
+        Build the echo response body, logging the request details along the way.
+
+        :param path: The request path.
+        :param headers: The request headers.
+        :param content: The request body.
+        :return: The response body.
+        """
         # resp_lines is a list of messages to send back to the client
-        resp_lines = ["Path: " + self.path, "Headers:"]
-        # Log for debugging purposes, and also include in the echo response
-        for k, v in self.headers.items():
-            self.logger.info("    %s: %s", k, v)
+        resp_lines = ["Path: " + path, "Headers:"]
+        for k, v in headers.items():
             resp_lines.append(f"    {k}: {v}")
 
+        # Log for debugging purposes, as a single record, with the body cut short
+        log_body = self._server.log_settings.truncate_body(content)
+        self.detail_logger.info(
+            "%s\nGot %d bytes in POST body%s: %r",
+            "\n".join(resp_lines),
+            len(content),
+            "" if len(log_body) == len(content) else f", first {len(log_body)}",
+            log_body,
+        )
+        resp_lines.append(f"Body ({len(content)} bytes):")
+
+        return "\n".join(resp_lines).encode("utf-8") + b"\n" + content
+
+
+class EchoRequestHandler(EchoRequestMixin, ProxyBaseHTTPRequestHandler):
+    """
+    A request handler which echoes information back to the client.
+    """
+
+    def do_POST(self):
+        self.record_request()
+        try:
+            simulation = self.request_simulation()
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        self.detail_logger.info("Got POST request for %s", self.path)
+
         # Basic validation
-        length = self.headers.get("Content-Length")
-        if length is None:
+        try:
+            body = self.iter_request_body()
+        except BodyFramingError as e:
+            self.logger.error("Invalid request body framing: %s", e)
+            self.send_error(HTTPStatus.BAD_REQUEST, "invalid body framing")
+            return
+        if body is None:
             self.logger.error("Missing Content-Length header!")
             self.send_error(HTTPStatus.BAD_REQUEST, "missing length")
             return
 
-        req_content = self.rfile.read(int(length))
-        self.logger.info("Got %d bytes in POST body: %r", len(req_content), req_content)
+        req_content = b"".join(body)
 
-        # Build and send the response
-        resp_lines.append(f"Body ({length} bytes):")
+        error = self.verify_token()
+        if error is not None:
+            self.send_error(HTTPStatus.UNAUTHORIZED, error)
+            return
 
-        resp_message = "\n".join(resp_lines).encode("utf-8") + b"\n" + req_content
+        delay = simulation.latency.sample()
+        if delay:
+            time.sleep(delay)
+        status, headers, pieces = self.simulated_response(simulation, req_content)
+        if status is None:
+            return
 
-        self.send_response(HTTPStatus.OK)
-        self.send_header("Content-type", "text/plain; charset=utf-8")
-        self.send_header("Content-Length", str(len(resp_message)))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
         self.end_headers()
 
-        self.wfile.write(resp_message)
+        for piece in pieces:
+            self.wfile.write(piece)
         self.wfile.flush()
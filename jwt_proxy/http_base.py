@@ -2,78 +2,685 @@
 Shared HTTP server components.
 """
 
+import email.utils
+import hmac
+import os
+import queue
+import select
 import signal
 import socket
+import subprocess
 import sys
 import threading
 import time
-from collections import Counter
+from email.message import Message
 from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from math import floor
-from typing import Union
+from typing import TYPE_CHECKING, Iterator, List, Optional, Sequence, Set, Tuple, Union
 
-from jwt_proxy.logger import get_logger
+from jwt_proxy.logger import LogSettings, dropped_log_records, get_logger, log_access
+from jwt_proxy.metrics import PROMETHEUS_CONTENT_TYPE, Metrics
+from jwt_proxy.profiler import (
+    PROFILE_PATH,
+    format_stacks,
+    parse_profile_duration,
+    sample_stacks,
+)
 
-_REQUESTS_PROCESSED_METRIC_KEY = "requests_processed"
+if TYPE_CHECKING:
+    from jwt_proxy.workers import SharedStats
 
+_REQUESTS_PROCESSED_METRIC_KEY = "requests_processed_total"
+_HTTP_REQUESTS_METRIC_KEY = "http_requests_total"
+_HTTP_REQUEST_DURATION_METRIC_KEY = "http_request_duration_seconds"
+_ACCEPT_QUEUE_REJECTED_METRIC_KEY = "accept_queue_rejected_total"
+_ACCEPT_QUEUE_WAIT_METRIC_KEY = "accept_queue_wait_seconds"
 
-class ProxyHTTPServer(ThreadingHTTPServer):
+# Size of the chunks in which request and response bodies are relayed, which bounds the memory
+# used per request regardless of the body size
+BODY_CHUNK_SIZE = 64 * 1024
+
+# Maximum length of a chunk size or trailer line
+_MAX_LINE_LENGTH = 65537
+
+# Terminating chunk of a chunked message body, without trailers
+LAST_CHUNK = b"0\r\n\r\n"
+
+# Environment variables by which a server passes its listening socket, and the pipe on which
+# the new process reports that it is ready, to the process replacing it
+_LISTEN_FD_VARIABLE = "SERVER_LISTEN_FD"
+_READY_FD_VARIABLE = "SERVER_READY_FD"
+
+
+class BodyFramingError(ValueError):
+    """
+    Raised when a message body is not correctly delimited.
+    """
+
+
+def encode_chunk(data: bytes) -> bytes:
+    """
+    Encode data as one chunk of a chunked message body.
+
+    :param data: The chunk data, which must not be empty.
+    :return: The encoded chunk.
+    """
+    return b"%x\r\n%s\r\n" % (len(data), data)
+
+
+def parse_chunk_size(line: bytes) -> int:
+    """
+    Parse the size line of a chunk of a chunked message body.
+
+    :param line: The line, including chunk extensions and the line terminator.
+    :return: The chunk size.
+    """
+    try:
+        size = int(line.split(b";", 1)[0].strip(), 16)
+    except ValueError:
+        raise BodyFramingError(f"Invalid chunk size line {line!r}")
+    if size < 0:
+        raise BodyFramingError(f"Invalid chunk size line {line!r}")
+    return size
+
+
+def is_chunked(transfer_encoding: str) -> bool:
+    """
+    Check whether a ``Transfer-Encoding`` header value ends with the chunked coding.
+
+    :param transfer_encoding: The header value.
+    :return: Whether the message body is chunked.
+    :raises BodyFramingError: if the final coding is not chunked, so the body cannot be delimited.
+    """
+    if transfer_encoding.split(",")[-1].strip().lower() != "chunked":
+        raise BodyFramingError(f"Unsupported Transfer-Encoding {transfer_encoding!r}")
+    return True
+
+
+def create_server_metrics(server) -> Metrics:
+    """
+    Create the metrics registry of a server, with the metrics recorded for every request.
+
+    :param server: The server, which must provide ``start_time``.
+    :return: The metrics.
+    """
+    metrics = Metrics()
+    metrics.counter(_REQUESTS_PROCESSED_METRIC_KEY, "Requests processed by the request handlers.")
+    metrics.counter(
+        _HTTP_REQUESTS_METRIC_KEY, "Responses sent, by method and status.", ("method", "code")
+    )
+    metrics.histogram(
+        _HTTP_REQUEST_DURATION_METRIC_KEY,
+        "Time from reading a request to sending the complete response.",
+    )
+    metrics.gauge(
+        "process_start_time_seconds",
+        "Start time of the process since the epoch, in seconds.",
+        lambda: [((), server.start_time)],
+    )
+    metrics.gauge(
+        "log_records_dropped_total",
+        "Log records dropped because the log queue was full.",
+        lambda: [((), dropped_log_records())],
+        kind="counter",
+    )
+    return metrics
+
+
+def observe_request(metrics: Metrics, method: str, status: int, duration: float) -> None:
+    """
+    Record the metrics of a completed request.
+
+    :param metrics: The server metrics.
+    :param method: The request method.
+    :param status: The response status.
+    :param duration: The time spent handling the request, in seconds.
+    """
+    metrics.inc(_HTTP_REQUESTS_METRIC_KEY, (method, str(int(status))))
+    metrics.observe(_HTTP_REQUEST_DURATION_METRIC_KEY, duration)
+
+
+class WorkerStatsMixin:
+    """
+    Statistics shared with the other worker processes, for the servers of all engines. Classes
+    using this mixin must provide ``start_time`` and the ``metrics`` registry.
+    """
+
+    #: The statistics shared by all workers, or None when running a single process.
+    shared_stats: Optional["SharedStats"] = None
+    #: The slot of this worker in the shared statistics.
+    worker_id = 0
+
+    def attach_shared_stats(self, shared_stats: "SharedStats", worker_id: int) -> None:
+        """
+        Report statistics for all workers, continuing from the counts of the worker previously
+        running in the same slot.
+
+        :param shared_stats: The shared statistics.
+        :param worker_id: The slot of this worker.
+        """
+        self.shared_stats = shared_stats
+        self.worker_id = worker_id
+        self.start_time = shared_stats.start_time
+        # Only needed by the threads of this worker, since each worker has its own slot
+        self._shared_stats_lock = threading.Lock()
+
+    def count_request(self) -> None:
+        """
+        Count a processed request.
+        """
+        self.metrics.inc(_REQUESTS_PROCESSED_METRIC_KEY)
+        if self.shared_stats is not None:
+            with self._shared_stats_lock:
+                count = self.shared_stats.get_requests(self.worker_id)
+                self.shared_stats.set_requests(self.worker_id, count + 1)
+
+    def requests_processed(self) -> int:
+        """
+        Get the number of requests processed, by all workers if there are several.
+        """
+        if self.shared_stats is not None:
+            return self.shared_stats.total_requests()
+        return int(self.metrics.get(_REQUESTS_PROCESSED_METRIC_KEY))
+
+    def server_status_lines(self) -> List[str]:
+        """
+        Lines describing the server itself for the ``/status`` page.
+        """
+        if self.shared_stats is None:
+            return []
+        return [
+            f"{self.shared_stats.workers} worker processes, {self.shared_stats.restarts} restarted"
+        ]
+
+
+class ProxyHTTPServer(WorkerStatsMixin, ThreadingHTTPServer):
     """
     Override of :class:`ThreadingHTTPServer` which stores global metrics that can be accessed
     by request handlers, because request handlers are instantiated freshly for each request.
+
+    By default, each connection is handled on a new thread. With a ``thread_pool_size``, connections
+    are instead handled by a fixed number of threads, and wait for a free thread in a queue of at
+    most ``accept_queue_size`` connections. Connections arriving while the queue is full are
+    answered with ``503 Service Unavailable`` and a ``Retry-After`` header, without being read, so
+    that a spike or a stalled upstream cannot make the server create an unbounded number of threads.
+    While connections are waiting, finished requests close their connection instead of keeping it
+    alive, so that waiting clients get a thread.
+
+    Open connections are tracked, so that the server can :meth:`drain` them before it exits.
     """
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    # The socketserver default of 5 drops connection attempts during bursts of new clients
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        *args,
+        reuse_port: bool = False,
+        listen_socket: Optional[socket.socket] = None,
+        **kwargs,
+    ):
+        """
+        :param reuse_port: Whether to set ``SO_REUSEPORT``, so that several worker processes can
+                           listen on the same port.
+        :param listen_socket: A socket which is already listening, such as one inherited from the
+                              process this one replaces, used instead of binding the address.
+        """
+        self.reuse_port = reuse_port
+        if listen_socket is None:
+            super().__init__(*args, **kwargs)
+        else:
+            super().__init__(*args, bind_and_activate=False, **kwargs)
+            self.socket.close()
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
+            self.server_name = socket.getfqdn(self.server_address[0])
+            self.server_port = self.server_address[1]
         self.start_time = time.time()
-        self.metrics_lock = threading.Lock()
-        self.metrics = Counter(_REQUESTS_PROCESSED_METRIC_KEY=0)
+        # Seconds a client connection may stay idle between requests
+        self.keep_alive_timeout = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 15))
+        # Maximum number of requests served on one client connection
+        self.max_keep_alive_requests = int(os.environ.get("HTTP_KEEPALIVE_MAX_REQUESTS", 100))
+        self.log_settings = LogSettings.from_environment()
+        # Bearer token required by admin endpoints, which are disabled if it is not set
+        self.admin_token = os.environ.get("ADMIN_TOKEN") or None
+        self.metrics = create_server_metrics(self)
+
+        # Number of threads handling connections, or 0 for a thread per connection
+        self.thread_pool_size = int(os.environ.get("SERVER_THREAD_POOL_SIZE", 0))
+        # Maximum number of connections waiting for a thread
+        self.accept_queue_size = int(os.environ.get("SERVER_ACCEPT_QUEUE_SIZE", 64))
+        # Seconds after which rejected clients are asked to retry
+        self.retry_after = int(os.environ.get("SERVER_RETRY_AFTER", 1))
+        # Set once the server drains, after which every request closes its connection
+        self.draining = False
+        # The open client connections, and those of them waiting for their next request
+        self._connections_changed = threading.Condition()
+        self._connections: Set[socket.socket] = set()
+        self._idle_connections: Set[socket.socket] = set()
+        # Entries are (socket, client address, monotonic time queued). Only the thread accepting
+        # connections adds to the queue, so checking its size before adding is not racy.
+        self._accept_queue: "Optional[queue.Queue]" = None
+        self._pool_threads: List[threading.Thread] = []
+        if self.thread_pool_size > 0:
+            self._accept_queue = queue.Queue()
+            self.metrics.counter(
+                _ACCEPT_QUEUE_REJECTED_METRIC_KEY,
+                "Connections rejected because the queue was full.",
+            )
+            self.metrics.histogram(
+                _ACCEPT_QUEUE_WAIT_METRIC_KEY, "Time connections waited in the queue for a thread."
+            )
+            self.metrics.gauge(
+                "accept_queue_depth",
+                "Connections waiting in the queue for a thread.",
+                lambda: [((), self._accept_queue.qsize())],
+            )
+            for i in range(self.thread_pool_size):
+                thread = threading.Thread(
+                    target=self._pool_worker, daemon=True, name=f"http-worker-{i}"
+                )
+                thread.start()
+                self._pool_threads.append(thread)
+
+        self.RequestHandlerClass.init_server(self)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        with self._connections_changed:
+            self._connections.add(request)
+            self._idle_connections.add(request)
+        if self._accept_queue is None:
+            super().process_request(request, client_address)
+        elif self._accept_queue.qsize() >= self.accept_queue_size:
+            self.reject_request(request)
+        else:
+            self._accept_queue.put((request, client_address, time.monotonic()))
+
+    def reject_request(self, request: socket.socket) -> None:
+        """
+        Answer a connection which cannot be queued with ``503 Service Unavailable``, and close it.
+        This runs on the thread accepting connections, so it must not block.
+
+        :param request: The client socket.
+        """
+        self.metrics.inc(_ACCEPT_QUEUE_REJECTED_METRIC_KEY)
+
+        body = b"Server busy, retry later"
+        response = (
+            b"HTTP/1.1 503 Service Unavailable\r\n"
+            b"Content-Type: text/plain; charset=utf-8\r\n"
+            b"Retry-After: %d\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n%s" % (self.retry_after, len(body), body)
+        )
+        try:
+            request.setblocking(False)
+            request.send(response)
+            # Discard whatever the client already sent, since closing a socket with unread input
+            # resets the connection, and the client could lose the response
+            while request.recv(BODY_CHUNK_SIZE):
+                pass
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def shutdown_request(self, request):
+        super().shutdown_request(request)
+        with self._connections_changed:
+            self._connections.discard(request)
+            self._idle_connections.discard(request)
+            self._connections_changed.notify_all()
+
+    def set_connection_idle(self, request: socket.socket, idle: bool) -> None:
+        """
+        Record whether a connection is waiting for its next request, or handling one.
+        """
+        with self._connections_changed:
+            if not idle:
+                self._idle_connections.discard(request)
+            elif request in self._connections:
+                self._idle_connections.add(request)
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Let the open connections finish the requests in progress, after :meth:`shutdown` stopped
+        accepting new ones. Idle keep-alive connections are closed right away, and the others once
+        their current request is answered.
+
+        :param timeout: Seconds to wait for the connections to close.
+        :return: Whether they all closed in time.
+        """
+        with self._connections_changed:
+            self.draining = True
+            # A request arriving on an idle connection at this very moment is cut off, as clients
+            # of keep-alive connections must expect anyway
+            for request in self._idle_connections:
+                try:
+                    request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            return self._connections_changed.wait_for(lambda: not self._connections, timeout)
+
+    def open_connections(self) -> int:
+        """
+        Get the number of open client connections.
+        """
+        return len(self._connections)
+
+    def reload_config(self) -> None:
+        """
+        Reload the configuration of the request handler type, see
+        :meth:`ProxyBaseHTTPRequestHandler.reload_server`.
+        """
+        self.RequestHandlerClass.reload_server(self)
+
+    def has_waiting_connections(self) -> bool:
+        """
+        Check whether connections are waiting in the queue for a thread.
+        """
+        return self._accept_queue is not None and not self._accept_queue.empty()
+
+    def _pool_worker(self) -> None:
+        while True:
+            entry = self._accept_queue.get()
+            if entry is None:
+                break
+            request, client_address, queued = entry
+            self.metrics.observe(_ACCEPT_QUEUE_WAIT_METRIC_KEY, time.monotonic() - queued)
+            # Handles errors and closes the connection like ThreadingMixIn's per-connection threads
+            self.process_request_thread(request, client_address)
+
+    def server_status_lines(self) -> List[str]:
+        lines = super().server_status_lines()
+        if self._accept_queue is not None:
+            waited, wait_seconds = self.metrics.get_histogram(_ACCEPT_QUEUE_WAIT_METRIC_KEY)
+            rejected = int(self.metrics.get(_ACCEPT_QUEUE_REJECTED_METRIC_KEY))
+            mean_wait = wait_seconds / waited if waited else 0.0
+            lines.append(
+                f"{self._accept_queue.qsize()} connections queued for {self.thread_pool_size} "
+                f"threads, {rejected} rejected"
+            )
+            lines.append(f"Queue wait {mean_wait * 1000:.1f} ms mean over {waited} connections")
+        return lines
+
+    def server_close(self):
+        super().server_close()
+        if self._accept_queue is not None:
+            # Close connections which never got a thread, then stop the threads once they finish
+            while True:
+                try:
+                    entry = self._accept_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is not None:
+                    self.shutdown_request(entry[0])
+            for _ in self._pool_threads:
+                self._accept_queue.put(None)
+        self.RequestHandlerClass.close_server(self)
 
 
 class ProxyBaseHTTPRequestHandler(BaseHTTPRequestHandler):
     """
     Common HTTP request handler shared by both the proxy and the echo server.
+
+    Client connections are persistent (HTTP/1.1 keep-alive). A connection is closed after it has
+    been idle for the server's ``keep_alive_timeout``, or once it has served
+    ``max_keep_alive_requests`` requests. Pipelined requests are served in order from the buffered
+    input stream, so every request body must be consumed, and every response must be framed by
+    ``Content-Length``, chunked encoding, or by closing the connection.
     """
 
+    protocol_version = "HTTP/1.1"
+
+    # Responses are written as separate header and body writes, which would otherwise be delayed
+    # by Nagle's algorithm on a persistent connection.
+    disable_nagle_algorithm = True
+
     def __init__(self, socket, client, server: ProxyHTTPServer):
         # Assign instance variables first because the parent constructor will call handler methods
         self._server = server
         self.logger = get_logger(type(self))
+        # The logger for request details, chosen for each request
+        self.detail_logger = self.logger
+        # StreamRequestHandler applies this to the socket, so it bounds the wait for each request
+        self.timeout = server.keep_alive_timeout
+        self.requests_on_connection = 0
+        self._connection_header_sent = False
+        # The status of the response to the current request, once it has been started
+        self.response_status: Optional[int] = None
+        self._request_start = 0.0
         super(BaseHTTPRequestHandler, self).__init__(socket, client, server)
 
+    @classmethod
+    def init_server(cls, server: ProxyHTTPServer) -> None:
+        """
+        Hook for attaching shared state used by this handler type to the server, called once
+        when the server is created.
+
+        :param server: The server.
+        """
+
+    @classmethod
+    def close_server(cls, server: ProxyHTTPServer) -> None:
+        """
+        Hook for releasing the shared state created in :meth:`init_server`.
+
+        :param server: The server.
+        """
+
+    @classmethod
+    def reload_server(cls, server: ProxyHTTPServer) -> None:
+        """
+        Hook for reloading the configuration of this handler type, called when the server
+        receives ``SIGHUP``.
+
+        :param server: The server.
+        """
+
+    def handle_one_request(self) -> None:
+        self.response_status = None
+        super().handle_one_request()
+        if self._server.draining:
+            self.close_connection = True
+        elif not self.close_connection:
+            self._server.set_connection_idle(self.connection, True)
+        if self.response_status is not None:
+            duration = time.perf_counter() - self._request_start
+            observe_request(
+                self._server.metrics, self.command or "-", self.response_status, duration
+            )
+            log_access(self.client_address[0], self.requestline, self.response_status, duration)
+
+    def parse_request(self) -> bool:
+        # The request line has just been read, so idle time on the connection is not counted
+        self._request_start = time.perf_counter()
+        self._server.set_connection_idle(self.connection, False)
+        self._connection_header_sent = False
+        self.detail_logger = self._server.log_settings.detail_logger(self.logger)
+        if not super().parse_request():
+            return False
+
+        self.requests_on_connection += 1
+        if self.requests_on_connection >= self._server.max_keep_alive_requests:
+            self.close_connection = True
+        elif self._server.has_waiting_connections() or self._server.draining:
+            # Free the thread for a waiting connection, or let the server exit, after this request
+            self.close_connection = True
+        return True
+
+    def send_response_only(self, code: int, message: Optional[str] = None) -> None:
+        if code >= 200:
+            self.response_status = code
+        super().send_response_only(code, message)
+
+    def send_header(self, keyword: str, value: str) -> None:
+        if keyword.lower() == "connection":
+            self._connection_header_sent = True
+        super().send_header(keyword, value)
+
+    def end_headers(self) -> None:
+        # Tell the client explicitly when the connection state differs from its protocol default
+        if not self._connection_header_sent:
+            if self.close_connection and self.request_version != "HTTP/1.0":
+                self.send_header("Connection", "close")
+            elif not self.close_connection and self.request_version == "HTTP/1.0":
+                self.send_header("Connection", "keep-alive")
+        super().end_headers()
+
+    def iter_request_body(self, chunk_size: int = BODY_CHUNK_SIZE) -> Optional[Iterator[bytes]]:
+        """
+        Read the request body incrementally, delimited either by ``Content-Length`` or by
+        chunked transfer encoding.
+
+        :param chunk_size: The maximum size of each piece.
+        :return: An iterator over the pieces of the body, or None if the request has no body.
+        :raises BodyFramingError: if the body framing headers are invalid.
+        """
+        transfer_encoding = self.headers.get("Transfer-Encoding")
+        length = self.headers.get("Content-Length")
+        if transfer_encoding is not None:
+            # Intermediaries which pick the other framing would see a different request boundary,
+            # letting one request be smuggled inside another (RFC 9112 section 6.3)
+            if length is not None:
+                raise BodyFramingError("Both Transfer-Encoding and Content-Length")
+            if is_chunked(transfer_encoding):
+                return self._iter_chunked_body(chunk_size)
+
+        if length is None:
+            return None
+        try:
+            remaining = int(length)
+        except ValueError:
+            raise BodyFramingError(f"Invalid Content-Length {length!r}")
+        if remaining < 0:
+            raise BodyFramingError(f"Invalid Content-Length {length!r}")
+        return self._iter_sized_body(remaining, chunk_size)
+
+    def _read(self, size: int) -> bytes:
+        # Failures of the client's connection are framing errors, so that they are not mistaken
+        # for failures of the upstream the body is being streamed to
+        try:
+            return self.rfile.read(size)
+        except OSError as e:
+            self.close_connection = True
+            raise BodyFramingError(f"Error reading the body from the client: {e!r}") from e
+
+    def _readline(self) -> bytes:
+        try:
+            return self.rfile.readline(_MAX_LINE_LENGTH)
+        except OSError as e:
+            self.close_connection = True
+            raise BodyFramingError(f"Error reading the body from the client: {e!r}") from e
+
+    def _iter_sized_body(self, remaining: int, chunk_size: int) -> Iterator[bytes]:
+        while remaining > 0:
+            chunk = self._read(min(remaining, chunk_size))
+            if not chunk:
+                self.close_connection = True
+                raise BodyFramingError("Client closed the connection before sending the whole body")
+            remaining -= len(chunk)
+            yield chunk
+
+    def _iter_chunked_body(self, chunk_size: int) -> Iterator[bytes]:
+        while True:
+            size = parse_chunk_size(self._readline())
+            if size == 0:
+                break
+            yield from self._iter_sized_body(size, chunk_size)
+            if self._readline() not in (b"\r\n", b"\n"):
+                self.close_connection = True
+                raise BodyFramingError("Missing line terminator after chunk data")
+
+        # Trailers are not forwarded
+        while True:
+            line = self._readline()
+            if line in (b"\r\n", b"\n"):
+                break
+            if not line:
+                self.close_connection = True
+                raise BodyFramingError("Client closed the connection before the end of the body")
+
+    def discard_request_body(self) -> None:
+        """
+        Read and discard a request body which the handler does not use, so that the next request
+        on the connection can be parsed. Requests whose body cannot be delimited close the connection.
+        """
+        try:
+            body = self.iter_request_body()
+            if body is not None:
+                for _ in body:
+                    pass
+        except BodyFramingError:
+            self.close_connection = True
+
     def record_request(self) -> None:
         """
         Add a metric that a request was processed.
         """
-        with self._server.metrics_lock:
-            self._server.metrics[_REQUESTS_PROCESSED_METRIC_KEY] += 1
+        self._server.count_request()
 
     def do_GET(self):
-        if self.path != "/status":
+        self.discard_request_body()
+        content_type = "text/plain; charset=utf-8"
+        path, _, query = self.path.partition("?")
+        if path == "/status":
+            status = HTTPStatus.OK
+            response = build_status_page(
+                self.server_version,
+                self._server.start_time,
+                self._server.requests_processed(),
+                self._server.server_status_lines() + self.status_lines(),
+            )
+        elif path == "/metrics":
+            status = HTTPStatus.OK
+            response = self._server.metrics.render_prometheus().encode("utf-8")
+            content_type = PROMETHEUS_CONTENT_TYPE
+        elif path == PROFILE_PATH:
+            status, response = self.profile(query)
+        else:
             status = HTTPStatus.NOT_FOUND
             response = b"Not Found"
-        else:
-            status = HTTPStatus.OK
-            now = time.time()
-            started = self.date_time_string(self._server.start_time)
-            uptime = self.format_time_duration(now - self._server.start_time)
-
-            response_lines = [f"{self.server_version} up {uptime} (since {started})"]
-            with self._server.metrics_lock:
-                response_lines.append(
-                    f"{self._server.metrics[_REQUESTS_PROCESSED_METRIC_KEY]} requests processed"
-                )
-            response = "\n".join(response_lines).encode("utf-8")
 
         self.send_response(status)
-        self.send_header("Content-type", "text/plain; charset=utf-8")
+        self.send_header("Content-type", content_type)
         self.send_header("Content-Length", str(len(response)))
         self.end_headers()
 
         self.wfile.write(response)
         self.wfile.flush()
 
+    def profile(self, query: str) -> Tuple[HTTPStatus, bytes]:
+        """
+        Serve the admin-only profiling endpoint: sample the stacks of all threads for the number
+        of ``seconds`` given in the query, and return the most frequent stacks.
+
+        :param query: The query string.
+        :return: The response status and body.
+        """
+        error = check_admin_request(self.headers, self._server.admin_token)
+        if error is not None:
+            return error
+        try:
+            seconds = parse_profile_duration(query)
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, str(e).encode("utf-8")
+        self.logger.info("Profiling for %g seconds", seconds)
+        return HTTPStatus.OK, format_stacks(sample_stacks(seconds)).encode("utf-8")
+
+    def status_lines(self) -> List[str]:
+        """
+        Additional lines for the ``/status`` page, for subclasses which keep their own statistics.
+
+        :return: The lines.
+        """
+        return []
+
     @staticmethod
     def format_time_duration(duration_secs: Union[int, float]) -> str:
         """
@@ -106,43 +713,232 @@ class ProxyBaseHTTPRequestHandler(BaseHTTPRequestHandler):
     def log_message(self, format: str, *args) -> None:
         self.logger.info("[%s] %s", self.address_string(), format % args)
 
+    def log_request(self, code="-", size="-") -> None:
+        # Replaced by the access log line written once the request is complete
+        pass
+
+
+def check_admin_request(
+    headers: Message, admin_token: Optional[str]
+) -> Optional[Tuple[HTTPStatus, bytes]]:
+    """
+    Check that a request to an admin endpoint carries the admin token as a bearer token.
+
+    :param headers: The request headers.
+    :param admin_token: The admin token, or None if admin endpoints are disabled.
+    :return: None if the request is allowed, otherwise the error status and body to send.
+    """
+    if admin_token is None:
+        return HTTPStatus.NOT_FOUND, b"Not Found"
+    expected = f"Bearer {admin_token}".encode("utf-8")
+    provided = headers.get("Authorization", "").encode("utf-8")
+    if not hmac.compare_digest(provided, expected):
+        return HTTPStatus.FORBIDDEN, b"Forbidden"
+    return None
+
+
+def build_status_page(
+    server_version: str, start_time: float, requests_processed: int, extra_lines: List[str]
+) -> bytes:
+    """
+    Build the body of the ``/status`` page.
+
+    :param server_version: The server name.
+    :param start_time: Timestamp when the server was started.
+    :param requests_processed: Number of requests processed so far.
+    :param extra_lines: Additional handler-specific lines.
+    :return: The page body.
+    """
+    started = email.utils.formatdate(start_time, usegmt=True)
+    uptime = ProxyBaseHTTPRequestHandler.format_time_duration(time.time() - start_time)
+
+    response_lines = [
+        f"{server_version} up {uptime} (since {started})",
+        f"{requests_processed} requests processed",
+    ]
+    response_lines.extend(extra_lines)
+    return "\n".join(response_lines).encode("utf-8")
+
+
+def inherited_listen_socket() -> Optional[socket.socket]:
+    """
+    Get the listening socket passed by the process this one replaces, see
+    :func:`spawn_replacement`. The variable is removed, so that it is not passed on further.
 
-def run_server(handler_cls, port: int):
+    :return: The socket, or None if the server should bind its own.
+    """
+    fd = os.environ.pop(_LISTEN_FD_VARIABLE, None)
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+
+def notify_ready() -> None:
+    """
+    Tell the process this one replaces that the server is accepting connections, if there is one.
+    """
+    fd = os.environ.pop(_READY_FD_VARIABLE, None)
+    if fd is not None:
+        try:
+            os.write(int(fd), b"1")
+        finally:
+            os.close(int(fd))
+
+
+def spawn_replacement(
+    listen_socket: socket.socket, timeout: float, argv: Optional[Sequence[str]] = None
+) -> bool:
+    """
+    Start a new process running the same command, which inherits the listening socket instead of
+    binding the port again, so that no connection is refused while the two processes overlap.
+    The new process must call :func:`inherited_listen_socket` and then :func:`notify_ready`.
+
+    :param listen_socket: The listening socket.
+    :param timeout: Seconds to wait for the new process to be ready.
+    :param argv: The command, by default the one which started this process.
+    :return: Whether the new process is ready, in which case this one should stop accepting
+             connections and drain. Otherwise, it should keep serving.
+    """
+    log = get_logger(spawn_replacement)
+    if argv is None:
+        argv = [sys.executable] + sys.orig_argv[1:]
+    fd = listen_socket.fileno()
+    ready_read, ready_write = os.pipe()
+    env = dict(os.environ)
+    env[_LISTEN_FD_VARIABLE] = str(fd)
+    env[_READY_FD_VARIABLE] = str(ready_write)
+    try:
+        process = subprocess.Popen(argv, env=env, pass_fds=(fd, ready_write))
+    except OSError as e:
+        log.error("Could not start a new process: %s", e)
+        return False
+    finally:
+        os.close(ready_write)
+
+    try:
+        # The pipe reaches the end of file without a byte if the new process exits
+        readable, _, _ = select.select([ready_read], [], [], timeout)
+        ready = bool(readable) and os.read(ready_read, 1) == b"1"
+    finally:
+        os.close(ready_read)
+    if not ready:
+        log.error(
+            "New process %d did not start within %g seconds, keeping this one", process.pid, timeout
+        )
+        # So that two servers do not end up sharing the socket
+        process.kill()
+        process.wait()
+        return False
+    log.info("New process %d is accepting connections", process.pid)
+    return True
+
+
+def run_server(handler_cls, port: int, engine: Optional[str] = None, workers: Optional[int] = None):
     """
     Run an HTTP server.
 
     :param handler_cls: The :class:`BaseHTTPRequestHandler` class type.
     :param port: The port to listen on.
+    :param engine: The server engine, ``threaded`` or ``asyncio``. Defaults to the ``SERVER_ENGINE``
+                   environment variable, or ``threaded`` if that is not set.
+    :param workers: The number of worker processes. Defaults to the ``SERVER_WORKERS`` environment
+                    variable, or 1 if that is not set. With more than one, a supervisor process
+                    forks the workers, which all listen on the port with ``SO_REUSEPORT``.
+
+    The server runs until ``SIGINT`` or ``SIGTERM``, and then stops accepting connections and
+    drains the open ones for up to ``SERVER_DRAIN_TIMEOUT`` seconds. ``SIGHUP`` reloads the
+    configuration, see :meth:`ProxyBaseHTTPRequestHandler.reload_server`. With a single process,
+    ``SIGUSR2`` starts a new process which inherits the listening socket, see
+    :func:`spawn_replacement`, and this one drains once the new one is ready.
     """
     log = get_logger(run_server)
 
-    log.info("Starting server on on 0.0.0.0:%d", port)
+    engine = engine or os.environ.get("SERVER_ENGINE", "threaded")
+    if engine not in ("threaded", "asyncio"):
+        raise ValueError(f"Unknown server engine {engine!r}")
+    workers = workers or int(os.environ.get("SERVER_WORKERS", 1))
 
-    ProxyHTTPServer.address_family = socket.AddressFamily.AF_INET
+    if workers > 1:
+        from jwt_proxy.workers import WorkerSupervisor
 
-    with ProxyHTTPServer(("0.0.0.0", port), handler_cls) as server:
-        # Run the server on another thread so that the main thread can handle the shutdown signal.
-        # running will be set by the signal handler, and then the main thread will resume and
-        # gracefully shut down.
-        thread = threading.Thread(target=server.serve_forever, daemon=True, name="server-main")
+        log.info("Starting %d %s workers on 0.0.0.0:%d", workers, engine, port)
 
-        running = True
+        def _worker(shared_stats, worker_id):
+            _serve(handler_cls, port, engine, shared_stats, worker_id)
 
-        def _handler(signum, frame):
-            log.info("Got signal %d (%s), exiting", signum, signal.strsignal(signum))
-            nonlocal running
-            running = False
+        WorkerSupervisor(_worker, workers).run()
+        sys.exit(0)
 
-        signal.signal(signal.SIGINT, _handler)
-        signal.signal(signal.SIGTERM, _handler)
+    _serve(handler_cls, port, engine)
 
-        thread.start()
 
-        log.info("Started server")
+def _serve(
+    handler_cls,
+    port: int,
+    engine: str,
+    shared_stats: Optional["SharedStats"] = None,
+    worker_id: int = 0,
+):
+    """
+    Run an HTTP server in the current process, optionally as one of several workers.
+    """
+    log = get_logger(run_server)
 
-        while running:
-            time.sleep(0.01)
+    if engine == "asyncio":
+        # Imported here because the asyncio engine depends on the handler modules
+        from jwt_proxy.aio_server import run_async_server
 
-        log.info("Shutting down")
+        log.info("Starting asyncio server on 0.0.0.0:%d", port)
+        run_async_server(handler_cls, port, shared_stats, worker_id)
+        return
+
+    log.info("Starting server on on 0.0.0.0:%d", port)
+
+    ProxyHTTPServer.address_family = socket.AddressFamily.AF_INET
+
+    with ProxyHTTPServer(
+        ("0.0.0.0", port),
+        handler_cls,
+        reuse_port=shared_stats is not None,
+        listen_socket=inherited_listen_socket(),
+    ) as server:
+        if shared_stats is not None:
+            server.attach_shared_stats(shared_stats, worker_id)
+
+        # Run the server on another thread, while the main thread waits for signals. A signal may
+        # be delivered to any thread, so the main thread blocks on a pipe which Python's C-level
+        # handler writes the signal number to, rather than waiting for a Python handler to run.
+        thread = threading.Thread(target=server.serve_forever, daemon=True, name="server-main")
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_write, False)
+        signal.set_wakeup_fd(wakeup_write)
+        signums = [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]
+        if shared_stats is None:
+            # Workers share the port through SO_REUSEPORT rather than a socket to hand over
+            signums.append(signal.SIGUSR2)
+        for signum in signums:
+            signal.signal(signum, lambda signum, frame: None)
+
+        thread.start()
+        log.info("Started server")
+        notify_ready()
+
+        while True:
+            signum = os.read(wakeup_read, 1)[0]
+            if signum == signal.SIGHUP:
+                server.reload_config()
+                continue
+            log.info("Got signal %d (%s)", signum, signal.strsignal(signum))
+            if signum != signal.SIGUSR2 or spawn_replacement(
+                server.socket, float(os.environ.get("SERVER_REEXEC_TIMEOUT", 30))
+            ):
+                break
+
+        drain_timeout = float(os.environ.get("SERVER_DRAIN_TIMEOUT", 30))
+        log.info("Shutting down, draining connections for up to %g seconds", drain_timeout)
         server.shutdown()
+        # Refuse new connections, unless a new process listens on the same socket
+        server.socket.close()
+        if not server.drain(drain_timeout):
+            log.warning("Closing %d connections which did not finish", server.open_connections())
         sys.exit(0)
@@ -1,13 +1,37 @@
 """
-Utilities for encoding JWT.
+Utilities for encoding and verifying JWT.
 """
 
 import base64
+import binascii
 import hmac
 import json
 import secrets
+import threading
 import time
-from typing import Dict, Optional, Union
+from collections import OrderedDict
+from json.encoder import encode_basestring_ascii
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    from jwt_proxy.keys import SigningKey
+
+# Supported signing algorithms, and the hash function each uses for the HMAC
+SIGNING_ALGORITHMS = {
+    "HS256": "sha256",
+    "HS384": "sha384",
+    "HS512": "sha512",
+}
+
+# Translation from the standard base64 alphabet to the URL-safe one
+_URLSAFE_TRANSLATION = bytes.maketrans(b"+/", b"-_")
+
+
+class InvalidTokenError(ValueError):
+    """
+    Raised when a token is malformed, its signature does not match, or it is not valid at the
+    current time.
+    """
 
 
 def _base64_url(s: Union[str, bytes]) -> bytes:
@@ -24,6 +48,18 @@ def _base64_url(s: Union[str, bytes]) -> bytes:
     return base64.urlsafe_b64encode(encoded).rstrip(b"=")
 
 
+def _base64_url_decode(s: bytes) -> bytes:
+    """
+    Decode a base64url-encoded string without padding.
+
+    :raises InvalidTokenError: if it is not valid base64url.
+    """
+    try:
+        return base64.urlsafe_b64decode(s + b"=" * (-len(s) % 4))
+    except (binascii.Error, ValueError):
+        raise InvalidTokenError("Invalid base64url encoding")
+
+
 def encode_jwt_hs512(
     payload: Dict[str, str],
     secret: bytes,
@@ -58,3 +94,230 @@ def encode_jwt_hs512(
     sig = _base64_url(hm.digest())
 
     return header_enc + b"." + payload_enc + b"." + sig
+
+
+def _json_number(value: Union[int, float]) -> str:
+    """
+    Serialize a number exactly like :func:`json.dumps`.
+    """
+    if type(value) is int:
+        return int.__repr__(value)
+    if type(value) is float:
+        return float.__repr__(value)
+    return json.dumps(value)
+
+
+class JWTSigner:
+    """
+    A reusable HMAC signer for tokens with a fixed payload. With the default HS512 algorithm and
+    no key ID, it produces exactly the same tokens as :func:`encode_jwt_hs512`.
+
+    Everything which does not change between tokens is prepared once: the encoded header, the
+    serialized payload, and the HMAC keyed with the secret, which is cloned for each token instead
+    of being keyed again.
+    """
+
+    def __init__(
+        self,
+        payload: Dict[str, str],
+        secret: bytes,
+        algorithm: str = "HS512",
+        key_id: Optional[str] = None,
+    ):
+        """
+        :param payload: The payload dictionary.
+        :param secret: The signing secret.
+        :param algorithm: The signing algorithm, one of :data:`SIGNING_ALGORITHMS`.
+        :param key_id: The ID of the signing key, added to the header as ``kid`` if set.
+        """
+        if algorithm not in SIGNING_ALGORITHMS:
+            raise ValueError(f"Unsupported signing algorithm {algorithm}")
+        self.algorithm = algorithm
+        self.key_id = key_id
+
+        header_msg = {
+            "alg": algorithm,
+            "typ": "jwt",
+        }
+        if key_id is not None:
+            header_msg["kid"] = key_id
+        self._header_prefix = _base64_url(json.dumps(header_msg, sort_keys=True)) + b"."
+        # The token claims are serialized in sorted key order: iat, jti, payload
+        self._payload_suffix = ', "payload": ' + json.dumps(payload, sort_keys=True) + "}"
+        self._hmac = hmac.new(
+            secret, msg=self._header_prefix, digestmod=SIGNING_ALGORITHMS[algorithm]
+        )
+
+    def encode(self, issued_at: Optional[int] = None, jwt_id: Optional[str] = None) -> bytes:
+        """
+        Create a signed token.
+
+        :param issued_at: Timestamp (seconds since epoch) that the token was issued at. Pass None to
+                          use the current timestamp.
+        :param jwt_id: ID of the claim. This is meant only for unit tests and should not be explicitly set.
+        :return: The signed token.
+        """
+        payload_json = (
+            '{"iat": '
+            + _json_number(issued_at or time.time())
+            + ', "jti": '
+            + encode_basestring_ascii(jwt_id or secrets.token_hex(32))
+            + self._payload_suffix
+        )
+        payload_enc = (
+            binascii.b2a_base64(payload_json.encode("ascii"), newline=False)
+            .translate(_URLSAFE_TRANSLATION)
+            .rstrip(b"=")
+        )
+
+        hm = self._hmac.copy()
+        hm.update(payload_enc)
+        sig = (
+            binascii.b2a_base64(hm.digest(), newline=False)
+            .translate(_URLSAFE_TRANSLATION)
+            .rstrip(b"=")
+        )
+
+        return self._header_prefix + payload_enc + b"." + sig
+
+
+class JWTVerifier:
+    """
+    Verifies tokens signed with HMAC, such as those of :class:`JWTSigner`, and checks their time
+    claims:
+
+    * ``iat`` and ``nbf`` must not be later than the current time,
+    * ``exp``, and ``iat`` plus ``max_age`` if set, must be later than the current time,
+
+    with ``leeway`` seconds of tolerance for clocks which differ between hosts. Signatures are
+    compared in constant time. The token header must name the algorithm of the key it is
+    verified with, found by its ``kid`` header, or the key without an ID if it has none.
+
+    Recently verified tokens are kept in a bounded LRU cache keyed by their signature, so that a
+    token seen again is checked against the cached one instead of computing the HMAC again.
+    Its time claims are still checked on every use.
+    """
+
+    def __init__(
+        self,
+        keys: Iterable["SigningKey"],
+        max_age: Optional[float] = None,
+        leeway: float = 30.0,
+        cache_size: int = 10000,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        :param keys: The keys tokens may be signed with, see :class:`jwt_proxy.keys.SigningKey`.
+        :param max_age: Seconds after ``iat`` from which a token is expired, or None to only rely
+                        on ``exp``.
+        :param leeway: Seconds of tolerance in the time checks.
+        :param cache_size: The number of verified tokens kept, or 0 to not cache them.
+        :param clock: Returns the current time in seconds since the epoch.
+        """
+        self.max_age = max_age
+        self.leeway = leeway
+        self.cache_size = cache_size
+        self.clock = clock
+        # The HMAC keyed with each secret, which is cloned for each token instead of being keyed
+        # again, like in JWTSigner
+        self._keys = {
+            key.key_id: (
+                key.algorithm,
+                hmac.new(key.secret, digestmod=SIGNING_ALGORITHMS[key.algorithm]),
+            )
+            for key in keys
+        }
+
+        self._lock = threading.Lock()
+        # Signature -> (signing input, claims, valid from, valid until)
+        self._cache: "OrderedDict[bytes, Tuple[bytes, Dict[str, Any], float, float]]" = (
+            OrderedDict()
+        )
+        #: Tokens found in the cache.
+        self.hits = 0
+        #: Tokens verified with their HMAC.
+        self.misses = 0
+
+    def verify(self, token: Union[str, bytes]) -> Dict[str, Any]:
+        """
+        Verify a token.
+
+        :param token: The token, as sent in a header.
+        :return: The token claims, which are shared with the cache and must not be modified.
+        :raises InvalidTokenError: if the token is malformed, wrongly signed, or not valid now.
+        """
+        if isinstance(token, str):
+            token = token.encode("ascii", "replace")
+        signing_input, _, signature = token.rpartition(b".")
+        if not signing_input or b"." not in signing_input:
+            raise InvalidTokenError("Malformed token, expected three parts")
+
+        with self._lock:
+            cached = self._cache.get(signature)
+            # A cached signature only vouches for the header and claims it was verified with
+            if cached is not None and cached[0] == signing_input:
+                self._cache.move_to_end(signature)
+                self.hits += 1
+            else:
+                cached = None
+                self.misses += 1
+        if cached is not None:
+            _, claims, valid_from, valid_until = cached
+        else:
+            claims, valid_from, valid_until = self._verify_signature(signing_input, signature)
+            if self.cache_size > 0:
+                with self._lock:
+                    self._cache[signature] = (signing_input, claims, valid_from, valid_until)
+                    if len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+
+        now = self.clock()
+        if now < valid_from - self.leeway:
+            raise InvalidTokenError("Token is not valid yet")
+        if now >= valid_until + self.leeway:
+            raise InvalidTokenError("Token has expired")
+        return claims
+
+    def _verify_signature(
+        self, signing_input: bytes, signature: bytes
+    ) -> Tuple[Dict[str, Any], float, float]:
+        header_enc, _, payload_enc = signing_input.partition(b".")
+        try:
+            header = json.loads(_base64_url_decode(header_enc))
+            claims = json.loads(_base64_url_decode(payload_enc))
+        except ValueError:
+            raise InvalidTokenError("Malformed token header or claims")
+        if not isinstance(header, dict) or not isinstance(claims, dict):
+            raise InvalidTokenError("Malformed token header or claims")
+
+        key_id = header.get("kid")
+        if key_id is not None and not isinstance(key_id, str):
+            raise InvalidTokenError("Malformed key ID")
+        key = self._keys.get(key_id)
+        if key is None:
+            raise InvalidTokenError(f"Unknown key ID {key_id!r}")
+        algorithm, keyed_hmac = key
+        if header.get("alg") != algorithm:
+            raise InvalidTokenError(f"Unexpected algorithm {header.get('alg')!r}")
+        hm = keyed_hmac.copy()
+        hm.update(signing_input)
+        if not hmac.compare_digest(_base64_url(hm.digest()), signature):
+            raise InvalidTokenError("Invalid signature")
+
+        try:
+            issued_at = float(claims.get("iat", 0.0))
+            valid_from = max(issued_at, float(claims.get("nbf", 0.0)))
+            valid_until = float(claims.get("exp", float("inf")))
+        except (TypeError, ValueError):
+            raise InvalidTokenError("Malformed time claims")
+        if self.max_age is not None:
+            if "iat" not in claims:
+                raise InvalidTokenError("Token has no iat claim")
+            valid_until = min(valid_until, issued_at + self.max_age)
+        return claims, valid_from, valid_until
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the number of cached tokens, and of cache ``hits`` and ``misses``.
+        """
+        return {"entries": len(self._cache), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,181 @@
+"""
+Signing keys, and reloading of key files for key rotation without a restart.
+"""
+
+import json
+import os
+import threading
+from typing import Callable, Dict, Mapping, NamedTuple, Optional, Tuple
+
+from jwt_proxy.jwt import SIGNING_ALGORITHMS
+from jwt_proxy.logger import get_logger
+
+
+class SigningKey(NamedTuple):
+    """
+    A secret used for signing tokens.
+    """
+
+    #: The key ID sent as the ``kid`` token header, or None to omit it.
+    key_id: Optional[str]
+    #: The signing secret.
+    secret: bytes
+    #: The signing algorithm, one of :data:`jwt_proxy.jwt.SIGNING_ALGORITHMS`.
+    algorithm: str = "HS512"
+
+
+class KeySet(NamedTuple):
+    """
+    The active signing keys. New tokens are signed with the current key; the others stay active,
+    so that tokens signed with them are still accepted while a rotation is rolled out.
+    """
+
+    #: The active keys by key ID.
+    keys: Dict[str, SigningKey]
+    #: The ID of the key used for signing new tokens.
+    current: str
+
+    @property
+    def signing_key(self) -> SigningKey:
+        """
+        The key used for signing new tokens.
+        """
+        return self.keys[self.current]
+
+
+def signing_key_from_settings(settings: Mapping[str, str]) -> SigningKey:
+    """
+    Get the signing key configured by ``JWT_SIGNING_SECRET``, ``JWT_SIGNING_ALGORITHM`` and
+    ``JWT_KEY_ID``.
+
+    :param settings: The settings, such as :data:`os.environ`.
+    :return: The key.
+    :raises ValueError: if the secret is missing or the algorithm is not supported.
+    """
+    secret = settings.get("JWT_SIGNING_SECRET")
+    if secret is None:
+        raise ValueError(
+            "Could not get signing secret from environment variable JWT_SIGNING_SECRET"
+        )
+    algorithm = settings.get("JWT_SIGNING_ALGORITHM", "HS512")
+    if algorithm not in SIGNING_ALGORITHMS:
+        raise ValueError(f"Unsupported signing algorithm {algorithm}")
+    return SigningKey(settings.get("JWT_KEY_ID") or None, secret.encode("ascii"), algorithm)
+
+
+def load_key_set(path: str) -> KeySet:
+    """
+    Load signing keys from a JSON file of the form::
+
+        {
+            "current": "2024-02",
+            "keys": {
+                "2024-01": {"secret": "...", "algorithm": "HS512"},
+                "2024-02": {"secret": "...", "algorithm": "HS256"}
+            }
+        }
+
+    The algorithm of each key defaults to HS512.
+
+    :param path: The path of the key file.
+    :return: The keys.
+    :raises ValueError: If the file is not a valid key file.
+    """
+    with open(path, "rb") as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid key file {path}: {e}") from e
+
+    try:
+        keys = {}
+        for key_id, entry in data["keys"].items():
+            algorithm = entry.get("algorithm", "HS512")
+            if algorithm not in SIGNING_ALGORITHMS:
+                raise ValueError(f"Unsupported signing algorithm {algorithm} for key {key_id}")
+            keys[key_id] = SigningKey(key_id, entry["secret"].encode("ascii"), algorithm)
+        current = data["current"]
+    except (KeyError, AttributeError, TypeError) as e:
+        raise ValueError(f"Invalid key file {path}: missing or malformed {e}") from e
+
+    if current not in keys:
+        raise ValueError(f"Invalid key file {path}: current key {current} is not defined")
+    return KeySet(keys, current)
+
+
+class KeyFileWatcher:
+    """
+    Reloads a key file in a background thread when its modification time changes, and passes the
+    new keys to a callback. Request handlers never look at the file; they only see the new keys
+    once the callback has installed them. If the changed file is invalid, the previous keys are
+    kept.
+    """
+
+    def __init__(self, path: str, on_change: Callable[[KeySet], None], interval: float = 5.0):
+        """
+        :param path: The path of the key file.
+        :param on_change: Called with the new keys after the file has changed.
+        :param interval: Seconds between checks of the file.
+        """
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.logger = get_logger(type(self))
+
+        self._stamp = self._file_stamp()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """
+        Start watching the file.
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True, name="key-file-watcher")
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop watching the file.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def check(self) -> bool:
+        """
+        Reload the file if it has changed since the last check.
+
+        :return: Whether new keys were installed.
+        """
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+
+        try:
+            key_set = load_key_set(self.path)
+        except (OSError, ValueError) as e:
+            self.logger.error("Could not reload keys, keeping the previous keys: %s", e)
+            return False
+        self.logger.info(
+            "Reloaded %d keys from %s, signing with key %s",
+            len(key_set.keys),
+            self.path,
+            key_set.current,
+        )
+        self.on_change(key_set)
+        return True
+
+    def _file_stamp(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                self.logger.exception("Error while checking key file %s", self.path)
@@ -1,15 +1,34 @@
 """
 Logging subsystem helpers.
 """
+import atexit
+import functools
 import logging
-from typing import Any, Callable, Union
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import IO, Any, Callable, NamedTuple, Optional, Union
 
 _FORMAT = "%(asctime)s %(levelname)s [%(thread)5d] [%(name)s] %(message)s"
 
+# Logger for the one-line summary of each request
+_ACCESS_LOGGER_NAME = "jwt_proxy.access"
 
+# A disabled logger, which handlers use instead of their own for requests not sampled for detail
+_SUPPRESSED_LOGGER = logging.getLogger("jwt_proxy.suppressed")
+_SUPPRESSED_LOGGER.disabled = True
+
+# The writer thread, when logging through a queue
+_listener: Optional[QueueListener] = None
+
+
+@functools.lru_cache(maxsize=None)
 def get_logger(name: Union[str, Callable[[...], Any]]) -> logging.Logger:
     """
-    Get a named logger.
+    Get a named logger. Handlers get their logger for every connection, so loggers are cached
+    here rather than looked up under the logging module's global lock each time.
 
     :param name: The name, or a callable which will have a name auto-generated.
     :return:
@@ -21,9 +40,153 @@ def get_logger(name: Union[str, Callable[[...], Any]]) -> logging.Logger:
     return logging.getLogger(real_name)
 
 
-def init_logging() -> None:
+class LogSettings(NamedTuple):
+    """
+    Settings for the logging done while handling requests.
+    """
+
+    #: Fraction of requests for which details such as headers and bodies are logged.
+    detail_sample_rate: float = 1.0
+    #: Maximum number of bytes of a request body included in the log.
+    body_max_bytes: int = 1024
+
+    @classmethod
+    def from_environment(cls) -> "LogSettings":
+        """
+        Read the settings from the ``LOG_DETAIL_SAMPLE_RATE`` and ``LOG_BODY_MAX_BYTES``
+        environment variables.
+        """
+        return cls(
+            detail_sample_rate=float(os.environ.get("LOG_DETAIL_SAMPLE_RATE", 1.0)),
+            body_max_bytes=int(os.environ.get("LOG_BODY_MAX_BYTES", 1024)),
+        )
+
+    def detail_logger(self, logger: logging.Logger) -> logging.Logger:
+        """
+        Choose the logger for the details of a request: the given one if the request is sampled,
+        otherwise a disabled logger, whose calls return without formatting anything.
+
+        :param logger: The handler's logger.
+        :return: The logger for request details.
+        """
+        if self.detail_sample_rate >= 1 or random.random() < self.detail_sample_rate:
+            return logger
+        return _SUPPRESSED_LOGGER
+
+    def truncate_body(self, body: bytes) -> bytes:
+        """
+        Cut a body down to the size allowed in the log.
+        """
+        return body[: self.body_max_bytes]
+
+
+def suppressed_logger() -> logging.Logger:
+    """
+    Get the disabled logger used for requests whose details are not logged.
+    """
+    return _SUPPRESSED_LOGGER
+
+
+def log_access(client: str, requestline: str, status: int, duration: float) -> None:
+    """
+    Log the one-line summary of a completed request.
+
+    :param client: The client address.
+    :param requestline: The request line.
+    :param status: The response status.
+    :param duration: Seconds taken to handle the request.
+    """
+    logging.getLogger(_ACCESS_LOGGER_NAME).info(
+        '%s "%s" %d %.2fms', client, requestline, status, duration * 1000
+    )
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    A queue handler which leaves formatting to the writer thread, and drops records instead of
+    blocking when the queue is full.
+
+    :class:`QueueHandler` formats records before queueing them, so that they can be pickled; here
+    they stay in the process, so the arguments are formatted later, off the request thread. Log
+    arguments must therefore not be modified after logging, which holds for the strings, numbers
+    and bytes logged by the servers.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def dropped_log_records() -> int:
+    """
+    Get the number of log records dropped because the queue was full.
+    """
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, _DeferredQueueHandler):
+            return handler.dropped
+    return 0
+
+
+def init_logging(stream: Optional[IO[str]] = None) -> None:
     """
     Initialize the logging system with standard configuration.
+
+    The level is set by ``LOG_LEVEL`` (default ``DEBUG``). With ``LOG_QUEUE_SIZE`` above 0,
+    request threads only put records on a queue of that size, and a single writer thread formats
+    and writes them.
+
+    :param stream: The stream to write to, by default standard error.
     """
+    global _listener
+
+    stop_logging()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(_FORMAT))
+    root.setLevel(os.environ.get("LOG_LEVEL", "DEBUG").upper())
+
+    queue_size = int(os.environ.get("LOG_QUEUE_SIZE", 0))
+    if queue_size <= 0:
+        root.addHandler(handler)
+        return
+
+    queue_handler = _DeferredQueueHandler(queue.Queue(queue_size))
+    root.addHandler(queue_handler)
+    _listener = QueueListener(queue_handler.queue, handler)
+    _listener.start()
+
+    def restart_in_child():
+        # The writer thread does not survive a fork, and the queue's lock may have been held by it
+        global _listener
+        if queue_handler not in logging.getLogger().handlers:
+            return
+        queue_handler.queue = queue.Queue(queue_size)
+        _listener = QueueListener(queue_handler.queue, handler)
+        _listener.start()
+
+    os.register_at_fork(after_in_child=restart_in_child)
+
+
+def stop_logging() -> None:
+    """
+    Write the queued log records, and stop the writer thread, if any.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
 
-    logging.basicConfig(format=_FORMAT, level=logging.DEBUG)
+atexit.register(stop_logging)
@@ -0,0 +1,325 @@
+"""
+Low-overhead metrics: counters and latency histograms recorded without locks into per-thread
+shards, which are only combined when the metrics are read, and rendered in the Prometheus text
+exposition format.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Label values of a sample, in the order of the metric's label names
+Labels = Tuple[str, ...]
+
+# Latency histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Content type of the Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricDefinition(NamedTuple):
+    """
+    The description of a metric.
+    """
+
+    #: ``counter``, ``gauge`` or ``histogram``.
+    kind: str
+    #: The help text.
+    help: str
+    #: The label names.
+    label_names: Tuple[str, ...]
+    #: The histogram bucket upper bounds.
+    buckets: Tuple[float, ...] = ()
+    #: For metrics computed when read, returns the samples as (label values, value).
+    callback: Optional[Callable[[], Iterable[Tuple[Labels, float]]]] = None
+
+
+class _Shard:
+    """
+    The metrics recorded by one thread. Only the owning thread writes to it.
+    """
+
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        # Values are the count of each bucket including +Inf, followed by the sum
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+
+    def merge(self, other: "_Shard") -> None:
+        # Copying is atomic under the GIL, so the owning thread may keep writing meanwhile
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, values in list(other.histograms.items()):
+            values = list(values)
+            combined = self.histograms.get(key)
+            if combined is None:
+                self.histograms[key] = values
+            else:
+                for i, value in enumerate(values):
+                    combined[i] += value
+
+
+class Metrics:
+    """
+    A registry of metrics. Recording a value only touches a shard owned by the current thread,
+    so request threads never contend on a lock. Reading combines all shards. The shards of
+    finished threads are folded into a single one whenever a thread registers a new shard or the
+    metrics are read, so that a thread per connection neither grows memory nor makes reads slower
+    over time, even if the metrics are never read.
+
+    Metrics must be defined with :meth:`counter`, :meth:`histogram` or :meth:`gauge` before they
+    are recorded.
+    """
+
+    def __init__(self):
+        self.definitions: Dict[str, MetricDefinition] = {}
+        self._local = threading.local()
+        self._shards_lock = threading.Lock()
+        self._shards: List[Tuple[threading.Thread, _Shard]] = []
+        # Metrics of threads which have finished
+        self._retired = _Shard()
+
+    def counter(self, name: str, help: str, label_names: Tuple[str, ...] = ()) -> None:
+        """
+        Define a counter.
+
+        :param name: The metric name.
+        :param help: The help text.
+        :param label_names: The label names.
+        """
+        self.definitions[name] = MetricDefinition("counter", help, label_names)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        """
+        Define a histogram.
+
+        :param name: The metric name.
+        :param help: The help text.
+        :param label_names: The label names.
+        :param buckets: The bucket upper bounds, in increasing order.
+        """
+        self.definitions[name] = MetricDefinition("histogram", help, label_names, tuple(buckets))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        callback: Callable[[], Iterable[Tuple[Labels, float]]],
+        label_names: Tuple[str, ...] = (),
+        kind: str = "gauge",
+    ) -> None:
+        """
+        Define a metric whose value is computed when the metrics are read, such as a queue depth,
+        or a counter kept elsewhere.
+
+        :param name: The metric name.
+        :param help: The help text.
+        :param callback: Returns the samples, as (label values, value).
+        :param label_names: The label names.
+        :param kind: The Prometheus type, ``gauge`` or ``counter``.
+        """
+        self.definitions[name] = MetricDefinition(kind, help, label_names, callback=callback)
+
+    def _shard(self) -> _Shard:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._shards_lock:
+                self._retire_finished()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _retire_finished(self) -> None:
+        # Fold the shards of finished threads into the retired one. Called with the lock held.
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._retired.merge(shard)
+        self._shards = live
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1) -> None:
+        """
+        Increment a counter.
+
+        :param name: The metric name.
+        :param labels: The label values.
+        :param value: The increment.
+        """
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Labels = ()) -> None:
+        """
+        Record a value in a histogram.
+
+        :param name: The metric name.
+        :param value: The value, such as a duration in seconds.
+        :param labels: The label values.
+        """
+        buckets = self.definitions[name].buckets
+        histograms = self._shard().histograms
+        key = (name, labels)
+        values = histograms.get(key)
+        if values is None:
+            values = histograms[key] = [0] * (len(buckets) + 2)
+        values[bisect_left(buckets, value)] += 1
+        values[-1] += value
+
+    def collect(self) -> _Shard:
+        """
+        Combine the metrics recorded by all threads.
+        """
+        combined = _Shard()
+        with self._shards_lock:
+            self._retire_finished()
+            combined.merge(self._retired)
+            for _, shard in self._shards:
+                combined.merge(shard)
+        return combined
+
+    def get(self, name: str, labels: Labels = ()) -> float:
+        """
+        Get the combined value of a counter.
+        """
+        return self.collect().counters.get((name, labels), 0)
+
+    def get_histogram(self, name: str, labels: Labels = ()) -> Tuple[int, float]:
+        """
+        Get the combined count and sum of a histogram.
+        """
+        values = self.collect().histograms.get((name, labels))
+        if values is None:
+            return 0, 0.0
+        return int(sum(values[:-1])), values[-1]
+
+    def render_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        combined = self.collect()
+        counters: Dict[str, List[Tuple[Labels, float]]] = {}
+        for (name, labels), value in combined.counters.items():
+            counters.setdefault(name, []).append((labels, value))
+        histograms: Dict[str, List[Tuple[Labels, List[float]]]] = {}
+        for (name, labels), values in combined.histograms.items():
+            histograms.setdefault(name, []).append((labels, values))
+
+        lines = []
+        for name, definition in self.definitions.items():
+            lines.append(f"# HELP {name} {_escape_help(definition.help)}")
+            lines.append(f"# TYPE {name} {definition.kind}")
+            names = definition.label_names
+            if definition.callback is not None:
+                for labels, value in definition.callback():
+                    lines.append(f"{name}{_format_labels(names, labels)} {_format_value(value)}")
+            elif definition.kind == "histogram":
+                for labels, values in sorted(histograms.get(name, [])):
+                    cumulative = 0
+                    for bound, count in zip(definition.buckets + (float("inf"),), values):
+                        cumulative += count
+                        bucket_labels = _format_labels(
+                            names + ("le",), labels + (_format_value(bound),)
+                        )
+                        lines.append(f"{name}_bucket{bucket_labels} {_format_value(cumulative)}")
+                    label_text = _format_labels(names, labels)
+                    lines.append(f"{name}_sum{label_text} {_format_value(values[-1])}")
+                    lines.append(f"{name}_count{label_text} {_format_value(cumulative)}")
+            else:
+                samples = counters.get(name) or ([((), 0)] if not names else [])
+                for labels, value in sorted(samples):
+                    lines.append(f"{name}{_format_labels(names, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class PhaseTimer:
+    """
+    Measures the consecutive phases of handling one request. Each phase lasts from the end of the
+    previous one, or from the creation of the timer, until it is marked.
+    """
+
+    __slots__ = ("phases", "_last")
+
+    def __init__(self):
+        #: Seconds spent in each phase, in the order the phases first ended
+        self.phases: Dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def mark(self, phase: str) -> None:
+        """
+        End a phase. A phase which is marked again, such as when a request is retried, accumulates.
+
+        :param phase: The phase name.
+        """
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def observe(self, metrics: Metrics, name: str) -> None:
+        """
+        Record the phases in a histogram labelled by ``phase``.
+
+        :param metrics: The metrics registry.
+        :param name: The histogram name.
+        """
+        for phase, duration in self.phases.items():
+            metrics.observe(name, duration, (phase,))
+
+    def server_timing(self) -> str:
+        """
+        Format the phases for the ``Server-Timing`` response header, in milliseconds.
+        """
+        return ", ".join(
+            f"{phase};dur={duration * 1000:.3f}" for phase, duration in self.phases.items()
+        )
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Labels) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -0,0 +1,86 @@
+"""
+A sampling profiler for the live process, which periodically records the stack of every thread and
+aggregates identical stacks, so that it sees all request threads and the event loop alike, unlike
+:mod:`cProfile` which only profiles the thread that runs it.
+"""
+
+import gc
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict
+from urllib.parse import parse_qs
+
+# Path of the profiling endpoint on both servers
+PROFILE_PATH = "/debug/profile"
+
+# Longest profile which can be requested, in seconds
+MAX_PROFILE_SECONDS = 60.0
+
+
+def sample_stacks(duration: float, interval: float = 0.005) -> "Counter[str]":
+    """
+    Sample the stacks of all other threads.
+
+    :param duration: Seconds to sample for.
+    :param interval: Seconds between samples.
+    :return: The number of samples of each stack, as frames from the outermost to the innermost
+             joined by ``;``, prefixed by the thread name.
+    """
+    own = threading.get_ident()
+    names: Dict[int, str] = {}
+    stacks: "Counter[str]" = Counter()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        # sys._current_frames() holds the lock on the interpreter's threads, and a collection
+        # inside it can run a finalizer which releases the GIL, such as a socket's, and deadlock
+        # with a thread starting or exiting, so collections are paused meanwhile
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            current_frames = sys._current_frames()
+        finally:
+            if collecting:
+                gc.enable()
+        for ident, frame in current_frames.items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            if ident not in names:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def format_stacks(stacks: "Counter[str]", limit: int = 100) -> str:
+    """
+    Format sampled stacks in the collapsed format read by flame graph tools, most frequent first.
+
+    :param stacks: The stacks from :func:`sample_stacks`.
+    :param limit: The maximum number of stacks.
+    :return: One line per stack, with the number of samples at the end.
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common(limit))
+
+
+def parse_profile_duration(query: str, default: float = 5.0) -> float:
+    """
+    Get the profile duration from the ``seconds`` query parameter.
+
+    :param query: The query string of the request.
+    :param default: The duration if not given.
+    :return: The duration in seconds.
+    :raises ValueError: if the duration is invalid or longer than :data:`MAX_PROFILE_SECONDS`.
+    """
+    values = parse_qs(query).get("seconds")
+    seconds = float(values[0]) if values else default
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise ValueError(f"seconds must be between 0 and {MAX_PROFILE_SECONDS:g}")
+    return seconds
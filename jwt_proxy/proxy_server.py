@@ -1,32 +1,1018 @@
 """
-Implements an HTTP server which adds a signed JWT header to POST requests.
+Implements an HTTP server which adds a signed JWT header to requests.
 """
-import getpass
-import os
+import math
+import select
+import socket
+import time
 from collections import OrderedDict
-from datetime import date
+from contextlib import ExitStack, contextmanager
 from http import HTTPStatus
-from http.client import HTTPResponse
-from urllib.error import HTTPError
-from urllib.parse import urlparse, urlunparse
-from urllib.request import Request, urlopen
+from http.client import (
+    HTTPConnection,
+    HTTPException,
+    HTTPResponse,
+    IncompleteRead,
+    RemoteDisconnected,
+)
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlsplit, urlunsplit
 
-from jwt_proxy.http_base import ProxyBaseHTTPRequestHandler
-from jwt_proxy.jwt import encode_jwt_hs512
+from jwt_proxy.balancer import Upstream, UpstreamBalancer
+from jwt_proxy.breaker import BREAKER_STATES, CircuitOpenError
+from jwt_proxy.cache import (
+    CachedResponse,
+    ResponseCache,
+    get_header,
+    is_storable,
+    parse_cache_control,
+)
+from jwt_proxy.compression import Compressor, choose_encoding, is_compressible_type
+from jwt_proxy.concurrency import AdaptiveLimiter, ConcurrencyLimitExceeded
+from jwt_proxy.config import ProxyConfig, ProxyState, read_settings
+from jwt_proxy.http_base import (
+    BODY_CHUNK_SIZE,
+    LAST_CHUNK,
+    BodyFramingError,
+    ProxyBaseHTTPRequestHandler,
+    encode_chunk,
+)
+from jwt_proxy.logger import get_logger
+from jwt_proxy.metrics import PhaseTimer
+from jwt_proxy.profiler import PROFILE_PATH
+from jwt_proxy.relay import SocketBody, SourceError, relay
+from jwt_proxy.retry import (
+    RETRYABLE_STATUSES,
+    LatencyTracker,
+    backoff_delay,
+    is_retryable,
+)
+from jwt_proxy.tokens import (
+    TokenPool,
+    close_token_source,
+    create_token_source,
+    token_factory,
+)
+from jwt_proxy.upstream import UpstreamConnectionPool, UpstreamPoolExhausted
 
+_UPSTREAM_ERRORS_METRIC_KEY = "upstream_errors_total"
+_PHASE_DURATION_METRIC_KEY = "proxy_phase_duration_seconds"
+_UPSTREAM_RETRIES_METRIC_KEY = "upstream_retries_total"
+_UPSTREAM_HEDGES_METRIC_KEY = "upstream_hedged_requests_total"
+_COMPRESSED_RESPONSES_METRIC_KEY = "compressed_responses_total"
+_COMPRESSION_CPU_METRIC_KEY = "compression_cpu_seconds_total"
+_COMPRESSION_BYTES_METRIC_KEY = "compression_bytes_total"
 
-class ProxyRequestHandler(ProxyBaseHTTPRequestHandler):
+# Headers which only apply to a single connection, and must not be forwarded (RFC 7230 section 6.1)
+HOP_BY_HOP_HEADERS = frozenset(
+    [
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "proxy-connection",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    ]
+)
+
+
+# Methods which must have a request body, delimited by Content-Length or chunked encoding
+METHODS_WITH_BODY = frozenset(("POST", "PUT", "PATCH"))
+
+# The proxy's own endpoints, for which GET requests are not forwarded
+LOCAL_PATHS = frozenset(("/status", "/metrics", PROFILE_PATH))
+
+# Conditional request headers, which the cache replaces with its own when it fetches a response
+_CONDITIONAL_HEADERS = frozenset(("if-none-match", "if-modified-since"))
+
+
+def _wait_readable(conns: List[HTTPConnection], timeout: Optional[float]) -> List[HTTPConnection]:
+    """
+    Wait until the sockets of upstream connections are readable, which means that a response has
+    started, or that the connection was closed.
+
+    :param conns: The connections.
+    :param timeout: Seconds to wait, or None to wait forever.
+    :return: The readable connections, in the given order, or an empty list after the timeout.
+    """
+    poller = select.poll()
+    for conn in conns:
+        poller.register(conn.sock, select.POLLIN)
+    events = poller.poll(None if timeout is None else timeout * 1000)
+    ready = {fd for fd, _ in events}
+    return [conn for conn in conns if conn.sock.fileno() in ready]
+
+
+class HedgeTarget:
+    """
+    The upstream a hedged copy of a request is sent to. It is chosen by the balancer when the copy
+    is due, and admitted like any other request by its circuit breaker and, without waiting, by
+    the concurrency limiter; the admission is held until :meth:`close`. The race between the two
+    requests sets :attr:`winner` and :attr:`loser_failed`, from which :meth:`record` records the
+    outcome for each upstream.
+    """
+
+    def __init__(self, balancer: UpstreamBalancer, limiter: Optional[AdaptiveLimiter], path: str):
+        """
+        :param balancer: The balancer which chose the upstream of the request.
+        :param limiter: The concurrency limiter, if any.
+        :param path: The URL path of the request, including the query.
+        """
+        self.balancer = balancer
+        self.limiter = limiter
+        self.path = path
+        #: The upstream the copy is sent to, or None if it was not sent.
+        self.upstream: Optional[Upstream] = None
+        #: The generation of the upstream's circuit breaker the copy was let through in.
+        self.generation = 0
+        #: ``primary`` or ``hedge``, whichever request answered first, once one has.
+        self.winner: Optional[str] = None
+        #: Whether the request which did not answer first failed.
+        self.loser_failed = False
+        self._admission: Optional[ExitStack] = None
+
+    def choose(self) -> Optional[str]:
+        """
+        Choose and admit the upstream for the copy. A request is hedged at most once.
+
+        :return: The URL to send the copy to, or None if it should not be sent, because the
+                 concurrency limit is reached or the circuit breaker of the upstream refuses it.
+        """
+        if self._admission is not None:
+            return None
+        self._admission = ExitStack()
+        if self.limiter is not None:
+            if not self.limiter.try_acquire():
+                return None
+            self._admission.callback(self.limiter.release)
+        try:
+            self.upstream, self.generation = self._admission.enter_context(
+                self.balancer.select(self.path)
+            )
+        except CircuitOpenError:
+            self._admission.close()
+            return None
+        return self.upstream.build_url(self.path)
+
+    def abandon(self) -> None:
+        """
+        Give the admission back right away, as the copy could not be sent.
+        """
+        if self.upstream is not None:
+            self.balancer.release(self.upstream, self.generation)
+            self.upstream = None
+        self.close()
+
+    def record(self, upstream: Upstream, generation: int, success: bool) -> None:
+        """
+        Record the outcome of a request in the circuit breakers of the upstreams it was sent to.
+        Without a copy, that is ``upstream``'s outcome. Otherwise it is the outcome of the upstream
+        which answered first, and the other one counts as failed if its request failed, and is
+        released if it was cut short.
+
+        :param upstream: The upstream the request was first sent to.
+        :param generation: The generation of its circuit breaker the request was let through in.
+        :param success: Whether the first response came without a server error, or False if no
+                        response came.
+        """
+        if self.upstream is None:
+            self.balancer.record(upstream, generation, success)
+        elif self.winner is None:
+            self.balancer.record(upstream, generation, False)
+            self.balancer.record(self.upstream, self.generation, False)
+        else:
+            primary, hedge = (upstream, generation), (self.upstream, self.generation)
+            answered, other = (primary, hedge) if self.winner == "primary" else (hedge, primary)
+            self.balancer.record(*answered, success)
+            if self.loser_failed:
+                self.balancer.record(*other, False)
+            else:
+                self.balancer.release(*other)
+
+    def close(self) -> None:
+        """
+        End the admission of the copy, if any.
+        """
+        if self._admission is not None:
+            self._admission.close()
+
+
+def response_has_body(method: str, status: int) -> bool:
     """
-    An HTTP server which adds a signed JWT header to POST requests.
+    Check whether a response can have a message body (RFC 7230 section 3.3.3).
+
+    :param method: The request method.
+    :param status: The response status.
+    :return: Whether the response has a body.
+    """
+    return method != "HEAD" and status >= 200 and status not in (204, 304)
+
+
+def is_response_chunked(headers: List[Tuple[str, str]]) -> bool:
+    """
+    Check whether response headers returned by :meth:`ProxyRequestMixin.frame_response` require
+    chunked encoding.
+    """
+    return any(name == "Transfer-Encoding" for name, _ in headers)
+
+
+def create_proxy_metrics(server) -> None:
+    """
+    Define the proxy's metrics on a server, once its upstream pool and token source are created.
+    """
+    metrics = server.metrics
+    metrics.histogram(
+        _PHASE_DURATION_METRIC_KEY,
+        "Time spent in each phase of proxying a request: read_body (reading a buffered request "
+        "body), token (obtaining the JWT), connect (checking out or opening an upstream "
+        "connection), upstream (sending the request until the upstream response headers arrive) "
+        "and respond (relaying the response to the client).",
+        ("phase",),
+    )
+    metrics.counter(
+        _UPSTREAM_ERRORS_METRIC_KEY,
+        "Upstream requests which failed, by reason: status (an error status from the upstream), "
+        "connect, timeout, relay (the response body was cut short) or pool_exhausted.",
+        ("reason",),
+    )
+    metrics.counter(
+        _UPSTREAM_RETRIES_METRIC_KEY,
+        "Upstream requests sent again, by the reason the previous attempt failed: error, "
+        "timeout or status (502, 503 or 504).",
+        ("reason",),
+    )
+    metrics.counter(
+        _UPSTREAM_HEDGES_METRIC_KEY,
+        "Late upstream requests raced by a copy, by which one answered first: primary or hedge.",
+        ("winner",),
+    )
+
+    metrics.counter(
+        _COMPRESSED_RESPONSES_METRIC_KEY,
+        "Responses compressed for the client, by content coding.",
+        ("encoding",),
+    )
+    metrics.counter(
+        _COMPRESSION_CPU_METRIC_KEY, "CPU time spent compressing responses.", ("encoding",)
+    )
+    metrics.counter(
+        _COMPRESSION_BYTES_METRIC_KEY,
+        "Bytes of compressed response bodies, before (in) and after (out) compression; the "
+        "difference is the bytes saved.",
+        ("direction",),
+    )
+
+    def pool_stats(*names):
+        return lambda: [((name,), server.upstream_pool.stats()[name]) for name in names]
+
+    metrics.gauge(
+        "upstream_pool_connections",
+        "Upstream connections, by state.",
+        pool_stats("in_use", "idle"),
+        ("state",),
+    )
+    metrics.gauge(
+        "upstream_pool_checkouts_total",
+        "Upstream connection checkouts, by whether an idle connection was reused.",
+        pool_stats("hits", "misses"),
+        ("result",),
+        kind="counter",
+    )
+    metrics.gauge(
+        "upstream_healthy",
+        "Whether each upstream is in rotation, according to the health checks.",
+        lambda: [((url,), int(healthy)) for url, healthy, _ in server.proxy_state.balancer.stats()],
+        ("upstream",),
+    )
+    metrics.gauge(
+        "upstream_outstanding_requests",
+        "Requests in progress to each upstream.",
+        lambda: [
+            ((url,), outstanding) for url, _, outstanding in server.proxy_state.balancer.stats()
+        ],
+        ("upstream",),
+    )
+    metrics.gauge(
+        "upstream_circuit_state",
+        "The state of each upstream's circuit breaker: 0 closed, 1 half-open (probing the "
+        "upstream) or 2 open (refusing requests).",
+        lambda: [
+            ((url,), BREAKER_STATES.index(breaker.state))
+            for url, breaker in server.proxy_state.balancer.breaker_stats()
+        ],
+        ("upstream",),
+    )
+    metrics.gauge(
+        "upstream_circuit_transitions_total",
+        "Circuit breaker state changes, by upstream and the state entered.",
+        lambda: [
+            ((url, state), count)
+            for url, breaker in server.proxy_state.balancer.breaker_stats()
+            for state, count in breaker.transitions.items()
+        ],
+        ("upstream", "state"),
+        kind="counter",
+    )
+    metrics.gauge(
+        "upstream_short_circuited_total",
+        "Requests refused without being sent, because the upstream's circuit breaker was open.",
+        lambda: [
+            ((url,), breaker.short_circuited)
+            for url, breaker in server.proxy_state.balancer.breaker_stats()
+        ],
+        ("upstream",),
+        kind="counter",
+    )
+
+    def limiter_stats(name):
+        limiter = server.proxy_state.concurrency_limiter
+        return [] if limiter is None else [((), getattr(limiter, name))]
+
+    metrics.gauge(
+        "upstream_concurrency_limit",
+        "The adaptive limit on requests in flight to the upstreams.",
+        lambda: limiter_stats("limit"),
+    )
+    metrics.gauge(
+        "upstream_requests_in_flight",
+        "Requests in flight to the upstreams, admitted by the concurrency limiter.",
+        lambda: limiter_stats("in_flight"),
+    )
+    metrics.gauge(
+        "upstream_concurrency_rejected_total",
+        "Requests refused because the concurrency limit was reached.",
+        lambda: limiter_stats("rejected"),
+        kind="counter",
+    )
+
+    def rate_limit_stats(name):
+        limiter = server.proxy_state.rate_limiter
+        return [] if limiter is None else [((), limiter.stats()[name])]
+
+    metrics.gauge(
+        "rate_limited_requests_total",
+        "Requests refused because their client exceeded its rate limit.",
+        lambda: rate_limit_stats("rejected"),
+        kind="counter",
+    )
+    metrics.gauge(
+        "rate_limit_clients",
+        "Clients whose request rate is tracked.",
+        lambda: rate_limit_stats("clients"),
+    )
+    metrics.gauge(
+        "rate_limit_evictions_total",
+        "Clients no longer tracked, to make room for other clients.",
+        lambda: rate_limit_stats("evicted"),
+        kind="counter",
+    )
+    if server.response_cache is not None:
+
+        def cache_stats(*names):
+            return lambda: [((name,), server.response_cache.stats()[name]) for name in names]
+
+        metrics.gauge(
+            "response_cache_lookups_total",
+            "Cacheable requests, by result: hit, coalesced (a hit after waiting for a concurrent "
+            "fetch), revalidated (a stale entry confirmed by the upstream) or miss.",
+            cache_stats("hit", "coalesced", "revalidated", "miss"),
+            ("result",),
+            kind="counter",
+        )
+        metrics.gauge(
+            "response_cache_bytes",
+            "Memory used by cached responses.",
+            lambda: [((), server.response_cache.stats()["bytes"])],
+        )
+        metrics.gauge(
+            "response_cache_entries",
+            "Cached responses.",
+            lambda: [((), server.response_cache.stats()["entries"])],
+        )
+        metrics.gauge(
+            "response_cache_evictions_total",
+            "Cached responses evicted to make room for new ones.",
+            lambda: [((), server.response_cache.stats()["evictions"])],
+            kind="counter",
+        )
+    if isinstance(server.token_source, TokenPool):
+        metrics.gauge(
+            "token_pool_depth",
+            "Pre-minted tokens buffered.",
+            lambda: [((), server.token_source.stats()["depth"])],
+        )
+        metrics.gauge(
+            "token_pool_fallbacks_total",
+            "Tokens minted synchronously because the pool was empty.",
+            lambda: [((), server.token_source.stats()["fallbacks"])],
+            kind="counter",
+        )
+
+
+class ProxyRequestMixin:
+    """
+    Request processing shared by the proxy's request handlers for all server engines.
+    Classes using this mixin must provide a ``logger`` and the server as ``_server``.
     """
 
     server_version = "JWTProxyServer"
 
     JWT_TOKEN_HEADER = "x-my-jwt"
 
-    def do_POST(self):
+    # The configuration, balancer and limiters for the current request, read once from the
+    # server when it starts
+    proxy_state: Optional[ProxyState] = None
+    # The configuration for the current request, from proxy_state
+    config: Optional[ProxyConfig] = None
+    # Timing of the phases of the current request
+    timer: Optional[PhaseTimer] = None
+    # The compressor of the response being relayed, if it is compressed for the client
+    compressor: Optional[Compressor] = None
+    # The length of the current request's body, or None if it is chunked or absent
+    body_length: Optional[int] = None
+
+    @classmethod
+    def init_proxy_server(cls, server, upstream_pool, response_cache) -> None:
+        """
+        Attach the configuration, token source, upstream pool and response cache to a server, and
+        define the proxy's metrics. Shared by the ``init_server`` hooks of both engines.
+
+        :param server: The server.
+        :param upstream_pool: The engine's upstream connection pool.
+        :param response_cache: The engine's response cache, or None if caching is disabled.
+        """
+        settings = read_settings()
+        server.proxy_state = ProxyState.create(ProxyConfig.from_settings(settings))
+        server.token_source = create_token_source(settings)
+        server.upstream_pool = upstream_pool
+        server.response_cache = response_cache
+        server.upstream_latency = LatencyTracker()
+        create_proxy_metrics(server)
+
+    @classmethod
+    def reload_server(cls, server) -> None:
+        """
+        Reload the configuration from the environment and ``PROXY_CONFIG_FILE``. Requests started
+        afterwards use the new configuration, while those in progress finish with the old one.
+        The configuration, balancer and limiters are published together as one
+        :class:`~jwt_proxy.config.ProxyState`. An invalid configuration is logged, and the current
+        one kept.
+
+        :param server: The server.
+        """
+        logger = get_logger(cls)
+        try:
+            config = ProxyConfig.from_environment()
+        except (OSError, ValueError) as e:
+            logger.error("Keeping the current configuration, the new one is invalid: %s", e)
+            return
+
+        old_state = server.proxy_state
+        factory = token_factory(server.token_source)
+        if config.keys_file != old_state.config.keys_file:
+            logger.warning("Changing JWT_KEYS_FILE requires a restart, ignoring the change")
+            config = config._replace(
+                keys_file=old_state.config.keys_file, signing_key=old_state.config.signing_key
+            )
+        elif config.signing_key is not None and config.signing_key != factory.key:
+            factory.set_key(config.signing_key)
+        elif factory.key_watcher is not None:
+            factory.key_watcher.check()
+        # Requests in progress release the balancer and limiter of the state they read
+        state = old_state.reconfigure(config)
+        server.proxy_state = state
+        if state.balancer is not old_state.balancer:
+            # Without waiting for a health check in progress, which may block the event loop
+            old_state.balancer.close(wait=False)
+        logger.info("Reloaded configuration, upstreams %s", ", ".join(config.upstreams))
+
+    def create_token(self) -> bytes:
+        """
+        Create the signed JWT token for the current user and date.
+
+        :return: The token.
+        """
+        return self._server.token_source.create_token()
+
+    def count_upstream_error(self, reason: str) -> None:
+        """
+        Count a failed upstream request in the metrics.
+
+        :param reason: ``status``, ``connect``, ``timeout``, ``relay`` or ``pool_exhausted``.
+        """
+        self._server.metrics.inc(_UPSTREAM_ERRORS_METRIC_KEY, (reason,))
+
+    def can_resend(self, body) -> bool:
+        """
+        Whether the request may be sent to the upstream more than once, by retries or hedging: it
+        must be :func:`~jwt_proxy.retry.is_retryable`, and its body must be complete.
+
+        :param body: The request body as passed to the upstream request.
+        """
+        return isinstance(body, (bytes, type(None))) and is_retryable(self.command, self.headers)
+
+    def retry_attempts(self, body) -> int:
+        """
+        The number of times the request may be sent to an upstream: once, plus the configured
+        retries if it :meth:`can_resend`.
+        """
+        return 1 + self.config.retries if self.can_resend(body) else 1
+
+    def retry_delay(self, retry: int, reason: str) -> float:
+        """
+        Count a retry, and get the delay before it.
+
+        :param retry: The number of the retry, from 1.
+        :param reason: Why the previous attempt failed: ``error``, ``timeout`` or ``status``.
+        :return: The delay in seconds.
+        """
+        self._server.metrics.inc(_UPSTREAM_RETRIES_METRIC_KEY, (reason,))
+        return backoff_delay(retry, self.config.retry_backoff)
+
+    def hedge_delay(self, body) -> Optional[float]:
+        """
+        The delay after which the request is hedged, if hedging is enabled and the request may be
+        sent twice: the configured percentile of recent upstream latencies, or the minimum delay
+        if it is higher.
+
+        :param body: The request body as passed to the upstream request.
+        :return: The delay in seconds, or None to not hedge the request.
+        """
+        config = self.config
+        if not config.hedging or not self.can_resend(body):
+            return None
+        latency = self._server.upstream_latency.percentile(config.hedge_percentile)
+        if latency is None:
+            return None
+        return max(config.hedge_min_delay, latency)
+
+    def count_hedge(self, winner: str) -> None:
+        """
+        Count a hedged request in the metrics.
+
+        :param winner: ``primary`` or ``hedge``.
+        """
+        self._server.metrics.inc(_UPSTREAM_HEDGES_METRIC_KEY, (winner,))
+
+    def short_circuit_response(
+        self, error: Union[CircuitOpenError, ConcurrencyLimitExceeded], req_body
+    ) -> Tuple[int, List[Tuple[str, str]], bytes]:
+        """
+        Build the response to a request refused by a circuit breaker or the concurrency limiter:
+        ``503 Service Unavailable``, with a ``Retry-After`` header.
+
+        :param error: The error raised by the balancer or the limiter.
+        :param req_body: The request body as passed to the upstream request. If it was not read
+                         completely, the connection is closed after the response.
+        :return: The status, headers and body for the client.
+        """
+        self.logger.warning("%s, refusing the request", error)
+        if not isinstance(req_body, (bytes, type(None))):
+            self.close_connection = True
+        body = f"503 {error.reason}".encode("utf-8")
+        headers = [
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+            ("Retry-After", str(max(1, math.ceil(error.retry_after)))),
+        ]
+        return HTTPStatus.SERVICE_UNAVAILABLE, headers + self.server_timing_headers(), body
+
+    def rate_limit_response(self) -> Optional[Tuple[int, List[Tuple[str, str]], bytes]]:
+        """
+        Take a token from the rate limit of the request's client, identified by the configured
+        header, or by its IP address. This is checked before the request body is read or a token
+        is minted, so that refused requests cost as little as possible.
+
+        :return: None if the request is allowed, or else the status, headers and body of a
+                 ``429 Too Many Requests`` response for the client, with a ``Retry-After`` header.
+        """
+        limiter = self.proxy_state.rate_limiter
+        if limiter is None:
+            return None
+        client = None
+        if self.config.rate_limit_header is not None:
+            client = self.headers.get(self.config.rate_limit_header)
+        if client is None:
+            client = self.client_address[0]
+        retry_after = limiter.acquire(client)
+        if retry_after is None:
+            return None
+
+        self.detail_logger.info("Client %s exceeded its rate limit, refusing the request", client)
+        # The body is left unread, so the connection cannot be used for another request
+        if "Transfer-Encoding" in self.headers or self.headers.get("Content-Length", "0") != "0":
+            self.close_connection = True
+        body = b"429 rate limit exceeded"
+        headers = [
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+            ("Retry-After", str(max(1, math.ceil(retry_after)))),
+        ]
+        return HTTPStatus.TOO_MANY_REQUESTS, headers, body
+
+    def observe_phases(self) -> None:
+        """
+        Record the phases timed for the current request in the metrics.
+        """
+        self.timer.observe(self._server.metrics, _PHASE_DURATION_METRIC_KEY)
+
+    def count_compression(self, compressor: Compressor) -> None:
+        """
+        Record a compressed response in the metrics.
+        """
+        metrics = self._server.metrics
+        metrics.inc(_COMPRESSED_RESPONSES_METRIC_KEY, (compressor.encoding,))
+        metrics.inc(_COMPRESSION_CPU_METRIC_KEY, (compressor.encoding,), compressor.cpu_seconds)
+        metrics.inc(_COMPRESSION_BYTES_METRIC_KEY, ("in",), compressor.bytes_in)
+        metrics.inc(_COMPRESSION_BYTES_METRIC_KEY, ("out",), compressor.bytes_out)
+
+    def is_local_request(self) -> bool:
+        """
+        Whether the request is for one of the proxy's own endpoints, rather than the upstream.
+        """
+        return self.command == "GET" and self.path.partition("?")[0] in LOCAL_PATHS
+
+    def cache_key(self) -> Optional[str]:
+        """
+        Get the key of the request in the response cache. Requests bypass the cache if it is
+        disabled, if they are not GET or HEAD, if they carry credentials, since their responses
+        may be specific to the client, or if they ask for the response not to be stored.
+
+        :return: The key, or None if the request bypasses the cache.
+        """
+        if self._server.response_cache is None or self.command not in ("GET", "HEAD"):
+            return None
+        if "Authorization" in self.headers:
+            return None
+        if "no-store" in parse_cache_control(self.headers.get("Cache-Control")):
+            return None
+        return self.path
+
+    def is_servable(self, entry: Optional[CachedResponse]) -> bool:
+        """
+        Whether a cache entry can be sent to the client without asking the upstream: it must be
+        fresh, and the request must not ask for revalidation with ``Cache-Control: no-cache``.
+        """
+        if entry is None or not entry.is_fresh(time.time()):
+            return False
+        return "no-cache" not in parse_cache_control(self.headers.get("Cache-Control"))
+
+    def cache_request_headers(
+        self, headers: Dict[str, str], entry: Optional[CachedResponse]
+    ) -> Dict[str, str]:
+        """
+        Build the request headers for fetching a response into the cache. The client's conditional
+        headers are replaced by the validators of the stale entry, if any, since the cache needs
+        the complete response unless its own entry is still valid.
+
+        :param headers: The client's request headers.
+        :param entry: The stale entry, or None.
+        :return: The headers.
+        """
+        headers = OrderedDict(
+            (name, value)
+            for name, value in headers.items()
+            if name.lower() not in _CONDITIONAL_HEADERS
+        )
+        if entry is not None:
+            headers.update(entry.validators())
+        return headers
+
+    def should_store(self, status: int, headers: List[Tuple[str, str]]) -> bool:
+        """
+        Whether to read an upstream response completely, and store it in the cache. Only GET
+        responses with a ``Content-Length`` within the cache's entry size limit are stored; others
+        are relayed as they arrive.
+
+        :param status: The upstream status.
+        :param headers: The upstream response headers.
+        """
+        if self.command != "GET":
+            return False
+        length = next((value for name, value in headers if name.lower() == "content-length"), None)
+        if length is None or not length.isdigit():
+            return False
+        if int(length) > self._server.response_cache.max_entry_bytes:
+            return False
+        return is_storable(status, headers)
+
+    def store_response(
+        self, key: str, status: int, headers: List[Tuple[str, str]], body: bytes
+    ) -> CachedResponse:
+        """
+        Store a complete upstream response for which :meth:`should_store` holds.
+
+        :return: The new entry.
+        """
+        headers = [
+            (name, value) for name, value in headers if name.lower() not in HOP_BY_HOP_HEADERS
+        ]
+        entry = CachedResponse.create(status, headers, body, time.time())
+        self._server.response_cache.put(key, entry)
+        return entry
+
+    def refresh_response(
+        self, key: str, entry: CachedResponse, headers: List[Tuple[str, str]]
+    ) -> CachedResponse:
+        """
+        Refresh a stale entry which the upstream confirmed with ``304 Not Modified``.
+
+        :param key: The cache key.
+        :param entry: The stale entry.
+        :param headers: The headers of the ``304`` response.
+        :return: The refreshed entry, which is removed from the cache if the new headers no longer
+                 allow storing it.
+        """
+        headers = [
+            (name, value) for name, value in headers if name.lower() not in HOP_BY_HOP_HEADERS
+        ]
+        entry = entry.revalidate(headers, time.time())
+        if is_storable(entry.status, entry.headers):
+            self._server.response_cache.put(key, entry)
+        else:
+            self._server.response_cache.remove(key)
+        return entry
+
+    def request_body_length(self) -> Optional[int]:
+        """
+        Get the length of the request body from ``Content-Length``, once ``iter_request_body``
+        has validated the framing headers.
+
+        :return: The length, or None if the body is chunked or there is none.
+        """
+        length = self.headers.get("Content-Length")
+        return None if length is None else int(length)
+
+    def cached_response(
+        self, entry: CachedResponse, result: str
+    ) -> Tuple[int, List[Tuple[str, str]], bytes]:
+        """
+        Build the response to the client from a cache entry, and count the cache lookup.
+
+        :param entry: The entry.
+        :param result: The lookup result, see :meth:`jwt_proxy.cache.ResponseCache.count`.
+        :return: The status, headers and body for the client.
+        """
+        self._server.response_cache.count(result)
+        headers = entry.headers + [
+            ("Age", str(entry.age(time.time()))),
+            ("X-Cache", result.upper()),
+        ]
+        headers.extend(self.server_timing_headers())
+        if entry.is_not_modified(self.headers):
+            return HTTPStatus.NOT_MODIFIED, headers, b""
+        if not response_has_body(self.command, entry.status):
+            return entry.status, headers, b""
+        headers, compressor = self.negotiate_compression(entry.status, headers)
+        if compressor is None:
+            return entry.status, headers, entry.body
+        body = compressor.finish(entry.body)
+        self.count_compression(compressor)
+        return entry.status, headers + [("Content-Length", str(len(body)))], body
+
+    @classmethod
+    def build_upstream_headers(
+        cls, headers: Dict[str, str], token: bytes, length: Optional[int] = None
+    ) -> "OrderedDict[str, Union[str, bytes]]":
+        """
+        Build the headers for the upstream request from the client's request headers. The
+        client's ``Content-Length`` is replaced by the length of the body actually sent, so the
+        upstream request is framed independently of the client's framing headers.
+
+        :param headers: The client's request headers.
+        :param token: The JWT token to add.
+        :param length: The length of the request body, or None to send it chunked if there is one.
+        :return: The upstream request headers.
+        """
+        upstream_headers = OrderedDict()
+        for name, value in headers.items():
+            lower_name = name.lower()
+            if lower_name not in HOP_BY_HOP_HEADERS and lower_name != "content-length":
+                upstream_headers[name] = value
+        if length is not None:
+            upstream_headers["Content-Length"] = str(length)
+        upstream_headers[cls.JWT_TOKEN_HEADER] = token
+        return upstream_headers
+
+    def translate_upstream_response(
+        self, upstream_url: str, status: int, reason: str, headers: List[Tuple[str, str]]
+    ) -> Tuple[int, List[Tuple[str, str]], Optional[bytes]]:
+        """
+        Translate the head of an upstream response into the response for the client.
+
+        Upstream errors are reported to the client as ``502 Bad Gateway``, with a generated body
+        replacing the upstream body. Otherwise the upstream body is relayed, and the returned headers
+        are framed for the client with :meth:`frame_response`.
+
+        :param upstream_url: The upstream URL, for error messages.
+        :param status: The upstream status code.
+        :param reason: The upstream reason phrase.
+        :param headers: The upstream response headers.
+        :return: The status and headers for the client, and the generated body for error
+                 responses or None if the upstream body should be relayed.
+        """
+        self.compressor = None
+        if status >= 400:
+            self.count_upstream_error("status")
+            self.logger.error(
+                "Error while submitting request to upstream %s: %d %s",
+                upstream_url,
+                status,
+                reason,
+            )
+            resp_body = f"{upstream_url} - {status} {reason}".encode("utf-8")
+            resp_headers = [
+                ("Content-type", "text/plain; charset=utf-8"),
+                ("Content-Length", str(len(resp_body))),
+            ] + self.server_timing_headers()
+            return HTTPStatus.BAD_GATEWAY, resp_headers, resp_body
+
+        resp_headers = [
+            (name, value) for name, value in headers if name.lower() not in HOP_BY_HOP_HEADERS
+        ]
+        resp_headers.extend(self.server_timing_headers())
+        resp_headers, self.compressor = self.negotiate_compression(status, resp_headers)
+        return status, self.frame_response(status, resp_headers), None
+
+    def negotiate_compression(
+        self, status: int, headers: List[Tuple[str, str]]
+    ) -> Tuple[List[Tuple[str, str]], Optional[Compressor]]:
+        """
+        Decide whether to compress a response body for the client, if ``PROXY_COMPRESSION`` is
+        enabled. Bodies are compressed if they are not compressed already, their type is allowed
+        by ``PROXY_COMPRESSION_TYPES``, their length is unknown or at least
+        ``PROXY_COMPRESSION_MIN_SIZE``, and the client accepts ``gzip`` or ``deflate``.
+
+        :param status: The response status.
+        :param headers: The response headers, without hop-by-hop headers.
+        :return: The headers to send, with ``Content-Encoding`` and without ``Content-Length`` if
+                 the body is compressed, and the compressor, or None to send the body unchanged.
+        """
+        config = self.config
+        if (
+            not config.compression
+            or not response_has_body(self.command, status)
+            or status == HTTPStatus.PARTIAL_CONTENT
+            or get_header(headers, "Content-Encoding") is not None
+            or "no-transform" in parse_cache_control(get_header(headers, "Cache-Control"))
+            or not is_compressible_type(
+                get_header(headers, "Content-Type"), config.compression_types
+            )
+        ):
+            return headers, None
+        length = get_header(headers, "Content-Length")
+        if length is not None and length.isdigit() and int(length) < config.compression_min_size:
+            return headers, None
+
+        # The body depends on Accept-Encoding from here on, whether it is compressed or not
+        vary = get_header(headers, "Vary")
+        if vary is None:
+            headers = headers + [("Vary", "Accept-Encoding")]
+        elif "accept-encoding" not in vary.lower() and vary.strip() != "*":
+            headers = [
+                (name, f"{value}, Accept-Encoding" if name.lower() == "vary" else value)
+                for name, value in headers
+            ]
+        encoding = choose_encoding(self.headers.get("Accept-Encoding"))
+        if encoding is None:
+            return headers, None
+
+        compressed = [("Content-Encoding", encoding)]
+        for name, value in headers:
+            if name.lower() == "content-length":
+                continue
+            if name.lower() == "etag" and not value.startswith("W/"):
+                # The compressed body is not byte-for-byte the entity the strong ETag describes
+                value = "W/" + value
+            compressed.append((name, value))
+        return compressed, Compressor(encoding, config.compression_level)
+
+    def server_timing_headers(self) -> List[Tuple[str, str]]:
+        """
+        The ``Server-Timing`` header with the phases timed so far, if enabled by
+        ``PROXY_SERVER_TIMING``.
+        """
+        if self.timer is None or not self.config.server_timing:
+            return []
+        return [("Server-Timing", self.timer.server_timing())]
+
+    def frame_response(self, status: int, headers: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """
+        Choose how a relayed response body is delimited for the client. Bodies with a known length
+        keep their ``Content-Length``; others are sent with chunked encoding to HTTP/1.1 clients,
+        or delimited by closing the connection for HTTP/1.0 clients.
+
+        :param status: The response status.
+        :param headers: The response headers, without hop-by-hop headers.
+        :return: The headers, with ``Transfer-Encoding`` added if the body must be chunk-encoded.
+        """
+        if not response_has_body(self.command, status):
+            return headers
+        if any(name.lower() == "content-length" for name, _ in headers):
+            return headers
+        if self.request_version == "HTTP/1.0":
+            self.close_connection = True
+            return headers
+        return headers + [("Transfer-Encoding", "chunked")]
+
+    def status_lines(self) -> List[str]:
+        lines = []
+        cache = self._server.response_cache
+        if cache is not None:
+            stats = cache.stats()
+            lookups = stats["hit"] + stats["coalesced"] + stats["revalidated"] + stats["miss"]
+            served = lookups - stats["miss"]
+            lines.append(
+                f"{stats['entries']} cached responses, {stats['bytes']} bytes, "
+                f"{served} of {lookups} cacheable requests served from the cache"
+            )
+        proxy_state = self._server.proxy_state
+        balancer = proxy_state.balancer
+        lines.append(f"Balancing upstream requests with {balancer.policy}")
+        breakers = dict(balancer.breaker_stats())
+        for url, healthy, outstanding in balancer.stats():
+            state = "healthy" if healthy else "unhealthy"
+            line = f"Upstream {url}: {state}, {outstanding} requests outstanding"
+            breaker = breakers.get(url)
+            if breaker is not None:
+                line += (
+                    f", circuit {breaker.state.replace('_', '-')}, "
+                    f"{breaker.short_circuited} requests short-circuited"
+                )
+            lines.append(line)
+        limiter = proxy_state.concurrency_limiter
+        if limiter is not None:
+            lines.append(
+                f"Upstream concurrency limit {int(limiter.limit)}, {limiter.in_flight} requests in "
+                f"flight, {limiter.rejected} rejected"
+            )
+        rate_limiter = proxy_state.rate_limiter
+        if rate_limiter is not None:
+            stats = rate_limiter.stats()
+            lines.append(
+                f"Rate limit {proxy_state.config.rate_limit:g} requests/s per client, "
+                f"{stats['clients']} clients tracked, {stats['rejected']} requests rejected"
+            )
+        stats = self._server.upstream_pool.stats()
+        lines += [
+            f"{stats['hits']} upstream connection pool hits, {stats['misses']} misses",
+            f"{stats['in_use']} upstream connections in use, {stats['idle']} idle",
+        ]
+        token_source = self._server.token_source
+        if isinstance(token_source, TokenPool):
+            stats = token_source.stats()
+            lines.append(
+                f"{stats['depth']} pre-minted tokens buffered, {stats['fallbacks']} synchronous "
+                f"fallbacks, {stats['discarded']} discarded"
+            )
+        factory = token_factory(token_source)
+        key = factory.key
+        key_line = f"Signing tokens with {key.algorithm}"
+        if key.key_id is not None:
+            key_line += f" key {key.key_id}"
+        if factory.key_set is not None:
+            key_line += f", {len(factory.key_set.keys)} keys active"
+        lines.append(key_line)
+        return lines
+
+
+class ProxyRequestHandler(ProxyRequestMixin, ProxyBaseHTTPRequestHandler):
+    """
+    An HTTP server which adds a signed JWT header to requests.
+    """
+
+    # The socket of the upstream connection while a response is relayed, see upstream_request()
+    upstream_socket: Optional[socket.socket] = None
+    # The time until the headers of the last upstream response arrived, see upstream_request()
+    upstream_rtt: Optional[float] = None
+    # Whether the upstream connection can be reused after a response whose body was relayed
+    # around the HTTPResponse, which then cannot tell, or None, see relay_sized_body()
+    upstream_reusable: Optional[bool] = None
+
+    def do_GET(self):
+        if self.is_local_request():
+            super().do_GET()
+        else:
+            self.forward_request()
+
+    def forward_request(self):
+        """
+        Forward the request to an upstream with the JWT header, and relay the response, or serve
+        it from the response cache.
+        """
         self.record_request()
-        self.logger.info("Got POST request for %s", self.path)
+        self.proxy_state = self._server.proxy_state
+        self.config = self.proxy_state.config
+        self.timer = PhaseTimer()
+        self.detail_logger.info("Got %s request for %s", self.command, self.path)
+
+        refusal = self.rate_limit_response()
+        if refusal is not None:
+            self.send_complete_response(*refusal)
+            return
 
         # Read headers
         headers = OrderedDict()
@@ -34,54 +1020,409 @@ class ProxyRequestHandler(ProxyBaseHTTPRequestHandler):
             headers[name] = value
 
         # Input validation
-        length = headers.get("Content-Length")
-        if length is None:
+        try:
+            req_body = self.iter_request_body()
+        except BodyFramingError as e:
+            self.logger.error("Invalid request body framing: %s", e)
+            self.send_error(HTTPStatus.BAD_REQUEST, "invalid body framing")
+            return
+        if req_body is None and self.command in METHODS_WITH_BODY:
             self.logger.error("Missing Content-Length header!")
             self.send_error(HTTPStatus.BAD_REQUEST, "missing length")
             return
 
-        req_body = self.rfile.read(int(length))
-        self.logger.info("Got %d bytes in POST body", len(req_body))
+        # Small bodies are read up front, so that the request can be replayed if a pooled
+        # connection turns out to be closed. Larger ones are streamed to the upstream, straight
+        # from the client's socket if their length is known.
+        self.body_length = self.request_body_length()
+        if req_body is not None and self.body_length is not None:
+            if self.body_length <= BODY_CHUNK_SIZE:
+                req_body = b"".join(req_body)
+                self.detail_logger.info("Got %d bytes in %s body", len(req_body), self.command)
+            elif self.config.zero_copy:
+                req_body = SocketBody(self.rfile, self.connection, self.body_length)
+        self.timer.mark("read_body")
 
-        # Generate the token
-        token_payload = dict(user=getpass.getuser(), date=date.today().isoformat())
-        token = encode_jwt_hs512(token_payload, os.getenv("JWT_SIGNING_SECRET").encode("ascii"))
-
-        # Send the upstream request
-        upstream_url = self.build_upstream_url(self.path)
-        headers[self.JWT_TOKEN_HEADER] = token
-        upstream_request = Request(
-            method="POST",
-            url=upstream_url,
-            data=req_body,
-            headers=headers,
-        )
+        # Fresh cached responses are served without a token or an upstream request
+        cache = self._server.response_cache
+        cache_key = self.cache_key()
+        entry = None
+        if cache_key is not None:
+            entry = cache.get(cache_key)
+            if self.is_servable(entry):
+                self.send_cached_response(entry, "hit")
+                self.timer.mark("respond")
+                self.observe_phases()
+                return
 
-        # Read the upstream response
-        resp_status = HTTPStatus.OK
-        resp_headers = []
-        try:
-            response: HTTPResponse = urlopen(upstream_request)
+        # Generate the token
+        token = self.create_token()
+        self.timer.mark("token")
 
-            resp_length = None
-            resp_headers.extend(response.getheaders())
-            for name, value in resp_headers:
-                if name.lower() == "content-length":
-                    resp_length = int(value)
+        if cache_key is None:
+            self.proxy_upstream(headers, req_body, token)
+            return
 
-            if resp_length is None:
-                self.logger.error("Missing Content-Length header in upstream response!")
-                self.send_error(HTTPStatus.BAD_GATEWAY, "missing length in upstream response")
+        # Only one request fetches a missing or stale entry, while the others wait for it
+        waiter = cache.claim(cache_key)
+        if waiter is not None:
+            waiter.wait(cache.coalesce_timeout)
+            entry = cache.get(cache_key)
+            if self.is_servable(entry):
+                self.send_cached_response(entry, "coalesced")
+                self.timer.mark("respond")
+                self.observe_phases()
                 return
-            resp_body = response.read(resp_length)
-        except HTTPError as e:
-            self.logger.error(
-                "Error while submitting request to upstream %s", upstream_url, exc_info=e
+        try:
+            self.proxy_upstream(
+                self.cache_request_headers(headers, entry), req_body, token, cache_key, entry
             )
-            resp_status = HTTPStatus.BAD_GATEWAY
-            resp_body = f"{upstream_url} - {e.status} {e.reason}".encode("utf-8")
-            resp_headers.append(("Content-type", "text/plain; charset=utf-8"))
-            resp_headers.append(("Content-Length", str(len(resp_body))))
+        finally:
+            if waiter is None:
+                cache.release(cache_key)
+
+    do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = forward_request
+
+    def proxy_upstream(
+        self,
+        headers: Dict[str, str],
+        req_body: Union[None, bytes, Iterable[bytes], SocketBody],
+        token: bytes,
+        cache_key: Optional[str] = None,
+        entry: Optional[CachedResponse] = None,
+    ) -> None:
+        """
+        Send the request to an upstream chosen by the balancer, and relay the response. Requests
+        which may be sent again are retried after errors, timeouts and ``502``, ``503`` or
+        ``504`` responses, with jittered exponential backoff. Requests to an upstream whose
+        circuit breaker is open are refused right away, and those over the concurrency limit
+        after a short wait.
+
+        :param headers: The request headers to forward.
+        :param req_body: The request body, complete, as an iterable of pieces or still on the
+                         client's socket, or None.
+        :param token: The JWT token to add.
+        :param cache_key: The key for storing the response in the cache, or None.
+        :param entry: The stale cache entry being revalidated, if any.
+        """
+        upstream_headers = self.build_upstream_headers(headers, token, self.body_length)
+        attempts = self.retry_attempts(req_body)
+        try:
+            retry_reason = None
+            for attempt in range(1, attempts + 1):
+                if retry_reason is not None:
+                    time.sleep(self.retry_delay(attempt - 1, retry_reason))
+                retry_reason = self.attempt_upstream(
+                    upstream_headers, req_body, cache_key, entry, attempt == attempts
+                )
+                if retry_reason is None:
+                    break
+        except (CircuitOpenError, ConcurrencyLimitExceeded) as e:
+            self.send_complete_response(*self.short_circuit_response(e, req_body))
+        finally:
+            self.observe_phases()
+
+    def attempt_upstream(
+        self,
+        headers: Dict[str, Union[str, bytes]],
+        req_body: Union[None, bytes, Iterable[bytes], SocketBody],
+        cache_key: Optional[str],
+        entry: Optional[CachedResponse],
+        last: bool,
+    ) -> Optional[str]:
+        """
+        Send the request to an upstream once, and relay the response unless the request should be
+        retried. Errors are sent to the client after the last attempt.
+
+        :param headers: The upstream request headers.
+        :param req_body: See :meth:`proxy_upstream`.
+        :param cache_key: See :meth:`proxy_upstream`.
+        :param entry: See :meth:`proxy_upstream`.
+        :param last: Whether this is the last attempt.
+        :return: None if the request was answered, otherwise why it should be retried:
+                 ``error``, ``timeout`` or ``status``.
+        """
+        balancer = self.proxy_state.balancer
+        limiter = self.proxy_state.concurrency_limiter
+        # The limiter is acquired first, so that waiting for it does not hold a circuit breaker
+        # probe, and a refused request never takes one
+        if limiter is not None and not limiter.acquire(self.config.concurrency_queue_timeout):
+            raise ConcurrencyLimitExceeded(int(limiter.limit))
+        rtt, failed = None, False
+        hedge = HedgeTarget(balancer, limiter, self.path)
+        try:
+            with balancer.select(self.path) as (upstream, generation):
+                upstream_url = upstream.build_url(self.path)
+                hedge_delay = self.hedge_delay(req_body)
+                try:
+                    with self.upstream_request(
+                        upstream_url,
+                        self.command,
+                        req_body,
+                        headers,
+                        None if hedge_delay is None else (hedge_delay, hedge),
+                    ) as response:
+                        rtt, failed = self.upstream_rtt, response.status >= 500
+                        hedge.record(upstream, generation, not failed)
+                        if not last and response.status in RETRYABLE_STATUSES:
+                            self.logger.warning(
+                                "Upstream %s answered %d %s, retrying",
+                                upstream_url,
+                                response.status,
+                                response.reason,
+                            )
+                            self._discard_upstream_body(response)
+                            return "status"
+                        if cache_key is None:
+                            self.relay_upstream_response(upstream_url, response)
+                        else:
+                            self.relay_cacheable_response(upstream_url, response, cache_key, entry)
+                        self.timer.mark("respond")
+                except BodyFramingError as e:
+                    # Raised while reading the request body from the client, before any response
+                    # was sent, so it says nothing about the upstream
+                    balancer.release(upstream, generation)
+                    self.logger.error("Invalid request body framing: %s", e)
+                    self.send_error(HTTPStatus.BAD_REQUEST, "invalid body framing")
+                except UpstreamPoolExhausted as e:
+                    balancer.release(upstream, generation)
+                    self.logger.error("%s", e)
+                    self.count_upstream_error("pool_exhausted")
+                    self.send_error(
+                        HTTPStatus.SERVICE_UNAVAILABLE, "upstream connections exhausted"
+                    )
+                except (OSError, HTTPException) as e:
+                    # Errors after the response was started are handled by relay_upstream_response
+                    if self.response_status is not None:
+                        raise
+                    hedge.record(upstream, generation, False)
+                    failed = True
+                    reason = "timeout" if isinstance(e, TimeoutError) else "error"
+                    if not last:
+                        self.logger.warning("Error from upstream %s, retrying: %s", upstream_url, e)
+                        return reason
+                    self.close_connection = True
+                    if reason == "timeout":
+                        self.logger.error("Timed out waiting for upstream %s", upstream_url)
+                        self.count_upstream_error("timeout")
+                        self.send_error(HTTPStatus.GATEWAY_TIMEOUT, "upstream timed out")
+                    else:
+                        self.logger.error(
+                            "Error while connecting to upstream %s", upstream_url, exc_info=e
+                        )
+                        self.count_upstream_error("connect")
+                        self.send_error(HTTPStatus.BAD_GATEWAY, "upstream unavailable")
+        finally:
+            hedge.close()
+            if limiter is not None:
+                limiter.release(rtt, failed)
+        return None
+
+    @contextmanager
+    def upstream_request(
+        self,
+        url: str,
+        method: str,
+        body: Union[None, bytes, Iterable[bytes], SocketBody],
+        headers: Dict[str, Union[str, bytes]],
+        hedge: Optional[Tuple[float, HedgeTarget]] = None,
+    ) -> Iterator[HTTPResponse]:
+        """
+        Send a request to the upstream server over a pooled persistent connection. The connection
+        is returned to the pool when the context exits, if the response was completely read.
+        The ``connect`` and ``upstream`` phases are marked on the request's :attr:`timer`.
+
+        :param url: The complete upstream URL.
+        :param method: The HTTP method.
+        :param body: The request body, either complete, as an iterable of pieces or still on the
+                     client's socket, or None. Iterables are sent with chunked encoding unless
+                     the headers include ``Content-Length``, which they must for socket bodies.
+        :param headers: The request headers.
+        :param hedge: Seconds after which a copy of the request is sent if no response has
+                      started, and the target of the copy, see :meth:`race_hedge`, or None to not
+                      hedge.
+        :return: A context manager for the response, whose body has not been read yet. While it
+                 is open, :attr:`upstream_socket` is the socket of the upstream connection.
+        """
+        pool: UpstreamConnectionPool = self._server.upstream_pool
+
+        while True:
+            conn, reused = self.acquire_upstream(url)
+            try:
+                if conn.sock is None:
+                    pool.connect(conn)
+                self.timer.mark("connect")
+                sent_at = time.perf_counter()
+                self.send_upstream_request(conn, url, method, body, headers)
+                if hedge is None:
+                    response = conn.getresponse()
+                else:
+                    conn, response = self.race_hedge(conn, url, method, body, headers, *hedge)
+                self.upstream_rtt = time.perf_counter() - sent_at
+                self._server.upstream_latency.observe(self.upstream_rtt)
+                self.timer.mark("upstream")
+                break
+            except (ConnectionResetError, BrokenPipeError, RemoteDisconnected):
+                pool.release(conn, False)
+                # A pooled connection may have been closed by the upstream after the staleness
+                # check; retry once on a fresh connection, since the request never got a response.
+                # Streamed bodies cannot be replayed.
+                if not reused or not isinstance(body, (bytes, type(None))):
+                    raise
+                self.logger.info("Pooled connection to %s was closed, reconnecting", conn.host)
+            except BaseException:
+                pool.release(conn, False)
+                raise
+
+        reusable = False
+        self.upstream_socket = conn.sock
+        self.upstream_reusable = None
+        try:
+            yield response
+            reusable = self.upstream_reusable
+            if reusable is None:
+                if response.length == 0:
+                    # read1() leaves the response open after the last byte of a sized body, and
+                    # the connection refuses further requests until it is closed
+                    response.close()
+                reusable = response.isclosed()
+            reusable = reusable and not response.will_close
+        finally:
+            self.upstream_socket = None
+            pool.release(conn, reusable)
+
+    def acquire_upstream(self, url: str) -> Tuple[HTTPConnection, bool]:
+        """
+        Check out a pooled connection for an upstream URL, see
+        :meth:`jwt_proxy.upstream.UpstreamConnectionPool.acquire`.
+        """
+        scheme, netloc, _, _, _ = urlsplit(url)
+        parsed = urlsplit(f"//{netloc}")
+        return self._server.upstream_pool.acquire(scheme, parsed.hostname, parsed.port)
+
+    def send_upstream_request(
+        self,
+        conn: HTTPConnection,
+        url: str,
+        method: str,
+        body: Union[None, bytes, Iterable[bytes], SocketBody],
+        headers: Dict[str, Union[str, bytes]],
+    ) -> None:
+        """
+        Send a request over a connected upstream connection, see :meth:`upstream_request`.
+        """
+        _, _, path, query, _ = urlsplit(url)
+        target = urlunsplit(("", "", path or "/", query, ""))
+        if isinstance(body, SocketBody):
+            conn.request(method, target, headers=headers)
+            try:
+                sent = body.send(conn.sock)
+            except SourceError as e:
+                self.close_connection = True
+                raise BodyFramingError(
+                    f"Error reading the body from the client: {e.__cause__!r}"
+                ) from e
+            if sent < body.length:
+                self.close_connection = True
+                raise BodyFramingError("Client closed the connection before sending the whole body")
+        else:
+            conn.request(method, target, body=body, headers=headers)
+
+    def race_hedge(
+        self,
+        conn: HTTPConnection,
+        url: str,
+        method: str,
+        body: Optional[bytes],
+        headers: Dict[str, Union[str, bytes]],
+        delay: float,
+        target: HedgeTarget,
+    ) -> Tuple[HTTPConnection, HTTPResponse]:
+        """
+        Wait for the response to a request, and if it has not started after a delay, send a copy
+        of the request to the upstream chosen by ``target``, over another connection, unless that
+        upstream is not admitted. The first response to arrive wins, and the other connection is
+        closed. If one of the requests fails, the other one may still answer. The outcome of the
+        race is left on ``target``.
+
+        :param conn: The connection the request was sent over. It is released if the copy wins,
+                     and otherwise left to the caller.
+        :param url: The URL of the request, for error messages.
+        :param method: The HTTP method.
+        :param body: The request body.
+        :param headers: The request headers.
+        :param delay: Seconds to wait before sending the copy.
+        :param target: Chooses the upstream for the copy.
+        :return: The winning connection, and its response.
+        :raises OSError: if both requests failed, or no response started within the read timeout.
+        """
+        pool: UpstreamConnectionPool = self._server.upstream_pool
+        if _wait_readable([conn], delay):
+            return conn, conn.getresponse()
+
+        hedge_url = target.choose()
+        if hedge_url is None:
+            return conn, conn.getresponse()
+        try:
+            hedge, _ = self.acquire_upstream(hedge_url)
+        except UpstreamPoolExhausted as e:
+            target.abandon()
+            self.logger.info("Could not hedge request to %s: %s", hedge_url, e)
+            return conn, conn.getresponse()
+        try:
+            if hedge.sock is None:
+                pool.connect(hedge)
+            self.send_upstream_request(hedge, hedge_url, method, body, headers)
+        except (OSError, HTTPException) as e:
+            pool.release(hedge, False)
+            target.abandon()
+            self.logger.info("Could not hedge request to %s: %s", hedge_url, e)
+            return conn, conn.getresponse()
+
+        self.detail_logger.info("Hedged request to %s after %.3f seconds", hedge_url, delay)
+        pending = [conn, hedge]
+        winner = response = None
+        error: Optional[Exception] = None
+        deadline = None if pool.read_timeout is None else time.monotonic() + pool.read_timeout
+        try:
+            while winner is None and pending:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                ready = _wait_readable(pending, timeout)
+                if not ready:
+                    raise TimeoutError(f"No response from {url} within the read timeout")
+                candidate = ready[0]
+                pending.remove(candidate)
+                try:
+                    response = candidate.getresponse()
+                    winner = candidate
+                except (OSError, HTTPException) as e:
+                    error = e
+                    target.loser_failed = True
+            if winner is None:
+                raise error
+        finally:
+            if winner is not hedge:
+                pool.release(hedge, False)
+        if winner is hedge:
+            pool.release(conn, False)
+        target.winner = "primary" if winner is conn else "hedge"
+        self.count_hedge(target.winner)
+        return winner, response
+
+    def relay_upstream_response(self, upstream_url: str, response: HTTPResponse) -> None:
+        """
+        Relay an upstream response to the client, copying the body in bounded chunks, or moving it
+        between the sockets with :func:`jwt_proxy.relay.relay` if it is large and has a known
+        length.
+
+        :param upstream_url: The upstream URL, for error messages.
+        :param response: The upstream response.
+        """
+        resp_status, resp_headers, resp_body = self.translate_upstream_response(
+            upstream_url, response.status, response.reason, response.getheaders()
+        )
+        if resp_body is not None:
+            self._discard_upstream_body(response)
 
         # Build and send the response to the client
         self.send_proxy_response(resp_status)
@@ -89,38 +1430,152 @@ class ProxyRequestHandler(ProxyBaseHTTPRequestHandler):
             self.send_header(name, value)
         self.end_headers()
 
-        self.wfile.write(resp_body)
+        if resp_body is not None:
+            self.wfile.write(resp_body)
+        elif response_has_body(self.command, resp_status):
+            chunked = is_response_chunked(resp_headers)
+            compressor = self.compressor
+            try:
+                if (
+                    self.config.zero_copy
+                    and compressor is None
+                    and not chunked
+                    and response.length is not None
+                    and response.length > BODY_CHUNK_SIZE
+                ):
+                    self.relay_sized_body(response)
+                else:
+                    while True:
+                        chunk = response.read1(BODY_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        if compressor is not None:
+                            chunk = compressor.compress(chunk)
+                            if not chunk:
+                                continue
+                        self.wfile.write(encode_chunk(chunk) if chunked else chunk)
+            except (IncompleteRead, OSError) as e:
+                # The response cannot be completed, so the client has to see a closed connection
+                self.logger.error("Error while relaying response from %s", upstream_url, exc_info=e)
+                self.count_upstream_error("relay")
+                self.close_connection = True
+                return
+            if compressor is not None:
+                tail = compressor.finish()
+                self.wfile.write(encode_chunk(tail) if chunked else tail)
+                self.count_compression(compressor)
+            if chunked:
+                self.wfile.write(LAST_CHUNK)
         self.wfile.flush()
 
-    def send_proxy_response(self, code, message=None):
+    def relay_sized_body(self, response: HTTPResponse) -> None:
         """
-        Variant of :meth:`BaseHTTPRequestHandler.send_response` which does not send
-        ``Server`` or ``Date`` headers, so that the upstream headers are preserved.
+        Relay an upstream response body delimited by ``Content-Length`` to the client, without
+        copying it into ``bytes`` objects. The part already buffered by the response is sent first.
+        The response is closed afterwards, and whether the connection can be reused is left in
+        :attr:`upstream_reusable`.
+
+        :param response: The upstream response, whose body has not been read yet.
+        :raises IncompleteRead: if the upstream closed the connection before the end of the body.
         """
-        self.log_request(code)
-        self.send_response_only(code, message)
+        self.upstream_reusable = False
+        try:
+            self.wfile.write(response.read1(len(response.fp.peek())))
+            moved = relay(self.upstream_socket, self.connection, response.length)
+            if moved < response.length:
+                raise IncompleteRead(b"", response.length - moved)
+            self.upstream_reusable = True
+        finally:
+            response.close()
 
-    @staticmethod
-    def build_upstream_url(path: str) -> str:
+    def relay_cacheable_response(
+        self,
+        upstream_url: str,
+        response: HTTPResponse,
+        cache_key: str,
+        entry: Optional[CachedResponse],
+    ) -> None:
         """
-        Build the translated upstream URL.
+        Relay an upstream response to a cacheable request, storing it in the cache if allowed, or
+        refreshing the stale entry if the upstream confirmed it.
 
-        :param path: The URL path.
-        :return: The complete new URL.
+        :param upstream_url: The upstream URL, for error messages.
+        :param response: The upstream response.
+        :param cache_key: The cache key.
+        :param entry: The stale entry which was revalidated, or None.
         """
-        upstream = os.getenv("UPSTREAM_SERVER")
-        if upstream is None:
-            raise ValueError(
-                "Could not get upstream server address from environment variable UPSTREAM_SERVER"
+        headers = response.getheaders()
+        if response.status == HTTPStatus.NOT_MODIFIED and entry is not None:
+            response.read()
+            self.send_cached_response(
+                self.refresh_response(cache_key, entry, headers), "revalidated"
+            )
+        elif self.should_store(response.status, headers):
+            body = response.read()
+            self.send_cached_response(
+                self.store_response(cache_key, response.status, headers, body), "miss"
             )
-
-        if "://" in upstream:
-            scheme, netloc, _, params, query, fragment = urlparse(upstream)
         else:
-            scheme = "http"
-            netloc = upstream
-            params = ""
-            query = ""
-            fragment = ""
+            self._server.response_cache.count("miss")
+            self.relay_upstream_response(upstream_url, response)
 
-        return urlunparse([scheme, netloc, path, params, query, fragment])
+    def send_cached_response(self, entry: CachedResponse, result: str) -> None:
+        """
+        Send a response from the cache, see :meth:`ProxyRequestMixin.cached_response`.
+        """
+        status, headers, body = self.cached_response(entry, result)
+        self.send_proxy_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    @staticmethod
+    def _discard_upstream_body(response: HTTPResponse, limit: int = 16 * BODY_CHUNK_SIZE) -> None:
+        """
+        Read and discard an upstream response body, so that the connection can be reused. Bodies
+        larger than the limit are left unread, and the connection is closed instead.
+        """
+        discarded = 0
+        while discarded < limit:
+            chunk = response.read1(BODY_CHUNK_SIZE)
+            if not chunk:
+                break
+            discarded += len(chunk)
+
+    @classmethod
+    def init_server(cls, server) -> None:
+        cls.init_proxy_server(
+            server, UpstreamConnectionPool.from_environment(), ResponseCache.from_environment()
+        )
+
+    @classmethod
+    def close_server(cls, server) -> None:
+        server.proxy_state.balancer.close()
+        server.upstream_pool.close()
+        close_token_source(server.token_source)
+
+    def send_complete_response(
+        self, status: int, headers: List[Tuple[str, str]], body: bytes
+    ) -> None:
+        """
+        Send a response built by the proxy itself, such as a refusal.
+
+        :param status: The status code.
+        :param headers: The response headers, which must include ``Content-Length``.
+        :param body: The response body.
+        """
+        self.send_proxy_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+    def send_proxy_response(self, code, message=None):
+        """
+        Variant of :meth:`BaseHTTPRequestHandler.send_response` which does not send
+        ``Server`` or ``Date`` headers, so that the upstream headers are preserved.
+        """
+        self.send_response_only(code, message)
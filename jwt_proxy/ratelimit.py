@@ -0,0 +1,98 @@
+"""
+Rate limiting per client with token buckets, so that one client cannot take all the proxy's
+threads and upstream capacity.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+
+class _Shard:
+    """
+    A part of the table of buckets, with its own lock. Buckets are ``(tokens, updated)`` tuples,
+    ordered from the least to the most recently used.
+    """
+
+    __slots__ = ("lock", "buckets", "evicted", "rejected")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.evicted = 0
+        self.rejected = 0
+
+
+class RateLimiter:
+    """
+    Limits the request rate of each client with a token bucket, which holds up to ``burst``
+    tokens and is refilled at ``rate`` tokens per second. Each request takes a token, and is
+    refused while the bucket is empty.
+
+    The buckets are kept in a table split into ``shards``, each with its own lock, so that requests
+    of different clients rarely wait for each other. Each shard holds at most its share of
+    ``max_clients`` buckets, and evicts the least recently used one to make room. An evicted
+    client starts again with a full bucket, which is what an idle client would have anyway, so
+    the memory used stays bounded however many clients there are.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        max_clients: int = 100000,
+        shards: int = 64,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param rate: Tokens added to each bucket per second.
+        :param burst: The capacity of each bucket, which is the number of requests a client may
+                      send at once after being idle.
+        :param max_clients: The number of buckets kept.
+        :param shards: The number of parts of the table.
+        :param clock: Returns the current time in seconds.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._shards = [_Shard() for _ in range(shards)]
+        self._shard_size = max(1, -(-max_clients // shards))
+
+    def acquire(self, client: str) -> Optional[float]:
+        """
+        Take a token from a client's bucket.
+
+        :param client: The key of the client, such as its IP address.
+        :return: None if the request is allowed, or else the seconds until a token is available.
+        """
+        shard = self._shards[hash(client) % len(self._shards)]
+        with shard.lock:
+            now = self.clock()
+            bucket = shard.buckets.get(client)
+            if bucket is None:
+                tokens = float(self.burst)
+                if len(shard.buckets) >= self._shard_size:
+                    shard.buckets.popitem(last=False)
+                    shard.evicted += 1
+            else:
+                tokens, updated = bucket
+                tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+                shard.buckets.move_to_end(client)
+            if tokens < 1:
+                shard.buckets[client] = (tokens, now)
+                shard.rejected += 1
+                return (1 - tokens) / self.rate
+            shard.buckets[client] = (tokens - 1, now)
+            return None
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the number of ``clients`` tracked, of buckets ``evicted`` to make room, and of
+        requests ``rejected``.
+        """
+        return {
+            "clients": sum(len(shard.buckets) for shard in self._shards),
+            "evicted": sum(shard.evicted for shard in self._shards),
+            "rejected": sum(shard.rejected for shard in self._shards),
+        }
@@ -0,0 +1,223 @@
+"""
+Copying of message bodies between sockets without passing them through Python objects.
+
+On Linux, :func:`splice` moves data from one socket to another through a pipe, inside the kernel.
+Elsewhere, and for TLS sockets whose data must be decrypted, :func:`copy_into` copies it through
+a buffer allocated once per thread, instead of creating a ``bytes`` object for every chunk.
+"""
+
+import os
+import select
+import socket
+import threading
+from typing import BinaryIO, Callable, Optional
+
+try:
+    from fcntl import F_GETPIPE_SZ, F_SETPIPE_SZ, fcntl
+except ImportError:  # pragma: no cover - not Linux
+    F_SETPIPE_SZ = None
+
+# Whether the kernel can move data between sockets with splice()
+SPLICE_AVAILABLE = hasattr(os, "splice")
+
+# Size of the pipe used by splice(), and of the copy buffer
+RELAY_BUFFER_SIZE = 1024 * 1024
+
+# The pipe and buffer of each thread, created on first use
+_local = threading.local()
+
+
+class SourceError(OSError):
+    """
+    Raised when reading from the source of a copy fails, to tell it apart from a failure to write
+    to the destination. The original error is the ``__cause__``.
+    """
+
+
+def _read_source(read: Callable, *args) -> int:
+    try:
+        return read(*args)
+    except OSError as e:
+        raise SourceError(*e.args) from e
+
+
+def can_splice(*socks: socket.socket) -> bool:
+    """
+    Check whether data can be spliced between sockets: splice() must be available, and they must be
+    plain sockets rather than TLS ones.
+    """
+    return SPLICE_AVAILABLE and all(type(sock) is socket.socket for sock in socks)
+
+
+class _Pipe:
+    """
+    A pipe for splice(), closed when the thread which uses it ends.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.size = 65536
+        if F_SETPIPE_SZ is not None:
+            try:
+                fcntl(self.write_fd, F_SETPIPE_SZ, RELAY_BUFFER_SIZE)
+            except OSError:
+                # Limited by /proc/sys/fs/pipe-max-size; the default size still works
+                pass
+            self.size = fcntl(self.write_fd, F_GETPIPE_SZ)
+
+    def close(self) -> None:
+        if self.read_fd >= 0:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+            self.read_fd = self.write_fd = -1
+
+    __del__ = close
+
+
+def _thread_pipe() -> _Pipe:
+    pipe = getattr(_local, "pipe", None)
+    if pipe is None:
+        pipe = _local.pipe = _Pipe()
+    return pipe
+
+
+def _wait(fd: int, events: int, timeout: Optional[float]) -> None:
+    poller = select.poll()
+    poller.register(fd, events)
+    if not poller.poll(None if timeout is None else timeout * 1000):
+        raise socket.timeout("timed out")
+
+
+def _splice(src: int, dst: int, size: int, wait_fd: int, events: int, timeout) -> int:
+    # Sockets with a timeout are non-blocking at the OS level, so wait for them like Python does
+    while True:
+        try:
+            return os.splice(src, dst, size)
+        except BlockingIOError:
+            _wait(wait_fd, events, timeout)
+        except InterruptedError:
+            pass
+
+
+def splice(src: socket.socket, dst: socket.socket, length: int) -> int:
+    """
+    Move bytes from one plain socket to another in the kernel, through a pipe, honouring the
+    timeouts of the sockets.
+
+    :param src: The socket to read from.
+    :param dst: The socket to write to.
+    :param length: The number of bytes to move.
+    :return: The number of bytes moved, which is less than ``length`` if ``src`` was closed first.
+    :raises SourceError: if ``src`` fails or times out.
+    :raises OSError: if ``dst`` fails or times out.
+    """
+    pipe = _thread_pipe()
+    moved = 0
+    try:
+        while moved < length:
+            received = _read_source(
+                _splice,
+                src.fileno(),
+                pipe.write_fd,
+                min(length - moved, pipe.size),
+                src.fileno(),
+                select.POLLIN,
+                src.gettimeout(),
+            )
+            if received == 0:
+                break
+            while received > 0:
+                sent = _splice(
+                    pipe.read_fd,
+                    dst.fileno(),
+                    received,
+                    dst.fileno(),
+                    select.POLLOUT,
+                    dst.gettimeout(),
+                )
+                received -= sent
+                moved += sent
+    except OSError:
+        # The pipe may still hold data, which must not leak into the next relay
+        pipe.close()
+        _local.pipe = None
+        raise
+    return moved
+
+
+def copy_into(
+    readinto: Callable[[memoryview], int],
+    write: Callable[[memoryview], object],
+    length: Optional[int] = None,
+) -> int:
+    """
+    Copy bytes through the thread's buffer.
+
+    :param readinto: Reads into a buffer, and returns the number of bytes read, or 0 at the end,
+                     such as :meth:`socket.socket.recv_into` or
+                     :meth:`http.client.HTTPResponse.readinto`.
+    :param write: Writes all of a buffer, such as :meth:`socket.socket.sendall`.
+    :param length: The number of bytes to copy, or None to copy until the end.
+    :return: The number of bytes copied, which is less than ``length`` if the source ended first.
+    :raises SourceError: if reading fails with :class:`OSError`.
+    """
+    view = getattr(_local, "buffer", None)
+    if view is None:
+        view = _local.buffer = memoryview(bytearray(RELAY_BUFFER_SIZE))
+    copied = 0
+    while length is None or copied < length:
+        size = RELAY_BUFFER_SIZE if length is None else min(length - copied, RELAY_BUFFER_SIZE)
+        received = _read_source(readinto, view[:size])
+        if not received:
+            break
+        write(view[:received])
+        copied += received
+    return copied
+
+
+class SocketBody:
+    """
+    A request body of known length which has not been read from the client's connection yet, so
+    that it can be relayed to the upstream socket with :func:`relay`.
+    """
+
+    def __init__(self, rfile: BinaryIO, sock: socket.socket, length: int):
+        """
+        :param rfile: The buffered reader of the client's connection, which may hold the start of
+                      the body.
+        :param sock: The client's socket.
+        :param length: The length of the body, from ``Content-Length``.
+        """
+        self.rfile = rfile
+        self.sock = sock
+        self.length = length
+
+    def send(self, dst: socket.socket) -> int:
+        """
+        Send the body to a socket: the part already buffered by the reader, then the rest straight
+        from the client's socket.
+
+        :param dst: The socket to send to.
+        :return: The number of bytes sent, which is less than :attr:`length` if the client closed
+                 the connection first.
+        :raises SourceError: if reading from the client fails.
+        """
+        # Only what is buffered, as the reader may hold the next request after the body
+        head = _read_source(lambda: self.rfile.read1(min(self.length, len(self.rfile.peek()))))
+        if not head:
+            return 0
+        dst.sendall(head)
+        return len(head) + relay(self.sock, dst, self.length - len(head))
+
+
+def relay(src: socket.socket, dst: socket.socket, length: int) -> int:
+    """
+    Move bytes from one socket to another with :func:`splice` if possible, otherwise with
+    :func:`copy_into`.
+
+    :return: The number of bytes moved, which is less than ``length`` if ``src`` was closed first.
+    :raises SourceError: if reading from ``src`` fails.
+    """
+    if can_splice(src, dst):
+        return splice(src, dst, length)
+    return copy_into(src.recv_into, dst.sendall, length)
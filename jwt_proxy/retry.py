@@ -0,0 +1,84 @@
+"""
+Policies for retrying and hedging upstream requests.
+"""
+
+import random
+import threading
+from collections import deque
+from typing import Deque, List, Mapping, Optional
+
+# Methods which can be sent again without changing the outcome (RFC 9110 section 9.2.2)
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"))
+
+# Upstream statuses for which another attempt may succeed
+RETRYABLE_STATUSES = frozenset((502, 503, 504))
+
+# The request header by which clients opt in to retries of other methods
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+
+
+def is_retryable(method: str, headers: Mapping[str, str]) -> bool:
+    """
+    Check whether a request may be sent to the upstream more than once: its method must be
+    idempotent, or the client must have sent an ``Idempotency-Key`` header.
+    """
+    return method in IDEMPOTENT_METHODS or headers.get(IDEMPOTENCY_KEY_HEADER) is not None
+
+
+def backoff_delay(retry: int, base: float, cap: float = 1.0) -> float:
+    """
+    Get the delay before a retry, with exponential backoff and full jitter, so that the retries
+    of requests which failed together are spread out.
+
+    :param retry: The number of the retry, from 1.
+    :param base: The maximum delay before the first retry, in seconds.
+    :param cap: The maximum delay before any retry.
+    :return: A random delay between 0 and ``base * 2 ** (retry - 1)``, capped.
+    """
+    return random.uniform(0.0, min(cap, base * 2 ** (retry - 1)))
+
+
+class LatencyTracker:
+    """
+    Tracks the latencies of recent upstream responses, to tell when a response is late.
+
+    Percentiles are computed from a sorted copy of the window, which is only refreshed every
+    ``refresh`` observations, so that looking one up does not sort on every request.
+    """
+
+    def __init__(self, window: int = 1000, min_samples: int = 20, refresh: int = 50):
+        """
+        :param window: The number of recent latencies kept.
+        :param min_samples: The number of latencies needed before percentiles are known.
+        :param refresh: The number of observations after which the sorted copy is refreshed.
+        """
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._recent: Deque[float] = deque(maxlen=window)
+        self._sorted: List[float] = []
+        self._unsorted = 0
+
+    def observe(self, seconds: float) -> None:
+        """
+        Record the latency of a response.
+        """
+        with self._lock:
+            self._recent.append(seconds)
+            self._unsorted += 1
+            if self._unsorted >= self.refresh or len(self._sorted) < self.min_samples:
+                self._sorted = sorted(self._recent)
+                self._unsorted = 0
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """
+        Get a percentile of the recent latencies.
+
+        :param pct: The percentile, from 0 to 100.
+        :return: The latency in seconds, or None if fewer than ``min_samples`` were observed.
+        """
+        latencies = self._sorted
+        if len(latencies) < self.min_samples:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * pct / 100))
+        return latencies[index]
@@ -0,0 +1,212 @@
+"""
+Simulated upstream behaviour for the echo server, so that proxy benchmarks and resilience tests
+can model realistic backends: response sizes, latencies, body framing and injected failures.
+"""
+
+import math
+import os
+import random
+from email.message import Message
+from typing import Dict, Iterator, Mapping, NamedTuple, Optional, Tuple, Union
+from urllib.parse import parse_qsl
+
+from jwt_proxy.config import parse_flag
+from jwt_proxy.http_base import BODY_CHUNK_SIZE
+
+#: The ways a response body can be delimited: by ``Content-Length``, by chunked encoding, or by
+#: closing the connection.
+FRAMINGS = ("length", "chunked", "close")
+
+#: The failure status which closes the connection without a response.
+DROP = "drop"
+
+#: The prefix of the request headers which set simulation parameters, such as ``X-Echo-Size``.
+HEADER_PREFIX = "x-echo-"
+
+# Printable bytes from which generated bodies are sliced, without copying
+_FILLER = memoryview((bytes(range(0x21, 0x7F)) * 700)[: 64 * 1024])
+
+# The number of parameters of each latency distribution
+_DISTRIBUTIONS = {"fixed": 1, "uniform": 2, "exponential": 1, "normal": 2, "lognormal": 2}
+
+
+class Latency(NamedTuple):
+    """
+    A distribution of response latencies, in seconds.
+    """
+
+    #: One of ``fixed``, ``uniform``, ``exponential``, ``normal`` or ``lognormal``.
+    distribution: str = "fixed"
+    #: The fixed latency; the minimum and maximum; the mean; the mean and standard deviation; or
+    #: the median and the standard deviation of the latency's logarithm.
+    params: Tuple[float, ...] = (0.0,)
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        """
+        Parse a latency, either a number of seconds or ``<distribution>:<param>[:<param>]``, such
+        as ``uniform:0.01:0.1`` or ``lognormal:0.05:0.5``.
+
+        :raises ValueError: if the latency is invalid, with the reason.
+        """
+        distribution, sep, rest = spec.strip().partition(":")
+        if not sep:
+            distribution, rest = "fixed", distribution
+        if distribution not in _DISTRIBUTIONS:
+            raise ValueError(f"unknown distribution {distribution!r}")
+        params = tuple(float(param) for param in rest.split(":"))
+        if len(params) != _DISTRIBUTIONS[distribution]:
+            raise ValueError(f"{distribution} takes {_DISTRIBUTIONS[distribution]} parameters")
+        if not all(math.isfinite(param) and param >= 0 for param in params):
+            raise ValueError("parameters must be positive")
+        if distribution == "uniform" and params[0] > params[1]:
+            raise ValueError("the minimum exceeds the maximum")
+        return cls(distribution, params)
+
+    def sample(self) -> float:
+        """
+        Draw a latency from the distribution.
+        """
+        if self.distribution == "uniform":
+            return random.uniform(*self.params)
+        if self.distribution == "exponential":
+            return random.expovariate(1 / self.params[0]) if self.params[0] else 0.0
+        if self.distribution == "normal":
+            return max(0.0, random.gauss(*self.params))
+        if self.distribution == "lognormal":
+            median, sigma = self.params
+            return random.lognormvariate(math.log(median), sigma) if median else 0.0
+        return self.params[0]
+
+
+def _parse_status(value: str) -> int:
+    status = int(value)
+    if not 200 <= status <= 599 or status in (204, 205, 304):
+        raise ValueError("must be a final status which allows a body")
+    return status
+
+
+def _parse_fraction(value: str) -> float:
+    fraction = float(value)
+    if not 0 <= fraction <= 1:
+        raise ValueError("must be between 0 and 1")
+    return fraction
+
+
+def _parse_count(value: str, minimum: int) -> int:
+    count = int(value)
+    if count < minimum:
+        raise ValueError(f"must be at least {minimum}")
+    return count
+
+
+def _parse_framing(value: str) -> str:
+    if value not in FRAMINGS:
+        raise ValueError(f"must be one of {', '.join(FRAMINGS)}")
+    return value
+
+
+# The parser of each field of ResponseSimulation, which raises ValueError with the reason
+_PARSERS = {
+    "status": _parse_status,
+    "size": lambda value: _parse_count(value, 0),
+    "latency": Latency.parse,
+    "framing": _parse_framing,
+    "chunk_size": lambda value: _parse_count(value, 1),
+    "fail_rate": _parse_fraction,
+    "fail_status": lambda value: DROP if value == DROP else _parse_status(value),
+    "quiet": parse_flag,
+}
+
+
+class ResponseSimulation(NamedTuple):
+    """
+    How the echo server answers a request. The server's defaults are read from ``ECHO_<NAME>``
+    environment variables, and each request may override them with query parameters or
+    ``X-Echo-<Name>`` headers, such as ``?size=1024`` or ``X-Echo-Fail-Rate: 0.1``.
+    """
+
+    #: The status of responses which do not fail.
+    status: int = 200
+    #: The size of a generated response body in bytes, or None to echo the request.
+    size: Optional[int] = None
+    #: The time to wait before responding.
+    latency: Latency = Latency()
+    #: How the response body is delimited, one of :data:`FRAMINGS`.
+    framing: str = "length"
+    #: The size of the pieces in which the body is written, which are the chunks when chunked.
+    chunk_size: int = BODY_CHUNK_SIZE
+    #: The fraction of responses which fail.
+    fail_rate: float = 0.0
+    #: The status of failed responses, or :data:`DROP` to close the connection instead.
+    fail_status: Union[int, str] = 503
+    #: Whether to skip logging request details.
+    quiet: bool = False
+
+    @classmethod
+    def from_environment(cls) -> "ResponseSimulation":
+        """
+        Read the defaults from the ``ECHO_STATUS``, ``ECHO_SIZE``, ``ECHO_LATENCY``,
+        ``ECHO_FRAMING``, ``ECHO_CHUNK_SIZE``, ``ECHO_FAIL_RATE``, ``ECHO_FAIL_STATUS`` and
+        ``ECHO_QUIET`` environment variables.
+
+        :raises ValueError: if a variable is invalid.
+        """
+        params = {}
+        for name in cls._fields:
+            value = os.environ.get("ECHO_" + name.upper())
+            if value is not None:
+                params[name] = value
+        return cls().override(params)
+
+    def override(self, params: Mapping[str, str]) -> "ResponseSimulation":
+        """
+        Get a copy with some parameters changed.
+
+        :param params: Unparsed values by field name, see :func:`request_params`.
+        :raises ValueError: if a value is invalid.
+        """
+        if not params:
+            return self
+        changes = {}
+        for name, value in params.items():
+            try:
+                changes[name] = _PARSERS[name](value.strip())
+            except ValueError as e:
+                raise ValueError(f"Invalid {name} {value!r}: {e}") from e
+        return self._replace(**changes)
+
+    def body_pieces(self) -> Iterator[memoryview]:
+        """
+        Generate a body of ``size`` bytes, in pieces of at most ``chunk_size`` bytes.
+        """
+        piece_size = min(self.chunk_size, len(_FILLER))
+        remaining = self.size or 0
+        while remaining > 0:
+            piece = _FILLER[: min(piece_size, remaining)]
+            remaining -= len(piece)
+            yield piece
+
+
+def request_params(path: str, headers: Message) -> Dict[str, str]:
+    """
+    Get the simulation parameters of a request, from its query string and from ``X-Echo-*``
+    headers, which take precedence. Other query parameters and headers are ignored.
+
+    :param path: The request path, with the query string.
+    :param headers: The request headers.
+    :return: Unparsed values by field name of :class:`ResponseSimulation`.
+    """
+    params = {}
+    _, _, query = path.partition("?")
+    if query:
+        for name, value in parse_qsl(query, keep_blank_values=True):
+            if name in _PARSERS:
+                params[name] = value
+    for header, value in headers.items():
+        header = header.lower()
+        if header.startswith(HEADER_PREFIX):
+            name = header[len(HEADER_PREFIX) :].replace("-", "_")
+            if name in _PARSERS:
+                params[name] = value
+    return params
@@ -0,0 +1,344 @@
+"""
+Creation of the JWT tokens which the proxy adds to upstream requests.
+"""
+
+import getpass
+import os
+import threading
+import time
+from collections import deque
+from datetime import date, datetime, timedelta
+from typing import Deque, Dict, Mapping, Optional, Tuple, Union
+
+from jwt_proxy.jwt import SIGNING_ALGORITHMS, JWTSigner
+from jwt_proxy.keys import (
+    KeyFileWatcher,
+    KeySet,
+    SigningKey,
+    load_key_set,
+    signing_key_from_settings,
+)
+from jwt_proxy.logger import get_logger
+
+
+def _next_midnight(today: date) -> float:
+    """
+    Get the timestamp of the local midnight at the end of a day.
+    """
+    return datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()
+
+
+class UserTokenFactory:
+    """
+    Creates tokens whose payload is the current user and date.
+
+    The user name and signing key are looked up once, and a :class:`JWTSigner` is prepared for the
+    current date, so creating a token only serializes the per-token claims and signs them. The
+    signer is replaced when the date or the signing key changes.
+    """
+
+    def __init__(
+        self,
+        secret: bytes,
+        user: Optional[str] = None,
+        algorithm: str = "HS512",
+        key_id: Optional[str] = None,
+    ):
+        """
+        :param secret: The signing secret.
+        :param user: The user name, or None to use the user running the process.
+        :param algorithm: The signing algorithm, one of :data:`jwt_proxy.jwt.SIGNING_ALGORITHMS`.
+        :param key_id: The ID of the signing key, sent as the ``kid`` token header if set.
+        """
+        self.user = user or getpass.getuser()
+        self.key = SigningKey(key_id, secret, algorithm)
+        self.key_set: Optional[KeySet] = None
+        self.key_watcher: Optional[KeyFileWatcher] = None
+        self._signer: Optional[JWTSigner] = None
+        self._date = ""
+        self._rollover = 0.0
+        # Only taken when the signer is replaced, not for every token
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, settings: Optional[Mapping[str, str]] = None) -> "UserTokenFactory":
+        """
+        Create a factory using the keys in the file named by the ``JWT_KEYS_FILE`` environment
+        variable, or else the secret in ``JWT_SIGNING_SECRET`` with the algorithm in
+        ``JWT_SIGNING_ALGORITHM`` and the key ID in ``JWT_KEY_ID``.
+
+        :param settings: The settings to use instead of the environment.
+        """
+        settings = os.environ if settings is None else settings
+        keys_file = settings.get("JWT_KEYS_FILE")
+        if keys_file:
+            key_set = load_key_set(keys_file)
+            factory = cls(key_set.signing_key.secret)
+            factory.set_keys(key_set)
+            return factory
+
+        key = signing_key_from_settings(settings)
+        return cls(key.secret, algorithm=key.algorithm, key_id=key.key_id)
+
+    @property
+    def signer(self) -> JWTSigner:
+        """
+        The signer for the current date and signing key.
+        """
+        if time.time() >= self._rollover:
+            with self._lock:
+                if time.time() >= self._rollover:
+                    today = date.today()
+                    self._date = today.isoformat()
+                    self._signer = JWTSigner(
+                        dict(user=self.user, date=self._date),
+                        self.key.secret,
+                        self.key.algorithm,
+                        self.key.key_id,
+                    )
+                    self._rollover = _next_midnight(today)
+        return self._signer
+
+    def set_key(self, key: SigningKey) -> None:
+        """
+        Change the signing key. Tokens created afterwards are signed with the new key.
+
+        :param key: The new key.
+        """
+        if key.algorithm not in SIGNING_ALGORITHMS:
+            raise ValueError(f"Unsupported signing algorithm {key.algorithm}")
+        with self._lock:
+            self.key = key
+            self._rollover = 0.0
+
+    def set_keys(self, key_set: KeySet) -> None:
+        """
+        Change the active keys, signing tokens created afterwards with the current key of the set.
+
+        :param key_set: The new keys.
+        """
+        self.set_key(key_set.signing_key)
+        self.key_set = key_set
+
+    def set_secret(self, secret: bytes) -> None:
+        """
+        Change the signing secret, keeping the algorithm and key ID.
+
+        :param secret: The new secret.
+        """
+        self.set_key(self.key._replace(secret=secret))
+
+    def watch_key_file(self, path: str, interval: float = 5.0) -> None:
+        """
+        Install new keys whenever a key file changes, checking it in a background thread.
+
+        :param path: The path of the key file.
+        :param interval: Seconds between checks of the file.
+        """
+        self.key_watcher = KeyFileWatcher(path, self.set_keys, interval)
+        self.key_watcher.start()
+
+    def close(self) -> None:
+        """
+        Stop watching the key file, if any.
+        """
+        if self.key_watcher is not None:
+            self.key_watcher.stop()
+            self.key_watcher = None
+
+    def create_token(self) -> bytes:
+        """
+        Create a signed token for the current user and date.
+
+        :return: The token.
+        """
+        return self.signer.encode()
+
+
+class TokenPool:
+    """
+    Keeps a buffer of tokens minted in advance by a background thread, so that request handlers
+    can take a ready token in O(1) instead of minting one on the request thread.
+
+    Each buffered token is tagged with the :class:`JWTSigner` which created it. Since the factory
+    replaces its signer when the date or the secret changes, tokens for an outdated payload or
+    secret are recognized and discarded when they are taken. Tokens older than ``max_age`` seconds
+    are discarded too, which bounds how far their ``iat`` claim lags behind the time of use.
+
+    The producer refills the buffer up to ``size`` tokens whenever it drops below
+    ``low_watermark``. When the buffer is empty, tokens are minted synchronously.
+    """
+
+    def __init__(
+        self,
+        factory: UserTokenFactory,
+        size: int = 1024,
+        low_watermark: Optional[int] = None,
+        max_age: float = 30.0,
+    ):
+        """
+        :param factory: The factory used to mint tokens.
+        :param size: The buffer size, which is the high watermark for refills.
+        :param low_watermark: The buffer depth below which the producer refills the buffer.
+                              Defaults to a quarter of the size.
+        :param max_age: Seconds after which a buffered token is discarded.
+        """
+        self.factory = factory
+        self.size = size
+        self.low_watermark = size // 4 if low_watermark is None else low_watermark
+        self.max_age = max_age
+        self.logger = get_logger(type(self))
+
+        # Entries are (signer, monotonic time minted, token). deque appends and pops are atomic,
+        # so the buffer is shared without a lock.
+        self._buffer: Deque[Tuple[JWTSigner, float, bytes]] = deque()
+        self._wanted = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self.fallbacks = 0
+        self.discarded = 0
+
+    @classmethod
+    def from_environment(
+        cls, factory: UserTokenFactory, settings: Optional[Mapping[str, str]] = None
+    ) -> Optional["TokenPool"]:
+        """
+        Create a pool configured from the ``TOKEN_POOL_*`` environment variables.
+
+        :param factory: The factory used to mint tokens.
+        :param settings: The settings to use instead of the environment.
+        :return: The pool, or None if ``TOKEN_POOL_SIZE`` is unset or zero.
+        """
+        settings = os.environ if settings is None else settings
+        size = int(settings.get("TOKEN_POOL_SIZE", 0))
+        if size <= 0:
+            return None
+        low_watermark = settings.get("TOKEN_POOL_LOW_WATERMARK")
+        return cls(
+            factory,
+            size=size,
+            low_watermark=None if low_watermark is None else int(low_watermark),
+            max_age=float(settings.get("TOKEN_POOL_MAX_AGE", 30)),
+        )
+
+    def start(self) -> None:
+        """
+        Start the background producer.
+        """
+        self._thread = threading.Thread(target=self._run, daemon=True, name="token-pool")
+        self._thread.start()
+        self._wanted.set()
+
+    def stop(self) -> None:
+        """
+        Stop the background producer.
+        """
+        self._stopped = True
+        self._wanted.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def create_token(self) -> bytes:
+        """
+        Take a token from the buffer, or mint one synchronously if none is available.
+
+        :return: The token.
+        """
+        signer = self.factory.signer
+        oldest = time.monotonic() - self.max_age
+        while True:
+            try:
+                entry_signer, minted, token = self._buffer.popleft()
+            except IndexError:
+                break
+            if entry_signer is signer and minted >= oldest:
+                if len(self._buffer) < self.low_watermark:
+                    self._wanted.set()
+                return token
+            with self._stats_lock:
+                self.discarded += 1
+
+        self._wanted.set()
+        with self._stats_lock:
+            self.fallbacks += 1
+        return signer.encode()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the buffer depth and the counts of synchronous fallbacks and discarded tokens.
+        """
+        with self._stats_lock:
+            return {
+                "depth": len(self._buffer),
+                "fallbacks": self.fallbacks,
+                "discarded": self.discarded,
+            }
+
+    def _run(self) -> None:
+        while not self._stopped:
+            # Wake up periodically to replace tokens which are getting too old
+            self._wanted.wait(self.max_age / 2)
+            self._wanted.clear()
+            try:
+                self._fill()
+            except Exception:
+                self.logger.exception("Error while pre-minting tokens")
+
+    def _fill(self) -> None:
+        signer = self.factory.signer
+        oldest = time.monotonic() - self.max_age / 2
+        # The oldest tokens are at the front. Consumers may pop concurrently, so the buffer can
+        # become empty at any point.
+        while True:
+            try:
+                head_signer, minted, _ = self._buffer[0]
+                if head_signer is signer and minted >= oldest:
+                    break
+                self._buffer.popleft()
+            except IndexError:
+                break
+            with self._stats_lock:
+                self.discarded += 1
+
+        while len(self._buffer) < self.size and not self._stopped:
+            self._buffer.append((signer, time.monotonic(), signer.encode()))
+
+
+def create_token_source(
+    settings: Optional[Mapping[str, str]] = None
+) -> Union[UserTokenFactory, TokenPool]:
+    """
+    Create the token source configured by the environment: a started :class:`TokenPool` if
+    ``TOKEN_POOL_SIZE`` is set, otherwise a :class:`UserTokenFactory`. Both provide ``create_token()``.
+    If keys are loaded from ``JWT_KEYS_FILE``, the file is watched for changes.
+
+    :param settings: The settings to use instead of the environment.
+    """
+    settings = os.environ if settings is None else settings
+    factory = UserTokenFactory.from_environment(settings)
+    keys_file = settings.get("JWT_KEYS_FILE")
+    if keys_file:
+        factory.watch_key_file(keys_file, float(settings.get("JWT_KEYS_RELOAD_INTERVAL", 5)))
+    pool = TokenPool.from_environment(factory, settings)
+    if pool is None:
+        return factory
+    pool.start()
+    return pool
+
+
+def token_factory(source: Union[UserTokenFactory, TokenPool]) -> UserTokenFactory:
+    """
+    Get the factory of a token source created by :func:`create_token_source`.
+    """
+    return source.factory if isinstance(source, TokenPool) else source
+
+
+def close_token_source(source: Union[UserTokenFactory, TokenPool]) -> None:
+    """
+    Stop the background threads of a token source created by :func:`create_token_source`.
+    """
+    if isinstance(source, TokenPool):
+        source.stop()
+        source = source.factory
+    source.close()
@@ -0,0 +1,305 @@
+"""
+Persistent connection pooling for upstream requests.
+"""
+
+import os
+import select
+import threading
+import time
+from collections import deque
+from http.client import HTTPConnection, HTTPSConnection
+from typing import Deque, Dict, Optional, Tuple
+
+from jwt_proxy.logger import get_logger
+
+# Pool key: (scheme, host, port)
+PoolKey = Tuple[str, str, int]
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class UpstreamPoolExhausted(Exception):
+    """
+    Raised when no upstream connection became available within the acquire timeout.
+    """
+
+
+def pool_key(scheme: str, host: str, port: Optional[int]) -> PoolKey:
+    """
+    Normalize an upstream address into a pool key.
+
+    :param scheme: The URL scheme, ``http`` or ``https``.
+    :param host: The host name.
+    :param port: The port, or None to use the scheme's default port.
+    :return: The key.
+    """
+    scheme = scheme.lower()
+    if scheme not in _DEFAULT_PORTS:
+        raise ValueError(f"Unsupported upstream scheme {scheme!r}")
+    return scheme, host.lower(), port or _DEFAULT_PORTS[scheme]
+
+
+def timeouts_from_environment() -> Dict[str, Optional[float]]:
+    """
+    Read the upstream connect and read timeouts from ``UPSTREAM_CONNECT_TIMEOUT`` and
+    ``UPSTREAM_READ_TIMEOUT``, where 0 means no timeout.
+
+    :return: The ``connect_timeout`` and ``read_timeout`` arguments of the connection pools.
+    """
+    timeouts = {}
+    for name, default in (("connect", 5.0), ("read", 30.0)):
+        seconds = float(os.environ.get(f"UPSTREAM_{name.upper()}_TIMEOUT", default))
+        timeouts[f"{name}_timeout"] = seconds if seconds > 0 else None
+    return timeouts
+
+
+class UpstreamConnectionPool:
+    """
+    A thread-safe pool of persistent HTTP/1.1 connections, keyed by scheme, host and port.
+
+    Connections are checked out with :meth:`acquire` and must always be handed back with
+    :meth:`release`, indicating whether they are still usable. Idle connections are reused
+    most-recently-used first, so that rarely needed ones age out and are evicted after
+    ``idle_timeout`` seconds.
+    """
+
+    def __init__(
+        self,
+        max_idle_per_host: int = 10,
+        max_total: int = 100,
+        idle_timeout: float = 30.0,
+        acquire_timeout: Optional[float] = 10.0,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+    ):
+        """
+        :param max_idle_per_host: Maximum number of idle connections kept for each key.
+        :param max_total: Maximum number of open connections (idle and in use) across all keys.
+        :param idle_timeout: Seconds after which an idle connection is closed.
+        :param acquire_timeout: Seconds to wait for a free slot when ``max_total`` is reached,
+                                or None to wait forever.
+        :param connect_timeout: Seconds to wait for new connections to be established, or None
+                                for no timeout.
+        :param read_timeout: Seconds to wait for each read from or write to an established
+                             connection, or None for no timeout.
+        """
+        self.max_idle_per_host = max_idle_per_host
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.logger = get_logger(type(self))
+
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        # Idle connections per key, as (connection, time returned to the pool)
+        self._idle: Dict[PoolKey, Deque[Tuple[HTTPConnection, float]]] = {}
+        self._in_use = 0
+        self._idle_count = 0
+        self._last_sweep = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_environment(cls) -> "UpstreamConnectionPool":
+        """
+        Create a pool configured from the ``UPSTREAM_POOL_*`` and ``UPSTREAM_*_TIMEOUT``
+        environment variables.
+        """
+        return cls(
+            max_idle_per_host=int(os.environ.get("UPSTREAM_POOL_MAX_IDLE", 10)),
+            max_total=int(os.environ.get("UPSTREAM_POOL_MAX_TOTAL", 100)),
+            idle_timeout=float(os.environ.get("UPSTREAM_POOL_IDLE_TIMEOUT", 30)),
+            **timeouts_from_environment(),
+        )
+
+    def acquire(
+        self, scheme: str, host: str, port: Optional[int] = None
+    ) -> Tuple[HTTPConnection, bool]:
+        """
+        Check out a connection to an upstream server.
+
+        :param scheme: The URL scheme.
+        :param host: The host name.
+        :param port: The port, or None for the scheme's default port.
+        :return: The connection, and whether it was reused from the pool.
+        :raises UpstreamPoolExhausted: if ``max_total`` connections stayed busy for longer than
+                                       the acquire timeout.
+        """
+        key = pool_key(scheme, host, port)
+        deadline = None if self.acquire_timeout is None else time.monotonic() + self.acquire_timeout
+        stale = []
+        reused = False
+
+        with self._available:
+            self._sweep_locked(time.monotonic())
+            while True:
+                idle = self._idle.get(key)
+                while idle:
+                    conn, _ = idle.pop()
+                    self._idle_count -= 1
+                    if self._is_stale(conn):
+                        stale.append(conn)
+                        continue
+                    self._in_use += 1
+                    self.hits += 1
+                    reused = True
+                    break
+                else:
+                    conn = None
+
+                if conn is not None:
+                    break
+
+                if self._in_use + self._idle_count >= self.max_total:
+                    # Make room by dropping the least recently used idle connection of another key
+                    victim = self._pop_oldest_idle_locked()
+                    if victim is not None:
+                        stale.append(victim)
+
+                if self._in_use + self._idle_count < self.max_total:
+                    self._in_use += 1
+                    self.misses += 1
+                    conn = self._new_connection(key)
+                    break
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise UpstreamPoolExhausted(
+                        f"No upstream connection available after {self.acquire_timeout} seconds"
+                    )
+                self._available.wait(remaining)
+
+        for old in stale:
+            old.close()
+
+        return conn, reused
+
+    def connect(self, conn: HTTPConnection) -> None:
+        """
+        Establish a new connection from :meth:`acquire` within the connect timeout, and apply the
+        read timeout to it.
+        """
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+
+    def release(self, conn: HTTPConnection, reusable: bool) -> None:
+        """
+        Return a connection to the pool.
+
+        :param conn: The connection from :meth:`acquire`.
+        :param reusable: Whether the last response was fully read and the connection may be
+                         used for another request. Non-reusable connections are closed.
+        """
+        key = pool_key(conn._pool_scheme, conn.host, conn.port)
+        close = not reusable or conn.sock is None
+        with self._available:
+            self._in_use -= 1
+            if not close:
+                idle = self._idle.setdefault(key, deque())
+                if len(idle) >= self.max_idle_per_host:
+                    close = True
+                else:
+                    idle.append((conn, time.monotonic()))
+                    self._idle_count += 1
+            self._available.notify()
+
+        if close:
+            conn.close()
+
+    def evict_idle(self) -> int:
+        """
+        Close all idle connections which have exceeded the idle timeout.
+
+        :return: The number of evicted connections.
+        """
+        with self._lock:
+            expired = self._collect_expired_locked(time.monotonic())
+        for conn in expired:
+            conn.close()
+        return len(expired)
+
+    def close(self) -> None:
+        """
+        Close all idle connections. Connections which are in use are closed when released.
+        """
+        with self._lock:
+            conns = [conn for idle in self._idle.values() for conn, _ in idle]
+            self._idle.clear()
+            self._idle_count = 0
+            self.max_idle_per_host = 0
+        for conn in conns:
+            conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get a snapshot of the pool counters.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "idle": self._idle_count,
+                "in_use": self._in_use,
+            }
+
+    def _new_connection(self, key: PoolKey) -> HTTPConnection:
+        scheme, host, port = key
+        conn_cls = HTTPSConnection if scheme == "https" else HTTPConnection
+        conn = conn_cls(host, port, timeout=self.connect_timeout)
+        conn._pool_scheme = scheme
+        return conn
+
+    @staticmethod
+    def _is_stale(conn: HTTPConnection) -> bool:
+        """
+        Check whether an idle connection has been closed by the peer.
+
+        An idle HTTP connection should never be readable; readability means either EOF or
+        unsolicited data, and in both cases the connection cannot be reused.
+        """
+        sock = conn.sock
+        if sock is None:
+            return True
+        # poll rather than select, which cannot watch descriptors above FD_SETSIZE
+        poller = select.poll()
+        try:
+            poller.register(sock, select.POLLIN)
+            return bool(poller.poll(0))
+        except (OSError, ValueError):
+            return True
+
+    def _pop_oldest_idle_locked(self) -> Optional[HTTPConnection]:
+        oldest_key = None
+        oldest_time = None
+        for key, idle in self._idle.items():
+            if idle and (oldest_time is None or idle[0][1] < oldest_time):
+                oldest_key = key
+                oldest_time = idle[0][1]
+        if oldest_key is None:
+            return None
+        conn, _ = self._idle[oldest_key].popleft()
+        self._idle_count -= 1
+        return conn
+
+    def _collect_expired_locked(self, now: float):
+        expired = []
+        for key in list(self._idle):
+            idle = self._idle[key]
+            while idle and now - idle[0][1] > self.idle_timeout:
+                expired.append(idle.popleft()[0])
+                self._idle_count -= 1
+            if not idle:
+                del self._idle[key]
+        self._last_sweep = now
+        return expired
+
+    def _sweep_locked(self, now: float) -> None:
+        # Sweep at most once per second, so that acquire() stays cheap
+        if now - self._last_sweep < 1.0:
+            return
+        expired = self._collect_expired_locked(now)
+        for conn in expired:
+            # Closing an idle socket does not block, so this is safe under the lock
+            conn.close()
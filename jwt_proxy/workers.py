@@ -0,0 +1,227 @@
+"""
+Pre-forked worker processes, which each run a server on the same port with ``SO_REUSEPORT``, so
+that request handling is not limited to the one core the GIL allows a single process.
+"""
+
+import mmap
+import os
+import signal
+import struct
+import threading
+import time
+from typing import Callable, Dict
+
+from jwt_proxy.logger import get_logger, stop_logging
+
+
+class SharedStats:
+    """
+    A block of counters in anonymous shared memory, created by the supervisor before the workers
+    are forked, so that every worker can report statistics for the whole server.
+
+    Each worker only writes its own slot, so no lock is needed between processes. Slots survive
+    worker restarts, so counts are not lost when a worker crashes.
+    """
+
+    # Supervisor start time, and the number of workers restarted
+    _HEADER = struct.Struct("=dq")
+    # Per worker: the number of requests processed
+    _SLOT = struct.Struct("=q")
+
+    def __init__(self, workers: int):
+        """
+        :param workers: The number of worker slots.
+        """
+        self.workers = workers
+        self._mmap = mmap.mmap(-1, self._HEADER.size + self._SLOT.size * workers)
+        self._HEADER.pack_into(self._mmap, 0, time.time(), 0)
+
+    @property
+    def start_time(self) -> float:
+        """
+        Timestamp when the supervisor was started.
+        """
+        return self._HEADER.unpack_from(self._mmap, 0)[0]
+
+    @property
+    def restarts(self) -> int:
+        """
+        The number of workers which were restarted after exiting.
+        """
+        return self._HEADER.unpack_from(self._mmap, 0)[1]
+
+    def add_restart(self) -> None:
+        """
+        Count a worker restart. Only called by the supervisor.
+        """
+        self._HEADER.pack_into(self._mmap, 0, self.start_time, self.restarts + 1)
+
+    def get_requests(self, worker_id: int) -> int:
+        """
+        Get the number of requests processed by a worker slot.
+        """
+        return self._SLOT.unpack_from(self._mmap, self._slot_offset(worker_id))[0]
+
+    def set_requests(self, worker_id: int, value: int) -> None:
+        """
+        Set the number of requests processed by a worker slot. Only called by the worker itself.
+        """
+        self._SLOT.pack_into(self._mmap, self._slot_offset(worker_id), value)
+
+    def total_requests(self) -> int:
+        """
+        Get the number of requests processed by all workers.
+        """
+        return sum(self.get_requests(worker_id) for worker_id in range(self.workers))
+
+    def _slot_offset(self, worker_id: int) -> int:
+        if not 0 <= worker_id < self.workers:
+            raise IndexError(f"Invalid worker ID {worker_id}")
+        return self._HEADER.size + self._SLOT.size * worker_id
+
+
+class WorkerSupervisor:
+    """
+    Forks worker processes and restarts those which exit, until ``SIGINT`` or ``SIGTERM`` is
+    received, which is forwarded to the workers, so that they drain. ``SIGHUP`` is forwarded to the
+    workers, so that they reload their configuration. ``SIGUSR2`` is ignored: a new supervisor can
+    be started alongside instead, since the workers share the port through ``SO_REUSEPORT``.
+
+    The supervisor blocks in :func:`os.wait` rather than polling, so it only wakes up when a worker
+    exits or a signal arrives. Workers which exit soon after starting are restarted with an
+    increasing delay, so that a worker which cannot start (for example because of a configuration
+    error) does not restart in a tight loop.
+    """
+
+    def __init__(
+        self,
+        target: Callable[[SharedStats, int], None],
+        workers: int,
+        min_uptime: float = 1.0,
+        max_restart_delay: float = 30.0,
+    ):
+        """
+        :param target: Runs the server in a worker process, given the shared statistics and the
+                       worker ID. It should return, or exit, when the worker receives ``SIGTERM``.
+        :param workers: The number of worker processes.
+        :param min_uptime: Workers which exit sooner than this many seconds after starting are
+                           restarted with a delay.
+        :param max_restart_delay: The maximum delay before restarting a worker.
+        """
+        self.target = target
+        self.workers = workers
+        self.min_uptime = min_uptime
+        self.max_restart_delay = max_restart_delay
+        self.shared_stats = SharedStats(workers)
+        self.logger = get_logger(type(self))
+
+        # Worker ID and start time by process ID
+        self._children: Dict[int, int] = {}
+        self._started: Dict[int, float] = {}
+        self._restart_delays: Dict[int, float] = {}
+        self._stopping = threading.Event()
+
+    def run(self) -> None:
+        """
+        Start the workers, and supervise them until the supervisor is signalled to stop.
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self._stop)
+        signal.signal(signal.SIGHUP, self._forward)
+        signal.signal(signal.SIGUSR2, self._ignore)
+
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id = self._children.pop(pid, None)
+            if worker_id is None:
+                continue
+            uptime = time.monotonic() - self._started.pop(pid)
+            if self._stopping.is_set():
+                continue
+
+            self.logger.error(
+                "Worker %d (pid %d) exited with %s after %.1f seconds, restarting",
+                worker_id,
+                pid,
+                self._describe_status(status),
+                uptime,
+            )
+            if uptime < self.min_uptime:
+                delay = min(self._restart_delays.get(worker_id, 0.5) * 2, self.max_restart_delay)
+                self._restart_delays[worker_id] = delay
+                # The signal handler sets the event, which ends the delay early
+                if self._stopping.wait(delay):
+                    continue
+            else:
+                self._restart_delays.pop(worker_id, None)
+            self.shared_stats.add_restart()
+            self._spawn(worker_id)
+
+        self.logger.info("All workers exited")
+
+    def _spawn(self, worker_id: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(worker_id)
+        self._children[pid] = worker_id
+        self._started[pid] = time.monotonic()
+        self.logger.info("Started worker %d (pid %d)", worker_id, pid)
+
+    def _run_worker(self, worker_id: int) -> None:
+        # The worker installs its own handlers; until then, a reload is ignored rather than fatal
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+        code = 1
+        try:
+            self.target(self.shared_stats, worker_id)
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+        except BaseException:
+            self.logger.exception("Worker %d failed", worker_id)
+        finally:
+            # Never return into the supervisor's code in the child process, which also skips the
+            # exit handlers, so queued log records are written here
+            stop_logging()
+            os._exit(code)
+
+    def _stop(self, signum, frame) -> None:
+        self.logger.info("Got signal %d (%s), stopping workers", signum, signal.strsignal(signum))
+        self._stopping.set()
+        self._signal_workers(signal.SIGTERM)
+
+    def _forward(self, signum, frame) -> None:
+        self.logger.info(
+            "Got signal %d (%s), forwarding to workers", signum, signal.strsignal(signum)
+        )
+        self._signal_workers(signum)
+
+    def _ignore(self, signum, frame) -> None:
+        self.logger.warning(
+            "Got signal %d (%s), which is not supported with worker processes",
+            signum,
+            signal.strsignal(signum),
+        )
+
+    def _signal_workers(self, signum: int) -> None:
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    @staticmethod
+    def _describe_status(status: int) -> str:
+        if os.WIFSIGNALED(status):
+            return f"signal {signal.Signals(os.WTERMSIG(status)).name}"
+        return f"code {os.waitstatus_to_exitcode(status)}"
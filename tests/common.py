@@ -1,10 +1,14 @@
 """
 Common utilities for unit tests.
 """
+import socket
+import time
+from collections import Counter
 from http import HTTPStatus
 from http.client import HTTPResponse, UnimplementedFileMode
+from http.server import BaseHTTPRequestHandler
 from io import BytesIO
-from typing import Callable, Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional
 from urllib.request import Request
 
 
@@ -48,6 +52,132 @@ class FakeSocket:
         pass
 
 
+class StreamingUpstreamHandler(BaseHTTPRequestHandler):
+    """
+    An upstream stand-in which reports the size of the request body it received, framing its
+    response according to the request path: ``/chunked`` responds with chunked encoding, ``/close``
+    delimits the body by closing the connection, and any other path uses ``Content-Length``.
+    The response body is the request body size, followed by ``X-Repeat`` repetitions of ``0123456789``.
+    Other methods with a body are handled alike, and report the method in ``X-Method``. The
+    ``X-Content-Encoding`` request header is returned as ``Content-Encoding``.
+
+    GET and HEAD requests are answered with ``Cache-Control`` depending on the path:
+    ``/cache/max-age`` and ``/cache/slow`` (which takes 0.3 seconds) are fresh for a minute,
+    ``/cache/private`` must not be stored by the proxy, and ``/cache/etag`` must be revalidated
+    with its ``ETag``. The body is the path and the number of requests for it so far, which are
+    counted in :attr:`gets`.
+
+    Latency and failures can be injected with GET: ``/sleep/<seconds>`` waits before every
+    response, ``/sleep-first/<seconds>`` only before the first response for the path, and
+    ``/fail-first/...`` answers its first request with 503.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    #: GET and HEAD requests by path
+    gets: "Counter[str]" = Counter()
+
+    def do_GET(self):
+        self.gets[self.path] += 1
+        cache_control = {
+            "/cache/max-age": "max-age=60",
+            "/cache/slow": "max-age=60",
+            "/cache/private": "private, max-age=60",
+            "/cache/etag": "no-cache",
+        }.get(self.path)
+        if self.path == "/cache/slow":
+            time.sleep(0.3)
+        elif self.path.startswith("/sleep/") or (
+            self.path.startswith("/sleep-first/") and self.gets[self.path] == 1
+        ):
+            time.sleep(float(self.path.rpartition("/")[2]))
+        elif self.path.startswith("/fail-first/") and self.gets[self.path] == 1:
+            self.send_error(HTTPStatus.SERVICE_UNAVAILABLE)
+            return
+        if self.path == "/cache/etag" and self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Cache-Control", cache_control)
+            self.end_headers()
+            return
+
+        body = f"{self.path} {self.gets[self.path]}".encode("ascii")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        if cache_control is not None:
+            self.send_header("Cache-Control", cache_control)
+        if self.path == "/cache/etag":
+            self.send_header("ETag", '"v1"')
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            received = 0
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                received += len(self.rfile.read(size))
+                self.rfile.readline()
+        else:
+            received = len(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+        pieces = [str(received).encode("ascii")] + [b"0123456789"] * int(
+            self.headers.get("X-Repeat", 0)
+        )
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("X-Method", self.command)
+        if "X-Content-Encoding" in self.headers:
+            self.send_header("Content-Encoding", self.headers["X-Content-Encoding"])
+        if self.path == "/chunked":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for piece in pieces:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(piece), piece))
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path == "/close":
+            self.close_connection = True
+            self.end_headers()
+            for piece in pieces:
+                self.wfile.write(piece)
+        else:
+            self.send_header("Content-Length", str(sum(len(piece) for piece in pieces)))
+            self.end_headers()
+            for piece in pieces:
+                self.wfile.write(piece)
+
+    do_PUT = do_PATCH = do_DELETE = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+def send_raw_request(port: int, payload: bytes) -> bytes:
+    """
+    Send raw bytes to a local server, and collect everything it sends back until it closes the connection.
+
+    :param port: The server's port on localhost.
+    :param payload: The raw request data.
+    :return: The raw response data.
+    """
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(payload)
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return data
+
+
 def create_http_response(
     status: HTTPStatus,
     headers: Optional[Dict[str, str]] = None,
@@ -62,38 +192,64 @@ def create_http_response(
     :return: The response.
     """
 
-    lines = [f"HTTP 1.0 {status.value} {status.phrase}"]
+    lines = [f"HTTP/1.1 {status.value} {status.phrase}"]
 
     if headers is None:
         headers = {}
     if content is None:
         content = b""
-    headers["Content-Length"] = str(len(content))
+    headers.setdefault("Content-Length", str(len(content)))
     for k, v in headers.items():
         lines.append(f"{k}: {v}")
 
     enc_headers = "\r\n".join(lines).encode("ascii")
     resp = HTTPResponse(FakeSocket(enc_headers + b"\r\n\r\n" + content))
-    resp.chunked = False
-    resp.headers = headers
-    resp.length = len(content)
+    resp.begin()
     return resp
 
 
-class URLOpenMock:
+class FakeUpstreamConnection:
     """
-    A simple mock facility for :func:`urllib.request.urlopen`, inspired by the ``requests-mock`` package.
+    A stand-in for :class:`http.client.HTTPConnection` which dispatches requests to the handlers
+    registered on an :class:`UpstreamPoolMock`.
+    """
+
+    def __init__(self, pool: "UpstreamPoolMock", scheme: str, host: str, port: Optional[int]):
+        self.pool = pool
+        self.base_url = f"{scheme}://{host}:{port}" if port else f"{scheme}://{host}"
+        self.response: Optional[HTTPResponse] = None
+        # Always "connected", like a pooled connection
+        self.sock = True
+
+    def request(self, method: str, url: str, body=None, headers=None) -> None:
+        request = Request(self.base_url + url, data=body, headers=headers or {}, method=method)
+        self.pool.requests.append(request)
+        if request.full_url in self.pool.handlers:
+            self.response = self.pool.handlers[request.full_url](request)
+        else:
+            raise Exception(f"No handler function defined for URL {request.full_url}")
+
+    def getresponse(self) -> HTTPResponse:
+        return self.response
+
+
+class UpstreamPoolMock:
+    """
+    A simple mock facility for :class:`jwt_proxy.upstream.UpstreamConnectionPool`, inspired by the
+    ``requests-mock`` package.
 
     Callers can optionally add handlers to validate specific URLs by calling :meth:`add_handler`, and can
     inspect all issued requests in the :attr:`requests` list.
 
-    A global instance of this class is available in :attr:`urlopen_mock`. Unit tests should patch
-    :func:`urllib.request.urlopen` using this class's instance method :func:`invoke`.
+    A global instance of this class is available in :attr:`upstream_pool_mock`. Unit tests should assign it
+    as the ``upstream_pool`` of the server passed to the request handler.
     """
 
     def __init__(self):
-        self.requests: List = []
-        self.handlers: Dict[str, Callable[[Request], ...]] = {}
+        self.requests: List[Request] = []
+        self.handlers: Dict[str, Callable[[Request], HTTPResponse]] = {}
+        self.hits = 0
+        self.misses = 0
 
     def clean(self) -> None:
         """
@@ -103,24 +259,24 @@ class URLOpenMock:
         """
         self.requests.clear()
         self.handlers.clear()
+        self.hits = 0
+        self.misses = 0
 
-    def invoke(self, url: Union[str, Request], data=None, *args, **kwargs) -> HTTPResponse:
+    def acquire(self, scheme: str, host: str, port: Optional[int] = None):
         """
-        Mock for :func:`urllib.request.urlopen`.
+        Mock for :meth:`jwt_proxy.upstream.UpstreamConnectionPool.acquire`, which always returns a new
+        connection.
+        """
+        self.misses += 1
+        return FakeUpstreamConnection(self, scheme, host, port), False
 
-        :param url: The URL or request.
-        :param data: The data.
-        :param args: Unused arguments.
-        :param kwargs: Unused arguments.
-        :return: The response.
+    def release(self, conn: FakeUpstreamConnection, reusable: bool) -> None:
         """
-        if isinstance(url, str):
-            url = Request(url, data)
-        self.requests.append(url)
-        if url.full_url in self.handlers:
-            return self.handlers[url.full_url](url)
-        else:
-            raise Exception(f"No handler function defined for URL {url.full_url}")
+        Mock for :meth:`jwt_proxy.upstream.UpstreamConnectionPool.release`.
+        """
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "idle": 0, "in_use": 0}
 
     def add_handler(self, url: str, function: Callable[[Request], HTTPResponse]):
         """
@@ -134,4 +290,4 @@ class URLOpenMock:
         self.handlers[url] = function
 
 
-urlopen_mock = URLOpenMock()
+upstream_pool_mock = UpstreamPoolMock()
@@ -0,0 +1,144 @@
+"""
+Unit tests for :mod:`jwt_proxy.aio_server`.
+"""
+
+import asyncio
+import os
+import socket
+import threading
+import unittest
+from http import HTTPStatus
+from http.client import HTTPConnection
+
+from jwt_proxy.aio_server import (
+    AsyncEchoRequestHandler,
+    AsyncHTTPServer,
+    AsyncProxyRequestHandler,
+    get_async_handler,
+)
+from jwt_proxy.echo_server import EchoRequestHandler
+from jwt_proxy.proxy_server import ProxyRequestHandler
+from tests.common import send_raw_request
+from tests.test_jwt import SECRET
+from tests.test_proxy_server import StreamingRelayTests
+
+
+class TestAsyncServer(unittest.TestCase):
+    """
+    Tests for :class:`AsyncHTTPServer`, running the asyncio proxy in front of the asyncio echo server.
+    """
+
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.echo = self.start(AsyncEchoRequestHandler)
+        os.environ["UPSTREAM_SERVER"] = f"127.0.0.1:{self.echo.server_address[1]}"
+        os.environ["JWT_SIGNING_SECRET"] = SECRET.decode("ascii")
+        self.proxy = self.start(AsyncProxyRequestHandler)
+
+    def tearDown(self) -> None:
+        for server in (self.proxy, self.echo):
+            asyncio.run_coroutine_threadsafe(server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def start(self, handler_cls) -> AsyncHTTPServer:
+        server = AsyncHTTPServer(("127.0.0.1", 0), handler_cls)
+        asyncio.run_coroutine_threadsafe(server.start(), self.loop).result()
+        return server
+
+    def test_drain(self):
+        """
+        Draining closes idle connections and stops accepting new ones.
+        """
+        conn = HTTPConnection("127.0.0.1", self.echo.server_address[1])
+        conn.request("POST", "/", body=b"hello")
+        self.assertEqual(conn.getresponse().read()[-5:], b"hello")
+
+        drain = asyncio.run_coroutine_threadsafe(self.echo.drain(5), self.loop)
+        self.assertTrue(drain.result())
+        self.assertEqual(conn.sock.recv(1), b"")
+        conn.close()
+        with self.assertRaises(ConnectionRefusedError):
+            socket.create_connection(self.echo.server_address)
+
+    def test_simulated_response(self):
+        """
+        Generated chunked bodies are relayed, and close-delimited ones end with the connection.
+        """
+        conn = HTTPConnection("127.0.0.1", self.proxy.server_address[1])
+        conn.request("POST", "/?size=200000&framing=chunked&chunk_size=5000", body=b"x")
+        response = conn.getresponse()
+        self.assertEqual(response.status, HTTPStatus.OK)
+        self.assertEqual(len(response.read()), 200000)
+        conn.close()
+
+        conn = HTTPConnection("127.0.0.1", self.echo.server_address[1])
+        conn.request("POST", "/", body=b"x", headers={"X-Echo-Framing": "close"})
+        response = conn.getresponse()
+        self.assertTrue(response.will_close)
+        self.assertTrue(response.read().endswith(b"Body (1 bytes):\nx"))
+        conn.close()
+
+    def test_get_async_handler(self):
+        self.assertIs(get_async_handler(EchoRequestHandler), AsyncEchoRequestHandler)
+        self.assertIs(get_async_handler(ProxyRequestHandler), AsyncProxyRequestHandler)
+        self.assertIs(get_async_handler(AsyncEchoRequestHandler), AsyncEchoRequestHandler)
+        with self.assertRaises(ValueError):
+            get_async_handler(object)
+
+    def test_proxy_request(self):
+        """
+        Requests are forwarded with the JWT header, over a reused upstream connection.
+        """
+        conn = HTTPConnection("127.0.0.1", self.proxy.server_address[1])
+        for _ in range(2):
+            conn.request("POST", "/foo?a=b", body=b"Input body")
+            response = conn.getresponse()
+            body = response.read()
+            self.assertEqual(response.status, HTTPStatus.OK)
+            self.assertFalse(response.will_close)
+            self.assertIn(b"Path: /foo?a=b", body)
+            self.assertRegex(body, rb"x-my-jwt: [a-zA-Z0-9_\-]+\.[a-zA-Z0-9_\-]+\.[a-zA-Z0-9_\-]+")
+            self.assertTrue(body.endswith(b"Body (10 bytes):\nInput body"))
+
+        self.assertEqual(self.proxy.upstream_pool.stats()["hits"], 1)
+
+        conn.request("GET", "/status")
+        status = conn.getresponse().read().decode("utf-8")
+        self.assertIn("2 requests processed", status)
+        self.assertIn("1 upstream connection pool hits, 1 misses", status)
+        conn.close()
+
+    def test_missing_length(self):
+        data = send_raw_request(self.echo.server_address[1], b"POST / HTTP/1.1\r\n\r\n")
+        self.assertTrue(data.startswith(b"HTTP/1.1 400 Bad Request"))
+        self.assertIn(b"Connection: close", data)
+
+    def test_pipelining(self):
+        request = b"POST /%d HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc"
+        payload = request % 1 + request % 2 + b"GET /status HTTP/1.1\r\nConnection: close\r\n\r\n"
+        data = send_raw_request(self.echo.server_address[1], payload)
+        self.assertLess(data.index(b"Path: /1"), data.index(b"Path: /2"))
+        self.assertIn(b"2 requests processed", data)
+
+
+class TestAsyncStreamingRelay(StreamingRelayTests, unittest.TestCase):
+    def setUp(self) -> None:
+        self.start_upstream()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.proxy = AsyncHTTPServer(("127.0.0.1", 0), AsyncProxyRequestHandler)
+        asyncio.run_coroutine_threadsafe(self.proxy.start(), self.loop).result()
+        self.proxy_port = self.proxy.server_address[1]
+
+    def tearDown(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.proxy.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.stop_upstream()
@@ -0,0 +1,209 @@
+"""
+Unit tests for :mod:`jwt_proxy.balancer`.
+"""
+
+import os
+import threading
+import unittest
+from collections import Counter
+from http import HTTPStatus
+from http.client import HTTPConnection
+from unittest import mock
+
+from jwt_proxy.balancer import HealthChecker, UpstreamBalancer
+from jwt_proxy.breaker import CircuitBreaker, CircuitOpenError
+from jwt_proxy.echo_server import EchoRequestHandler
+from jwt_proxy.http_base import ProxyHTTPServer
+from jwt_proxy.proxy_server import ProxyRequestHandler
+from tests.test_jwt import SECRET
+
+URLS = ["http://a:1", "http://b:2", "http://c:3"]
+
+
+class TestUpstreamBalancer(unittest.TestCase):
+    def test_round_robin(self):
+        balancer = UpstreamBalancer(URLS)
+        self.assertEqual([balancer.choose("/").url for _ in range(6)], URLS * 2)
+
+        balancer.set_healthy(balancer.upstreams[1], False)
+        self.assertEqual({balancer.choose("/").url for _ in range(6)}, {"http://a:1", "http://c:3"})
+
+    def test_all_unhealthy(self):
+        balancer = UpstreamBalancer(URLS)
+        for upstream in balancer.upstreams:
+            balancer.set_healthy(upstream, False)
+        self.assertEqual({balancer.choose("/").url for _ in range(6)}, set(URLS))
+
+    def test_least_outstanding(self):
+        balancer = UpstreamBalancer(URLS, "least_outstanding")
+        with balancer.select("/") as (first, _), balancer.select("/") as (second, _):
+            self.assertNotEqual(first, second)
+            self.assertEqual(first.outstanding, 1)
+            # Only the third upstream is idle
+            for _ in range(3):
+                with balancer.select("/") as (third, _):
+                    self.assertNotIn(third, (first, second))
+        self.assertEqual([upstream.outstanding for upstream in balancer.upstreams], [0, 0, 0])
+
+        # Upstreams with equal counts take turns
+        self.assertEqual({balancer.choose("/").url for _ in range(3)}, set(URLS))
+
+    def test_consistent_hash(self):
+        balancer = UpstreamBalancer(URLS, "consistent_hash")
+        paths = [f"/items/{i}" for i in range(300)]
+        owners = {path: balancer.choose(path) for path in paths}
+        # Stable, ignoring the query, and spread over all upstreams
+        self.assertEqual(balancer.choose("/items/1?a=b"), owners["/items/1"])
+        counts = Counter(upstream.url for upstream in owners.values())
+        self.assertEqual(set(counts), set(URLS))
+        self.assertGreater(min(counts.values()), 50)
+
+        # Only the paths of an unhealthy upstream move
+        down = balancer.upstreams[0]
+        balancer.set_healthy(down, False)
+        for path, owner in owners.items():
+            if owner is down:
+                self.assertIsNot(balancer.choose(path), down)
+            else:
+                self.assertIs(balancer.choose(path), owner)
+
+    def test_circuit_breakers(self):
+        balancer = UpstreamBalancer(
+            URLS, circuit_breaker=lambda url: CircuitBreaker(url, consecutive_failures=1)
+        )
+        with balancer.select("/") as (upstream, generation):
+            balancer.record(upstream, generation, False)
+        # Upstreams with an open breaker are skipped, and refused once all are open
+        self.assertNotIn(upstream, {balancer.choose("/") for _ in range(6)})
+        for other in balancer.upstreams:
+            if other is not upstream:
+                balancer.record(other, other.breaker.acquire(), False)
+        with self.assertRaises(CircuitOpenError):
+            with balancer.select("/"):
+                pass
+        self.assertEqual([upstream.outstanding for upstream in balancer.upstreams], [0, 0, 0])
+        self.assertEqual(
+            [(url, breaker.state) for url, breaker in balancer.breaker_stats()],
+            [(url, "open") for url in URLS],
+        )
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            UpstreamBalancer([])
+        with self.assertRaises(ValueError):
+            UpstreamBalancer(URLS, "random")
+
+
+class TestHealthChecks(unittest.TestCase):
+    """
+    Balances a proxy over several echo servers, and checks their health.
+    """
+
+    def setUp(self) -> None:
+        self.echoes = [self.start(EchoRequestHandler) for _ in range(3)]
+
+    def tearDown(self) -> None:
+        for server in self.echoes:
+            if server.socket.fileno() != -1:
+                self.stop(server)
+
+    @staticmethod
+    def start(handler_cls) -> ProxyHTTPServer:
+        server = ProxyHTTPServer(("127.0.0.1", 0), handler_cls)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        return server
+
+    @staticmethod
+    def stop(server: ProxyHTTPServer) -> None:
+        server.shutdown()
+        server.server_close()
+
+    def urls(self):
+        return [f"http://127.0.0.1:{server.server_address[1]}" for server in self.echoes]
+
+    def test_health_checks(self):
+        balancer = UpstreamBalancer(self.urls())
+        checker = HealthChecker(balancer, "/status", timeout=1.0, rise=2, fall=1)
+        checker.check()
+        self.assertEqual([healthy for _, healthy, _ in balancer.stats()], [True] * 3)
+
+        # A stopped echo server is taken out of rotation at once
+        port = self.echoes[1].server_address[1]
+        self.stop(self.echoes[1])
+        checker.check()
+        self.assertEqual([healthy for _, healthy, _ in balancer.stats()], [True, False, True])
+        self.assertNotIn(balancer.upstreams[1], [balancer.choose("/") for _ in range(6)])
+
+        # And added back after two passed checks, once it is running again
+        self.echoes[1] = ProxyHTTPServer(("127.0.0.1", port), EchoRequestHandler)
+        threading.Thread(target=self.echoes[1].serve_forever, args=(0.05,), daemon=True).start()
+        checker.check()
+        self.assertFalse(balancer.upstreams[1].healthy)
+        checker.check()
+        self.assertTrue(balancer.upstreams[1].healthy)
+
+    def test_stop_without_waiting(self):
+        """
+        Stopping without waiting returns during a check, which is the checker's last one.
+        """
+        balancer = UpstreamBalancer(self.urls()[:1])
+        checker = HealthChecker(balancer, "/status", interval=0.01)
+        started, release = threading.Event(), threading.Event()
+
+        def probe(upstream):
+            started.set()
+            release.wait()
+
+        with mock.patch.object(checker, "probe", side_effect=probe) as mock_probe:
+            checker.start()
+            self.assertTrue(started.wait(5))
+            checker.stop(wait=False)
+            release.set()
+            checker._thread.join(5)
+            self.assertFalse(checker._thread.is_alive())
+            self.assertEqual(mock_probe.call_count, 1)
+
+    def test_error_status(self):
+        balancer = UpstreamBalancer(self.urls()[:1])
+        checker = HealthChecker(balancer, "/missing", fall=2)
+        self.assertEqual(checker.probe(balancer.upstreams[0]), "404 Not Found")
+        checker.check()
+        self.assertTrue(balancer.upstreams[0].healthy)
+        checker.check()
+        self.assertFalse(balancer.upstreams[0].healthy)
+
+    def test_proxy(self):
+        """
+        The proxy spreads requests over the echo servers, and reports their health.
+        """
+        environ = {
+            "UPSTREAM_SERVER": ",".join(self.urls()),
+            "UPSTREAM_HEALTH_CHECK_PATH": "/status",
+            "UPSTREAM_HEALTH_CHECK_INTERVAL": "0.05",
+            "JWT_SIGNING_SECRET": SECRET.decode("ascii"),
+        }
+        with mock.patch.dict(os.environ, environ):
+            proxy = self.start(ProxyRequestHandler)
+        try:
+            self.assertIsNotNone(proxy.proxy_state.balancer.health_checker)
+            conn = HTTPConnection("127.0.0.1", proxy.server_address[1])
+            for _ in range(6):
+                conn.request("POST", "/echo", body=b"abc")
+                response = conn.getresponse()
+                self.assertEqual(response.status, HTTPStatus.OK)
+                self.assertTrue(response.read().endswith(b"abc"))
+            self.assertEqual(
+                [server.metrics.get("requests_processed_total") for server in self.echoes],
+                [2, 2, 2],
+            )
+
+            conn.request("GET", "/metrics")
+            metrics = conn.getresponse().read().decode("utf-8")
+            self.assertIn(f'upstream_healthy{{upstream="{self.urls()[0]}"}} 1', metrics)
+            conn.request("GET", "/status")
+            status = conn.getresponse().read().decode("utf-8")
+            self.assertIn(f"Upstream {self.urls()[0]}: healthy, 0 requests outstanding", status)
+            conn.close()
+        finally:
+            self.stop(proxy)
+        self.assertIsNone(proxy.proxy_state.balancer.health_checker)
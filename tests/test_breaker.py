@@ -0,0 +1,139 @@
+"""
+Unit tests for :mod:`jwt_proxy.breaker`.
+"""
+
+import unittest
+
+from jwt_proxy.breaker import CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+
+    def breaker(self, **kwargs) -> CircuitBreaker:
+        kwargs.setdefault("open_seconds", 10.0)
+        return CircuitBreaker("http://a:1", clock=self.clock, **kwargs)
+
+    @staticmethod
+    def request(breaker: CircuitBreaker, success: bool) -> None:
+        breaker.record(breaker.acquire(), success)
+
+    def test_consecutive_failures(self):
+        breaker = self.breaker(consecutive_failures=3)
+        for success in (False, False, True, False, False):
+            self.request(breaker, success)
+        self.assertEqual(breaker.state, "closed")
+        self.request(breaker, False)
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.available())
+
+        self.clock.now += 4
+        with self.assertRaises(CircuitOpenError) as cm:
+            breaker.acquire()
+        self.assertEqual(cm.exception.retry_after, 6.0)
+        self.assertEqual(breaker.short_circuited, 1)
+
+    def test_failure_rate(self):
+        breaker = self.breaker(consecutive_failures=100, failure_rate=0.5, window=10)
+        for _ in range(4):
+            self.request(breaker, True)
+            self.request(breaker, False)
+        self.request(breaker, True)
+        self.assertEqual(breaker.state, "closed")
+        # The window is full with 5 failures out of 10
+        self.request(breaker, False)
+        self.assertEqual(breaker.state, "open")
+
+        # Only the last 10 outcomes count
+        breaker = self.breaker(consecutive_failures=100, failure_rate=0.5, window=10)
+        for success in [False] * 4 + [True] * 10:
+            self.request(breaker, success)
+        self.request(breaker, False)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_half_open(self):
+        breaker = self.breaker(consecutive_failures=1, probes=2)
+        self.request(breaker, False)
+        self.clock.now += 10
+        self.assertTrue(breaker.available())
+
+        # Two probes are let through, the third request is refused
+        probes = [breaker.acquire(), breaker.acquire()]
+        self.assertEqual(breaker.state, "half_open")
+        self.assertFalse(breaker.available())
+        with self.assertRaises(CircuitOpenError):
+            breaker.acquire()
+        breaker.record(probes[0], True)
+        self.assertEqual(breaker.state, "half_open")
+        breaker.record(probes[1], True)
+        self.assertEqual(breaker.state, "closed")
+        self.assertEqual(dict(breaker.transitions), {"open": 1, "half_open": 1, "closed": 1})
+
+    def test_failed_probe(self):
+        breaker = self.breaker(consecutive_failures=1)
+        self.request(breaker, False)
+        self.clock.now += 10
+        self.request(breaker, False)
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(CircuitOpenError):
+            breaker.acquire()
+
+    def test_abandoned_probe(self):
+        breaker = self.breaker(consecutive_failures=1)
+        self.request(breaker, False)
+        self.clock.now += 10
+        abandoned = breaker.acquire()
+        with self.assertRaises(CircuitOpenError):
+            breaker.acquire()
+        # The probe's outcome was never recorded, so another one is sent eventually, and the
+        # abandoned one no longer counts
+        self.clock.now += 10
+        probe = breaker.acquire()
+        breaker.release(abandoned)
+        self.assertFalse(breaker.available())
+        breaker.record(abandoned, True)
+        self.assertEqual(breaker.state, "half_open")
+        breaker.record(probe, True)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_released_probe(self):
+        """
+        A probe released without an outcome is let through again right away.
+        """
+        breaker = self.breaker(consecutive_failures=1)
+        self.request(breaker, False)
+        self.clock.now += 10
+        probe = breaker.acquire()
+        self.assertFalse(breaker.available())
+        breaker.release(probe)
+        self.assertTrue(breaker.available())
+        probe = breaker.acquire()
+        breaker.record(probe, True)
+        self.assertEqual(breaker.state, "closed")
+        breaker.release(probe)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_stale_outcomes(self):
+        """
+        Outcomes of requests let through before the breaker opened do not decide its probes.
+        """
+        breaker = self.breaker(consecutive_failures=1)
+        late_success, late_release = breaker.acquire(), breaker.acquire()
+        self.request(breaker, False)
+        self.clock.now += 10
+        probe = breaker.acquire()
+        breaker.record(late_success, True)
+        self.assertEqual(breaker.state, "half_open")
+        breaker.release(late_release)
+        self.assertFalse(breaker.available())
+        breaker.record(probe, False)
+        self.assertEqual(breaker.state, "open")
@@ -0,0 +1,145 @@
+"""
+Unit tests for :mod:`jwt_proxy.cache`.
+"""
+
+import email.utils
+import unittest
+
+from jwt_proxy.cache import (
+    CachedResponse,
+    ResponseCache,
+    freshness_lifetime,
+    is_storable,
+    parse_cache_control,
+)
+
+NOW = 1700000000.0
+
+
+def http_date(timestamp: float) -> str:
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+class TestCachePolicy(unittest.TestCase):
+    def test_parse_cache_control(self):
+        self.assertEqual(
+            parse_cache_control('Public, max-age=60, no-cache="Set-Cookie"'),
+            {"public": None, "max-age": "60", "no-cache": "Set-Cookie"},
+        )
+        self.assertEqual(parse_cache_control(None), {})
+
+    def test_freshness_lifetime(self):
+        # headers, expected lifetime
+        cases = [
+            ([("Cache-Control", "max-age=60")], 60.0),
+            ([("Cache-Control", "max-age=60, s-maxage=10")], 10.0),
+            ([("Cache-Control", "max-age=60, no-cache")], 0.0),
+            ([("Cache-Control", "max-age=x")], None),
+            ([("Date", http_date(NOW)), ("Expires", http_date(NOW + 30))], 30.0),
+            ([("Expires", http_date(NOW + 30))], 30.0),
+            ([("Expires", "0")], 0.0),
+            ([], None),
+        ]
+        for headers, expected in cases:
+            self.assertEqual(freshness_lifetime(headers, NOW), expected, headers)
+
+    def test_is_storable(self):
+        self.assertTrue(is_storable(200, [("Cache-Control", "max-age=60")]))
+        self.assertTrue(is_storable(200, [("ETag", '"a"')]))
+        self.assertTrue(is_storable(301, [("Cache-Control", "no-cache"), ("ETag", '"a"')]))
+        self.assertFalse(is_storable(200, []))
+        self.assertFalse(is_storable(302, [("Cache-Control", "max-age=60")]))
+        self.assertFalse(is_storable(200, [("Cache-Control", "private, max-age=60")]))
+        self.assertFalse(is_storable(200, [("Cache-Control", "no-store")]))
+        self.assertFalse(is_storable(200, [("Cache-Control", "max-age=60"), ("Vary", "Cookie")]))
+
+
+class TestCachedResponse(unittest.TestCase):
+    def test_freshness(self):
+        entry = CachedResponse.create(
+            200, [("Cache-Control", "max-age=60"), ("Age", "20")], b"body", NOW
+        )
+        self.assertEqual(entry.headers, [("Cache-Control", "max-age=60")])
+        self.assertTrue(entry.is_fresh(NOW + 39))
+        self.assertFalse(entry.is_fresh(NOW + 40))
+        self.assertEqual(entry.age(NOW + 10), 30)
+
+    def test_revalidate(self):
+        last_modified = http_date(NOW - 100)
+        entry = CachedResponse.create(
+            200,
+            [("ETag", '"v1"'), ("Last-Modified", last_modified), ("Content-Length", "4")],
+            b"body",
+            NOW,
+        )
+        self.assertFalse(entry.is_fresh(NOW))
+        self.assertEqual(
+            entry.validators(), [("If-None-Match", '"v1"'), ("If-Modified-Since", last_modified)]
+        )
+
+        refreshed = entry.revalidate(
+            [("ETag", '"v1"'), ("Cache-Control", "max-age=10"), ("Content-Length", "0")], NOW + 5
+        )
+        self.assertEqual(refreshed.body, b"body")
+        self.assertIn(("Content-Length", "4"), refreshed.headers)
+        self.assertIn(("Cache-Control", "max-age=10"), refreshed.headers)
+        self.assertTrue(refreshed.is_fresh(NOW + 14))
+
+    def test_is_not_modified(self):
+        entry = CachedResponse.create(
+            200, [("ETag", 'W/"v1"'), ("Last-Modified", http_date(NOW - 100))], b"", NOW
+        )
+        self.assertTrue(entry.is_not_modified({"If-None-Match": '"v0", "v1"'}))
+        self.assertTrue(entry.is_not_modified({"If-None-Match": "*"}))
+        self.assertFalse(entry.is_not_modified({"If-None-Match": '"v2"'}))
+        # If-None-Match takes precedence over If-Modified-Since
+        self.assertFalse(
+            entry.is_not_modified({"If-None-Match": '"v2"', "If-Modified-Since": http_date(NOW)})
+        )
+        self.assertTrue(entry.is_not_modified({"If-Modified-Since": http_date(NOW)}))
+        self.assertFalse(entry.is_not_modified({"If-Modified-Since": http_date(NOW - 200)}))
+        self.assertFalse(entry.is_not_modified({}))
+
+
+class TestResponseCache(unittest.TestCase):
+    @staticmethod
+    def entry(size: int) -> CachedResponse:
+        return CachedResponse.create(200, [], b"x" * size, NOW)
+
+    def test_lru_eviction(self):
+        entry = self.entry(300)
+        cache = ResponseCache(2 * entry.size + 100, max_entry_bytes=1000)
+        cache.put("a", entry)
+        cache.put("b", entry)
+        cache.get("a")
+        cache.put("c", entry)
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertEqual(cache.stats()["bytes"], 2 * entry.size)
+
+        # Replacing an entry frees its space, and oversized bodies are not stored
+        cache.put("a", entry)
+        self.assertEqual(cache.stats()["entries"], 2)
+        cache.put("big", self.entry(1001))
+        self.assertIsNone(cache.get("big"))
+        cache.remove("a")
+        self.assertEqual(cache.stats()["bytes"], entry.size)
+
+    def test_claim(self):
+        cache = ResponseCache(1000)
+        self.assertIsNone(cache.claim("a"))
+        event = cache.claim("a")
+        self.assertFalse(event.is_set())
+        self.assertIsNone(cache.claim("b"))
+        cache.release("a")
+        self.assertTrue(event.is_set())
+        self.assertIsNone(cache.claim("a"))
+
+    def test_count(self):
+        cache = ResponseCache(1000)
+        cache.count("hit")
+        cache.count("miss")
+        cache.count("hit")
+        stats = cache.stats()
+        self.assertEqual((stats["hit"], stats["miss"], stats["coalesced"]), (2, 1, 0))
@@ -0,0 +1,67 @@
+"""
+Unit tests for :mod:`jwt_proxy.compression`.
+"""
+
+import unittest
+import zlib
+
+from jwt_proxy.compression import (
+    DEFAULT_COMPRESSIBLE_TYPES,
+    Compressor,
+    choose_encoding,
+    is_compressible_type,
+    parse_compressible_types,
+)
+
+
+class TestNegotiation(unittest.TestCase):
+    def test_choose_encoding(self):
+        # Accept-Encoding, expected coding
+        cases = [
+            ("gzip", "gzip"),
+            ("deflate, gzip", "gzip"),
+            ("GZIP;q=0.5, deflate", "deflate"),
+            ("gzip;q=0, *", "deflate"),
+            ("*;q=0.1", "gzip"),
+            ("br, identity", None),
+            ("gzip;q=x", None),
+            ("", None),
+            (None, None),
+        ]
+        for accept_encoding, expected in cases:
+            self.assertEqual(choose_encoding(accept_encoding), expected, accept_encoding)
+
+    def test_is_compressible_type(self):
+        types = ("text/*", "application/json")
+        self.assertTrue(is_compressible_type("text/html; charset=utf-8", types))
+        self.assertTrue(is_compressible_type("Application/JSON", types))
+        self.assertFalse(is_compressible_type("application/octet-stream", types))
+        self.assertFalse(is_compressible_type(None, types))
+        self.assertFalse(is_compressible_type("text/event-stream", DEFAULT_COMPRESSIBLE_TYPES))
+
+    def test_parse_compressible_types(self):
+        self.assertEqual(parse_compressible_types(None), DEFAULT_COMPRESSIBLE_TYPES)
+        self.assertEqual(
+            parse_compressible_types(" Text/* , application/json,"), ("text/*", "application/json")
+        )
+        self.assertEqual(parse_compressible_types(""), ())
+
+
+class TestCompressor(unittest.TestCase):
+    def test_streaming(self):
+        for encoding, wbits in (("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)):
+            compressor = Compressor(encoding, level=1)
+            pieces = [b"0123456789" * 1000] * 10
+            output = b"".join(compressor.compress(piece) for piece in pieces) + compressor.finish()
+            self.assertEqual(zlib.decompress(output, wbits), b"".join(pieces))
+            self.assertEqual(compressor.bytes_in, 100000)
+            self.assertEqual(compressor.bytes_out, len(output))
+            self.assertGreaterEqual(compressor.cpu_seconds, 0.0)
+
+    def test_complete_body(self):
+        compressor = Compressor("gzip")
+        self.assertEqual(zlib.decompress(compressor.finish(b"abc" * 100), 31), b"abc" * 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
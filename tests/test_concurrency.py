@@ -0,0 +1,104 @@
+"""
+Unit tests for :mod:`jwt_proxy.concurrency`.
+"""
+
+import asyncio
+import threading
+import unittest
+
+from jwt_proxy.concurrency import AdaptiveLimiter
+
+
+class ContendedUpstream:
+    """
+    A model of an upstream which serves ``capacity`` requests in parallel, and queues the others,
+    so that its latency rises with concurrency beyond that.
+    """
+
+    def __init__(self, capacity: int, service_time: float = 0.01):
+        self.capacity = capacity
+        self.service_time = service_time
+
+    def rtt(self, concurrency: int) -> float:
+        return self.service_time * max(1.0, concurrency / self.capacity)
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    def run_load(self, limiter: AdaptiveLimiter, upstream: ContendedUpstream, rounds: int):
+        """
+        Keep the limiter full, as with more clients than the limit, completing a round of
+        requests at a time with the latency of the upstream at that concurrency.
+        """
+        for _ in range(rounds):
+            admitted = 0
+            while limiter.acquire(0):
+                admitted += 1
+            rtt = upstream.rtt(admitted)
+            for _ in range(admitted):
+                limiter.release(rtt)
+
+    def test_converges(self):
+        upstream = ContendedUpstream(capacity=20)
+        limiter = AdaptiveLimiter(initial_limit=5, max_limit=1000, probe_interval=10**6)
+        self.run_load(limiter, upstream, 50)
+        # The limit grows past the capacity, up to the tolerated queueing of twice the latency
+        # plus the square root allowance
+        self.assertGreaterEqual(limiter.limit, 40)
+        self.assertLessEqual(limiter.limit, 50)
+
+        # and shrinks when the upstream slows down
+        upstream.capacity = 5
+        self.run_load(limiter, upstream, 50)
+        self.assertLessEqual(limiter.limit, 16)
+        self.assertGreater(limiter.rejected, 0)
+
+    def test_probe(self):
+        """
+        The no-load latency is measured again periodically, without drifting up under load.
+        """
+        upstream = ContendedUpstream(capacity=20)
+        limiter = AdaptiveLimiter(initial_limit=5, max_limit=1000, probe_interval=500)
+        limits, noloads = [], set()
+        for _ in range(20):
+            self.run_load(limiter, upstream, 10)
+            limits.append(limiter.limit)
+            noloads.add(limiter._rtt_noload)
+        # The limit drops while probing, and recovers
+        self.assertLess(min(limits), 20)
+        self.assertGreaterEqual(max(limits[-5:]), 40)
+        self.assertLessEqual(max(limits), 50)
+        self.assertEqual(noloads - {None}, {upstream.service_time})
+
+    def test_backoff(self):
+        limiter = AdaptiveLimiter(initial_limit=10, min_limit=2)
+        for _ in range(20):
+            self.assertTrue(limiter.acquire(0))
+            limiter.release(dropped=True)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_idle_limit_does_not_grow(self):
+        limiter = AdaptiveLimiter(initial_limit=10, min_window=1)
+        for _ in range(100):
+            limiter.acquire(0)
+            limiter.release(0.01)
+        self.assertEqual(limiter.limit, 10)
+
+    def test_queueing(self):
+        limiter = AdaptiveLimiter(initial_limit=1)
+        self.assertTrue(limiter.acquire(0))
+        self.assertFalse(limiter.acquire(0.01))
+        threading.Timer(0.05, limiter.release).start()
+        self.assertTrue(limiter.acquire(5))
+        self.assertEqual((limiter.in_flight, limiter.rejected), (1, 1))
+
+    def test_queueing_async(self):
+        async def run():
+            limiter = AdaptiveLimiter(initial_limit=1)
+            self.assertTrue(await limiter.acquire_async(0))
+            self.assertFalse(await limiter.acquire_async(0.01))
+            asyncio.get_running_loop().call_later(0.05, limiter.release)
+            self.assertTrue(await limiter.acquire_async(5))
+            return limiter
+
+        limiter = asyncio.run(run())
+        self.assertEqual((limiter.in_flight, limiter.rejected), (1, 1))
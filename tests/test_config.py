@@ -0,0 +1,268 @@
+"""
+Unit tests for :mod:`jwt_proxy.config`.
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from http.client import HTTPConnection
+from unittest import mock
+
+from jwt_proxy.config import ProxyConfig, ProxyState, read_config_file, read_settings
+from jwt_proxy.http_base import ProxyHTTPServer
+from jwt_proxy.keys import SigningKey
+from jwt_proxy.proxy_server import ProxyRequestHandler
+from tests.test_workers import REPO_DIR
+
+
+class TestProxyConfig(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "proxy.conf")
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def write_config(self, text: str) -> None:
+        with open(self.path, "w") as f:
+            f.write(text)
+
+    def test_build_upstream_url(self):
+        # upstream url, path, expected result
+        cases = [
+            ("echo:9100", "/", "http://echo:9100/"),
+            ("echo:9100", "/?a=b", "http://echo:9100/?a=b"),
+            ("echo:9100", "/foo/bar?a=b", "http://echo:9100/foo/bar?a=b"),
+            ("example.com", "/foo", "http://example.com/foo"),
+            ("https://example.com", "/foo", "https://example.com/foo"),
+        ]
+        for server, path, expected in cases:
+            config = ProxyConfig.from_settings(
+                {"UPSTREAM_SERVER": server, "JWT_SIGNING_SECRET": "secret"}
+            )
+            balancer = config.create_balancer()
+            self.assertEqual(balancer.choose(path).build_url(path), expected)
+
+    def test_upstreams(self):
+        config = ProxyConfig.from_settings(
+            {
+                "UPSTREAM_SERVER": "echo:9100, https://echo2:9101,",
+                "UPSTREAM_POLICY": "consistent_hash",
+                "UPSTREAM_HEALTH_CHECK_PATH": "/status",
+                "JWT_SIGNING_SECRET": "secret",
+            }
+        )
+        self.assertEqual(config.upstreams, ("http://echo:9100", "https://echo2:9101"))
+        self.assertEqual(config.balance_policy, "consistent_hash")
+        self.assertEqual(config.health_check_path, "/status")
+        self.assertTrue(config.same_balancing(config._replace(server_timing=True)))
+        self.assertFalse(config.same_balancing(config._replace(upstreams=("http://echo:9100",))))
+
+        for settings in (
+            {"UPSTREAM_SERVER": ",", "JWT_SIGNING_SECRET": "secret"},
+            {"UPSTREAM_SERVER": "echo,ftp://echo2", "JWT_SIGNING_SECRET": "secret"},
+            {"UPSTREAM_SERVER": "echo", "UPSTREAM_POLICY": "random", "JWT_SIGNING_SECRET": "s"},
+            {
+                "UPSTREAM_SERVER": "echo",
+                "UPSTREAM_HEALTH_CHECK_PATH": "status",
+                "JWT_SIGNING_SECRET": "s",
+            },
+        ):
+            with self.assertRaises(ValueError):
+                ProxyConfig.from_settings(settings)
+
+    def test_from_settings(self):
+        config = ProxyConfig.from_settings(
+            {
+                "UPSTREAM_SERVER": "echo:9100",
+                "JWT_SIGNING_SECRET": "secret",
+                "JWT_SIGNING_ALGORITHM": "HS256",
+                "PROXY_SERVER_TIMING": "true",
+                "PROXY_COMPRESSION": "on",
+                "PROXY_COMPRESSION_TYPES": "text/*, application/json",
+                "UPSTREAM_RETRIES": "0",
+                "UPSTREAM_HEDGING": "1",
+                "UPSTREAM_HEDGE_PERCENTILE": "99",
+                "UPSTREAM_ADAPTIVE_CONCURRENCY": "yes",
+                "UPSTREAM_CONCURRENCY_INITIAL_LIMIT": "8",
+                "PROXY_RATE_LIMIT": "2.5",
+                "PROXY_RATE_LIMIT_HEADER": "X-Api-Key",
+            }
+        )
+        self.assertEqual(config.signing_key, SigningKey(None, b"secret", "HS256"))
+        self.assertTrue(config.server_timing)
+        self.assertTrue(config.compression)
+        self.assertEqual(config.compression_types, ("text/*", "application/json"))
+        self.assertEqual((config.retries, config.hedging, config.hedge_percentile), (0, True, 99.0))
+        self.assertTrue(config.adaptive_concurrency)
+        self.assertEqual(config.create_concurrency_limiter().limit, 8)
+        self.assertEqual((config.rate_limit, config.rate_limit_burst), (2.5, 3))
+        self.assertEqual(config.rate_limit_header, "X-Api-Key")
+
+        config = ProxyConfig.from_settings(
+            {"UPSTREAM_SERVER": "echo", "JWT_KEYS_FILE": "keys.json"}
+        )
+        self.assertEqual((config.signing_key, config.keys_file), (None, "keys.json"))
+
+        for settings in (
+            {"JWT_SIGNING_SECRET": "secret"},
+            {"UPSTREAM_SERVER": "ftp://echo", "JWT_SIGNING_SECRET": "secret"},
+            {"UPSTREAM_SERVER": "echo"},
+            {
+                "UPSTREAM_SERVER": "echo",
+                "JWT_SIGNING_SECRET": "s",
+                "JWT_SIGNING_ALGORITHM": "RS256",
+            },
+            {"UPSTREAM_SERVER": "echo", "JWT_SIGNING_SECRET": "s", "PROXY_COMPRESSION_LEVEL": "10"},
+            {"UPSTREAM_SERVER": "echo", "JWT_SIGNING_SECRET": "s", "UPSTREAM_RETRIES": "-1"},
+            {
+                "UPSTREAM_SERVER": "echo",
+                "JWT_SIGNING_SECRET": "s",
+                "UPSTREAM_BREAKER_FAILURE_RATE": "0",
+            },
+            {
+                "UPSTREAM_SERVER": "echo",
+                "JWT_SIGNING_SECRET": "s",
+                "UPSTREAM_CONCURRENCY_INITIAL_LIMIT": "0",
+            },
+            {"UPSTREAM_SERVER": "echo", "JWT_SIGNING_SECRET": "s", "PROXY_RATE_LIMIT": "-1"},
+            {
+                "UPSTREAM_SERVER": "echo",
+                "JWT_SIGNING_SECRET": "s",
+                "UPSTREAM_HEDGE_PERCENTILE": "100",
+            },
+        ):
+            with self.assertRaises(ValueError):
+                ProxyConfig.from_settings(settings)
+
+    def test_config_file(self):
+        self.write_config("# Comment\n\nUPSTREAM_SERVER = file:1234\nJWT_KEY_ID=k=1\n")
+        self.assertEqual(
+            read_config_file(self.path), {"UPSTREAM_SERVER": "file:1234", "JWT_KEY_ID": "k=1"}
+        )
+        settings = read_settings(
+            {"PROXY_CONFIG_FILE": self.path, "UPSTREAM_SERVER": "env:1", "JWT_SIGNING_SECRET": "s"}
+        )
+        self.assertEqual(settings["UPSTREAM_SERVER"], "file:1234")
+        self.assertEqual(settings["JWT_SIGNING_SECRET"], "s")
+
+        self.write_config("UPSTREAM_SERVER\n")
+        with self.assertRaisesRegex(ValueError, "proxy.conf:1"):
+            read_config_file(self.path)
+
+    def test_reconfigure(self):
+        """
+        The balancer and limiters of a state are kept for configurations which do not change them.
+        """
+        config = ProxyConfig.from_settings(
+            {
+                "UPSTREAM_SERVER": "old:1",
+                "JWT_SIGNING_SECRET": "s",
+                "UPSTREAM_ADAPTIVE_CONCURRENCY": "1",
+                "PROXY_RATE_LIMIT": "5",
+            }
+        )
+        state = ProxyState.create(config)
+        same = state.reconfigure(config._replace(retries=0))
+        self.assertEqual(same.config.retries, 0)
+        self.assertIs(same.balancer, state.balancer)
+        self.assertIs(same.concurrency_limiter, state.concurrency_limiter)
+        self.assertIs(same.rate_limiter, state.rate_limiter)
+
+        other = state.reconfigure(config._replace(upstreams=("http://new:2",), rate_limit=1.0))
+        self.assertEqual(other.balancer.choose("/").url, "http://new:2")
+        self.assertIs(other.concurrency_limiter, state.concurrency_limiter)
+        self.assertEqual(other.rate_limiter.rate, 1.0)
+
+    def test_reload(self):
+        """
+        Reloading replaces the configuration and signing key, unless the new configuration is
+        invalid.
+        """
+        self.write_config("UPSTREAM_SERVER=old:1\nJWT_SIGNING_SECRET=old\n")
+        environ = {"PROXY_CONFIG_FILE": self.path}
+        with mock.patch.dict("os.environ", environ, clear=True):
+            server = ProxyHTTPServer(("127.0.0.1", 0), ProxyRequestHandler)
+            try:
+                old_state = server.proxy_state
+                old = old_state.config
+                self.write_config("UPSTREAM_SERVER=new:2\nJWT_SIGNING_SECRET=new\n")
+                server.reload_config()
+                # The configuration, balancer and limiters are replaced together
+                self.assertIsNot(server.proxy_state.balancer, old_state.balancer)
+                self.assertIsNone(old_state.balancer.health_checker)
+                self.assertEqual(server.proxy_state.config.upstreams, ("http://new:2",))
+                self.assertEqual(server.proxy_state.balancer.choose("/").url, "http://new:2")
+                self.assertEqual(server.token_source.key.secret, b"new")
+                # A request which started before the reload keeps the configuration it read
+                self.assertEqual(old.upstreams, ("http://old:1",))
+
+                # The balancer, and the health of its upstreams, is kept if they do not change
+                balancer = server.proxy_state.balancer
+                self.write_config("UPSTREAM_SERVER=new:2\nJWT_SIGNING_SECRET=new2\n")
+                server.reload_config()
+                self.assertIs(server.proxy_state.balancer, balancer)
+
+                self.write_config("JWT_SIGNING_SECRET=other\n")
+                server.reload_config()
+                self.assertEqual(server.proxy_state.config.upstreams, ("http://new:2",))
+                self.assertEqual(server.token_source.key.secret, b"new2")
+            finally:
+                server.server_close()
+
+
+@unittest.skipUnless(hasattr(signal, "SIGHUP"), "requires SIGHUP")
+class TestReloadSignal(unittest.TestCase):
+    """
+    Runs the proxy in a subprocess, and reloads its configuration file with ``SIGHUP``.
+    """
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "proxy.conf")
+        self.write_config("HS512")
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, "proxy_server.py"],
+            env={**os.environ, "PROXY_HTTP_PORT": str(self.port), "PROXY_CONFIG_FILE": self.path},
+            cwd=REPO_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def tearDown(self) -> None:
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(10), 0)
+        self.dir.cleanup()
+
+    def write_config(self, algorithm: str) -> None:
+        with open(self.path, "w") as f:
+            f.write(
+                f"UPSTREAM_SERVER=127.0.0.1:1\nJWT_SIGNING_SECRET=s\nJWT_SIGNING_ALGORITHM={algorithm}\n"
+            )
+
+    def wait_for_status(self, text: str) -> None:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+                conn.request("GET", "/status")
+                if text in conn.getresponse().read().decode("utf-8"):
+                    return
+            except OSError:
+                pass
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.05)
+
+    def test_sighup(self):
+        self.wait_for_status("Signing tokens with HS512")
+        self.write_config("HS256")
+        self.process.send_signal(signal.SIGHUP)
+        self.wait_for_status("Signing tokens with HS256")
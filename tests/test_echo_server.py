@@ -0,0 +1,116 @@
+"""
+Unit tests for :mod:`jwt_proxy.echo_server`.
+"""
+
+import os
+import threading
+import unittest
+from http import HTTPStatus
+from http.client import HTTPConnection, RemoteDisconnected
+from unittest import mock
+
+from jwt_proxy.echo_server import EchoRequestHandler
+from jwt_proxy.http_base import ProxyHTTPServer
+from jwt_proxy.jwt import JWTSigner
+from tests.test_jwt import SECRET
+
+
+class TestVerifyingEcho(unittest.TestCase):
+    """
+    Tests for the echo server's verification of the proxy's tokens.
+    """
+
+    def setUp(self) -> None:
+        settings = {"ECHO_VERIFY_JWT": "1", "JWT_SIGNING_SECRET": SECRET.decode("ascii")}
+        with mock.patch.dict(os.environ, settings):
+            self.server = ProxyHTTPServer(("127.0.0.1", 0), EchoRequestHandler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, headers) -> HTTPStatus:
+        conn = HTTPConnection("127.0.0.1", self.port)
+        conn.request("POST", "/", body=b"abc", headers=headers)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status
+
+    def test_verify(self):
+        token = JWTSigner({"user": "a"}, SECRET).encode()
+        self.assertEqual(self.post({"X-My-JWT": token}), HTTPStatus.OK)
+        self.assertEqual(self.post({"X-My-JWT": token}), HTTPStatus.OK)
+        self.assertEqual(self.post({"X-My-JWT": token[:-2]}), HTTPStatus.UNAUTHORIZED)
+        self.assertEqual(self.post({}), HTTPStatus.UNAUTHORIZED)
+
+        conn = HTTPConnection("127.0.0.1", self.port)
+        conn.request("GET", "/metrics")
+        metrics = conn.getresponse().read()
+        conn.close()
+        self.assertIn(b'jwt_verify_cache_lookups_total{result="hits"} 1\n', metrics)
+        self.assertIn(b"jwt_invalid_tokens_total 2\n", metrics)
+
+
+class TestSimulatedResponses(unittest.TestCase):
+    """
+    Tests for the echo server's responses shaped by query parameters and headers.
+    """
+
+    def setUp(self) -> None:
+        with mock.patch.dict(os.environ, {"ECHO_LATENCY": "uniform:0:0.01"}):
+            self.server = ProxyHTTPServer(("127.0.0.1", 0), EchoRequestHandler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.conn = HTTPConnection("127.0.0.1", self.port)
+
+    def tearDown(self) -> None:
+        self.conn.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, path, headers=None):
+        self.conn.request("POST", path, body=b"abc", headers=headers or {})
+        response = self.conn.getresponse()
+        return response, response.read()
+
+    def test_echo(self):
+        response, body = self.post("/?chunk_size=10")
+        self.assertEqual(response.status, HTTPStatus.OK)
+        self.assertTrue(body.startswith(b"Path: /?chunk_size=10\n"))
+        self.assertTrue(body.endswith(b"Body (3 bytes):\nabc"))
+        self.assertEqual(int(response.getheader("Content-Length")), len(body))
+
+    def test_framing(self):
+        response, body = self.post("/?size=100000&framing=chunked&chunk_size=30000")
+        self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+        self.assertEqual(len(body), 100000)
+        self.assertFalse(response.will_close)
+
+        response, body = self.post("/?size=1000&status=404", {"X-Echo-Framing": "close"})
+        self.assertEqual(response.status, HTTPStatus.NOT_FOUND)
+        self.assertIsNone(response.getheader("Content-Length"))
+        self.assertEqual(len(body), 1000)
+        self.assertTrue(response.will_close)
+
+    def test_failures(self):
+        response, body = self.post("/?fail_rate=1&fail_status=502")
+        self.assertEqual(response.status, HTTPStatus.BAD_GATEWAY)
+        self.assertEqual(body, b"502 simulated failure\n")
+        self.assertFalse(response.will_close)
+
+        with self.assertRaises(RemoteDisconnected):
+            self.post("/", {"X-Echo-Fail-Rate": "1", "X-Echo-Fail-Status": "drop"})
+        self.conn.close()
+
+        self.conn.request("GET", "/metrics")
+        metrics = self.conn.getresponse().read()
+        self.assertIn(b'echo_simulated_failures_total{status="502"} 1\n', metrics)
+        self.assertIn(b'echo_simulated_failures_total{status="drop"} 1\n', metrics)
+
+    def test_invalid(self):
+        response, body = self.post("/?latency=gamma:1")
+        self.assertEqual(response.status, HTTPStatus.BAD_REQUEST)
+        self.assertIn(b"Invalid latency 'gamma:1'", body)
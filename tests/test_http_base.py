@@ -2,10 +2,23 @@
 Unit tests for :mod:`jwt_proxy.http_base`.
 """
 
+import os
+import socket
+import sys
+import threading
+import time
 import unittest
 from datetime import timedelta
+from http import HTTPStatus
+from http.client import HTTPConnection
 
-from jwt_proxy.http_base import ProxyBaseHTTPRequestHandler
+from jwt_proxy.echo_server import EchoRequestHandler
+from jwt_proxy.http_base import (
+    ProxyBaseHTTPRequestHandler,
+    ProxyHTTPServer,
+    spawn_replacement,
+)
+from tests.common import send_raw_request
 
 
 class TestRequestHandler(unittest.TestCase):
@@ -29,3 +42,217 @@ class TestRequestHandler(unittest.TestCase):
         }
         for duration, expected in sorted(cases.items()):
             self.assertEqual(expected, ProxyBaseHTTPRequestHandler.format_time_duration(duration))
+
+
+class TestKeepAlive(unittest.TestCase):
+    """
+    Tests for persistent client connections, against a live echo server.
+    """
+
+    def setUp(self) -> None:
+        os.environ["HTTP_KEEPALIVE_MAX_REQUESTS"] = "3"
+        os.environ["HTTP_KEEPALIVE_TIMEOUT"] = "5"
+        self.server = ProxyHTTPServer(("127.0.0.1", 0), EchoRequestHandler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        del os.environ["HTTP_KEEPALIVE_MAX_REQUESTS"]
+        del os.environ["HTTP_KEEPALIVE_TIMEOUT"]
+
+    def test_reuse_until_limit(self):
+        """
+        Several requests are served on one connection, and the last allowed one closes it.
+        """
+        conn = HTTPConnection("127.0.0.1", self.port)
+        for i in range(3):
+            conn.request("POST", "/", body=b"hello")
+            response = conn.getresponse()
+            self.assertEqual(response.status, HTTPStatus.OK)
+            response.read()
+            if i < 2:
+                self.assertFalse(response.will_close)
+            else:
+                self.assertTrue(response.will_close)
+                self.assertEqual(response.getheader("Connection"), "close")
+        conn.close()
+
+    def test_status_keep_alive(self):
+        conn = HTTPConnection("127.0.0.1", self.port)
+        for _ in range(2):
+            conn.request("GET", "/status")
+            response = conn.getresponse()
+            self.assertIn(b"requests processed", response.read())
+            self.assertFalse(response.will_close)
+        conn.close()
+
+    def test_pipelining(self):
+        """
+        Pipelined requests are answered in order on the same connection.
+        """
+        request = b"POST /%d HTTP/1.1\r\nHost: test\r\nContent-Length: 3\r\n\r\nabc"
+        close = b"GET /status HTTP/1.1\r\nConnection: close\r\n\r\n"
+        data = send_raw_request(self.port, request % 1 + request % 2 + close)
+        self.assertLess(data.index(b"Path: /1"), data.index(b"Path: /2"))
+
+    def test_http10_closes(self):
+        data = send_raw_request(self.port, b"GET /status HTTP/1.0\r\n\r\n")
+        self.assertTrue(data.startswith(b"HTTP/1.1 200"))
+
+
+class TestThreadPool(unittest.TestCase):
+    """
+    Tests for the fixed-size thread pool and accept queue, against a live echo server.
+    """
+
+    def setUp(self) -> None:
+        os.environ["SERVER_THREAD_POOL_SIZE"] = "1"
+        os.environ["SERVER_ACCEPT_QUEUE_SIZE"] = "1"
+        os.environ["SERVER_RETRY_AFTER"] = "7"
+        self.server = ProxyHTTPServer(("127.0.0.1", 0), EchoRequestHandler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        for name in ("SERVER_THREAD_POOL_SIZE", "SERVER_ACCEPT_QUEUE_SIZE", "SERVER_RETRY_AFTER"):
+            del os.environ[name]
+
+    def wait_for_queue_depth(self, depth: int) -> None:
+        deadline = time.monotonic() + 5
+        while self.server._accept_queue.qsize() != depth:
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.01)
+
+    def test_reject_when_queue_full(self):
+        """
+        With the only thread busy and the queue full, new connections get a 503 with Retry-After,
+        and queued connections are served once the thread is free.
+        """
+        busy = HTTPConnection("127.0.0.1", self.port)
+        busy.request("POST", "/", body=b"first")
+        self.assertEqual(busy.getresponse().read()[-5:], b"first")
+
+        queued = socket.create_connection(("127.0.0.1", self.port))
+        queued.sendall(b"GET /status HTTP/1.1\r\nConnection: close\r\n\r\n")
+        self.wait_for_queue_depth(1)
+
+        data = send_raw_request(self.port, b"GET /status HTTP/1.1\r\n\r\n")
+        self.assertTrue(data.startswith(b"HTTP/1.1 503"))
+        self.assertIn(b"Retry-After: 7\r\n", data)
+
+        # The next request on the busy connection closes it, to free the thread
+        busy.request("POST", "/", body=b"second")
+        response = busy.getresponse()
+        response.read()
+        self.assertTrue(response.will_close)
+        busy.close()
+
+        status = b""
+        while chunk := queued.recv(65536):
+            status += chunk
+        queued.close()
+        self.assertIn(b"0 connections queued for 1 threads, 1 rejected", status)
+        self.assertIn(b"Queue wait", status)
+        self.assertEqual(self.server.metrics.get("accept_queue_rejected_total"), 1)
+        self.assertEqual(self.server.metrics.get_histogram("accept_queue_wait_seconds")[0], 2)
+
+
+class SlowEchoRequestHandler(EchoRequestHandler):
+    """
+    An echo handler which waits for ``X-Delay`` seconds before answering.
+    """
+
+    def do_POST(self):
+        time.sleep(float(self.headers.get("X-Delay", 0)))
+        super().do_POST()
+
+
+class TestDrain(unittest.TestCase):
+    """
+    Tests for draining the open connections before the server exits.
+    """
+
+    def setUp(self) -> None:
+        self.server = ProxyHTTPServer(("127.0.0.1", 0), SlowEchoRequestHandler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.server.server_close()
+
+    def start_slow_request(self, delay: float) -> threading.Thread:
+        def request():
+            conn = HTTPConnection("127.0.0.1", self.port)
+            conn.request("POST", "/", body=b"slow", headers={"X-Delay": str(delay)})
+            self.statuses.append(conn.getresponse().status)
+            conn.close()
+
+        self.statuses = []
+        thread = threading.Thread(target=request)
+        thread.start()
+        deadline = time.monotonic() + 5
+        # Until the request is read, the new connection counts as idle
+        while len(self.server._connections - self.server._idle_connections) < 1:
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.01)
+        return thread
+
+    def test_drain(self):
+        """
+        Requests in progress are answered, idle connections are closed, and new ones refused.
+        """
+        idle = HTTPConnection("127.0.0.1", self.port)
+        idle.request("POST", "/", body=b"hello")
+        idle.getresponse().read()
+        thread = self.start_slow_request(0.3)
+
+        self.server.shutdown()
+        self.server.socket.close()
+        self.assertTrue(self.server.drain(5))
+        thread.join()
+        self.assertEqual(self.statuses, [HTTPStatus.OK])
+        self.assertEqual(idle.sock.recv(1), b"")
+        idle.close()
+        with self.assertRaises(ConnectionRefusedError):
+            socket.create_connection(("127.0.0.1", self.port))
+
+    def test_drain_timeout(self):
+        thread = self.start_slow_request(0.5)
+        self.server.shutdown()
+        self.assertFalse(self.server.drain(0.05))
+        self.assertEqual(self.server.open_connections(), 1)
+        thread.join()
+
+
+class TestSpawnReplacement(unittest.TestCase):
+    """
+    Tests for handing the listening socket over to a new process.
+    """
+
+    def test_handover(self):
+        listener = socket.create_server(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        script = (
+            "from jwt_proxy.http_base import inherited_listen_socket, notify_ready\n"
+            "listener = inherited_listen_socket()\n"
+            "notify_ready()\n"
+            "conn, _ = listener.accept()\n"
+            "conn.sendall(b'new')\n"
+        )
+        self.assertTrue(spawn_replacement(listener, 10, [sys.executable, "-c", script]))
+        # A connection made before the old process closes its socket is not refused
+        client = socket.create_connection(("127.0.0.1", port))
+        listener.close()
+        self.assertEqual(client.recv(3), b"new")
+        client.close()
+
+    def test_failed_start(self):
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+            argv = [sys.executable, "-c", "raise SystemExit(1)"]
+            self.assertFalse(spawn_replacement(listener, 10, argv))
@@ -0,0 +1,70 @@
+"""
+Unit tests for :mod:`jwt_proxy.keys`.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+from jwt_proxy.keys import KeyFileWatcher, KeySet, SigningKey, load_key_set
+
+
+def write_key_file(path: str, current: str, keys: dict) -> None:
+    with open(path, "w") as f:
+        json.dump({"current": current, "keys": keys}, f)
+
+
+class TestKeys(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "keys.json")
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def test_load_key_set(self):
+        write_key_file(
+            self.path,
+            "new",
+            {"old": {"secret": "s1"}, "new": {"secret": "s2", "algorithm": "HS256"}},
+        )
+        key_set = load_key_set(self.path)
+        self.assertEqual(key_set.current, "new")
+        self.assertEqual(key_set.signing_key, SigningKey("new", b"s2", "HS256"))
+        self.assertEqual(key_set.keys["old"], SigningKey("old", b"s1", "HS512"))
+
+    def test_invalid_key_files(self):
+        for content in (
+            "not json",
+            json.dumps({"keys": {"a": {"secret": "s"}}}),
+            json.dumps({"current": "b", "keys": {"a": {"secret": "s"}}}),
+            json.dumps({"current": "a", "keys": {"a": {}}}),
+            json.dumps({"current": "a", "keys": {"a": {"secret": "s", "algorithm": "none"}}}),
+        ):
+            with open(self.path, "w") as f:
+                f.write(content)
+            with self.assertRaises(ValueError, msg=content):
+                load_key_set(self.path)
+
+    def test_watcher(self):
+        """
+        Changes to the key file are passed on, and invalid changes are ignored.
+        """
+        write_key_file(self.path, "a", {"a": {"secret": "s1"}})
+        received = []
+        watcher = KeyFileWatcher(self.path, received.append)
+        self.assertFalse(watcher.check())
+
+        write_key_file(self.path, "b", {"a": {"secret": "s1"}, "b": {"secret": "s2"}})
+        os.utime(self.path, ns=(0, 1))
+        self.assertTrue(watcher.check())
+        self.assertEqual(len(received), 1)
+        self.assertIsInstance(received[0], KeySet)
+        self.assertEqual(received[0].current, "b")
+
+        with open(self.path, "w") as f:
+            f.write("{")
+        os.utime(self.path, ns=(0, 2))
+        self.assertFalse(watcher.check())
+        self.assertEqual(len(received), 1)
@@ -0,0 +1,65 @@
+"""
+Unit tests for :mod:`jwt_proxy.logger`.
+"""
+
+import io
+import logging
+import os
+import queue
+import unittest
+
+from jwt_proxy.logger import (
+    LogSettings,
+    _DeferredQueueHandler,
+    get_logger,
+    init_logging,
+    log_access,
+    stop_logging,
+)
+
+
+class TestLogSettings(unittest.TestCase):
+    def test_detail_sampling(self):
+        logger = get_logger("test")
+        self.assertIs(LogSettings(detail_sample_rate=1).detail_logger(logger), logger)
+        suppressed = LogSettings(detail_sample_rate=0).detail_logger(logger)
+        self.assertIsNot(suppressed, logger)
+        self.assertFalse(suppressed.isEnabledFor(logging.CRITICAL))
+
+    def test_truncate_body(self):
+        settings = LogSettings(body_max_bytes=4)
+        self.assertEqual(settings.truncate_body(b"abcdefgh"), b"abcd")
+        self.assertEqual(settings.truncate_body(b"ab"), b"ab")
+
+
+class TestQueuedLogging(unittest.TestCase):
+    def setUp(self) -> None:
+        root = logging.getLogger()
+        self.saved = root.handlers[:], root.level
+        os.environ["LOG_QUEUE_SIZE"] = "100"
+
+    def tearDown(self) -> None:
+        stop_logging()
+        del os.environ["LOG_QUEUE_SIZE"]
+        root = logging.getLogger()
+        root.handlers[:], level = self.saved
+        root.setLevel(level)
+
+    def test_written_by_writer_thread(self):
+        stream = io.StringIO()
+        init_logging(stream)
+        log_access("127.0.0.1", "GET /status HTTP/1.1", 200, 0.0012)
+        stop_logging()
+        self.assertRegex(
+            stream.getvalue(),
+            r'INFO \[ *\d+\] \[jwt_proxy.access\] 127.0.0.1 "GET /status HTTP/1.1" 200 1.20ms\n$',
+        )
+
+    def test_drop_when_full(self):
+        handler = _DeferredQueueHandler(queue.Queue(1))
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, "%s", ("a",), None)
+        handler.emit(record)
+        handler.emit(record)
+        self.assertEqual(handler.dropped, 1)
+        # Formatting is left to the writer thread
+        self.assertEqual(handler.queue.get_nowait().args, ("a",))
@@ -0,0 +1,80 @@
+"""
+Unit tests for :mod:`jwt_proxy.metrics`.
+"""
+
+import threading
+import unittest
+
+from jwt_proxy.metrics import Metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        self.metrics = Metrics()
+        self.metrics.counter("requests_total", "Requests.", ("code",))
+        self.metrics.histogram("duration_seconds", "Durations.", buckets=(0.1, 1.0))
+
+    def test_shards_combined(self):
+        """
+        Values recorded by several threads are combined, including those of finished threads.
+        """
+        barrier = threading.Barrier(4)
+
+        def record():
+            for _ in range(1000):
+                self.metrics.inc("requests_total", ("200",))
+            self.metrics.observe("duration_seconds", 0.5)
+            # Keep the threads alive until all of them have recorded, so that none share a shard
+            barrier.wait()
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.metrics.inc("requests_total", ("500",))
+
+        self.assertEqual(self.metrics.get("requests_total", ("200",)), 4000)
+        self.assertEqual(self.metrics.get("requests_total", ("500",)), 1)
+        self.assertEqual(self.metrics.get_histogram("duration_seconds"), (4, 2.0))
+        # The finished threads' shards were folded together
+        self.assertEqual(len(self.metrics._shards), 1)
+        self.assertEqual(self.metrics.get("requests_total", ("200",)), 4000)
+
+    def test_shards_retired_without_reads(self):
+        """
+        Shards of finished threads are folded when new threads record, even if nothing reads.
+        """
+        for _ in range(20):
+            thread = threading.Thread(target=self.metrics.inc, args=("requests_total", ("200",)))
+            thread.start()
+            thread.join()
+            self.assertLessEqual(len(self.metrics._shards), 1)
+        self.assertEqual(self.metrics.get("requests_total", ("200",)), 20)
+
+    def test_render_prometheus(self):
+        self.metrics.inc("requests_total", ("200",), 3)
+        for value in (0.05, 0.5, 5):
+            self.metrics.observe("duration_seconds", value)
+        self.metrics.gauge("queue_depth", "Queue depth.", lambda: [((), 2)])
+
+        self.assertEqual(
+            self.metrics.render_prometheus(),
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{code="200"} 3\n'
+            "# HELP duration_seconds Durations.\n"
+            "# TYPE duration_seconds histogram\n"
+            'duration_seconds_bucket{le="0.1"} 1\n'
+            'duration_seconds_bucket{le="1"} 2\n'
+            'duration_seconds_bucket{le="+Inf"} 3\n'
+            "duration_seconds_sum 5.55\n"
+            "duration_seconds_count 3\n"
+            "# HELP queue_depth Queue depth.\n"
+            "# TYPE queue_depth gauge\n"
+            "queue_depth 2\n",
+        )
+
+    def test_unlabelled_counter_defaults_to_zero(self):
+        self.metrics.counter("errors_total", "Errors.")
+        self.assertIn("\nerrors_total 0\n", self.metrics.render_prometheus())
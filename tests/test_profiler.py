@@ -0,0 +1,37 @@
+"""
+Unit tests for :mod:`jwt_proxy.profiler`.
+"""
+
+import threading
+import unittest
+
+from jwt_proxy.profiler import format_stacks, parse_profile_duration, sample_stacks
+
+
+def _wait_for_profile(event: threading.Event) -> None:
+    event.wait()
+
+
+class TestProfiler(unittest.TestCase):
+    def test_sample_stacks(self):
+        event = threading.Event()
+        thread = threading.Thread(target=_wait_for_profile, args=(event,), name="profiled")
+        thread.start()
+        try:
+            stacks = sample_stacks(0.05, interval=0.01)
+        finally:
+            event.set()
+            thread.join()
+
+        profiled = [stack for stack in stacks if stack.startswith("profiled;")]
+        self.assertEqual(len(profiled), 1)
+        self.assertIn(";_wait_for_profile (", profiled[0])
+        self.assertGreaterEqual(stacks[profiled[0]], 2)
+        self.assertTrue(format_stacks(stacks, 1).endswith(f" {stacks.most_common(1)[0][1]}\n"))
+
+    def test_parse_profile_duration(self):
+        self.assertEqual(parse_profile_duration(""), 5.0)
+        self.assertEqual(parse_profile_duration("seconds=0.5"), 0.5)
+        for query in ("seconds=0", "seconds=61", "seconds=x"):
+            with self.assertRaises(ValueError):
+                parse_profile_duration(query)
@@ -4,14 +4,33 @@ Unit tests for :mod:`jwt_proxy.proxy_server`.
 
 import os
 import re
+import socket
+import struct
+import threading
+import time
 import unittest
+import zlib
 from http import HTTPStatus
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
 from io import BytesIO
 from unittest import mock
 from urllib.request import Request
 
+from jwt_proxy.concurrency import AdaptiveLimiter
+from jwt_proxy.config import ProxyConfig, ProxyState
+from jwt_proxy.http_base import ProxyHTTPServer
+from jwt_proxy.logger import LogSettings
+from jwt_proxy.metrics import PROMETHEUS_CONTENT_TYPE
 from jwt_proxy.proxy_server import ProxyRequestHandler
-from tests.common import create_http_response, urlopen_mock
+from jwt_proxy.ratelimit import RateLimiter
+from jwt_proxy.tokens import UserTokenFactory
+from tests.common import (
+    StreamingUpstreamHandler,
+    create_http_response,
+    send_raw_request,
+    upstream_pool_mock,
+)
 from tests.test_jwt import SECRET
 
 
@@ -26,9 +45,17 @@ class UTProxyRequestHandler(ProxyRequestHandler):
         socket = mock.Mock()
         socket.makefile.return_value = BytesIO()
         server = mock.Mock()
-        server.metrics_lock = mock.Mock()
-        server.metrics_lock.__enter__ = mock.Mock(return_value=server.metrics_lock)
-        server.metrics_lock.__exit__ = mock.Mock()
+        server.log_settings = LogSettings()
+        server.proxy_state = ProxyState.create(
+            ProxyConfig(("http://test-upstream:1234",), None, None)
+        )
+        server.response_cache = None
+        server.upstream_pool = upstream_pool_mock
+        server.token_source = UserTokenFactory(SECRET)
+        server.keep_alive_timeout = 15
+        server.max_keep_alive_requests = 100
+        server.has_waiting_connections.return_value = False
+        server.draining = False
         super().__init__(socket, None, server)
 
 
@@ -40,12 +67,9 @@ class TestProxyServerRequestHandler(unittest.TestCase):
     def setUp(self) -> None:
         self.handler = UTProxyRequestHandler()
         self.handler.client_address = ("127.0.0.1", 2345)
-        self.urlopen_mock = mock.patch("jwt_proxy.proxy_server.urlopen", urlopen_mock.invoke)
-        self.urlopen_mock.start()
 
     def tearDown(self) -> None:
-        urlopen_mock.clean()
-        self.urlopen_mock.stop()
+        upstream_pool_mock.clean()
 
     # The below three methods are copied from BaseHTTPRequestHandlerTestCase.
 
@@ -68,23 +92,6 @@ class TestProxyServerRequestHandler(unittest.TestCase):
         match = self.HTTPResponseMatch.search(response)
         self.assertIsNotNone(match)
 
-    def test_build_upstream_url(self):
-        """
-        Tests for constructing the upstream target URL.
-        """
-        # upstream url, path, expected result
-        cases = [
-            ("echo:9100", "/", "http://echo:9100/"),
-            ("echo:9100", "/?a=b", "http://echo:9100/?a=b"),
-            ("echo:9100", "/foo/bar?a=b", "http://echo:9100/foo/bar?a=b"),
-            ("example.com", "/foo", "http://example.com/foo"),
-            ("https://example.com", "/foo", "https://example.com/foo"),
-        ]
-        for server, path, expected in cases:
-            os.environ["UPSTREAM_SERVER"] = server
-            result = ProxyRequestHandler.build_upstream_url(path)
-            self.assertEqual(result, expected)
-
     def test_handle_request(self):
         """
         Test for forwarding a response to the upstream server, with the JWT token appended.
@@ -105,11 +112,7 @@ class TestProxyServerRequestHandler(unittest.TestCase):
             return create_http_response(HTTPStatus.OK, content=b"Example response")
 
         # Add our handler for the test URL
-        urlopen_mock.add_handler("http://test-upstream:1234/foo", _validator)
-
-        # Environment configuration
-        os.environ["UPSTREAM_SERVER"] = "test-upstream:1234"
-        os.environ["JWT_SIGNING_SECRET"] = SECRET.decode("ascii")
+        upstream_pool_mock.add_handler("http://test-upstream:1234/foo", _validator)
 
         # Request input
         req_body = b"Input body"
@@ -121,3 +124,549 @@ class TestProxyServerRequestHandler(unittest.TestCase):
         # Issue the request and validate the response
         response = self.send_typical_request(b"\r\n".join(req_lines) + b"\r\n\r\n" + req_body)
         self.verify_http_server_response(response[0])
+        self.assertEqual(response[-1], b"Example response")
+
+
+class StreamingRelayTests:
+    """
+    Tests for relaying request and response bodies with each kind of framing, shared by the
+    server engines. Subclasses start a proxy in ``setUp`` and set :attr:`proxy_port`.
+    """
+
+    proxy_port: int
+
+    def start_upstream(self) -> None:
+        self.upstream = ThreadingHTTPServer(("127.0.0.1", 0), StreamingUpstreamHandler)
+        self.upstream.daemon_threads = True
+        threading.Thread(target=self.upstream.serve_forever, args=(0.05,), daemon=True).start()
+        os.environ["UPSTREAM_SERVER"] = f"127.0.0.1:{self.upstream.server_address[1]}"
+        os.environ["JWT_SIGNING_SECRET"] = SECRET.decode("ascii")
+        os.environ["RESPONSE_CACHE_SIZE"] = "100000"
+        StreamingUpstreamHandler.gets.clear()
+
+    def stop_upstream(self) -> None:
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        del os.environ["RESPONSE_CACHE_SIZE"]
+
+    def configure(self, **changes) -> None:
+        state = self.proxy.proxy_state
+        self.proxy.proxy_state = state._replace(config=state.config._replace(**changes))
+
+    def get(self, path: str, method: str = "GET", headers=None):
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        conn.request(method, path, headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    def test_response_framing(self):
+        """
+        Length-delimited, chunked and close-delimited upstream responses all reach the client.
+        """
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        for path in ("/length", "/chunked", "/close", "/length"):
+            conn.request("POST", path, body=b"abc", headers={"X-Repeat": "3"})
+            response = conn.getresponse()
+            self.assertEqual(response.status, HTTPStatus.OK)
+            self.assertEqual(response.read(), b"3" + b"0123456789" * 3)
+            self.assertFalse(response.will_close)
+            self.assertEqual(
+                response.getheader("Transfer-Encoding"), "chunked" if path != "/length" else None
+            )
+        conn.close()
+
+    def test_http10_client(self):
+        """
+        Bodies of unknown length are delimited by closing the connection for HTTP/1.0 clients.
+        """
+        data = send_raw_request(
+            self.proxy_port, b"POST /chunked HTTP/1.0\r\nContent-Length: 2\r\n\r\nab"
+        )
+        head, _, body = data.partition(b"\r\n\r\n")
+        self.assertNotIn(b"Transfer-Encoding", head)
+        self.assertEqual(body, b"2")
+
+    def test_large_chunked_request(self):
+        """
+        A chunked request body much larger than the relay buffer is streamed to the upstream,
+        and a large response is streamed back.
+        """
+        body = (b"x" * 1000 for _ in range(5000))
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        conn.request("POST", "/length", body=body, headers={"X-Repeat": "100000"})
+        response = conn.getresponse()
+        data = response.read()
+        self.assertEqual(response.status, HTTPStatus.OK)
+        self.assertTrue(data.startswith(b"5000000"))
+        self.assertEqual(len(data), 7 + 1000000)
+        conn.close()
+
+    def test_large_sized_request(self):
+        """
+        Large bodies delimited by Content-Length are relayed both ways, and the connections stay
+        usable afterwards.
+        """
+        body = bytes(range(256)) * 20000
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        for _ in range(2):
+            conn.request("PUT", "/length", body=body, headers={"X-Repeat": "100000"})
+            response = conn.getresponse()
+            data = response.read()
+            self.assertEqual(response.status, HTTPStatus.OK)
+            self.assertEqual(data, b"5120000" + b"0123456789" * 100000)
+            self.assertFalse(response.will_close)
+        conn.close()
+        metrics = self.get("/metrics")[1]
+        self.assertIn(b'upstream_pool_checkouts_total{result="hits"} 1\n', metrics)
+
+    def test_metrics(self):
+        """
+        Responses are counted by status, and latencies recorded in histograms.
+        """
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        conn.request("POST", "/length", body=b"abc")
+        conn.getresponse().read()
+        # Not forwarded, and not found without an admin token
+        conn.request("GET", "/debug/profile")
+        conn.getresponse().read()
+        conn.request("GET", "/metrics")
+        response = conn.getresponse()
+        metrics = response.read().decode("utf-8")
+        conn.close()
+
+        self.assertEqual(response.getheader("Content-Type"), PROMETHEUS_CONTENT_TYPE)
+        self.assertIn('http_requests_total{method="POST",code="200"} 1\n', metrics)
+        self.assertIn('http_requests_total{method="GET",code="404"} 1\n', metrics)
+        self.assertIn("http_request_duration_seconds_count 2\n", metrics)
+        for phase in ("read_body", "token", "connect", "upstream", "respond"):
+            self.assertIn(f'proxy_phase_duration_seconds_count{{phase="{phase}"}} 1\n', metrics)
+        self.assertIn('upstream_pool_checkouts_total{result="misses"} 1\n', metrics)
+
+    def test_local_paths_with_query(self):
+        """
+        The proxy's own endpoints ignore the query, rather than forwarding or refusing requests.
+        """
+        response, body = self.get("/status?x=1")
+        self.assertEqual(response.status, HTTPStatus.OK)
+        self.assertIn(b"Upstream", body)
+        response, body = self.get("/metrics?x")
+        self.assertEqual(response.status, HTTPStatus.OK)
+        self.assertEqual(response.getheader("Content-Type"), PROMETHEUS_CONTENT_TYPE)
+        self.assertEqual(StreamingUpstreamHandler.gets, {})
+
+    def test_compression(self):
+        """
+        Responses are compressed with the client's preferred coding, streaming chunked or
+        length-delimited upstream bodies, unless they are small or already compressed.
+        """
+        self.configure(compression=True, compression_min_size=100)
+        expected = b"3" + b"0123456789" * 1000
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        # path, Accept-Encoding, expected coding
+        cases = [
+            ("/length", "gzip, deflate", "gzip"),
+            ("/chunked", "gzip;q=0.5, deflate", "deflate"),
+            ("/length", "identity", None),
+            ("/length", "br", None),
+        ]
+        for path, accept_encoding, encoding in cases:
+            headers = {"X-Repeat": "1000", "Accept-Encoding": accept_encoding}
+            conn.request("POST", path, body=b"abc", headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+            self.assertEqual(response.getheader("Content-Encoding"), encoding, accept_encoding)
+            self.assertEqual(response.getheader("Vary"), "Accept-Encoding")
+            if encoding is None:
+                self.assertEqual(data, expected)
+            else:
+                self.assertEqual(response.getheader("Transfer-Encoding"), "chunked")
+                self.assertLess(len(data), 200)
+                wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+                self.assertEqual(zlib.decompress(data, wbits), expected)
+
+        # Small and already compressed bodies are relayed unchanged
+        for headers in ({"X-Repeat": "5"}, {"X-Repeat": "1000", "X-Content-Encoding": "br"}):
+            conn.request(
+                "POST", "/length", body=b"abc", headers={"Accept-Encoding": "gzip", **headers}
+            )
+            response = conn.getresponse()
+            self.assertTrue(response.read().startswith(b"3012"))
+            self.assertIsNone(response.getheader("Vary"))
+            self.assertIsNotNone(response.getheader("Content-Length"))
+
+        conn.request("GET", "/metrics")
+        metrics = conn.getresponse().read().decode("utf-8")
+        conn.close()
+        self.assertIn('compressed_responses_total{encoding="gzip"} 1\n', metrics)
+        self.assertIn('compressed_responses_total{encoding="deflate"} 1\n', metrics)
+        self.assertIn(f'compression_bytes_total{{direction="in"}} {2 * len(expected)}\n', metrics)
+
+    def test_server_timing(self):
+        self.configure(server_timing=True)
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        conn.request("POST", "/length", body=b"abc")
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        self.assertRegex(
+            response.getheader("Server-Timing"),
+            r"^read_body;dur=[\d.]+, token;dur=[\d.]+, connect;dur=[\d.]+, upstream;dur=[\d.]+$",
+        )
+
+    def test_profile(self):
+        """
+        The profiling endpoint is disabled without an admin token, and requires the token.
+        """
+
+        def get(authorization=None):
+            conn = HTTPConnection("127.0.0.1", self.proxy_port)
+            headers = {"Authorization": authorization} if authorization else {}
+            conn.request("GET", "/debug/profile?seconds=0.05", headers=headers)
+            response = conn.getresponse()
+            result = response.status, response.read().decode("utf-8")
+            conn.close()
+            return result
+
+        self.assertEqual(get("Bearer secret")[0], HTTPStatus.NOT_FOUND)
+        self.proxy.admin_token = "secret"
+        self.assertEqual(get()[0], HTTPStatus.FORBIDDEN)
+        self.assertEqual(get("Bearer wrong")[0], HTTPStatus.FORBIDDEN)
+        status, stacks = get("Bearer secret")
+        self.assertEqual(status, HTTPStatus.OK)
+        self.assertRegex(stacks, r"(?m)^\S.*;.* \d+$")
+
+    def test_upstream_unavailable(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            os.environ["UPSTREAM_SERVER"] = f"127.0.0.1:{sock.getsockname()[1]}"
+        self.proxy.reload_config()
+        data = send_raw_request(self.proxy_port, b"POST / HTTP/1.1\r\nContent-Length: 1\r\n\r\na")
+        self.assertTrue(data.startswith(b"HTTP/1.1 502"))
+
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        conn.request("GET", "/metrics")
+        self.assertIn(b'upstream_errors_total{reason="connect"} 1\n', conn.getresponse().read())
+        conn.close()
+
+    def test_upstream_timeout(self):
+        self.configure(retries=0)
+        self.proxy.upstream_pool.read_timeout = 0.2
+        response, _ = self.get("/sleep/1")
+        self.assertEqual(response.status, HTTPStatus.GATEWAY_TIMEOUT)
+        metrics = self.get("/metrics")[1]
+        self.assertIn(b'upstream_errors_total{reason="timeout"} 1\n', metrics)
+
+    def test_retry(self):
+        """
+        Idempotent requests are sent again after a retryable status or a timeout.
+        """
+        self.configure(retries=1, retry_backoff=0.01)
+        self.proxy.upstream_pool.read_timeout = 0.2
+        response, body = self.get("/fail-first/a")
+        self.assertEqual((response.status, body), (HTTPStatus.OK, b"/fail-first/a 2"))
+        response, body = self.get("/sleep-first/1")
+        self.assertEqual((response.status, body), (HTTPStatus.OK, b"/sleep-first/1 2"))
+
+        # Without retries, the upstream's error is reported
+        self.configure(retries=0)
+        response, _ = self.get("/fail-first/b")
+        self.assertEqual(response.status, HTTPStatus.BAD_GATEWAY)
+
+        metrics = self.get("/metrics")[1]
+        self.assertIn(b'upstream_retries_total{reason="status"} 1\n', metrics)
+        self.assertIn(b'upstream_retries_total{reason="timeout"} 1\n', metrics)
+
+    def test_hedging(self):
+        """
+        Once the usual latency is known, a slow request is answered by a second one.
+        """
+        self.configure(hedging=True, hedge_min_delay=0.05)
+        for _ in range(20):
+            self.assertEqual(self.get("/items")[0].status, HTTPStatus.OK)
+        response, body = self.get("/sleep-first/2")
+        self.assertEqual((response.status, body), (HTTPStatus.OK, b"/sleep-first/2 2"))
+        metrics = self.get("/metrics")[1]
+        self.assertIn(b'upstream_hedged_requests_total{winner="hedge"} 1\n', metrics)
+
+    def test_hedging_breakers(self):
+        """
+        A copy of a request is only sent if the circuit breaker of its upstream lets it through,
+        and each upstream's breaker gets the outcome of its own request.
+        """
+        second = ThreadingHTTPServer(("127.0.0.1", 0), StreamingUpstreamHandler)
+        second.daemon_threads = True
+        threading.Thread(target=second.serve_forever, args=(0.05,), daemon=True).start()
+        self.addCleanup(second.server_close)
+        self.addCleanup(second.shutdown)
+        upstreams = f"{os.environ['UPSTREAM_SERVER']},127.0.0.1:{second.server_address[1]}"
+        with mock.patch.dict(os.environ, {"UPSTREAM_SERVER": upstreams}):
+            self.proxy.reload_config()
+        self.configure(hedging=True, hedge_min_delay=0.05)
+        for _ in range(20):
+            self.assertEqual(self.get("/items")[0].status, HTTPStatus.OK)
+        balancer = self.proxy.proxy_state.balancer
+        primary, hedge = balancer.upstreams
+
+        def get(path):
+            record = mock.Mock(wraps=balancer.record)
+            release = mock.Mock(wraps=balancer.release)
+            with mock.patch.multiple(
+                balancer,
+                choose=mock.Mock(side_effect=[primary, hedge]),
+                record=record,
+                release=release,
+            ):
+                response, body = self.get(path)
+            self.assertEqual(response.status, HTTPStatus.OK)
+            return body, record.call_args_list, release.call_args_list
+
+        # The copy wins, and the primary request is cut short
+        body, records, releases = get("/sleep-first/0.5")
+        self.assertEqual(body, b"/sleep-first/0.5 2")
+        self.assertEqual(records, [mock.call(hedge, 0, True)])
+        self.assertEqual(releases, [mock.call(primary, 0)])
+
+        # The copy is not sent while the breaker of its upstream is open
+        for _ in range(hedge.breaker.consecutive_failures):
+            hedge.breaker.record(hedge.breaker.acquire(), False)
+        body, records, releases = get("/sleep-first/0.4")
+        self.assertEqual(body, b"/sleep-first/0.4 1")
+        self.assertEqual(records, [mock.call(primary, 0, True)])
+        self.assertEqual(releases, [])
+        self.assertEqual(hedge.breaker.short_circuited, 1)
+        metrics = self.get("/metrics")[1]
+        self.assertIn(b'upstream_hedged_requests_total{winner="hedge"} 1\n', metrics)
+        self.assertNotIn(b'upstream_hedged_requests_total{winner="primary"}', metrics)
+
+    def test_circuit_breaker(self):
+        """
+        Requests to an upstream which keeps failing are refused without being sent.
+        """
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            upstream = f"127.0.0.1:{sock.getsockname()[1]}"
+        settings = {"UPSTREAM_SERVER": upstream, "UPSTREAM_BREAKER_FAILURES": "2"}
+        with mock.patch.dict(os.environ, settings):
+            self.proxy.reload_config()
+        for status in (
+            HTTPStatus.BAD_GATEWAY,
+            HTTPStatus.BAD_GATEWAY,
+            HTTPStatus.SERVICE_UNAVAILABLE,
+        ):
+            response, _ = self.get("/", "POST")
+            self.assertEqual(response.status, status)
+        self.assertEqual(response.getheader("Retry-After"), "10")
+
+        self.assertIn(b"circuit open, 1 requests short-circuited", self.get("/status")[1])
+        metrics = self.get("/metrics")[1].decode("utf-8")
+        self.assertIn(f'upstream_circuit_state{{upstream="http://{upstream}"}} 2\n', metrics)
+        self.assertIn(
+            f'upstream_short_circuited_total{{upstream="http://{upstream}"}} 1\n', metrics
+        )
+
+    def test_client_body_error(self):
+        """
+        A client resetting its connection while its body is streamed to the upstream is not
+        counted as an upstream failure.
+        """
+        with mock.patch.dict(os.environ, {"UPSTREAM_BREAKER_FAILURES": "1"}):
+            self.proxy.reload_config()
+        with socket.create_connection(("127.0.0.1", self.proxy_port)) as sock:
+            sock.sendall(
+                b"POST /length HTTP/1.1\r\nContent-Length: 1000000\r\n\r\n" + b"x" * 100000
+            )
+            time.sleep(0.1)
+            # Close with a reset rather than a FIN
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        time.sleep(0.2)
+        response, _ = self.get("/length", "POST")
+        self.assertEqual(response.status, HTTPStatus.OK)
+        self.assertNotIn(b"upstream_errors_total{", self.get("/metrics")[1])
+
+    def test_concurrency_limit(self):
+        """
+        Requests over the concurrency limit are refused once their wait is over.
+        """
+        self.proxy.proxy_state = self.proxy.proxy_state._replace(
+            concurrency_limiter=AdaptiveLimiter(initial_limit=2, max_limit=2)
+        )
+        self.configure(concurrency_queue_timeout=0.05)
+        statuses = []
+        # Distinct paths, which are not coalesced by the cache
+        threads = [
+            threading.Thread(
+                target=lambda path: statuses.append(self.get(path)[0].status),
+                args=(f"/sleep/0.3{i}",),
+            )
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(statuses), [200, 200, 503, 503])
+
+        self.assertIn(b"upstream_concurrency_rejected_total 2\n", self.get("/metrics")[1])
+        self.assertIn(b"Upstream concurrency limit 2,", self.get("/status")[1])
+
+    def test_rate_limit(self):
+        """
+        Clients over their rate limit are refused with 429 before their body is read.
+        """
+        self.proxy.proxy_state = self.proxy.proxy_state._replace(rate_limiter=RateLimiter(0.5, 2))
+        self.configure(rate_limit=0.5, rate_limit_header="X-Client")
+        for _ in range(2):
+            self.assertEqual(self.get("/items", headers={"X-Client": "a"})[0].status, HTTPStatus.OK)
+        response, body = self.get("/items", headers={"X-Client": "a"})
+        self.assertEqual(response.status, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertEqual(response.getheader("Retry-After"), "2")
+        self.assertEqual(body, b"429 rate limit exceeded")
+        self.assertEqual(self.get("/items", headers={"X-Client": "b"})[0].status, HTTPStatus.OK)
+
+        # The unread body cannot be skipped, so the connection is closed
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        conn.request("POST", "/length", body=b"abc", headers={"X-Client": "a"})
+        response = conn.getresponse()
+        self.assertEqual(response.status, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertEqual(response.getheader("Connection"), "close")
+        response.read()
+        conn.close()
+
+        self.assertIn(b"rate_limited_requests_total 2\n", self.get("/metrics")[1])
+        self.assertIn(
+            b"Rate limit 0.5 requests/s per client, 2 clients tracked, 2 requests rejected",
+            self.get("/status")[1],
+        )
+
+    def test_methods(self):
+        """
+        Requests with and without bodies are forwarded with every method.
+        """
+        conn = HTTPConnection("127.0.0.1", self.proxy_port)
+        for method, body in (("PUT", b"abc"), ("PATCH", b"ab"), ("DELETE", None)):
+            conn.request(method, "/length", body=body)
+            response = conn.getresponse()
+            self.assertEqual(response.status, HTTPStatus.OK)
+            self.assertEqual(response.getheader("X-Method"), method)
+            self.assertEqual(response.read(), str(len(body or b"")).encode("ascii"))
+        conn.close()
+
+        response, body = self.get("/items")
+        self.assertEqual((response.status, body), (HTTPStatus.OK, b"/items 1"))
+        self.assertIsNone(response.getheader("X-Cache"))
+        response, body = self.get("/items", "HEAD")
+        self.assertEqual((response.status, body), (HTTPStatus.OK, b""))
+        self.assertEqual(response.getheader("Content-Length"), "8")
+
+    def test_cache(self):
+        response, body = self.get("/cache/max-age")
+        self.assertEqual(body, b"/cache/max-age 1")
+        self.assertEqual(response.getheader("X-Cache"), "MISS")
+        response, body = self.get("/cache/max-age")
+        self.assertEqual(body, b"/cache/max-age 1")
+        self.assertEqual(response.getheader("X-Cache"), "HIT")
+        self.assertEqual(response.getheader("Age"), "0")
+        response, body = self.get("/cache/max-age", "HEAD")
+        self.assertEqual((response.getheader("X-Cache"), body), ("HIT", b""))
+
+        # Requests may ask for a new response, or for it not to be stored
+        response, body = self.get("/cache/max-age", headers={"Cache-Control": "no-cache"})
+        self.assertEqual((response.getheader("X-Cache"), body), ("MISS", b"/cache/max-age 2"))
+        response, body = self.get("/cache/max-age", headers={"Authorization": "Bearer x"})
+        self.assertEqual((response.getheader("X-Cache"), body), (None, b"/cache/max-age 3"))
+        self.assertEqual(self.get("/cache/max-age")[1], b"/cache/max-age 2")
+
+        # Private responses are not stored
+        self.assertEqual(self.get("/cache/private")[1], b"/cache/private 1")
+        self.assertEqual(self.get("/cache/private")[1], b"/cache/private 2")
+
+        metrics = self.get("/metrics")[1].decode("utf-8")
+        self.assertIn('response_cache_lookups_total{result="hit"} 3\n', metrics)
+        self.assertIn('response_cache_lookups_total{result="miss"} 4\n', metrics)
+        self.assertIn("response_cache_entries 1\n", metrics)
+
+    def test_cache_revalidation(self):
+        response, body = self.get("/cache/etag")
+        self.assertEqual((response.getheader("X-Cache"), body), ("MISS", b"/cache/etag 1"))
+        response, body = self.get("/cache/etag")
+        self.assertEqual((response.getheader("X-Cache"), body), ("REVALIDATED", b"/cache/etag 1"))
+        self.assertEqual(StreamingUpstreamHandler.gets["/cache/etag"], 2)
+
+        # The client's own conditional request is answered from the cache
+        response, body = self.get("/cache/etag", headers={"If-None-Match": '"v1"'})
+        self.assertEqual((response.status, body), (HTTPStatus.NOT_MODIFIED, b""))
+
+    def test_cache_coalescing(self):
+        """
+        Concurrent misses for the same path are fetched from the upstream once.
+        """
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(self.get("/cache/slow")[0].getheader("X-Cache"))
+            )
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), ["COALESCED"] * 3 + ["MISS"])
+        self.assertEqual(StreamingUpstreamHandler.gets["/cache/slow"], 1)
+
+    def test_invalid_chunked_request(self):
+        data = send_raw_request(
+            self.proxy_port,
+            b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\nabc\r\n0\r\n\r\n",
+        )
+        self.assertTrue(data.startswith(b"HTTP/1.1 400"))
+
+    def test_smuggled_request(self):
+        """
+        Requests framed by both ``Transfer-Encoding`` and ``Content-Length`` are refused, and the
+        connection closed, so a request hidden in the body never reaches the upstream.
+        """
+        data = send_raw_request(
+            self.proxy_port,
+            b"POST /length HTTP/1.1\r\nTransfer-Encoding: chunked\r\nContent-Length: 4\r\n\r\n"
+            b"0\r\n\r\nGET /smuggled HTTP/1.1\r\n\r\n",
+        )
+        self.assertTrue(data.startswith(b"HTTP/1.1 400"))
+        self.assertEqual(data.count(b"HTTP/1.1 "), 1)
+        self.assertNotIn("/smuggled", StreamingUpstreamHandler.gets)
+
+        data = send_raw_request(
+            self.proxy_port,
+            b"POST /length HTTP/1.1\r\nTransfer-Encoding: chunked\r\nContent-Length: abc\r\n\r\n"
+            b"3\r\nabc\r\n0\r\n\r\n",
+        )
+        self.assertTrue(data.startswith(b"HTTP/1.1 400"))
+
+
+class TestThreadedStreamingRelay(StreamingRelayTests, unittest.TestCase):
+    def setUp(self) -> None:
+        self.start_upstream()
+        self.proxy = ProxyHTTPServer(("127.0.0.1", 0), ProxyRequestHandler)
+        self.proxy_port = self.proxy.server_address[1]
+        threading.Thread(target=self.proxy.serve_forever, args=(0.05,), daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.proxy.shutdown()
+        self.proxy.server_close()
+        self.stop_upstream()
+
+
+class TestThreadedCopyingRelay(TestThreadedStreamingRelay):
+    """
+    Relays bodies through Python objects rather than between the sockets.
+    """
+
+    def setUp(self) -> None:
+        os.environ["PROXY_ZERO_COPY"] = "0"
+        super().setUp()
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        del os.environ["PROXY_ZERO_COPY"]
@@ -0,0 +1,47 @@
+"""
+Unit tests for :mod:`jwt_proxy.ratelimit`.
+"""
+
+import unittest
+
+from jwt_proxy.ratelimit import RateLimiter
+from tests.test_breaker import FakeClock
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+
+    def test_token_bucket(self):
+        limiter = RateLimiter(2.0, 3, clock=self.clock)
+        for _ in range(3):
+            self.assertIsNone(limiter.acquire("a"))
+        self.assertEqual(limiter.acquire("a"), 0.5)
+        # Other clients have their own bucket
+        self.assertIsNone(limiter.acquire("b"))
+
+        self.clock.now += 0.25
+        self.assertEqual(limiter.acquire("a"), 0.25)
+        self.clock.now += 0.25
+        self.assertIsNone(limiter.acquire("a"))
+        self.assertEqual(limiter.acquire("a"), 0.5)
+
+        # An idle bucket refills up to the burst
+        self.clock.now += 60
+        for _ in range(3):
+            self.assertIsNone(limiter.acquire("a"))
+        self.assertIsNotNone(limiter.acquire("a"))
+        self.assertEqual(limiter.stats(), {"clients": 2, "evicted": 0, "rejected": 4})
+
+    def test_eviction(self):
+        limiter = RateLimiter(1.0, 1, max_clients=4, shards=2, clock=self.clock)
+        for client in range(1000):
+            self.assertIsNone(limiter.acquire(str(client)))
+        stats = limiter.stats()
+        self.assertLessEqual(stats["clients"], 4)
+        self.assertEqual(stats["clients"] + stats["evicted"], 1000)
+
+        # The most recently used clients are kept
+        self.assertIsNotNone(limiter.acquire("999"))
+        # An evicted client starts again with a full bucket
+        self.assertIsNone(limiter.acquire("0"))
@@ -0,0 +1,99 @@
+"""
+Unit tests for :mod:`jwt_proxy.relay`.
+"""
+
+import socket
+import threading
+import unittest
+from functools import partial
+
+from jwt_proxy import relay
+
+DATA = bytes(range(256)) * 10000
+
+
+def receive_all(sock: socket.socket, received: list) -> None:
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        received.append(data)
+
+
+def send_all(sock: socket.socket, data: bytes) -> None:
+    sock.sendall(data)
+    sock.shutdown(socket.SHUT_WR)
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self) -> None:
+        # client -> src ... dst -> server
+        self.client, self.src = socket.socketpair()
+        self.dst, self.server = socket.socketpair()
+        self.received = []
+        self.receiver = threading.Thread(target=receive_all, args=(self.server, self.received))
+        self.receiver.start()
+
+    def tearDown(self) -> None:
+        self.dst.shutdown(socket.SHUT_WR)
+        self.receiver.join()
+        for sock in (self.client, self.src, self.dst, self.server):
+            sock.close()
+
+    def run_relay(self, move, data: bytes) -> bytes:
+        sender = threading.Thread(target=send_all, args=(self.client, data))
+        sender.start()
+        moved = move()
+        sender.join()
+        self.dst.shutdown(socket.SHUT_WR)
+        self.receiver.join()
+        received = b"".join(self.received)
+        self.assertEqual(moved, len(received))
+        return received
+
+    @unittest.skipUnless(relay.SPLICE_AVAILABLE, "splice() is not available")
+    def test_splice(self):
+        self.src.settimeout(5.0)
+        self.assertTrue(relay.can_splice(self.src, self.dst))
+        move = partial(relay.splice, self.src, self.dst, len(DATA) - 10)
+        self.assertEqual(self.run_relay(move, DATA), DATA[:-10])
+
+    @unittest.skipUnless(relay.SPLICE_AVAILABLE, "splice() is not available")
+    def test_splice_eof(self):
+        move = partial(relay.splice, self.src, self.dst, len(DATA) + 10)
+        self.assertEqual(self.run_relay(move, DATA), DATA)
+
+    def test_copy_into(self):
+        move = partial(relay.copy_into, self.src.recv_into, self.dst.sendall)
+        self.assertEqual(self.run_relay(move, DATA), DATA)
+
+    def test_source_error(self):
+        """
+        Failures to read the source are told apart from failures to write the destination.
+        """
+        self.src.settimeout(0.01)
+        with self.assertRaises(relay.SourceError):
+            relay.relay(self.src, self.dst, 10)
+        with self.assertRaises(relay.SourceError):
+            relay.copy_into(self.src.recv_into, self.dst.sendall, 10)
+
+    def test_socket_body(self):
+        """
+        The buffered start of the body is sent first, and data after the body is left unread.
+        """
+        sender = threading.Thread(target=send_all, args=(self.client, b"HEAD\n" + DATA + b"NEXT"))
+        sender.start()
+        rfile = self.src.makefile("rb")
+        self.assertEqual(rfile.readline(), b"HEAD\n")
+        body = relay.SocketBody(rfile, self.src, len(DATA))
+        self.assertEqual(body.send(self.dst), len(DATA))
+        self.assertEqual(rfile.read(4), b"NEXT")
+        sender.join()
+        rfile.close()
+        self.dst.shutdown(socket.SHUT_WR)
+        self.receiver.join()
+        self.assertEqual(b"".join(self.received), DATA)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+"""
+Unit tests for :mod:`jwt_proxy.retry`.
+"""
+
+import unittest
+
+from jwt_proxy.retry import LatencyTracker, backoff_delay, is_retryable
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable("GET", {}))
+        self.assertTrue(is_retryable("PUT", {}))
+        self.assertFalse(is_retryable("POST", {}))
+        self.assertFalse(is_retryable("PATCH", {}))
+        self.assertTrue(is_retryable("POST", {"Idempotency-Key": "8e0f"}))
+
+    def test_backoff_delay(self):
+        for _ in range(100):
+            self.assertLessEqual(backoff_delay(1, 0.1), 0.1)
+            self.assertLessEqual(backoff_delay(3, 0.1), 0.4)
+            self.assertLessEqual(backoff_delay(10, 0.1, cap=0.5), 0.5)
+        self.assertGreater(max(backoff_delay(3, 0.1) for _ in range(100)), 0.1)
+
+
+class TestLatencyTracker(unittest.TestCase):
+    def test_percentile(self):
+        tracker = LatencyTracker(window=100, min_samples=10, refresh=10)
+        for latency in range(9):
+            tracker.observe(latency / 100)
+        self.assertIsNone(tracker.percentile(95))
+        tracker.observe(0.09)
+        self.assertEqual(tracker.percentile(50), 0.05)
+        self.assertEqual(tracker.percentile(95), 0.09)
+
+        # The sorted latencies are only refreshed every 10 observations
+        for _ in range(9):
+            tracker.observe(1.0)
+        self.assertEqual(tracker.percentile(95), 0.09)
+        tracker.observe(1.0)
+        self.assertEqual(tracker.percentile(95), 1.0)
+
+    def test_window(self):
+        tracker = LatencyTracker(window=10, min_samples=10, refresh=1)
+        for _ in range(10):
+            tracker.observe(1.0)
+        for _ in range(10):
+            tracker.observe(0.1)
+        self.assertEqual(tracker.percentile(99), 0.1)
@@ -0,0 +1,82 @@
+"""
+Unit tests for :mod:`jwt_proxy.simulation`.
+"""
+
+import os
+import unittest
+from email.message import Message
+from unittest import mock
+
+from jwt_proxy.simulation import DROP, Latency, ResponseSimulation, request_params
+
+
+class TestLatency(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(Latency.parse("0.5"), Latency("fixed", (0.5,)))
+        self.assertEqual(Latency.parse("uniform:0.1:0.2"), Latency("uniform", (0.1, 0.2)))
+        self.assertEqual(Latency.parse(" exponential:1 "), Latency("exponential", (1.0,)))
+        for spec in ("", "-1", "nan", "gamma:1", "normal:1", "uniform:2:1", "lognormal:a:1"):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                Latency.parse(spec)
+
+    def test_sample(self):
+        self.assertEqual(Latency.parse("0.25").sample(), 0.25)
+        self.assertEqual(Latency.parse("exponential:0").sample(), 0.0)
+        for spec in ("uniform:0.1:0.2", "exponential:0.1", "normal:0.1:1", "lognormal:0.1:0.5"):
+            samples = [Latency.parse(spec).sample() for _ in range(100)]
+            self.assertTrue(all(sample >= 0 for sample in samples), spec)
+        self.assertTrue(
+            all(0.1 <= Latency.parse("uniform:0.1:0.2").sample() <= 0.2 for _ in range(100))
+        )
+
+
+class TestResponseSimulation(unittest.TestCase):
+    def test_from_environment(self):
+        settings = {"ECHO_SIZE": "10", "ECHO_FAIL_STATUS": "drop", "ECHO_QUIET": "1"}
+        with mock.patch.dict(os.environ, settings):
+            simulation = ResponseSimulation.from_environment()
+        self.assertEqual(simulation.size, 10)
+        self.assertEqual(simulation.fail_status, DROP)
+        self.assertTrue(simulation.quiet)
+        self.assertEqual(simulation.framing, "length")
+
+        with mock.patch.dict(os.environ, {"ECHO_FRAMING": "gzip"}):
+            with self.assertRaisesRegex(ValueError, "Invalid framing 'gzip': must be one of"):
+                ResponseSimulation.from_environment()
+
+    def test_override(self):
+        simulation = ResponseSimulation()
+        self.assertIs(simulation.override({}), simulation)
+        self.assertEqual(
+            simulation.override({"status": "404", "fail_rate": "0.5", "chunk_size": "16"}),
+            simulation._replace(status=404, fail_rate=0.5, chunk_size=16),
+        )
+        for name, value in (
+            ("status", "204"),
+            ("status", "99"),
+            ("fail_status", "close"),
+            ("fail_rate", "1.5"),
+            ("size", "-1"),
+            ("chunk_size", "0"),
+            ("latency", "fixed:1:2"),
+        ):
+            with self.subTest(name=name), self.assertRaisesRegex(ValueError, f"Invalid {name}"):
+                simulation.override({name: value})
+
+    def test_body_pieces(self):
+        simulation = ResponseSimulation(size=100000, chunk_size=40000)
+        pieces = [bytes(piece) for piece in simulation.body_pieces()]
+        self.assertEqual([len(piece) for piece in pieces], [40000, 40000, 20000])
+        self.assertTrue(all(0x21 <= byte < 0x7F for byte in pieces[0]))
+        self.assertEqual(list(ResponseSimulation(size=0).body_pieces()), [])
+
+    def test_request_params(self):
+        headers = Message()
+        headers["X-Echo-Fail-Rate"] = "0.5"
+        headers["X-Echo-Size"] = "20"
+        headers["X-Other"] = "1"
+        self.assertEqual(
+            request_params("/path?size=10&latency=0.1&page=2", headers),
+            {"size": "20", "latency": "0.1", "fail_rate": "0.5"},
+        )
+        self.assertEqual(request_params("/path", Message()), {})
@@ -0,0 +1,166 @@
+"""
+Unit tests for :mod:`jwt_proxy.tokens`.
+"""
+
+import base64
+import json
+import time
+import unittest
+from datetime import date
+from unittest import mock
+
+from jwt_proxy.keys import KeySet, SigningKey
+from jwt_proxy.tokens import TokenPool, UserTokenFactory
+from tests.test_jwt import SECRET
+
+
+def decode_part(part: bytes) -> dict:
+    return json.loads(base64.urlsafe_b64decode(part + b"=" * (-len(part) % 4)))
+
+
+def decode_header(token: bytes) -> dict:
+    """
+    Decode the header part of a token without verifying it.
+    """
+    return decode_part(token.split(b".")[0])
+
+
+def decode_payload(token: bytes) -> dict:
+    """
+    Decode the payload part of a token without verifying it.
+    """
+    return decode_part(token.split(b".")[1])
+
+
+class TestUserTokenFactory(unittest.TestCase):
+    def test_create_token(self):
+        factory = UserTokenFactory(SECRET, user="someone")
+        first = decode_payload(factory.create_token())
+        second = decode_payload(factory.create_token())
+        self.assertEqual(first["payload"], {"user": "someone", "date": date.today().isoformat()})
+        self.assertNotEqual(first["jti"], second["jti"])
+
+    def test_date_rollover(self):
+        """
+        Tokens created after midnight carry the new date.
+        """
+        factory = UserTokenFactory(SECRET, user="someone")
+        with mock.patch("jwt_proxy.tokens.date") as date_mock, mock.patch(
+            "jwt_proxy.tokens.time"
+        ) as time_mock:
+            date_mock.today.return_value = date(2022, 12, 7)
+            time_mock.time.return_value = 0
+            self.assertEqual(
+                decode_payload(factory.create_token())["payload"]["date"], "2022-12-07"
+            )
+
+            date_mock.today.return_value = date(2022, 12, 8)
+            self.assertEqual(
+                decode_payload(factory.create_token())["payload"]["date"], "2022-12-07"
+            )
+
+            time_mock.time.return_value = factory._rollover
+            self.assertEqual(
+                decode_payload(factory.create_token())["payload"]["date"], "2022-12-08"
+            )
+
+    def test_missing_secret(self):
+        with mock.patch.dict("os.environ", clear=True):
+            with self.assertRaises(ValueError):
+                UserTokenFactory.from_environment()
+
+    def test_key_environment(self):
+        with mock.patch.dict(
+            "os.environ",
+            {"JWT_SIGNING_SECRET": "secret", "JWT_SIGNING_ALGORITHM": "HS256", "JWT_KEY_ID": "k1"},
+            clear=True,
+        ):
+            factory = UserTokenFactory.from_environment()
+        self.assertEqual(
+            decode_header(factory.create_token()), {"alg": "HS256", "kid": "k1", "typ": "jwt"}
+        )
+
+    def test_key_rotation(self):
+        """
+        Tokens created after the keys change are signed with the new current key.
+        """
+        factory = UserTokenFactory(SECRET, user="someone")
+        self.assertEqual(decode_header(factory.create_token()), {"alg": "HS512", "typ": "jwt"})
+
+        keys = {"old": SigningKey("old", b"s1"), "new": SigningKey("new", b"s2", "HS384")}
+        factory.set_keys(KeySet(keys, "new"))
+        self.assertEqual(
+            decode_header(factory.create_token()), {"alg": "HS384", "kid": "new", "typ": "jwt"}
+        )
+        factory.set_keys(KeySet(keys, "old"))
+        self.assertEqual(decode_header(factory.create_token())["kid"], "old")
+
+
+class TestTokenPool(unittest.TestCase):
+    def wait_for_depth(self, pool: TokenPool, depth: int) -> None:
+        deadline = time.monotonic() + 5
+        while pool.stats()["depth"] < depth:
+            self.assertLess(time.monotonic(), deadline, "token pool was not refilled")
+            time.sleep(0.001)
+
+    def test_prefill_and_take(self):
+        """
+        The producer fills the buffer, and tokens taken from it are unique.
+        """
+        pool = TokenPool(UserTokenFactory(SECRET, user="someone"), size=20, low_watermark=5)
+        pool.start()
+        try:
+            self.wait_for_depth(pool, 20)
+            tokens = [pool.create_token() for _ in range(10)]
+            self.assertEqual(len({decode_payload(token)["jti"] for token in tokens}), 10)
+            self.assertEqual(pool.stats()["fallbacks"], 0)
+        finally:
+            pool.stop()
+
+    def test_refill_below_low_watermark(self):
+        pool = TokenPool(UserTokenFactory(SECRET, user="someone"), size=20, low_watermark=5)
+        pool.start()
+        try:
+            self.wait_for_depth(pool, 20)
+            for _ in range(16):
+                pool.create_token()
+            self.wait_for_depth(pool, 20)
+        finally:
+            pool.stop()
+
+    def test_fallback_when_empty(self):
+        pool = TokenPool(UserTokenFactory(SECRET, user="someone"), size=20)
+        decode_payload(pool.create_token())
+        self.assertEqual(pool.stats(), {"depth": 0, "fallbacks": 1, "discarded": 0})
+
+    def test_invalidation(self):
+        """
+        Tokens minted before a secret change, date change, or too long ago are discarded.
+        """
+        factory = UserTokenFactory(SECRET, user="someone")
+        pool = TokenPool(factory, size=3, max_age=60)
+        pool._fill()
+        factory.set_secret(b"other secret")
+        token = pool.create_token()
+        self.assertEqual(token, factory.signer.encode(*self.claims(token)))
+        self.assertEqual(pool.stats(), {"depth": 0, "fallbacks": 1, "discarded": 3})
+
+        pool._fill()
+        factory._rollover = 0.0
+        pool.create_token()
+        self.assertEqual(pool.stats()["discarded"], 6)
+
+        pool._fill()
+        factory.set_keys(KeySet({"k1": SigningKey("k1", SECRET)}, "k1"))
+        pool.create_token()
+        self.assertEqual(pool.stats()["discarded"], 9)
+
+        pool._fill()
+        pool.max_age = 0
+        pool.create_token()
+        self.assertEqual(pool.stats()["discarded"], 12)
+
+    @staticmethod
+    def claims(token: bytes):
+        payload = decode_payload(token)
+        return payload["iat"], payload["jti"]
@@ -0,0 +1,180 @@
+"""
+Unit tests for :mod:`jwt_proxy.upstream`.
+"""
+
+import os
+import socket
+import threading
+import time
+import unittest
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from jwt_proxy.upstream import (
+    UpstreamConnectionPool,
+    UpstreamPoolExhausted,
+    pool_key,
+    timeouts_from_environment,
+)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """
+    Minimal HTTP/1.1 handler which answers every request with a fixed body.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"ok"
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Length", str(len(body)))
+        if self.path == "/close":
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestUpstreamConnectionPool(unittest.TestCase):
+    """
+    Tests for :class:`UpstreamConnectionPool`.
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        cls.server.daemon_threads = True
+        cls.port = cls.server.server_address[1]
+        cls.thread = threading.Thread(target=cls.server.serve_forever, args=(0.05,), daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def get(self, pool: UpstreamConnectionPool, path: str = "/") -> bool:
+        conn, reused = pool.acquire("http", "127.0.0.1", self.port)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        self.assertEqual(response.read(), b"ok")
+        pool.release(conn, not response.will_close)
+        return reused
+
+    def test_pool_key(self):
+        self.assertEqual(pool_key("HTTP", "Example.com", None), ("http", "example.com", 80))
+        self.assertEqual(pool_key("https", "example.com", None), ("https", "example.com", 443))
+        self.assertEqual(pool_key("http", "echo", 9200), ("http", "echo", 9200))
+        with self.assertRaises(ValueError):
+            pool_key("ftp", "example.com", None)
+
+    def test_reuse(self):
+        """
+        Connections are reused after being released, and counted as hits.
+        """
+        pool = UpstreamConnectionPool()
+        self.assertFalse(self.get(pool))
+        self.assertTrue(self.get(pool))
+        self.assertTrue(self.get(pool))
+        self.assertEqual(pool.stats(), {"hits": 2, "misses": 1, "idle": 1, "in_use": 0})
+        pool.close()
+
+    def test_not_reusable(self):
+        """
+        Connections which the upstream will close are not kept.
+        """
+        pool = UpstreamConnectionPool()
+        self.assertFalse(self.get(pool, "/close"))
+        self.assertFalse(self.get(pool))
+        self.assertEqual(pool.stats()["misses"], 2)
+        pool.close()
+
+    def test_stale_detection(self):
+        """
+        An idle connection which was closed by the peer is discarded instead of reused.
+        """
+        pool = UpstreamConnectionPool()
+        self.get(pool)
+        conn, _ = pool._idle[("http", "127.0.0.1", self.port)][0]
+        # Simulate the upstream closing the connection by shutting down the server side
+        conn.sock.shutdown(2)
+        time.sleep(0.05)
+        self.assertFalse(self.get(pool))
+        pool.close()
+
+    def test_high_descriptor_not_stale(self):
+        """
+        Idle connections on descriptors too high for ``select`` are still reused.
+        """
+        pool = UpstreamConnectionPool()
+        self.get(pool)
+        conn, _ = pool._idle[("http", "127.0.0.1", self.port)][0]
+        low_sock = conn.sock
+        conn.sock = socket.socket(fileno=os.dup2(low_sock.fileno(), 1500))
+        low_sock.close()
+        self.assertFalse(pool._is_stale(conn))
+        self.assertTrue(self.get(pool))
+        pool.close()
+
+    def test_idle_eviction(self):
+        pool = UpstreamConnectionPool(idle_timeout=0.01)
+        self.get(pool)
+        time.sleep(0.05)
+        self.assertEqual(pool.evict_idle(), 1)
+        self.assertEqual(pool.stats()["idle"], 0)
+
+    def test_timeouts(self):
+        with mock.patch.dict(
+            "os.environ", {"UPSTREAM_CONNECT_TIMEOUT": "2", "UPSTREAM_READ_TIMEOUT": "0"}
+        ):
+            self.assertEqual(
+                timeouts_from_environment(), {"connect_timeout": 2.0, "read_timeout": None}
+            )
+
+        pool = UpstreamConnectionPool(connect_timeout=2, read_timeout=0.5)
+        conn, _ = pool.acquire("http", "127.0.0.1", self.port)
+        pool.connect(conn)
+        self.assertEqual(conn.sock.gettimeout(), 0.5)
+        pool.release(conn, False)
+        pool.close()
+
+    def test_max_idle(self):
+        pool = UpstreamConnectionPool(max_idle_per_host=1)
+        first, _ = pool.acquire("http", "127.0.0.1", self.port)
+        second, _ = pool.acquire("http", "127.0.0.1", self.port)
+        for conn in (first, second):
+            conn.request("GET", "/")
+            conn.getresponse().read()
+        pool.release(first, True)
+        pool.release(second, True)
+        self.assertEqual(pool.stats()["idle"], 1)
+        pool.close()
+
+    def test_max_total(self):
+        """
+        Acquiring beyond the total limit waits, and fails after the acquire timeout.
+        """
+        pool = UpstreamConnectionPool(max_total=1, acquire_timeout=0.05)
+        conn, _ = pool.acquire("http", "127.0.0.1", self.port)
+        with self.assertRaises(UpstreamPoolExhausted):
+            pool.acquire("http", "127.0.0.1", self.port)
+
+        threading.Timer(0.01, pool.release, (conn, False)).start()
+        pool.acquire_timeout = 5
+        other, _ = pool.acquire("http", "127.0.0.1", self.port)
+        pool.release(other, False)
+
+    def test_max_total_evicts_other_keys(self):
+        """
+        When the total limit is reached, idle connections for other keys are closed to make room.
+        """
+        pool = UpstreamConnectionPool(max_total=1, acquire_timeout=0.05)
+        self.get(pool)
+        conn, reused = pool.acquire("http", "localhost", self.port)
+        self.assertFalse(reused)
+        self.assertEqual(pool.stats()["idle"], 0)
+        pool.release(conn, False)
@@ -0,0 +1,104 @@
+"""
+Unit tests for :mod:`jwt_proxy.workers`.
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import unittest
+from http.client import HTTPConnection
+
+from jwt_proxy.workers import SharedStats
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestSharedStats(unittest.TestCase):
+    def test_counters(self):
+        stats = SharedStats(3)
+        self.assertLessEqual(stats.start_time, time.time())
+        stats.set_requests(0, 5)
+        stats.set_requests(2, 7)
+        stats.add_restart()
+        self.assertEqual(stats.get_requests(0), 5)
+        self.assertEqual(stats.total_requests(), 12)
+        self.assertEqual(stats.restarts, 1)
+        with self.assertRaises(IndexError):
+            stats.set_requests(3, 1)
+
+    def test_shared_with_forked_process(self):
+        stats = SharedStats(2)
+        pid = os.fork()
+        if pid == 0:
+            stats.set_requests(1, 42)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(stats.get_requests(1), 42)
+
+
+@unittest.skipUnless(os.path.exists("/proc/self/task"), "requires Linux /proc")
+class TestWorkerSupervisor(unittest.TestCase):
+    """
+    Runs the echo server with several workers in a subprocess.
+    """
+
+    def setUp(self) -> None:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, "echo_server.py"],
+            env={**os.environ, "ECHO_HTTP_PORT": str(self.port), "SERVER_WORKERS": "2"},
+            cwd=REPO_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        self.wait_for(lambda: len(self.worker_pids()) == 2 and self.status() is not None)
+
+    def tearDown(self) -> None:
+        self.process.send_signal(signal.SIGTERM)
+        self.assertEqual(self.process.wait(10), 0)
+
+    def wait_for(self, condition) -> None:
+        deadline = time.monotonic() + 10
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.05)
+
+    def worker_pids(self):
+        path = f"/proc/{self.process.pid}/task/{self.process.pid}/children"
+        with open(path) as f:
+            return [int(pid) for pid in f.read().split()]
+
+    def status(self):
+        try:
+            conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+            conn.request("GET", "/status")
+            return conn.getresponse().read().decode("utf-8")
+        except OSError:
+            return None
+
+    def post(self) -> None:
+        # A new connection for each request, so that the requests are spread over the workers
+        conn = HTTPConnection("127.0.0.1", self.port, timeout=5)
+        conn.request("POST", "/", body=b"x")
+        self.assertEqual(conn.getresponse().status, 200)
+        conn.close()
+
+    def test_combined_status_and_restart(self):
+        for _ in range(20):
+            self.post()
+        status = self.status()
+        self.assertIn("20 requests processed", status)
+        self.assertIn("2 worker processes, 0 restarted", status)
+
+        # A crashed worker is replaced, and the counts it reported are kept
+        killed = self.worker_pids()[0]
+        os.kill(killed, signal.SIGKILL)
+        self.wait_for(lambda: killed not in self.worker_pids() and len(self.worker_pids()) == 2)
+        self.wait_for(lambda: "1 restarted" in (self.status() or ""))
+        self.post()
+        self.assertIn("21 requests processed", self.status())